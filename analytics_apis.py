@@ -10,28 +10,72 @@ from datetime import datetime, timedelta
 import json
 import sqlite3
 import hashlib
+import hmac
 import time
 import os
+import atexit
 from typing import Dict, List, Optional, Any
 
+from analytics_recorder import AnalyticsRecorder, EVENT_CHAT_USAGE, EVENT_IMAGE_GENERATION, EVENT_REQUEST, write_events
+from analytics_rollup import UsageRollup, init_rollup_tables, query_rollups
+from analytics_cache import QueryCache
+from sqlite_pool import get_sqlite_pool
+
 # 全局变量存储认证装饰器（由主模块设置）
 require_api_key = None
+# 全局变量存储鉴权检查函数（由主模块设置，与主接口共用多密钥鉴权）
+auth_checker = None
+# 管理接口（修改或导出统计数据）的鉴权检查函数，只允许管理员密钥
+admin_checker = None
 
 def set_auth_decorator(decorator):
     """设置认证装饰器"""
     global require_api_key
     require_api_key = decorator
 
+def set_auth_checker(checker):
+    """设置鉴权检查函数，返回 None 表示通过，否则返回错误响应"""
+    global auth_checker
+    auth_checker = checker
+
+def set_admin_checker(checker):
+    """设置管理接口的鉴权检查函数，返回 None 表示通过，否则返回错误响应"""
+    global admin_checker
+    admin_checker = checker
+
 class AnalyticsManager:
     def __init__(self, db_path: str = "conversations.db"):
         """初始化统计分析管理器"""
         self.db_path = db_path
+        self.pool = get_sqlite_pool(db_path)
         self.init_analytics_tables()
+        self.recorder = None
+        # 仪表板查询结果缓存，统计写入提交后软失效
+        self.cache = QueryCache(
+            ttl=float(os.getenv('ANALYTICS_CACHE_TTL', '10')),
+            max_stale=float(os.getenv('ANALYTICS_CACHE_MAX_STALE', '300'))
+        )
+        # 统计事件异步批量写入（ANALYTICS_WRITE_BEHIND=false 时同步写入）
+        if os.getenv('ANALYTICS_WRITE_BEHIND', 'true').lower() == 'true':
+            self.recorder = AnalyticsRecorder(
+                db_path,
+                batch_size=int(os.getenv('ANALYTICS_BATCH_SIZE', '200')),
+                flush_interval_ms=int(os.getenv('ANALYTICS_FLUSH_INTERVAL_MS', '500')),
+                max_queue=int(os.getenv('ANALYTICS_QUEUE_SIZE', '10000'))
+            )
+            self.recorder.on_commit.append(self.cache.invalidate)
+            self.recorder.start()
+            atexit.register(self.recorder.stop)
+
+        # 请求事件增量汇总任务
+        self.rollup = UsageRollup(db_path, interval=float(os.getenv('ANALYTICS_ROLLUP_INTERVAL', '60')))
+        self.rollup.on_commit.append(self.cache.invalidate)
+        self.rollup.start()
 
     def init_analytics_tables(self):
         """初始化统计分析表"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.write() as conn:
                 cursor = conn.cursor()
 
                 # 直接创建必要的统计分析表
@@ -147,7 +191,9 @@ class AnalyticsManager:
                         if "already exists" not in str(e):
                             print(f"[统计分析] 表创建警告: {e}")
 
-                conn.commit()
+                # 请求事件日志与增量汇总表
+                init_rollup_tables(conn)
+
                 print("[统计分析] 数据库表初始化完成")
 
         except Exception as e:
@@ -156,7 +202,7 @@ class AnalyticsManager:
     def batch_delete_api_keys(self, api_key_hashes: List[str]) -> int:
         """批量删除API密钥统计数据"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.write() as conn:
                 cursor = conn.cursor()
 
                 # 构建IN子句
@@ -169,7 +215,6 @@ class AnalyticsManager:
                 ''', api_key_hashes)
 
                 deleted_count = cursor.rowcount
-                conn.commit()
 
                 print(f"[统计分析] 批量删除 {deleted_count} 个API密钥记录")
                 return deleted_count
@@ -181,7 +226,7 @@ class AnalyticsManager:
     def clear_all_api_keys(self) -> int:
         """清空所有API密钥统计数据"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.write() as conn:
                 cursor = conn.cursor()
 
                 # 获取删除前的数量
@@ -194,7 +239,6 @@ class AnalyticsManager:
                 # 重置自增ID
                 cursor.execute("DELETE FROM sqlite_sequence WHERE name='api_key_usage_stats'")
 
-                conn.commit()
 
                 print(f"[统计分析] 清空 {before_count} 个API密钥记录")
                 return before_count
@@ -211,7 +255,7 @@ class AnalyticsManager:
         details = []
 
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.write() as conn:
                 cursor = conn.cursor()
 
                 for i, account in enumerate(accounts):
@@ -256,8 +300,6 @@ class AnalyticsManager:
                         error_count += 1
                         details.append(f"第{i+1}个账号: 处理失败 - {str(e)}")
 
-                conn.commit()
-
         except Exception as e:
             print(f"[统计分析] 批量导入失败: {e}")
             return {
@@ -279,7 +321,7 @@ class AnalyticsManager:
     def export_api_keys(self) -> List[Dict[str, Any]]:
         """导出API密钥统计数据"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.read() as conn:
                 cursor = conn.cursor()
 
                 cursor.execute('''
@@ -306,181 +348,133 @@ class AnalyticsManager:
             print(f"[统计分析] 导出API密钥失败: {e}")
             return []
 
-    def record_chat_usage(self, usage_data: Dict[str, Any]):
-        """记录聊天对话使用事件"""
+    def _write_now(self, events):
+        """同步写入统计事件（未启用异步写入时使用）"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-
-                # 准备基础数据
-                api_key = usage_data.get('api_key', '')
-                api_key_hash = hashlib.sha256(api_key.encode()).hexdigest() if api_key else 'unknown'
-                api_key_masked = f"{api_key[:8]}...{api_key[-4:]}" if len(api_key) > 12 else api_key
-
-                model_name = usage_data.get('model', 'gemini-enterprise')
-                success = usage_data.get('success', True)
-                duration = usage_data.get('duration', 0)
-                tokens = usage_data.get('tokens', 0)
-                images = usage_data.get('images', 0)
-
-                # 插入或更新API密钥使用统计
-                cursor.execute('''
-                    INSERT OR REPLACE INTO api_key_usage_stats (
-                        api_key_hash, api_key_masked, account_team_id, account_email,
-                        total_requests, successful_requests, failed_requests,
-                        total_tokens_generated, total_images_generated,
-                        first_used_at, last_used_at, is_active, updated_at
-                    ) VALUES (
-                        ?, ?, ?, ?,
-                        COALESCE((SELECT total_requests FROM api_key_usage_stats WHERE api_key_hash = ?), 0) + 1,
-                        COALESCE((SELECT successful_requests FROM api_key_usage_stats WHERE api_key_hash = ?), 0) + ?,
-                        COALESCE((SELECT failed_requests FROM api_key_usage_stats WHERE api_key_hash = ?), 0) + ?,
-                        COALESCE((SELECT total_tokens_generated FROM api_key_usage_stats WHERE api_key_hash = ?), 0) + ?,
-                        COALESCE((SELECT total_images_generated FROM api_key_usage_stats WHERE api_key_hash = ?), 0) + ?,
-                        COALESCE((SELECT first_used_at FROM api_key_usage_stats WHERE api_key_hash = ?), CURRENT_TIMESTAMP),
-                        CURRENT_TIMESTAMP,
-                        TRUE,
-                        CURRENT_TIMESTAMP
-                    )
-                ''', (
-                    api_key_hash, api_key_masked, usage_data.get('team_id', ''), usage_data.get('email', ''),
-                    api_key_hash, api_key_hash, 1 if success else 0, api_key_hash, 0 if success else 1,
-                    api_key_hash, tokens, api_key_hash, images, api_key_hash
-                ))
-
-                # 更新模型使用统计
-                # 首先检查模型是否存在
-                cursor.execute('SELECT total_requests FROM model_usage_stats WHERE model_name = ?', (model_name,))
-                existing_record = cursor.fetchone()
-
-                if existing_record:
-                    # 更新现有记录
-                    cursor.execute('''
-                        UPDATE model_usage_stats SET
-                            total_requests = total_requests + 1,
-                            text_requests = text_requests + 1,
-                            image_requests = image_requests + ?,
-                            successful_requests = successful_requests + ?,
-                            failed_requests = failed_requests + ?,
-                            total_tokens_generated = total_tokens_generated + ?,
-                            total_images_generated = total_images_generated + ?,
-                            average_tokens_per_request = ROUND(CAST(total_tokens_generated AS REAL) / GREATEST(total_requests, 1)),
-                            total_usage_time = total_usage_time + ?,
-                            last_used_at = CURRENT_TIMESTAMP,
-                            updated_at = CURRENT_TIMESTAMP
-                        WHERE model_name = ?
-                    ''', (images, 1 if success else 0, 0 if success else 1, tokens, images, duration, model_name))
-                else:
-                    # 插入新记录
-                    cursor.execute('''
-                        INSERT INTO model_usage_stats (
-                            model_name, total_requests, text_requests, image_requests,
-                            successful_requests, failed_requests, total_tokens_generated,
-                            total_images_generated, average_tokens_per_request, total_usage_time,
-                            first_used_at, last_used_at, is_active, created_at, updated_at
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        model_name, 1, 1, images, 1 if success else 0, 0 if success else 1,
-                        tokens, images, tokens if tokens > 0 else 0, duration,
-                        CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, TRUE,
-                        CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
-                    ))
-
-                # 记录到日志
-                print(f"[统计分析] 记录聊天使用: 模型={model_name}, 成功={success}, 耗时={duration:.2f}s")
-
-                conn.commit()
-
+            self.pool.execute(write_events, events)
+            self.cache.invalidate()
         except Exception as e:
-            print(f"[统计分析] 记录聊天使用失败: {e}")
-
-    def record_image_generation(self, image_id: int, generation_data: Dict[str, Any]):
-        """记录图片生成事件"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            print(f"[统计分析] 记录统计事件失败: {e}")
 
-                # 准备基础数据
-                api_key = generation_data.get('api_key', '')
-                api_key_hash = hashlib.sha256(api_key.encode()).hexdigest() if api_key else 'unknown'
+    def cached(self, endpoint: str, compute, days: Optional[int] = None, limit: Optional[int] = None):
+        """按 (endpoint, days, limit) 读取缓存的查询结果"""
+        return self.cache.get_or_compute((endpoint, days, limit), compute)
 
-                # 插入生成记录
-                cursor.execute('''
-                    INSERT INTO image_generation_records (
-                        image_id, api_key_used, account_team_id, account_email,
-                        model_used, prompt_text, prompt_length, generation_duration,
-                        success, error_message, request_ip, user_agent,
-                        session_id, conversation_id
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    image_id,
-                    api_key_hash,
-                    generation_data.get('team_id', ''),
-                    generation_data.get('email', ''),
-                    generation_data.get('model', 'gemini-enterprise'),
-                    generation_data.get('prompt', ''),
-                    len(generation_data.get('prompt', '')),
-                    generation_data.get('duration', 0),
-                    generation_data.get('success', True),
-                    generation_data.get('error', ''),
-                    generation_data.get('ip', ''),
-                    generation_data.get('user_agent', ''),
-                    generation_data.get('session_id', ''),
-                    generation_data.get('conversation_id')
-                ))
-
-                conn.commit()
-                print(f"[统计分析] 记录图片生成: image_id={image_id}")
+    def record_chat_usage(self, usage_data: Dict[str, Any]):
+        """记录聊天对话使用事件（默认进入异步写入队列，不阻塞请求）"""
+        if self.recorder is not None:
+            self.recorder.record_chat_usage(usage_data)
+        else:
+            self._write_now([(EVENT_CHAT_USAGE, usage_data)])
 
-        except Exception as e:
-            print(f"[统计分析] 记录生成事件失败: {e}")
+    def record_image_generation(self, image_id: int, generation_data: Dict[str, Any]):
+        """记录图片生成事件（默认进入异步写入队列，不阻塞请求）"""
+        if self.recorder is not None:
+            self.recorder.record_image_generation(image_id, generation_data)
+        else:
+            self._write_now([(EVENT_IMAGE_GENERATION, (image_id, generation_data))])
+
+    def record_request_event(self, event: Dict[str, Any]):
+        """记录一次请求事件（kind 为 chat / upload / image 等）"""
+        if self.recorder is not None:
+            self.recorder.record_request(event)
+        else:
+            self._write_now([(EVENT_REQUEST, event)])
+
+    def run_rollup(self) -> int:
+        """立即执行一次增量汇总（先写完队列中的事件）"""
+        if self.recorder is not None:
+            self.recorder.flush()
+        return self.rollup.run_once()
+
+    def get_usage_rollups(self, bucket: str = 'day', days: int = 7,
+                          group_by: Optional[str] = None) -> List[Dict[str, Any]]:
+        """读取按小时/天的汇总数据，可按 model / account / api_key_hash / kind 分组"""
+        since = (datetime.now() - timedelta(days=days)).strftime(
+            '%Y-%m-%d 00:00:00' if bucket == 'hour' else '%Y-%m-%d')
+        with self.pool.read() as conn:
+            return query_rollups(conn, bucket, since, group_by)
+
+    def get_recorder_stats(self) -> Dict[str, Any]:
+        """获取异步写入队列状态"""
+        if self.recorder is None:
+            return {'enabled': False}
+        return {'enabled': True, **self.recorder.stats()}
 
     def get_overview_stats(self, days: int = 30) -> Dict[str, Any]:
         """获取总体统计概览"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.read() as conn:
                 cursor = conn.cursor()
 
                 # 获取指定时间范围内的总体统计
                 start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
                 print(f"[统计分析] 概览统计 - 查询时间范围: {start_date} 开始")
 
-                # 从model_usage_stats获取总体统计（包含聊天记录）
+                # 优先从按天汇总表读取范围内统计（只读取几百行预聚合数据）
+                start_day = start_date[:10]
                 cursor.execute('''
                     SELECT
-                        SUM(total_requests) as total_generations,
-                        SUM(successful_requests) as successful_generations,
-                        SUM(failed_requests) as failed_generations,
-                        SUM(total_tokens_generated) as total_tokens,
-                        SUM(total_images_generated) as total_images,
-                        SUM(total_usage_time) as total_usage_time,
-                        COUNT(CASE WHEN total_requests > 0 THEN 1 END) as active_models,
-                        ROUND(AVG(average_tokens_per_request), 2) as avg_tokens
-                    FROM model_usage_stats
-                    WHERE last_used_at >= ? OR (last_used_at < ? AND total_requests > 0)
-                ''', (start_date, start_date))
-
-                model_stats = cursor.fetchone()
-                print(f"[统计分析] 概览统计 - model_usage_stats查询结果: {model_stats}")
-
-                # 从api_key_usage_stats获取API密钥相关统计
-                cursor.execute('''
-                    SELECT
-                        COUNT(CASE WHEN total_requests > 0 THEN 1 END) as active_keys,
-                        SUM(total_requests) as key_total_requests,
-                        SUM(successful_requests) as key_successful_requests
-                    FROM api_key_usage_stats
-                    WHERE last_used_at >= ? OR (last_used_at < ? AND total_requests > 0)
-                ''', (start_date, start_date))
+                        SUM(requests) as total_generations,
+                        SUM(successful) as successful_generations,
+                        SUM(failed) as failed_generations,
+                        SUM(tokens) as total_tokens,
+                        SUM(images) as total_images,
+                        SUM(duration_ms) as total_usage_time,
+                        COUNT(DISTINCT CASE WHEN model != '' THEN model END) as active_models,
+                        ROUND(CAST(SUM(tokens) AS REAL) / MAX(SUM(requests), 1), 2) as avg_tokens
+                    FROM usage_rollups
+                    WHERE bucket = 'day' AND bucket_start >= ?
+                ''', (start_day,))
+                rollup_stats = cursor.fetchone()
+
+                if rollup_stats[0]:
+                    model_stats = rollup_stats
+                    cursor.execute('''
+                        SELECT
+                            COUNT(DISTINCT CASE WHEN api_key_hash NOT IN ('', 'unknown') THEN api_key_hash END),
+                            COUNT(DISTINCT bucket_start),
+                            MAX(unique_users)
+                        FROM usage_rollups
+                        LEFT JOIN daily_usage_summary ON summary_date = bucket_start
+                        WHERE bucket = 'day' AND bucket_start >= ?
+                    ''', (start_day,))
+                    active_keys, rollup_active_days, peak_daily_users = cursor.fetchone()
+                    api_stats = (active_keys,)
+                else:
+                    # 尚无汇总数据时回退到累计统计表
+                    cursor.execute('''
+                        SELECT
+                            SUM(total_requests) as total_generations,
+                            SUM(successful_requests) as successful_generations,
+                            SUM(failed_requests) as failed_generations,
+                            SUM(total_tokens_generated) as total_tokens,
+                            SUM(total_images_generated) as total_images,
+                            SUM(total_usage_time) as total_usage_time,
+                            COUNT(CASE WHEN total_requests > 0 THEN 1 END) as active_models,
+                            ROUND(AVG(average_tokens_per_request), 2) as avg_tokens
+                        FROM model_usage_stats
+                        WHERE last_used_at >= ? OR (last_used_at < ? AND total_requests > 0)
+                    ''', (start_date, start_date))
+                    model_stats = cursor.fetchone()
 
-                api_stats = cursor.fetchone()
+                    cursor.execute('''
+                        SELECT
+                            COUNT(CASE WHEN total_requests > 0 THEN 1 END) as active_keys,
+                            SUM(total_requests) as key_total_requests,
+                            SUM(successful_requests) as key_successful_requests
+                        FROM api_key_usage_stats
+                        WHERE last_used_at >= ? OR (last_used_at < ? AND total_requests > 0)
+                    ''', (start_date, start_date))
+                    api_stats = cursor.fetchone()
+                    rollup_active_days = peak_daily_users = None
 
                 # 从image_generation_records获取图片生成相关统计（如果有）
                 cursor.execute('''
                     SELECT
                         COUNT(*) as image_generations,
                         COUNT(DISTINCT session_id) as unique_sessions,
-                        COUNT(DISTINCT user_id) as unique_users,
+                        0 as unique_users,
                         AVG(generation_duration) as avg_duration,
                         COUNT(DISTINCT DATE(generation_time)) as active_days
                     FROM image_generation_records
@@ -490,13 +484,23 @@ class AnalyticsManager:
                 image_stats = cursor.fetchone()
 
                 # 获取热门模型
-                cursor.execute('''
-                    SELECT model_name, total_requests, successful_requests
-                    FROM model_usage_stats
-                    WHERE total_requests > 0
-                    ORDER BY total_requests DESC
-                    LIMIT 5
-                ''')
+                if rollup_stats[0]:
+                    cursor.execute('''
+                        SELECT model, SUM(requests), SUM(successful)
+                        FROM usage_rollups
+                        WHERE bucket = 'day' AND bucket_start >= ? AND model != ''
+                        GROUP BY model
+                        ORDER BY SUM(requests) DESC
+                        LIMIT 5
+                    ''', (start_day,))
+                else:
+                    cursor.execute('''
+                        SELECT model_name, total_requests, successful_requests
+                        FROM model_usage_stats
+                        WHERE total_requests > 0
+                        ORDER BY total_requests DESC
+                        LIMIT 5
+                    ''')
 
                 top_models_data = cursor.fetchall()
 
@@ -511,9 +515,18 @@ class AnalyticsManager:
 
                 keyword_stats = cursor.fetchall()
 
-                # 合并计算总统计 - 直接使用model_usage_stats的数据
+                # 合并计算总统计
                 total_generations = model_stats[0] or 0
                 successful_generations = model_stats[1] or 0
+                if rollup_stats[0]:
+                    avg_duration_ms = (model_stats[5] or 0) / max(total_generations, 1)
+                    active_days = rollup_active_days or 0
+                    # 去重用户数不可跨天累加，这里给出范围内单日活跃用户峰值
+                    unique_users = peak_daily_users or 0
+                else:
+                    avg_duration_ms = image_stats[3] or 0
+                    active_days = image_stats[4] or 0
+                    unique_users = image_stats[2] or 0
 
                 return {
                     'time_range_days': days,
@@ -523,9 +536,9 @@ class AnalyticsManager:
                         'success_rate': round(successful_generations / max(total_generations, 1) * 100, 2),
                         'active_api_keys': api_stats[0] or 0,
                         'unique_sessions': image_stats[1] or 0,
-                        'unique_users': image_stats[2] or 0,
-                        'avg_generation_duration_ms': round(image_stats[3] or 0, 2),
-                        'active_days': image_stats[4] or 0,
+                        'unique_users': unique_users,
+                        'avg_generation_duration_ms': round(avg_duration_ms, 2),
+                        'active_days': active_days,
                         'total_tokens': model_stats[3] or 0,
                         'total_images': model_stats[4] or 0,
                         'active_models': model_stats[6] or 0
@@ -544,32 +557,14 @@ class AnalyticsManager:
                 }
 
         except Exception as e:
+            # 抛给调用方：查询失败的空结果不能当作真实数据进入缓存
             print(f"[统计分析] 获取概览统计失败: {e}")
-            return {
-                'time_range_days': days,
-                'overall': {
-                    'total_generations': 0,
-                    'successful_generations': 0,
-                    'success_rate': 0.0,
-                    'active_api_keys': 0,
-                    'unique_sessions': 0,
-                    'unique_users': 0,
-                    'avg_generation_duration_ms': 0,
-                    'active_days': 0,
-                    'total_tokens': 0,
-                    'total_images': 0,
-                    'active_models': 0
-                },
-                'top_models': [],
-                'top_keywords': [],
-                'generated_at': datetime.now().isoformat(),
-                'error': str(e)
-            }
+            raise
 
     def get_api_key_stats(self, limit: int = 20) -> List[Dict[str, Any]]:
         """获取API密钥使用统计"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.read() as conn:
                 cursor = conn.cursor()
 
                 cursor.execute('''
@@ -609,12 +604,12 @@ class AnalyticsManager:
 
         except Exception as e:
             print(f"[统计分析] 获取API密钥统计失败: {e}")
-            return []
+            raise
 
     def get_model_usage_stats(self) -> List[Dict[str, Any]]:
         """获取模型使用统计"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.read() as conn:
                 cursor = conn.cursor()
 
                 cursor.execute('SELECT * FROM model_usage_stats ORDER BY total_requests DESC')
@@ -640,42 +635,44 @@ class AnalyticsManager:
 
         except Exception as e:
             print(f"[统计分析] 获取模型统计失败: {e}")
-            return []
+            raise
 
     def get_generation_timeline(self, days: int = 7) -> List[Dict[str, Any]]:
-        """获取生成时间线数据"""
+        """获取生成时间线数据（读取按天汇总表）"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-
-                start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
-
-                cursor.execute('''
-                    SELECT
-                        DATE(generation_time) as date,
-                        COUNT(*) as total_generations,
-                        SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful_generations,
-                        COUNT(DISTINCT api_key_used) as active_keys,
-                        AVG(generation_duration) as avg_duration
-                    FROM image_generation_records
-                    WHERE generation_time >= ?
-                    GROUP BY DATE(generation_time)
-                    ORDER BY date DESC
-                ''', (start_date,))
-
-                columns = [desc[0] for desc in cursor.description]
-                rows = cursor.fetchall()
-
-                return [dict(zip(columns, row)) for row in rows]
+            return [
+                {
+                    'date': row['bucket_start'],
+                    'total_generations': row['requests'],
+                    'successful_generations': row['successful'],
+                    'active_keys': row['active_keys'],
+                    'avg_duration': row['avg_duration_ms'],
+                }
+                for row in self._daily_timeline(days)
+            ]
 
         except Exception as e:
             print(f"[统计分析] 获取时间线数据失败: {e}")
-            return []
+            raise
+
+    def _daily_timeline(self, days: int) -> List[Dict[str, Any]]:
+        since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        with self.pool.read() as conn:
+            rows = query_rollups(conn, 'day', since)
+            active_keys = dict(conn.execute('''
+                SELECT bucket_start, COUNT(DISTINCT api_key_hash)
+                FROM usage_rollups
+                WHERE bucket = 'day' AND bucket_start >= ? AND api_key_hash NOT IN ('', 'unknown')
+                GROUP BY bucket_start
+            ''', (since,)).fetchall())
+        for row in rows:
+            row['active_keys'] = active_keys.get(row['bucket_start'], 0)
+        return rows
 
     def get_keyword_analysis(self, limit: int = 50) -> List[Dict[str, Any]]:
         """获取关键词分析"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.read() as conn:
                 cursor = conn.cursor()
 
                 cursor.execute('''
@@ -697,12 +694,12 @@ class AnalyticsManager:
 
         except Exception as e:
             print(f"[统计分析] 获取关键词分析失败: {e}")
-            return []
+            raise
 
     def get_user_activity_stats(self, limit: int = 20) -> List[Dict[str, Any]]:
         """获取用户活动统计"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.read() as conn:
                 cursor = conn.cursor()
 
                 cursor.execute('''
@@ -726,7 +723,7 @@ class AnalyticsManager:
 
         except Exception as e:
             print(f"[统计分析] 获取用户活动统计失败: {e}")
-            return []
+            raise
 
 # 创建全局分析管理器实例
 analytics_manager = None
@@ -740,13 +737,15 @@ def get_analytics_manager():
 
 def check_auth():
     """检查API认证"""
+    if auth_checker is not None:
+        return auth_checker()
     if require_api_key:
         # 如果设置了认证装饰器，则需要进行认证检查
         # 这里可以手动实现认证逻辑
         required_api_key = os.getenv('DOWNSTREAM_API_KEY', '')
         if required_api_key:
             provided_api_key = request.headers.get('Authorization', '').replace('Bearer ', '').replace('Api-Key ', '')
-            if provided_api_key != required_api_key:
+            if not hmac.compare_digest(provided_api_key.encode('utf-8'), required_api_key.encode('utf-8')):
                 return jsonify({
                     'error': {
                         'message': 'Authentication required',
@@ -755,6 +754,12 @@ def check_auth():
                 }), 401
     return None
 
+def check_admin():
+    """检查管理接口认证（团队密钥只能查询统计，不能修改或导出）"""
+    if admin_checker is not None:
+        return admin_checker()
+    return check_auth()
+
 def init_analytics_routes(app):
     """初始化统计分析API路由"""
 
@@ -804,7 +809,7 @@ def init_analytics_routes(app):
 
             manager = get_analytics_manager()
             print(f"[analytics_apis] analytics_manager获取成功: {manager is not None}")
-            stats = manager.get_overview_stats(days)
+            stats = manager.cached('overview', lambda: manager.get_overview_stats(days), days=days)
             print(f"[analytics_apis] get_overview_stats返回: {stats}")
 
             return jsonify(stats)
@@ -825,7 +830,7 @@ def init_analytics_routes(app):
             limit = min(max(limit, 1), 100)  # 限制在1-100之间
 
             manager = get_analytics_manager()
-            stats = manager.get_api_key_stats(limit)
+            stats = manager.cached('api_keys', lambda: manager.get_api_key_stats(limit), limit=limit)
 
             return jsonify({'api_keys': stats})
 
@@ -842,7 +847,7 @@ def init_analytics_routes(app):
 
         try:
             manager = get_analytics_manager()
-            stats = manager.get_model_usage_stats()
+            stats = manager.cached('models', manager.get_model_usage_stats)
 
             return jsonify({'models': stats})
 
@@ -862,7 +867,7 @@ def init_analytics_routes(app):
             days = min(max(days, 1), 30)  # 限制在1-30天之间
 
             manager = get_analytics_manager()
-            timeline = manager.get_generation_timeline(days)
+            timeline = manager.cached('timeline', lambda: manager.get_generation_timeline(days), days=days)
 
             return jsonify({'timeline': timeline})
 
@@ -882,7 +887,7 @@ def init_analytics_routes(app):
             limit = min(max(limit, 1), 200)  # 限制在1-200之间
 
             manager = get_analytics_manager()
-            keywords = manager.get_keyword_analysis(limit)
+            keywords = manager.cached('keywords', lambda: manager.get_keyword_analysis(limit), limit=limit)
 
             return jsonify({'keywords': keywords})
 
@@ -902,7 +907,7 @@ def init_analytics_routes(app):
             limit = min(max(limit, 1), 100)  # 限制在1-100之间
 
             manager = get_analytics_manager()
-            stats = manager.get_user_activity_stats(limit)
+            stats = manager.cached('users', lambda: manager.get_user_activity_stats(limit), limit=limit)
 
             return jsonify({'users': stats})
 
@@ -923,24 +928,78 @@ def init_analytics_routes(app):
 
             manager = get_analytics_manager()
 
-            dashboard_data = {
-                'overview': manager.get_overview_stats(days),
-                'timeline': manager.get_generation_timeline(min(days, 7)),  # 时间线最多7天
-                'top_models': manager.get_model_usage_stats(),
-                'top_keywords': manager.get_keyword_analysis(20),
-                'active_users': manager.get_user_activity_stats(10),
-                'api_keys': manager.get_api_key_stats(15),
-            }
+            def build_dashboard():
+                return {
+                    'overview': manager.get_overview_stats(days),
+                    'timeline': manager.get_generation_timeline(min(days, 7)),  # 时间线最多7天
+                    'top_models': manager.get_model_usage_stats(),
+                    'top_keywords': manager.get_keyword_analysis(20),
+                    'active_users': manager.get_user_activity_stats(10),
+                    'api_keys': manager.get_api_key_stats(15),
+                }
+
+            # 多个查看者并发轮询时只执行一组查询
+            dashboard_data = manager.cached('dashboard', build_dashboard, days=days)
 
             return jsonify(dashboard_data)
 
         except Exception as e:
             return jsonify({'error': f'获取仪表板数据失败: {str(e)}'}), 500
 
+    @app.route('/v1/analytics/recorder', methods=['GET'])
+    def get_recorder_stats():
+        """获取统计事件写入队列状态（队列深度、丢弃数、批次耗时）"""
+        auth_result = check_auth()
+        if auth_result:
+            return auth_result
+        return jsonify(get_analytics_manager().get_recorder_stats())
+
+    @app.route('/v1/analytics/cache', methods=['GET'])
+    def get_analytics_cache_stats():
+        """获取仪表板查询缓存命中情况"""
+        auth_result = check_auth()
+        if auth_result:
+            return auth_result
+        return jsonify(get_analytics_manager().cache.stats())
+
+    @app.route('/v1/analytics/usage', methods=['GET'])
+    def get_usage_rollups():
+        """获取按小时/天的汇总数据"""
+        auth_result = check_auth()
+        if auth_result:
+            return auth_result
+
+        bucket = request.args.get('bucket', 'day')
+        days = min(max(request.args.get('days', 7, type=int), 1), 365)
+        group_by = request.args.get('group_by') or None
+        try:
+            rows = get_analytics_manager().get_usage_rollups(bucket, days, group_by)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'bucket': bucket, 'days': days, 'group_by': group_by, 'data': rows})
+
+    @app.route('/v1/analytics/rollup', methods=['POST'])
+    def run_usage_rollup():
+        """立即执行一次增量汇总"""
+        auth_result = check_admin()
+        if auth_result:
+            return auth_result
+
+        manager = get_analytics_manager()
+        try:
+            processed = manager.run_rollup()
+        except Exception as e:
+            return jsonify({'error': f'汇总失败: {str(e)}'}), 500
+        return jsonify({'processed_events': processed, **manager.rollup.stats()})
+
     # API密钥批量操作路由
     @app.route('/v1/api-keys/batch-delete', methods=['POST'])
     def batch_delete_api_keys():
         """批量删除API密钥统计数据"""
+        auth_result = check_admin()
+        if auth_result:
+            return auth_result
+
         try:
             data = request.get_json()
             if not data or 'api_key_hashes' not in data:
@@ -964,6 +1023,10 @@ def init_analytics_routes(app):
     @app.route('/v1/api-keys/clear-all', methods=['POST'])
     def clear_all_api_keys():
         """清空所有API密钥统计数据"""
+        auth_result = check_admin()
+        if auth_result:
+            return auth_result
+
         try:
             # 添加安全确认
             data = request.get_json() or {}
@@ -987,6 +1050,10 @@ def init_analytics_routes(app):
     @app.route('/v1/api-keys/batch-import', methods=['POST'])
     def batch_import_api_keys():
         """批量导入API密钥统计数据"""
+        auth_result = check_admin()
+        if auth_result:
+            return auth_result
+
         try:
             data = request.get_json()
             if not data or 'accounts' not in data:
@@ -1016,6 +1083,10 @@ def init_analytics_routes(app):
     @app.route('/v1/api-keys/export', methods=['GET'])
     def export_api_keys():
         """导出API密钥统计数据"""
+        auth_result = check_admin()
+        if auth_result:
+            return auth_result
+
         try:
             manager = get_analytics_manager()
             keys_data = manager.export_api_keys()
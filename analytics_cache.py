@@ -0,0 +1,138 @@
+"""Business Gemini Pool 统计查询结果缓存
+按 (接口, days, limit) 缓存仪表板查询结果，短 TTL 内直接命中；
+统计写入提交后递增代数使缓存软失效（每个 TTL 内最多一次），过期结果先返回旧值（stale-while-revalidate），
+同一个键同时只有一个线程执行查询（single flight）
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger('gemini_pool.analytics')
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    created_at: float
+    generation: int
+
+
+class _Flight:
+    """一次进行中的查询，等待者通过 event 获取结果"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+
+class QueryCache:
+    """带 TTL、写入失效和单飞刷新的查询缓存"""
+
+    def __init__(self, ttl: float = 10.0, max_stale: float = 300.0):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.generation = 0
+        self._entries: Dict[Hashable, CacheEntry] = {}
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.invalidations = 0
+        self.coalesced_invalidations = 0
+        self._last_invalidated = float('-inf')
+
+    def invalidate(self):
+        """软失效：已缓存的结果变为过期，下次读取时后台刷新
+
+        写线程每批提交（约 500ms）都会调用；距上次失效不足 ttl 时忽略，
+        缓存结果本来最多只旧 ttl 秒，否则有流量时缓存在 TTL 内就会被反复清掉
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self._last_invalidated < self.ttl:
+                self.coalesced_invalidations += 1
+                return
+            self._last_invalidated = now
+            self.generation += 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def _start_flight(self, key: Hashable) -> Optional[_Flight]:
+        """占用键的刷新权，已有进行中的查询时返回 None（调用方需持锁）"""
+        if key in self._flights:
+            return None
+        flight = self._flights[key] = _Flight()
+        return flight
+
+    def _run_flight(self, key: Hashable, flight: _Flight, compute: Callable[[], Any], generation: int):
+        try:
+            flight.value = compute()
+            with self.lock:
+                self._entries[key] = CacheEntry(flight.value, time.monotonic(), generation)
+                self.refreshes += 1
+        except BaseException as e:
+            flight.error = e
+            logger.warning(f"统计查询刷新失败 {key}: {e}")
+        finally:
+            with self.lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        now = time.monotonic()
+        with self.lock:
+            generation = self.generation
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry.created_at
+                if age < self.ttl and entry.generation == generation:
+                    self.hits += 1
+                    return entry.value
+                if age < self.max_stale:
+                    # 返回旧值，由一个后台线程刷新
+                    self.stale_hits += 1
+                    flight = self._start_flight(key)
+                    if flight is not None:
+                        threading.Thread(target=self._run_flight, args=(key, flight, compute, generation),
+                                         name='analytics-cache-refresh', daemon=True).start()
+                    return entry.value
+
+            self.misses += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._start_flight(key)
+
+        if leader:
+            self._run_flight(key, flight, compute, generation)
+        else:
+            flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'entries': len(self._entries),
+                'generation': self.generation,
+                'ttl_seconds': self.ttl,
+                'max_stale_seconds': self.max_stale,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'invalidations': self.invalidations,
+                'coalesced_invalidations': self.coalesced_invalidations,
+                'in_flight': len(self._flights),
+            }
@@ -0,0 +1,341 @@
+"""Business Gemini Pool 统计事件异步写入器
+请求线程只把统计事件放入有界内存队列，由单个写线程每累积 N 条或每隔 T 毫秒
+在一个事务中批量落库（ON CONFLICT DO UPDATE 累加计数）；队列满时丢弃事件并计数，
+绝不阻塞请求
+"""
+
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from analytics_rollup import append_request_events
+from metrics import DB_WRITE_SECONDS
+from sqlite_pool import get_sqlite_pool
+
+logger = logging.getLogger('gemini_pool.analytics')
+
+# 事件类型
+EVENT_CHAT_USAGE = 'chat_usage'
+EVENT_IMAGE_GENERATION = 'image_generation'
+EVENT_REQUEST = 'request'
+
+
+def _hash_api_key(api_key: str) -> Tuple[str, str]:
+    """返回 (哈希, 掩码)"""
+    if not api_key:
+        return 'unknown', ''
+    masked = f"{api_key[:8]}...{api_key[-4:]}" if len(api_key) > 12 else api_key
+    return hashlib.sha256(api_key.encode()).hexdigest(), masked
+
+
+def _aggregate_chat_usage(events: List[Dict[str, Any]]):
+    """按API密钥和模型聚合聊天事件，减少同一批次内的重复更新"""
+    by_key: Dict[str, Dict[str, Any]] = {}
+    by_model: Dict[str, Dict[str, Any]] = {}
+    hashes: Dict[str, Tuple[str, str]] = {}
+
+    for usage_data in events:
+        api_key = usage_data.get('api_key', '')
+        if api_key not in hashes:
+            hashes[api_key] = _hash_api_key(api_key)
+        api_key_hash, api_key_masked = hashes[api_key]
+
+        success = 1 if usage_data.get('success', True) else 0
+        tokens = usage_data.get('tokens', 0) or 0
+        images = usage_data.get('images', 0) or 0
+
+        key_stats = by_key.get(api_key_hash)
+        if key_stats is None:
+            key_stats = by_key[api_key_hash] = {
+                'masked': api_key_masked, 'requests': 0, 'successful': 0,
+                'failed': 0, 'tokens': 0, 'images': 0
+            }
+        key_stats['team_id'] = usage_data.get('team_id', '')
+        key_stats['email'] = usage_data.get('email', '')
+        key_stats['requests'] += 1
+        key_stats['successful'] += success
+        key_stats['failed'] += 1 - success
+        key_stats['tokens'] += tokens
+        key_stats['images'] += images
+
+        model_name = usage_data.get('model', 'gemini-enterprise')
+        model_stats = by_model.get(model_name)
+        if model_stats is None:
+            model_stats = by_model[model_name] = {
+                'requests': 0, 'successful': 0, 'failed': 0,
+                'tokens': 0, 'images': 0, 'duration': 0
+            }
+        model_stats['requests'] += 1
+        model_stats['successful'] += success
+        model_stats['failed'] += 1 - success
+        model_stats['tokens'] += tokens
+        model_stats['images'] += images
+        model_stats['duration'] += usage_data.get('duration', 0) or 0
+
+    return by_key, by_model
+
+
+def _request_event_row(kind: str, data: Dict[str, Any], api_key_hash: str,
+                       duration_ms: int) -> tuple:
+    return (
+        int(data.get('ts') or time.time()),
+        kind,
+        data.get('model', '') or '',
+        data.get('team_id', '') or data.get('email', '') or '',
+        api_key_hash,
+        data.get('user_id'),
+        1 if data.get('success', True) else 0,
+        duration_ms,
+        data.get('tokens', 0) or 0,
+        data.get('images', 0) or 0,
+        data.get('bytes', 0) or 0,
+    )
+
+
+def write_events(conn: sqlite3.Connection, events: List[Tuple[str, Any]]):
+    """在调用方的事务中写入一批统计事件"""
+    chat_events = [payload for kind, payload in events if kind == EVENT_CHAT_USAGE]
+    image_events = [payload for kind, payload in events if kind == EVENT_IMAGE_GENERATION]
+    cursor = conn.cursor()
+
+    # 请求事件追加到 request_events，供增量汇总使用。
+    # 生成的图片已作为所属聊天请求的 images 计数记录，图片生成事件只写明细表，不再算一次请求
+    request_rows = []
+    for kind, payload in events:
+        if kind == EVENT_CHAT_USAGE:
+            request_rows.append(_request_event_row(
+                'chat', payload, _hash_api_key(payload.get('api_key', ''))[0],
+                int((payload.get('duration', 0) or 0) * 1000)))
+        elif kind == EVENT_REQUEST:
+            request_rows.append(_request_event_row(
+                payload.get('kind', 'other'), payload, _hash_api_key(payload.get('api_key', ''))[0],
+                int(payload.get('duration_ms', 0) or 0)))
+    if request_rows:
+        append_request_events(cursor, request_rows)
+
+    if chat_events:
+        by_key, by_model = _aggregate_chat_usage(chat_events)
+        cursor.executemany('''
+            INSERT INTO api_key_usage_stats (
+                api_key_hash, api_key_masked, account_team_id, account_email,
+                total_requests, successful_requests, failed_requests,
+                total_tokens_generated, total_images_generated
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(api_key_hash) DO UPDATE SET
+                account_team_id = excluded.account_team_id,
+                account_email = excluded.account_email,
+                total_requests = total_requests + excluded.total_requests,
+                successful_requests = successful_requests + excluded.successful_requests,
+                failed_requests = failed_requests + excluded.failed_requests,
+                total_tokens_generated = total_tokens_generated + excluded.total_tokens_generated,
+                total_images_generated = total_images_generated + excluded.total_images_generated,
+                last_used_at = CURRENT_TIMESTAMP,
+                is_active = TRUE,
+                updated_at = CURRENT_TIMESTAMP
+        ''', [
+            (api_key_hash, s['masked'], s['team_id'], s['email'], s['requests'],
+             s['successful'], s['failed'], s['tokens'], s['images'])
+            for api_key_hash, s in by_key.items()
+        ])
+
+        cursor.executemany('''
+            INSERT INTO model_usage_stats (
+                model_name, total_requests, text_requests, image_requests,
+                successful_requests, failed_requests, total_tokens_generated,
+                total_images_generated, average_tokens_per_request, total_usage_time
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(model_name) DO UPDATE SET
+                total_requests = total_requests + excluded.total_requests,
+                text_requests = text_requests + excluded.text_requests,
+                image_requests = image_requests + excluded.image_requests,
+                successful_requests = successful_requests + excluded.successful_requests,
+                failed_requests = failed_requests + excluded.failed_requests,
+                total_tokens_generated = total_tokens_generated + excluded.total_tokens_generated,
+                total_images_generated = total_images_generated + excluded.total_images_generated,
+                average_tokens_per_request = (total_tokens_generated + excluded.total_tokens_generated)
+                    / MAX(total_requests + excluded.total_requests, 1),
+                total_usage_time = total_usage_time + excluded.total_usage_time,
+                last_used_at = CURRENT_TIMESTAMP,
+                updated_at = CURRENT_TIMESTAMP
+        ''', [
+            (model_name, s['requests'], s['requests'], s['images'], s['successful'], s['failed'],
+             s['tokens'], s['images'], s['tokens'] // max(s['requests'], 1), s['duration'])
+            for model_name, s in by_model.items()
+        ])
+
+    if image_events:
+        rows = []
+        for image_id, generation_data in image_events:
+            api_key_hash, _ = _hash_api_key(generation_data.get('api_key', ''))
+            prompt = generation_data.get('prompt', '') or ''
+            rows.append((
+                image_id,
+                api_key_hash,
+                generation_data.get('team_id', ''),
+                generation_data.get('email', ''),
+                generation_data.get('model', 'gemini-enterprise'),
+                prompt,
+                len(prompt),
+                generation_data.get('duration', 0),
+                generation_data.get('success', True),
+                generation_data.get('error', ''),
+                generation_data.get('ip', ''),
+                generation_data.get('user_agent', ''),
+                generation_data.get('session_id', ''),
+                generation_data.get('conversation_id')
+            ))
+        cursor.executemany('''
+            INSERT INTO image_generation_records (
+                image_id, api_key_used, account_team_id, account_email,
+                model_used, prompt_text, prompt_length, generation_duration,
+                success, error_message, request_ip, user_agent,
+                session_id, conversation_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+
+class AnalyticsRecorder:
+    """统计事件写后缓冲（write-behind）记录器"""
+
+    def __init__(self, db_path: str, batch_size: int = 200,
+                 flush_interval_ms: int = 500, max_queue: int = 10000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.queue: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=max_queue)
+        self.stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.last_flush_ms = 0.0
+        # 每次批量提交成功后调用（例如使仪表板缓存失效）
+        self.on_commit: List[Callable[[], None]] = []
+        self._flush_requests: "queue.Queue[threading.Event]" = queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='analytics-writer', daemon=True)
+        self._thread.start()
+        logger.info(f"统计写线程已启动: 批量={self.batch_size}, 间隔={int(self.flush_interval * 1000)}ms, "
+                    f"队列上限={self.queue.maxsize}")
+
+    def submit(self, kind: str, payload: Any) -> bool:
+        """提交事件（非阻塞），队列满时丢弃并返回 False"""
+        try:
+            self.queue.put_nowait((kind, payload))
+        except queue.Full:
+            with self.stats_lock:
+                self.dropped += 1
+                dropped = self.dropped
+            # 丢弃计数按 2 的幂次记录日志，避免刷屏
+            if dropped & (dropped - 1) == 0:
+                logger.warning(f"统计事件队列已满，已丢弃 {dropped} 条事件")
+            return False
+        with self.stats_lock:
+            self.enqueued += 1
+        return True
+
+    # 入队时记录事件时间，避免队列积压时按落库时间归入错误的汇总时间桶
+    def record_chat_usage(self, usage_data: Dict[str, Any]) -> bool:
+        usage_data.setdefault('ts', time.time())
+        return self.submit(EVENT_CHAT_USAGE, usage_data)
+
+    def record_image_generation(self, image_id: int, generation_data: Dict[str, Any]) -> bool:
+        generation_data.setdefault('ts', time.time())
+        return self.submit(EVENT_IMAGE_GENERATION, (image_id, generation_data))
+
+    def record_request(self, event: Dict[str, Any]) -> bool:
+        event.setdefault('ts', time.time())
+        return self.submit(EVENT_REQUEST, event)
+
+    def _drain(self, batch: List[Tuple[str, Any]], deadline: float):
+        """从队列取事件直到批量满或超过截止时间"""
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+    def _write_batch(self, batch: List[Tuple[str, Any]]):
+        start = time.perf_counter()
+        try:
+            get_sqlite_pool(self.db_path).execute(write_events, batch)
+        except Exception as e:
+            with self.stats_lock:
+                self.failed_batches += 1
+            logger.error(f"统计事件批量写入失败({len(batch)} 条): {e}")
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        DB_WRITE_SECONDS.observe(elapsed_ms / 1000, 'analytics_batch')
+        with self.stats_lock:
+            self.written += len(batch)
+            self.batches += 1
+            self.last_flush_ms = elapsed_ms
+        for callback in self.on_commit:
+            callback()
+        logger.debug(f"统计事件已写入: {len(batch)} 条, 耗时 {elapsed_ms:.1f}ms")
+
+    def _run(self):
+        while True:
+            batch: List[Tuple[str, Any]] = []
+            stopping = self._stop_event.is_set()
+            # 阻塞等待第一条事件，之后最多再等待 flush_interval
+            try:
+                batch.append(self.queue.get(timeout=0.05 if stopping else self.flush_interval))
+            except queue.Empty:
+                pass
+            if batch:
+                self._drain(batch, time.monotonic() + (0 if stopping else self.flush_interval))
+                self._write_batch(batch)
+
+            # 处理同步 flush 请求（队列已清空后通知调用方）
+            if self.queue.empty():
+                while True:
+                    try:
+                        self._flush_requests.get_nowait().set()
+                    except queue.Empty:
+                        break
+                if stopping:
+                    return
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等待当前队列中的事件全部写入"""
+        if self._thread is None:
+            return self.queue.empty()
+        done = threading.Event()
+        self._flush_requests.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout: float = 5.0):
+        """写完剩余事件后停止写线程"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self.stats_lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queue_capacity': self.queue.maxsize,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'written': self.written,
+                'batches': self.batches,
+                'failed_batches': self.failed_batches,
+                'last_flush_ms': round(self.last_flush_ms, 2),
+            }
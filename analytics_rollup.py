@@ -0,0 +1,299 @@
+"""Business Gemini Pool 请求事件日志与增量汇总
+request_events 为只追加的请求事件表（每个聊天/上传请求一行，生成的图片计入所属聊天请求），
+汇总任务按高水位游标增量地把新事件累加到按小时/按天、按模型/账号/API密钥
+分组的 usage_rollups 表，并维护 daily_usage_summary；仪表板只读取汇总行
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import DB_WRITE_SECONDS
+from sqlite_pool import get_sqlite_pool
+
+logger = logging.getLogger('gemini_pool.analytics')
+
+CURSOR_NAME = 'request_events'
+
+# 汇总粒度 -> 时间桶格式（本地时间）
+BUCKET_FORMATS = {
+    'hour': '%Y-%m-%d %H:00:00',
+    'day': '%Y-%m-%d',
+}
+
+ROLLUP_GROUP_COLUMNS = ('model', 'account', 'api_key_hash', 'kind')
+
+ROLLUP_SCHEMA = [
+    # 只追加的请求事件表
+    """
+    CREATE TABLE IF NOT EXISTS request_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts INTEGER NOT NULL,
+        kind VARCHAR(16) NOT NULL,
+        model VARCHAR(50) NOT NULL DEFAULT '',
+        account VARCHAR(100) NOT NULL DEFAULT '',
+        api_key_hash VARCHAR(64) NOT NULL DEFAULT '',
+        user_id VARCHAR(50),
+        success INTEGER NOT NULL DEFAULT 1,
+        duration_ms INTEGER NOT NULL DEFAULT 0,
+        tokens INTEGER NOT NULL DEFAULT 0,
+        images INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_request_events_ts ON request_events(ts)",
+    # 按小时/天的增量汇总表
+    """
+    CREATE TABLE IF NOT EXISTS usage_rollups (
+        bucket VARCHAR(8) NOT NULL,
+        bucket_start VARCHAR(19) NOT NULL,
+        kind VARCHAR(16) NOT NULL,
+        model VARCHAR(50) NOT NULL,
+        account VARCHAR(100) NOT NULL,
+        api_key_hash VARCHAR(64) NOT NULL,
+        requests INTEGER NOT NULL DEFAULT 0,
+        successful INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        tokens INTEGER NOT NULL DEFAULT 0,
+        images INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        duration_ms INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, bucket_start, kind, model, account, api_key_hash)
+    )
+    """,
+    # 汇总任务高水位游标
+    """
+    CREATE TABLE IF NOT EXISTS rollup_cursors (
+        name VARCHAR(50) PRIMARY KEY,
+        last_event_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # 与 analytics_schema.sql 相同的每日汇总表
+    """
+    CREATE TABLE IF NOT EXISTS daily_usage_summary (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        summary_date DATE UNIQUE NOT NULL,
+        total_requests INTEGER DEFAULT 0,
+        successful_requests INTEGER DEFAULT 0,
+        failed_requests INTEGER DEFAULT 0,
+        unique_users INTEGER DEFAULT 0,
+        total_images_generated INTEGER DEFAULT 0,
+        total_tokens_generated INTEGER DEFAULT 0,
+        top_model_used VARCHAR(50),
+        top_keyword VARCHAR(100),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+
+def init_rollup_tables(conn: sqlite3.Connection):
+    """创建事件表、汇总表和游标表"""
+    for sql in ROLLUP_SCHEMA:
+        conn.execute(sql)
+
+
+def append_request_events(cursor, rows: List[tuple]):
+    """追加请求事件
+
+    rows: (ts, kind, model, account, api_key_hash, user_id, success, duration_ms, tokens, images, bytes)
+    """
+    cursor.executemany('''
+        INSERT INTO request_events (
+            ts, kind, model, account, api_key_hash, user_id,
+            success, duration_ms, tokens, images, bytes
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+
+def _day_range(day: str):
+    """返回本地日期对应的 [开始, 结束) 时间戳"""
+    start = datetime.strptime(day, '%Y-%m-%d')
+    return int(start.timestamp()), int((start + timedelta(days=1)).timestamp())
+
+
+class UsageRollup:
+    """增量汇总任务"""
+
+    def __init__(self, db_path: str, interval: float = 60.0, batch_limit: int = 50000):
+        self.db_path = db_path
+        self.interval = interval
+        self.batch_limit = batch_limit
+        self.runs = 0
+        self.events_processed = 0
+        self.last_run_ms = 0.0
+        self.last_event_id = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._run_lock = threading.Lock()
+        # 汇总有新数据提交后调用
+        self.on_commit: List[Callable[[], None]] = []
+
+    def run_once(self) -> int:
+        """处理游标之后的一批新事件，返回处理的事件数"""
+        with self._run_lock:
+            start = time.perf_counter()
+            # 写线程的事务以 BEGIN IMMEDIATE 开始，保证多进程下同一批事件只被汇总一次
+            processed = get_sqlite_pool(self.db_path).execute(self._rollup)
+
+            self.runs += 1
+            self.events_processed += processed
+            self.last_run_ms = (time.perf_counter() - start) * 1000
+            DB_WRITE_SECONDS.observe(self.last_run_ms / 1000, 'rollup')
+            if processed:
+                for callback in self.on_commit:
+                    callback()
+                logger.info(f"统计汇总完成: {processed} 条事件, 游标={self.last_event_id}, "
+                            f"耗时 {self.last_run_ms:.1f}ms")
+            return processed
+
+    def _rollup(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute('SELECT last_event_id FROM rollup_cursors WHERE name = ?',
+                           (CURSOR_NAME,)).fetchone()
+        last_id = row[0] if row else 0
+        row = conn.execute('''
+            SELECT MAX(id), COUNT(*) FROM (
+                SELECT id FROM request_events WHERE id > ? ORDER BY id LIMIT ?
+            )
+        ''', (last_id, self.batch_limit)).fetchone()
+        high_id, count = row
+        self.last_event_id = last_id
+        if not count:
+            return 0
+
+        for bucket, fmt in BUCKET_FORMATS.items():
+            conn.execute(f'''
+                INSERT INTO usage_rollups (
+                    bucket, bucket_start, kind, model, account, api_key_hash,
+                    requests, successful, failed, tokens, images, bytes, duration_ms
+                )
+                SELECT
+                    ?, strftime('{fmt}', ts, 'unixepoch', 'localtime'), kind, model, account, api_key_hash,
+                    COUNT(*), SUM(success), COUNT(*) - SUM(success),
+                    SUM(tokens), SUM(images), SUM(bytes), SUM(duration_ms)
+                FROM request_events
+                WHERE id > ? AND id <= ?
+                GROUP BY 2, 3, 4, 5, 6
+                ON CONFLICT(bucket, bucket_start, kind, model, account, api_key_hash) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    successful = successful + excluded.successful,
+                    failed = failed + excluded.failed,
+                    tokens = tokens + excluded.tokens,
+                    images = images + excluded.images,
+                    bytes = bytes + excluded.bytes,
+                    duration_ms = duration_ms + excluded.duration_ms
+            ''', (bucket, last_id, high_id))
+
+        days = [r[0] for r in conn.execute('''
+            SELECT DISTINCT strftime('%Y-%m-%d', ts, 'unixepoch', 'localtime')
+            FROM request_events WHERE id > ? AND id <= ?
+        ''', (last_id, high_id))]
+        for day in days:
+            self._refresh_daily_summary(conn, day)
+
+        conn.execute('''
+            INSERT INTO rollup_cursors (name, last_event_id) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                last_event_id = excluded.last_event_id,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (CURSOR_NAME, high_id))
+        self.last_event_id = high_id
+        return count
+
+    def _refresh_daily_summary(self, conn: sqlite3.Connection, day: str):
+        """根据当日汇总行重算 daily_usage_summary"""
+        totals = conn.execute('''
+            SELECT SUM(requests), SUM(successful), SUM(failed), SUM(images), SUM(tokens)
+            FROM usage_rollups WHERE bucket = 'day' AND bucket_start = ?
+        ''', (day,)).fetchone()
+        top_model = conn.execute('''
+            SELECT model FROM usage_rollups
+            WHERE bucket = 'day' AND bucket_start = ? AND model != ''
+            GROUP BY model ORDER BY SUM(requests) DESC LIMIT 1
+        ''', (day,)).fetchone()
+        # 去重用户数无法累加，只扫描当天的事件（按 ts 索引）
+        day_start, day_end = _day_range(day)
+        unique_users = conn.execute('''
+            SELECT COUNT(DISTINCT user_id) FROM request_events
+            WHERE ts >= ? AND ts < ? AND user_id IS NOT NULL AND user_id != ''
+        ''', (day_start, day_end)).fetchone()[0]
+
+        conn.execute('''
+            INSERT INTO daily_usage_summary (
+                summary_date, total_requests, successful_requests, failed_requests,
+                unique_users, total_images_generated, total_tokens_generated, top_model_used
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(summary_date) DO UPDATE SET
+                total_requests = excluded.total_requests,
+                successful_requests = excluded.successful_requests,
+                failed_requests = excluded.failed_requests,
+                unique_users = excluded.unique_users,
+                total_images_generated = excluded.total_images_generated,
+                total_tokens_generated = excluded.total_tokens_generated,
+                top_model_used = excluded.top_model_used,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (day, totals[0] or 0, totals[1] or 0, totals[2] or 0, unique_users,
+              totals[3] or 0, totals[4] or 0, top_model[0] if top_model else None))
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                # 积压较多时连续处理，直到追上最新事件
+                while self.run_once() >= self.batch_limit:
+                    pass
+            except Exception as e:
+                logger.error(f"统计汇总失败: {e}")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='analytics-rollup', daemon=True)
+        self._thread.start()
+        logger.info(f"统计汇总任务已启动，间隔 {self.interval} 秒")
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'runs': self.runs,
+            'events_processed': self.events_processed,
+            'last_event_id': self.last_event_id,
+            'last_run_ms': round(self.last_run_ms, 2),
+            'interval_seconds': self.interval,
+        }
+
+
+def query_rollups(conn: sqlite3.Connection, bucket: str, since: str,
+                  group_by: Optional[str] = None) -> List[Dict[str, Any]]:
+    """按时间桶（及可选维度）读取汇总数据"""
+    if bucket not in BUCKET_FORMATS:
+        raise ValueError(f"不支持的汇总粒度: {bucket}")
+    if group_by is not None and group_by not in ROLLUP_GROUP_COLUMNS:
+        raise ValueError(f"不支持的分组维度: {group_by}")
+
+    dimension = f", {group_by}" if group_by else ''
+    cursor = conn.execute(f'''
+        SELECT bucket_start{dimension},
+               SUM(requests) AS requests, SUM(successful) AS successful, SUM(failed) AS failed,
+               SUM(tokens) AS tokens, SUM(images) AS images, SUM(bytes) AS bytes,
+               SUM(duration_ms) AS duration_ms
+        FROM usage_rollups
+        WHERE bucket = ? AND bucket_start >= ?
+        GROUP BY bucket_start{dimension}
+        ORDER BY bucket_start DESC
+    ''', (bucket, since))
+    columns = [desc[0] for desc in cursor.description]
+    results = []
+    for row in cursor.fetchall():
+        data = dict(zip(columns, row))
+        data['avg_duration_ms'] = round(data['duration_ms'] / max(data['requests'], 1), 2)
+        results.append(data)
+    return results
@@ -0,0 +1,488 @@
+"""Business Gemini Pool 下游API密钥注册表
+支持多个下游API密钥：密钥以 SHA-256 哈希存储在 SQLite 中，并在内存中
+维护 哈希 -> 密钥记录 的字典用于 O(1) 查找；每个密钥可配置令牌桶限流
+和并发上限，吊销后无需重启即可生效
+"""
+
+import hashlib
+import logging
+import secrets
+import threading
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from sqlite_pool import get_sqlite_pool
+
+logger = logging.getLogger('gemini_pool.auth')
+
+# 环境变量 DOWNSTREAM_API_KEY 对应的内置密钥ID
+ENV_KEY_ID = 0
+
+
+@dataclass
+class ApiKeyRecord:
+    """下游API密钥记录（不包含明文）"""
+    id: int
+    key_hash: str
+    key_prefix: str
+    name: str
+    rate_limit_rpm: int = 0        # 每分钟请求数，0 表示不限
+    burst: int = 0                 # 令牌桶容量，0 表示与 rate_limit_rpm 相同
+    max_concurrency: int = 0       # 最大并发请求数，0 表示不限
+    is_active: bool = True
+    created_at: Optional[str] = None
+    revoked_at: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        data = asdict(self)
+        data.pop('key_hash', None)
+        return data
+
+
+class TokenBucket:
+    """令牌桶限流器"""
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> Tuple[bool, float]:
+        """尝试获取一个令牌，返回 (是否成功, 建议重试等待秒数)"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True, 0.0
+            return False, (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+
+class KeyLimiter:
+    """单个密钥的运行时限流状态（跨注册表刷新保留）"""
+
+    def __init__(self, record: ApiKeyRecord):
+        self.bucket = None
+        self.max_concurrency = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.configure(record)
+
+    def configure(self, record: ApiKeyRecord):
+        if record.rate_limit_rpm > 0:
+            capacity = record.burst if record.burst > 0 else record.rate_limit_rpm
+            rate = record.rate_limit_rpm / 60.0
+            if self.bucket is None or self.bucket.rate != rate or self.bucket.capacity != capacity:
+                self.bucket = TokenBucket(rate, capacity)
+        else:
+            self.bucket = None
+        self.max_concurrency = record.max_concurrency
+
+    def check_rate(self) -> Tuple[bool, float]:
+        if self.bucket is None:
+            return True, 0.0
+        return self.bucket.try_acquire()
+
+    def acquire_slot(self) -> bool:
+        if self.max_concurrency <= 0:
+            return True
+        with self.lock:
+            if self.in_flight >= self.max_concurrency:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release_slot(self):
+        if self.max_concurrency <= 0:
+            return
+        with self.lock:
+            if self.in_flight > 0:
+                self.in_flight -= 1
+
+
+def hash_api_key(api_key: str) -> str:
+    """计算API密钥的 SHA-256 哈希"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def mask_api_key(api_key: str) -> str:
+    return f"{api_key[:8]}...{api_key[-4:]}" if len(api_key) > 12 else api_key[:4] + '...'
+
+
+class ApiKeyRegistry:
+    """API密钥注册表：SQLite 持久化 + 内存哈希索引"""
+
+    def __init__(self, db_path: Optional[str] = None, refresh_interval: float = 5.0):
+        if db_path is None:
+            db_path = Path(__file__).parent / "conversations.db"
+        self.db_path = db_path
+        self.pool = get_sqlite_pool(db_path)
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self._index: Dict[str, ApiKeyRecord] = {}
+        self._limiters: Dict[str, KeyLimiter] = {}
+        self._fingerprint = None
+        self._next_refresh = 0.0
+        self._init_table()
+        self.refresh(force=True)
+
+    def _init_table(self):
+        try:
+            with self.pool.write() as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS downstream_api_keys (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        key_hash VARCHAR(64) UNIQUE NOT NULL,
+                        key_prefix VARCHAR(32) NOT NULL,
+                        name VARCHAR(100) NOT NULL,
+                        rate_limit_rpm INTEGER DEFAULT 0,
+                        burst INTEGER DEFAULT 0,
+                        max_concurrency INTEGER DEFAULT 0,
+                        is_active BOOLEAN DEFAULT TRUE,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        revoked_at TIMESTAMP
+                    )
+                """)
+                # 版本号行：密钥表每次写入（含其他进程和直接改库）都由触发器加一，刷新时只比较版本号。
+                # updated_at 只精确到秒，同一秒内的两次修改用时间戳比较会漏掉
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS downstream_api_keys_version (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+                conn.execute("INSERT OR IGNORE INTO downstream_api_keys_version (id, version) VALUES (1, 0)")
+                for event in ('INSERT', 'UPDATE', 'DELETE'):
+                    conn.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS downstream_api_keys_{event.lower()}_version
+                        AFTER {event} ON downstream_api_keys BEGIN
+                            UPDATE downstream_api_keys_version SET version = version + 1 WHERE id = 1;
+                        END
+                    """)
+        except Exception as e:
+            logger.error(f"初始化API密钥表失败: {e}")
+
+    def refresh(self, force: bool = False):
+        """从数据库重新加载密钥索引（其他进程吊销的密钥也会在刷新后生效）"""
+        try:
+            with self.pool.read() as conn:
+                fingerprint = conn.execute(
+                    "SELECT version FROM downstream_api_keys_version WHERE id = 1"
+                ).fetchone()
+                if not force and fingerprint == self._fingerprint:
+                    return
+                rows = conn.execute("""
+                    SELECT id, key_hash, key_prefix, name, rate_limit_rpm, burst,
+                           max_concurrency, is_active, created_at, revoked_at
+                    FROM downstream_api_keys
+                """).fetchall()
+        except Exception as e:
+            logger.error(f"加载API密钥失败: {e}")
+            return
+
+        index = {}
+        for row in rows:
+            record = ApiKeyRecord(
+                id=row[0], key_hash=row[1], key_prefix=row[2], name=row[3],
+                rate_limit_rpm=row[4] or 0, burst=row[5] or 0, max_concurrency=row[6] or 0,
+                is_active=bool(row[7]), created_at=row[8], revoked_at=row[9]
+            )
+            index[record.key_hash] = record
+
+        with self.lock:
+            for key_hash, record in index.items():
+                limiter = self._limiters.get(key_hash)
+                if limiter is None:
+                    self._limiters[key_hash] = KeyLimiter(record)
+                else:
+                    limiter.configure(record)
+            for key_hash in list(self._limiters):
+                if key_hash not in index:
+                    del self._limiters[key_hash]
+            self._index = index
+            self._fingerprint = fingerprint
+        logger.info(f"API密钥索引已加载: {len(index)} 个, 启用 {sum(1 for r in index.values() if r.is_active)} 个")
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        if now < self._next_refresh:
+            return
+        self._next_refresh = now + self.refresh_interval
+        self.refresh()
+
+    def lookup(self, api_key: str) -> Optional[ApiKeyRecord]:
+        """按明文密钥查找启用中的记录"""
+        self._maybe_refresh()
+        record = self._index.get(hash_api_key(api_key))
+        if record is None or not record.is_active:
+            return None
+        return record
+
+    def limiter_for(self, record: ApiKeyRecord) -> Optional[KeyLimiter]:
+        return self._limiters.get(record.key_hash)
+
+    def has_active_keys(self) -> bool:
+        self._maybe_refresh()
+        return any(r.is_active for r in self._index.values())
+
+    def list_keys(self) -> List[Dict]:
+        self._maybe_refresh()
+        result = []
+        for record in sorted(self._index.values(), key=lambda r: r.id):
+            data = record.to_dict()
+            limiter = self._limiters.get(record.key_hash)
+            data['in_flight'] = limiter.in_flight if limiter else 0
+            result.append(data)
+        return result
+
+    def create_key(self, name: str, rate_limit_rpm: int = 0, burst: int = 0,
+                   max_concurrency: int = 0) -> Tuple[str, ApiKeyRecord]:
+        """创建新密钥，返回 (明文密钥, 记录)；明文只在创建时返回一次"""
+        api_key = f"sk-{secrets.token_urlsafe(32)}"
+        key_hash = hash_api_key(api_key)
+        with self.pool.write() as conn:
+            cursor = conn.execute("""
+                INSERT INTO downstream_api_keys (key_hash, key_prefix, name, rate_limit_rpm, burst, max_concurrency)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (key_hash, mask_api_key(api_key), name, rate_limit_rpm, burst, max_concurrency))
+            key_id = cursor.lastrowid
+        self.refresh(force=True)
+        logger.info(f"已创建API密钥: id={key_id}, name={name}")
+        return api_key, self._index[key_hash]
+
+    def update_key(self, key_id: int, **fields) -> bool:
+        allowed = {k: v for k, v in fields.items() if k in ('name', 'rate_limit_rpm', 'burst', 'max_concurrency')}
+        if not allowed:
+            return False
+        assignments = ', '.join(f"{k} = ?" for k in allowed)
+        with self.pool.write() as conn:
+            cursor = conn.execute(
+                f"UPDATE downstream_api_keys SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (*allowed.values(), key_id)
+            )
+            updated = cursor.rowcount > 0
+        self.refresh(force=True)
+        return updated
+
+    def revoke_key(self, key_id: int) -> bool:
+        """吊销密钥，立即在本进程生效，其他进程在下次刷新时生效"""
+        with self.pool.write() as conn:
+            cursor = conn.execute("""
+                UPDATE downstream_api_keys
+                SET is_active = 0, revoked_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND is_active = 1
+            """, (key_id,))
+            revoked = cursor.rowcount > 0
+        self.refresh(force=True)
+        if revoked:
+            logger.info(f"已吊销API密钥: id={key_id}")
+        return revoked
+
+    def delete_key(self, key_id: int) -> bool:
+        with self.pool.write() as conn:
+            cursor = conn.execute("DELETE FROM downstream_api_keys WHERE id = ?", (key_id,))
+            deleted = cursor.rowcount > 0
+        self.refresh(force=True)
+        return deleted
+
+
+# 内置环境变量密钥的记录（不限流）
+ENV_KEY_RECORD = ApiKeyRecord(id=ENV_KEY_ID, key_hash='', key_prefix='env', name='DOWNSTREAM_API_KEY')
+
+
+class AuthError(Exception):
+    """鉴权失败，携带返回给客户端的错误信息和状态码"""
+
+    def __init__(self, status: int, error_type: str, message: str,
+                 suggestion: Optional[str] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.message = message
+        self.suggestion = suggestion
+        self.retry_after = retry_after
+
+    def to_payload(self) -> Dict:
+        error = {"message": self.message, "type": self.error_type}
+        if self.suggestion:
+            error["suggestion"] = self.suggestion
+        return {"error": error}
+
+
+def extract_api_key(authorization: str) -> str:
+    """从 Authorization 请求头提取API密钥"""
+    return authorization.replace('Bearer ', '').replace('Api-Key ', '')
+
+
+class DownstreamAuthenticator:
+    """下游请求鉴权：主装饰器和统计分析接口共用的快速路径"""
+
+    def __init__(self, auth_config_manager, registry: Optional[ApiKeyRegistry]):
+        self.auth_config_manager = auth_config_manager
+        self.registry = registry
+
+    def authenticate(self, authorization: str) -> Optional[ApiKeyRecord]:
+        """校验密钥并执行令牌桶限流
+
+        返回匹配的密钥记录；未启用鉴权时返回 None；失败时抛出 AuthError
+        """
+        auth_config = self.auth_config_manager.get()
+        if not auth_config.require_auth:
+            return None
+
+        has_registry_keys = self.registry is not None and self.registry.has_active_keys()
+        if not auth_config.required_api_key and not has_registry_keys:
+            raise AuthError(503, "configuration_error",
+                            "Server requires authentication but API key not configured",
+                            "Please set DOWNSTREAM_API_KEY environment variable or create API keys")
+
+        provided_api_key = extract_api_key(authorization)
+        if not provided_api_key:
+            raise AuthError(401, "authentication_required", "Authentication required",
+                            "Please provide API key in Authorization header")
+
+        if auth_config.verify_key(provided_api_key):
+            return ENV_KEY_RECORD
+
+        record = self.registry.lookup(provided_api_key) if self.registry is not None else None
+        if record is None:
+            raise AuthError(401, "authentication_failed", "Invalid API key")
+
+        limiter = self.registry.limiter_for(record)
+        if limiter is not None:
+            allowed, retry_after = limiter.check_rate()
+            if not allowed:
+                raise AuthError(429, "rate_limit_exceeded",
+                                f"Rate limit exceeded for API key '{record.name}'",
+                                retry_after=retry_after)
+        return record
+
+    def acquire_slot(self, record: Optional[ApiKeyRecord]) -> Optional[KeyLimiter]:
+        """占用并发槽位，返回需要释放的 limiter；超出并发上限时抛出 AuthError"""
+        if record is None or record is ENV_KEY_RECORD or self.registry is None:
+            return None
+        limiter = self.registry.limiter_for(record)
+        if limiter is None or limiter.max_concurrency <= 0:
+            return None
+        if not limiter.acquire_slot():
+            raise AuthError(429, "concurrency_limit_exceeded",
+                            f"Too many concurrent requests for API key '{record.name}'",
+                            retry_after=1.0)
+        return limiter
+
+
+# 全局API密钥注册表
+_api_key_registry = None
+
+
+def get_api_key_registry() -> Optional[ApiKeyRegistry]:
+    """获取全局API密钥注册表实例"""
+    global _api_key_registry
+    if _api_key_registry is None:
+        import os
+        interval = float(os.getenv('API_KEY_REFRESH_INTERVAL', '5.0'))
+        _api_key_registry = ApiKeyRegistry(refresh_interval=interval)
+    return _api_key_registry
+
+
+def check_admin_record():
+    """鉴权通过后检查是否为管理员密钥（DOWNSTREAM_API_KEY），不是时返回 403 响应，是则返回 None
+
+    注册表中的团队密钥只能调用 /v1/* 和统计查询接口；未启用鉴权时（没有密钥记录）不做限制
+    """
+    from flask import g, jsonify
+
+    record = getattr(g, 'api_key_record', None)
+    if record is not None and record is not ENV_KEY_RECORD:
+        return jsonify({
+            "error": {
+                "message": "Only the admin key (DOWNSTREAM_API_KEY) can access this endpoint",
+                "type": "permission_denied"
+            }
+        }), 403
+    return None
+
+
+def admin_only(f):
+    """只允许管理员密钥访问，放在鉴权装饰器之后"""
+    from functools import wraps
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        denied = check_admin_record()
+        if denied is not None:
+            return denied
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def init_api_key_routes(app, auth_decorator, registry: ApiKeyRegistry):
+    """初始化API密钥管理路由（仅 DOWNSTREAM_API_KEY 管理员密钥可操作）"""
+    from flask import request, jsonify
+
+    @app.route('/api/keys', methods=['GET'])
+    @auth_decorator
+    @admin_only
+    def list_downstream_keys():
+        """获取下游API密钥列表"""
+        return jsonify({"keys": registry.list_keys()})
+
+    @app.route('/api/keys', methods=['POST'])
+    @auth_decorator
+    @admin_only
+    def create_downstream_key():
+        """创建下游API密钥"""
+        data = request.get_json() or {}
+        name = (data.get('name') or '').strip()
+        if not name:
+            return jsonify({"error": "name 不能为空"}), 400
+        try:
+            api_key, record = registry.create_key(
+                name=name,
+                rate_limit_rpm=int(data.get('rate_limit_rpm', 0)),
+                burst=int(data.get('burst', 0)),
+                max_concurrency=int(data.get('max_concurrency', 0))
+            )
+        except (TypeError, ValueError):
+            return jsonify({"error": "限流参数必须是整数"}), 400
+        except Exception as e:
+            return jsonify({"error": f"创建API密钥失败: {e}"}), 500
+        return jsonify({"api_key": api_key, "key": record.to_dict()}), 201
+
+    @app.route('/api/keys/<int:key_id>', methods=['PUT'])
+    @auth_decorator
+    @admin_only
+    def update_downstream_key(key_id):
+        """更新下游API密钥的名称和限流配置"""
+        data = request.get_json() or {}
+        try:
+            fields = {k: (int(v) if k != 'name' else str(v)) for k, v in data.items()}
+        except (TypeError, ValueError):
+            return jsonify({"error": "限流参数必须是整数"}), 400
+        if not registry.update_key(key_id, **fields):
+            return jsonify({"error": "API密钥不存在或没有可更新的字段"}), 404
+        return jsonify({"success": True})
+
+    @app.route('/api/keys/<int:key_id>/revoke', methods=['POST'])
+    @auth_decorator
+    @admin_only
+    def revoke_downstream_key(key_id):
+        """吊销下游API密钥（无需重启）"""
+        if not registry.revoke_key(key_id):
+            return jsonify({"error": "API密钥不存在或已吊销"}), 404
+        return jsonify({"success": True})
+
+    @app.route('/api/keys/<int:key_id>', methods=['DELETE'])
+    @auth_decorator
+    @admin_only
+    def delete_downstream_key(key_id):
+        """删除下游API密钥"""
+        if not registry.delete_key(key_id):
+            return jsonify({"error": "API密钥不存在"}), 404
+        return jsonify({"success": True})
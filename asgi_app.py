@@ -0,0 +1,628 @@
+"""Business Gemini Pool ASGI 网关模式
+
+同步 WSGI 模式下每个进行中的聊天请求在等待上游（最长 120 秒）时占用一个线程。ASGI 模式下
+/v1/chat/completions、/v1/files 和 /image/* 由 asyncio 原生处理：访问上游使用带连接池的异步
+HTTP 客户端（async_http.py），SQLite、磁盘和偶发的 JWT/会话刷新放到专用线程池，不阻塞事件循环；
+请求解析和响应构建复用 gemini.py 中的同一套函数。其余管理接口通过 WSGI 桥接在线程池中交给 Flask 处理。
+
+原生处理的请求同样在 Flask 请求上下文中执行（before/after_request 钩子照常运行，
+指标、追踪、压缩、鉴权、request/g 的用法与同步模式一致）。
+
+启动: python server.py --server asgi（安装了 uvicorn 时使用 uvicorn，否则使用内置 asyncio 服务），
+      或 uvicorn asgi_app:app
+"""
+
+import asyncio
+import base64
+import contextvars
+import functools
+import json
+import logging
+import mimetypes
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from flask import Response, g, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+import gemini
+from api_keys import AuthError
+from async_http import AsyncHTTPClient, HTTPError, supports_proxy
+from file_registry import to_openai_file
+from metrics import HTTP_FINISHED, HTTP_STARTED, UPSTREAM_ERRORS, classify_upstream_error
+from streaming_body import BlobSlice, RequestTooLarge, StreamingJsonBody
+
+logger = logging.getLogger('gemini_pool.asgi')
+chat_logger = logging.getLogger('gemini_pool.chat')
+upload_logger = logging.getLogger('gemini_pool.upload')
+
+tracer = gemini.tracer
+latency_metrics = gemini.latency_metrics
+
+# 发送给客户端的文件按该大小分批从线程池读取
+FILE_BATCH_BYTES = 64 * 1024
+
+
+class ClientDisconnected(Exception):
+    """读取请求体时客户端断开"""
+
+
+def build_environ(scope: Dict, body, length: int) -> Dict:
+    """由 ASGI scope 构建 WSGI environ（请求体已完整读取到 body 中）"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = client[0], str(client[1])
+    for raw_name, raw_value in scope.get('headers', ()):
+        name = raw_name.decode('latin-1').lower()
+        value = raw_value.decode('latin-1')
+        if name in ('content-length', 'transfer-encoding'):
+            # 请求体已读完，长度以实际读取的为准
+            continue
+        key = 'CONTENT_TYPE' if name == 'content-type' else 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _declared_length(scope: Dict) -> Optional[int]:
+    for name, value in scope.get('headers', ()):
+        if name.lower() == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+class AsgiGateway:
+    """ASGI 应用：原生处理注册的端点，其余请求桥接到 Flask"""
+
+    def __init__(self, flask_app, bridge_threads: int = 32, io_threads: int = 16,
+                 spool_bytes: int = 1024 * 1024, max_idle_connections: int = 32):
+        self.app = flask_app
+        self.spool_bytes = spool_bytes
+        self.max_idle_connections = max_idle_connections
+        self.bridge_executor = ThreadPoolExecutor(bridge_threads, thread_name_prefix='asgi-wsgi')
+        self.io_executor = ThreadPoolExecutor(io_threads, thread_name_prefix='asgi-io')
+        # endpoint -> (方法, 请求体上限, 处理协程)
+        self.native: Dict[str, Tuple[Tuple[str, ...], Optional[int], Callable[..., Awaitable]]] = {}
+        self._client: Optional[AsyncHTTPClient] = None
+
+    # ---------- 注册 ----------
+
+    def route(self, endpoint: str, methods: Iterable[str], max_body: Optional[int] = None):
+        """以协程原生处理 Flask 中同名端点的请求（URL 规则沿用 Flask 的路由表）"""
+        def decorator(handler):
+            self.native[endpoint] = (tuple(methods), max_body, handler)
+            return handler
+        return decorator
+
+    def offload(self, endpoint: str, methods: Iterable[str]):
+        """Flask 视图本身只做本地 I/O（SQLite、读文件）：在 I/O 线程池中执行视图，响应体由事件循环发送"""
+        view = self.app.view_functions[endpoint]
+
+        async def handler(**view_args):
+            return await self.run_sync(view, **view_args)
+        self.route(endpoint, methods)(handler)
+
+    # ---------- 工具 ----------
+
+    def http_client(self) -> AsyncHTTPClient:
+        if self._client is None:
+            self._client = AsyncHTTPClient(max_idle_per_host=self.max_idle_connections)
+        return self._client
+
+    async def run_sync(self, func, *args, **kwargs):
+        """在 I/O 线程池中执行同步函数（复制当前上下文，request/g/追踪在线程中照常可用）"""
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, call)
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+        self.bridge_executor.shutdown(wait=False)
+        self.io_executor.shutdown(wait=False)
+
+    # ---------- ASGI 入口 ----------
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise RuntimeError(f"不支持的 ASGI 请求类型: {scope['type']}")
+
+        endpoint, handler, max_body = None, None, None
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(build_environ(scope, None, 0)).match(method=scope['method'])
+        except HTTPException:
+            pass
+        if endpoint in self.native and scope['method'] in self.native[endpoint][0]:
+            _, max_body, handler = self.native[endpoint]
+
+        try:
+            body, length = await self._read_body(scope, receive, max_body)
+        except ClientDisconnected:
+            return
+        except RequestTooLarge as e:
+            payload = json.dumps({"error": str(e)}).encode('utf-8')
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'application/json'),
+                                    (b'content-length', str(len(payload)).encode())]})
+            await send({'type': 'http.response.body', 'body': payload})
+            return
+
+        try:
+            environ = build_environ(scope, body, length)
+            if handler is not None:
+                await self._handle_native(handler, environ, send)
+            else:
+                await self._handle_wsgi(environ, send)
+        finally:
+            body.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, scope, receive, max_body: Optional[int]):
+        """读取完整请求体（超过 spool_bytes 的部分写入临时文件），不让慢速上传占用线程"""
+        declared = _declared_length(scope)
+        if max_body is not None and declared is not None and declared > max_body:
+            raise RequestTooLarge(max_body)
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        size = 0
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise ClientDisconnected()
+                chunk = message.get('body', b'')
+                if chunk:
+                    size += len(chunk)
+                    if max_body is not None and size > max_body:
+                        raise RequestTooLarge(max_body)
+                    body.write(chunk)
+                if not message.get('more_body', False):
+                    break
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return body, size
+
+    # ---------- 原生处理 ----------
+
+    async def _handle_native(self, handler, environ: Dict, send):
+        HTTP_STARTED.inc()
+        ctx = self.app.request_context(environ)
+        ctx.push()
+        error = None
+        try:
+            try:
+                try:
+                    rv = self.app.preprocess_request()
+                    if rv is None:
+                        rv = await handler(**(request.view_args or {}))
+                except Exception as e:
+                    rv = self.app.handle_user_exception(e)
+                response = self.app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                response = self.app.handle_exception(e)
+            await self._send_response(response, send)
+        finally:
+            ctx.pop(error)
+            HTTP_FINISHED.inc()
+
+    async def _send_response(self, response: Response, send):
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in response.headers.items()]})
+        try:
+            chunks = iter(response.iter_encoded())
+            if response.direct_passthrough:
+                # 文件响应：分批在线程池中读取
+                while True:
+                    data = await self.run_sync(_next_batch, chunks, FILE_BATCH_BYTES)
+                    if not data:
+                        break
+                    await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            else:
+                for data in chunks:
+                    if data:
+                        await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            response.close()
+
+    # ---------- WSGI 桥接 ----------
+
+    async def _handle_wsgi(self, environ: Dict, send):
+        loop = asyncio.get_running_loop()
+
+        def call_send(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            state = {'status': None, 'headers': None, 'started': False}
+
+            def start_response(status, headers, exc_info=None):
+                if exc_info and state['started']:
+                    raise exc_info[1].with_traceback(exc_info[2])
+                state['status'], state['headers'] = status, headers
+                return write
+
+            def start():
+                if not state['started']:
+                    state['started'] = True
+                    call_send({'type': 'http.response.start', 'status': int(state['status'].split(' ', 1)[0]),
+                               'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                           for name, value in state['headers']]})
+
+            def write(data: bytes):
+                start()
+                if data:
+                    call_send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+            try:
+                result = self.app(environ, start_response)
+            except Exception:
+                logger.exception("WSGI 应用异常: %s %s", environ['REQUEST_METHOD'], environ['PATH_INFO'])
+                state['status'], state['headers'] = '500 Internal Server Error', [('Content-Length', '0')]
+                result = []
+            try:
+                for data in result:
+                    write(data)
+                start()
+                call_send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        await loop.run_in_executor(self.bridge_executor, run)
+
+
+def _next_batch(chunks, size: int) -> bytes:
+    parts, total = [], 0
+    for data in chunks:
+        parts.append(data)
+        total += len(data)
+        if total >= size:
+            break
+    return b''.join(parts)
+
+
+gateway = AsgiGateway(
+    gemini.app,
+    bridge_threads=int(os.getenv('ASGI_BRIDGE_THREADS', os.getenv('WEB_THREADS', '32'))),
+    io_threads=int(os.getenv('ASGI_IO_THREADS', '16')),
+    spool_bytes=int(os.getenv('ASGI_SPOOL_BYTES', str(1024 * 1024))),
+    max_idle_connections=int(os.getenv('ASGI_MAX_IDLE_CONNECTIONS', '32')),
+)
+app = gateway
+
+
+# ==================== 上游访问 ====================
+
+def resolve_proxy(url: str, proxy: Optional[str]) -> Optional[str]:
+    """账号池配置的代理优先；未配置时与 requests 一样使用环境变量中的代理"""
+    if proxy:
+        return proxy
+    split = urlsplit(url)
+    if urllib.request.proxy_bypass(split.hostname or ''):
+        return None
+    return urllib.request.getproxies().get(split.scheme)
+
+
+def record_upstream_error(operation: str, error: Exception):
+    if isinstance(error, (OSError, asyncio.TimeoutError, HTTPError)):
+        UPSTREAM_ERRORS.inc(operation, classify_upstream_error(error))
+    else:
+        gemini.record_upstream_error(operation, error)
+
+
+async def upload_file_to_gemini(jwt: str, session_name: str, team_id: str, file_content: Optional[bytes],
+                                filename: str, mime_type: str, proxy: Optional[str] = None,
+                                file_contents_b64=None) -> str:
+    """gemini.upload_file_to_gemini 的异步版本"""
+    proxy = resolve_proxy(gemini.ADD_CONTEXT_FILE_URL, proxy)
+    if not supports_proxy(proxy):
+        return await gateway.run_sync(gemini.upload_file_to_gemini, jwt, session_name, team_id, file_content,
+                                      filename, mime_type, proxy, file_contents_b64)
+    if file_contents_b64 is None:
+        file_contents_b64 = base64.b64encode(file_content).decode('ascii')
+        file_size = len(file_content)
+    elif isinstance(file_contents_b64, BlobSlice):
+        file_size = file_contents_b64.decoded_size()
+    else:
+        file_size = gemini.base64_decoded_size(file_contents_b64)
+
+    streaming = isinstance(file_contents_b64, BlobSlice)
+    body = gemini.build_add_context_file_body(session_name, team_id, filename, mime_type,
+                                              StreamingJsonBody.PLACEHOLDER if streaming else file_contents_b64)
+    data = StreamingJsonBody(body, file_contents_b64) if streaming else json.dumps(body).encode('utf-8')
+
+    request_start = time.time()
+    with tracer.span('upload', bytes=file_size, mime_type=mime_type):
+        resp = await gateway.http_client().post(gemini.ADD_CONTEXT_FILE_URL, headers=gemini.get_headers(jwt),
+                                                data=data, proxy=proxy, timeout=60)
+        await resp.read()
+    latency_metrics.observe('upload', time.time() - request_start)
+    if resp.status != 200:
+        UPSTREAM_ERRORS.inc('upload', classify_upstream_error(status_code=resp.status))
+        upload_logger.warning("[upload_file_to_gemini] 上传失败 - 状态码: %s, 响应内容: %s", resp.status, resp.text[:500])
+        raise Exception(f"文件上传失败: {resp.status} - {resp.text}")
+    return gemini.extract_context_file_id(resp.json())
+
+
+async def download_image_from_url(url: str, proxy: Optional[str] = None) -> Tuple[bytes, str]:
+    """gemini.download_image_from_url 的异步版本"""
+    proxy = resolve_proxy(url, proxy)
+    if not supports_proxy(proxy):
+        return await gateway.run_sync(gemini.download_image_from_url, url, proxy)
+    with latency_metrics.timer('image_download'), tracer.span('image_download'):
+        resp = await gateway.http_client().get(url, proxy=proxy, timeout=60, follow_redirects=True)
+        content = await resp.read()
+    resp.raise_for_status()
+    return content, resp.headers.get('content-type', 'image/png').split(';')[0].strip()
+
+
+async def upload_inline_image_to_gemini(jwt: str, session_name: str, team_id: str,
+                                        image_data: Dict, proxy: Optional[str] = None) -> Optional[str]:
+    """gemini.upload_inline_image_to_gemini 的异步版本"""
+    try:
+        if image_data.get("type") == "base64":
+            mime_type = image_data.get("mime_type", "image/png")
+            return await upload_file_to_gemini(jwt, session_name, team_id, None,
+                                               gemini.inline_image_filename("inline", mime_type), mime_type, proxy,
+                                               file_contents_b64=image_data.get("data", ""))
+        if image_data.get("type") == "url":
+            file_content, mime_type = await download_image_from_url(image_data.get("url"), proxy)
+            return await upload_file_to_gemini(jwt, session_name, team_id, file_content,
+                                               gemini.inline_image_filename("url", mime_type), mime_type, proxy)
+        return None
+    except Exception:
+        return None
+
+
+async def stream_chat_with_images(jwt: str, sess_name: str, message: str, proxy: Optional[str], team_id: str,
+                                  file_ids: Optional[List[str]] = None, user_id: Optional[str] = None,
+                                  conversation_id: Optional[int] = None,
+                                  prompt: Optional[str] = None) -> 'gemini.ChatResponse':
+    """gemini.stream_chat_with_images 的异步版本：等待上游时不占用线程，解析和图片保存在线程池中执行"""
+    proxy = resolve_proxy(gemini.STREAM_ASSIST_URL, proxy)
+    if not supports_proxy(proxy):
+        return await gateway.run_sync(gemini.stream_chat_with_images, jwt, sess_name, message, proxy, team_id,
+                                      file_ids, user_id, conversation_id, prompt)
+    body = gemini.build_stream_assist_body(sess_name, message, team_id, file_ids)
+
+    upstream_start = time.time()
+    with tracer.span('upstream_ttfb'):
+        resp = await gateway.http_client().post(gemini.STREAM_ASSIST_URL, headers=gemini.get_headers(jwt),
+                                                json_body=body, proxy=proxy, timeout=120)
+    latency_metrics.observe('upstream_ttfb', time.time() - upstream_start)
+
+    if resp.status != 200:
+        resp.aclose()
+        UPSTREAM_ERRORS.inc('chat', classify_upstream_error(status_code=resp.status))
+        raise Exception(f"请求失败: {resp.status}")
+
+    lines = []
+    with tracer.span('upstream_stream') as stream_span:
+        async for line in resp.iter_lines():
+            if line:
+                lines.append(line.decode('utf-8') + "\n")
+        full_response = "".join(lines)
+        if stream_span is not None:
+            stream_span.attributes['bytes'] = len(full_response)
+    latency_metrics.observe('upstream_total', time.time() - upstream_start)
+
+    return await gateway.run_sync(gemini.parse_chat_response, full_response, jwt, team_id, proxy,
+                                  user_id, conversation_id, prompt)
+
+
+# ==================== 原生处理的接口 ====================
+
+def require_api_key(handler):
+    """gemini.require_api_key 的协程版本"""
+    @functools.wraps(handler)
+    async def decorated(**kwargs):
+        with tracer.span('auth'):
+            auth_error = gemini.check_request_auth()
+            if auth_error is not None:
+                return auth_error
+            try:
+                limiter = gemini.downstream_authenticator.acquire_slot(g.api_key_record)
+            except AuthError as e:
+                return gemini._auth_error_response(e)
+        if limiter is None:
+            return await handler(**kwargs)
+
+        try:
+            result = await handler(**kwargs)
+        except Exception:
+            limiter.release_slot()
+            raise
+        response = gemini.app.make_response(result)
+        # 流式响应在传输结束后才释放槽位
+        response.call_on_close(limiter.release_slot)
+        return response
+    return decorated
+
+
+@gateway.route('chat_completions', methods=('POST',), max_body=gemini.CHAT_MAX_BODY_BYTES)
+@require_api_key
+async def chat_completions():
+    """聊天对话接口（与 gemini.chat_completions 相同的行为）"""
+    start_time = time.time()
+    try:
+        try:
+            data = await gateway.run_sync(gemini.read_chat_request_body)
+        except RequestTooLarge as e:
+            chat_logger.warning(f"请求体过大: {e}")
+            return jsonify({"error": str(e)}), 413
+        messages = data.get('messages', [])
+        prompts = data.get('prompts', [])
+        stream = data.get('stream', False)
+        model = data.get('model', 'unknown')
+        force_new_session = data.get('force_new_session', False)
+
+        user_id, active_conversation_id = await gateway.run_sync(gemini.load_chat_user_context)
+        await gateway.run_sync(gemini.cleanup_expired_images)
+
+        # 转存到临时文件的图片在解析时要读文件，选亲和账号要持账号锁并读写共享状态，都放到线程池中
+        user_message, input_images, input_file_ids = await gateway.run_sync(gemini.extract_chat_inputs,
+                                                                            messages, prompts)
+        input_files = [f for f in await gateway.run_sync(lambda: [gemini.file_manager.get_file(fid)
+                                                                   for fid in input_file_ids]) if f]
+        affinity_account = (await gateway.run_sync(gemini.pick_file_affinity_account, input_files)
+                            if input_files else None)
+        if not user_message and not input_images and not input_files:
+            chat_logger.warning("请求中未找到有效的用户消息、图片或文件")
+            return jsonify({"error": "No user message found"}), 400
+
+        account_manager = gemini.account_manager
+        max_retries = len(account_manager.accounts)
+        last_error = None
+        chat_response = None
+        team_id = ''
+        for retry in range(max_retries):
+            account_idx = None
+            try:
+                with tracer.span('account_pick'):
+                    if retry == 0 and affinity_account is not None:
+                        account_idx, account = affinity_account
+                    else:
+                        account_idx, account = await gateway.run_sync(account_manager.get_next_account)
+                tracer.set_attribute('account', account_idx)
+                latency_metrics.set_context(account=account_idx, model=model)
+
+                session, jwt, team_id = await gateway.run_sync(gemini.ensure_session_for_account,
+                                                               account_idx, account, force_new_session)
+                proxy = account_manager.config.get("proxy")
+                gemini_file_ids = await gateway.run_sync(gemini.resolve_files_for_session, input_files,
+                                                         account_idx, session, jwt, team_id, proxy)
+                for img in input_images:
+                    uploaded_file_id = await upload_inline_image_to_gemini(jwt, session, team_id, img, proxy)
+                    if uploaded_file_id:
+                        gemini_file_ids.append(uploaded_file_id)
+
+                chat_response = await stream_chat_with_images(jwt, session, user_message, proxy, team_id,
+                                                              gemini_file_ids, user_id, active_conversation_id,
+                                                              user_message or None)
+                chat_logger.info(f"账号 {account_idx + 1 if account_idx is not None else '?'} 请求成功")
+                break
+            except Exception as e:
+                last_error = e
+                record_upstream_error('chat', e)
+                chat_logger.warning(f"账号 {account_idx + 1 if account_idx is not None else '?'} 请求失败: {e}")
+        else:
+            chat_logger.error(f"所有账号都失败，最后错误: {last_error}")
+            gemini.record_chat_analytics(model, False, time.time() - start_time, user_id=user_id,
+                                         conversation_id=active_conversation_id)
+            return jsonify({"error": f"所有账号请求失败: {last_error}"}), 500
+
+        response_content = gemini.build_openai_response_content(chat_response, request.host_url)
+        gemini.record_chat_analytics(model, True, time.time() - start_time, team_id, user_id,
+                                     active_conversation_id, len(chat_response.images))
+        if stream:
+            return Response(gemini.iter_chat_completion_chunks(response_content), mimetype='text/event-stream')
+        return jsonify(gemini.build_chat_completion(chat_response, response_content, user_message))
+    except Exception as e:
+        chat_logger.exception(f"聊天请求异常，耗时: {time.time() - start_time:.2f}秒，错误: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def read_uploaded_file() -> Optional[Tuple[str, bytes, str, str]]:
+    """解析 multipart 请求体，返回 (文件名, 内容, MIME 类型, purpose)；没有文件字段时返回 None"""
+    file = request.files.get('file')
+    if file is None:
+        return None
+    mime_type = file.content_type or mimetypes.guess_type(file.filename or '')[0] or 'application/octet-stream'
+    return file.filename or '', file.read(), mime_type, request.form.get('purpose', 'assistants')
+
+
+@gateway.route('upload_file', methods=('POST',))
+async def upload_file():
+    """OpenAI 兼容的文件上传接口（与 gemini.upload_file 相同的行为）"""
+    request_start_time = time.time()
+    try:
+        uploaded = await gateway.run_sync(read_uploaded_file)
+        if uploaded is None:
+            return jsonify({"error": {"message": "No file provided", "type": "invalid_request_error"}}), 400
+        filename, file_content, mime_type, purpose = uploaded
+        if filename == '':
+            return jsonify({"error": {"message": "No file selected", "type": "invalid_request_error"}}), 400
+
+        account_manager = gemini.account_manager
+        last_error = None
+        for retry_idx in range(len(account_manager.accounts)):
+            try:
+                with tracer.span('account_pick'):
+                    account_idx, account = await gateway.run_sync(account_manager.get_next_account)
+                tracer.set_attribute('account', account_idx)
+                latency_metrics.set_context(account=account_idx)
+                session, jwt, team_id = await gateway.run_sync(gemini.ensure_session_for_account, account_idx, account)
+                proxy = account_manager.config.get("proxy")
+                gemini_file_id = await upload_file_to_gemini(jwt, session, team_id, file_content, filename,
+                                                             mime_type, proxy)
+                file_info = await gateway.run_sync(
+                    gemini.file_manager.add_file, openai_file_id=f"file-{uuid.uuid4().hex[:24]}",
+                    gemini_file_id=gemini_file_id, session_name=session, filename=filename, mime_type=mime_type,
+                    size=len(file_content), purpose=purpose, account_idx=account_idx, content=file_content)
+                total_time = time.time() - request_start_time
+                await gateway.run_sync(gemini.record_upload_analytics, True, total_time, team_id, len(file_content))
+                upload_logger.info("[文件上传] 上传成功: %s -> %s, 账号=%s, 总耗时=%.3f秒",
+                                   filename, file_info["id"], account_idx, total_time)
+                return jsonify(to_openai_file(file_info))
+            except Exception as e:
+                last_error = e
+                record_upstream_error('upload', e)
+                upload_logger.warning("[文件上传] 第%d次尝试失败: %s: %s", retry_idx + 1, type(e).__name__, e)
+
+        total_time = time.time() - request_start_time
+        await gateway.run_sync(gemini.record_upload_analytics, False, total_time, '', len(file_content))
+        upload_logger.error("[文件上传] 所有重试均失败: %s, 总耗时=%.3f秒", last_error, total_time)
+        return jsonify({"error": {"message": f"文件上传失败: {last_error}", "type": "api_error"}}), 500
+    except Exception as e:
+        upload_logger.exception("[文件上传] 发生异常: %s: %s", type(e).__name__, e)
+        return jsonify({"error": {"message": str(e), "type": "api_error"}}), 500
+
+
+# 只访问 SQLite / 本地文件的接口：视图在 I/O 线程池中执行，响应体由事件循环发送
+gateway.offload('list_files', ('GET',))
+gateway.offload('get_file', ('GET',))
+gateway.offload('delete_file', ('DELETE',))
+gateway.offload('serve_image', ('GET',))
@@ -0,0 +1,422 @@
+"""内置 asyncio HTTP/1.1 服务（ASGI）
+
+未安装 uvicorn 时 `python server.py --server asgi` 使用这里的服务运行 asgi_app:app。
+每个 worker 一个事件循环，支持 keep-alive、分块传输的请求和响应、Expect: 100-continue、
+空闲连接和请求读写超时、处理一定请求数后平滑重启，以及 lifespan 启动/关闭事件。
+收到 SIGTERM/SIGINT 时停止接受新连接、关闭空闲连接，并等待处理中的请求完成。
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+from email.utils import formatdate
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote
+
+logger = logging.getLogger('gemini_pool.server')
+
+MAX_HEADER_BYTES = 64 * 1024
+READ_CHUNK = 64 * 1024
+# 应用没有读完的请求体超过该大小时直接关闭连接，不再排空
+MAX_DRAIN_BYTES = 1024 * 1024
+
+
+class BadRequest(Exception):
+    pass
+
+
+class _RequestBody:
+    """按 Content-Length 或分块编码读取请求体，提供 ASGI receive"""
+
+    def __init__(self, reader: asyncio.StreamReader, length: int, chunked: bool, timeout: Optional[float],
+                 on_first_read=None):
+        self.reader = reader
+        self.remaining = length
+        self.chunked = chunked
+        self.timeout = timeout
+        self.done = not chunked and length == 0
+        self.received = False
+        self.on_first_read = on_first_read
+        self.response_done = asyncio.Event()
+
+    async def read(self) -> bytes:
+        if self.done:
+            return b''
+        if self.on_first_read is not None:
+            await self.on_first_read()
+            self.on_first_read = None
+        if not self.chunked:
+            data = await asyncio.wait_for(self.reader.read(min(self.remaining, READ_CHUNK)), self.timeout)
+            if not data:
+                raise ConnectionError("读取请求体时连接断开")
+            self.remaining -= len(data)
+            self.done = self.remaining == 0
+            return data
+        if self.remaining == 0:
+            size_line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            try:
+                self.remaining = int(size_line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise BadRequest("无效的分块长度")
+            if self.remaining == 0:
+                # 跳过 trailer
+                while (await asyncio.wait_for(self.reader.readline(), self.timeout)).strip():
+                    pass
+                self.done = True
+                return b''
+        data = await asyncio.wait_for(self.reader.read(min(self.remaining, READ_CHUNK)), self.timeout)
+        if not data:
+            raise ConnectionError("读取请求体时连接断开")
+        self.remaining -= len(data)
+        if self.remaining == 0:
+            await asyncio.wait_for(self.reader.readexactly(2), self.timeout)
+        return data
+
+    async def receive(self) -> Dict:
+        if not self.done or not self.received:
+            self.received = True
+            data = await self.read()
+            return {'type': 'http.request', 'body': data, 'more_body': not self.done}
+        # 请求体已读完：等到响应结束再通知断开
+        await self.response_done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def drain(self) -> bool:
+        """读掉应用没有读完的请求体，返回连接能否继续复用"""
+        drained = 0
+        while not self.done:
+            drained += len(await self.read())
+            if drained > MAX_DRAIN_BYTES:
+                return False
+        return True
+
+
+class _ResponseWriter:
+    """把 ASGI send 消息写成 HTTP/1.1 响应"""
+
+    def __init__(self, writer: asyncio.StreamWriter, method: str, http_version: str, keep_alive: bool,
+                 timeout: Optional[float]):
+        self.writer = writer
+        self.method = method
+        self.http_version = http_version
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.status: Optional[int] = None
+        self.headers: List[Tuple[bytes, bytes]] = []
+        self.started = False
+        self.complete = False
+        self.chunked = False
+        self.has_body = True
+        self.bytes_sent = 0
+
+    async def send(self, message: Dict):
+        if message['type'] == 'http.response.start':
+            if self.status is not None:
+                raise RuntimeError("响应头已发送")
+            self.status = message['status']
+            self.headers = list(message.get('headers', ()))
+        elif message['type'] == 'http.response.body':
+            if self.status is None or self.complete:
+                raise RuntimeError("响应状态无效")
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            out = b''
+            if not self.started:
+                out = self._head(final=not more_body, body_length=len(body))
+            if body and self.has_body:
+                self.bytes_sent += len(body)
+                out += b'%x\r\n%s\r\n' % (len(body), body) if self.chunked else body
+            if not more_body:
+                if self.chunked:
+                    out += b'0\r\n\r\n'
+                self.complete = True
+            if out:
+                self.writer.write(out)
+                await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    def _head(self, final: bool, body_length: int) -> bytes:
+        self.started = True
+        names = {name.lower() for name, _ in self.headers}
+        self.has_body = self.method != 'HEAD' and self.status not in (204, 304) and self.status >= 200
+        extra = []
+        if b'content-length' not in names and self.has_body:
+            if final:
+                # 整个响应体在一条消息中：直接给出长度
+                extra.append((b'content-length', str(body_length).encode()))
+            elif self.http_version == '1.1':
+                self.chunked = True
+                extra.append((b'transfer-encoding', b'chunked'))
+            else:
+                self.keep_alive = False
+        if b'date' not in names:
+            extra.append((b'date', formatdate(usegmt=True).encode()))
+        extra.append((b'connection', b'keep-alive' if self.keep_alive else b'close'))
+        reason = _REASONS.get(self.status, '')
+        lines = [f"HTTP/1.1 {self.status} {reason}".encode('latin-1')]
+        lines += [name + b': ' + value for name, value in self.headers
+                  if name.lower() not in (b'connection', b'transfer-encoding')]
+        lines += [name + b': ' + value for name, value in extra]
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+def _reasons() -> Dict[int, str]:
+    from http import HTTPStatus
+    return {status.value: status.phrase for status in HTTPStatus}
+
+
+_REASONS = _reasons()
+
+
+class AsgiHttpServer:
+    """单个事件循环上的 HTTP/1.1 服务"""
+
+    def __init__(self, app, config, max_requests: int = 0):
+        self.app = app
+        self.keepalive = config.keepalive
+        self.request_timeout = config.timeout or None
+        self.graceful_timeout = config.graceful_timeout
+        self.backlog = config.backlog
+        self.access_log = config.access_log
+        self.max_requests = max_requests
+        self.handled = 0
+        self.stopping = False
+        self._busy = 0
+        self._idle: Set[asyncio.StreamWriter] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._stop_event: Optional[asyncio.Event] = None
+        self._lifespan: Optional[Dict] = None
+
+    def begin_shutdown(self):
+        if not self.stopping:
+            self.stopping = True
+            for writer in list(self._idle):
+                writer.close()
+            if self._stop_event is not None:
+                self._stop_event.set()
+
+    async def serve(self, sock: socket.socket):
+        self._stop_event = asyncio.Event()
+        if self.stopping:
+            self._stop_event.set()
+        await self._startup()
+        server = await asyncio.start_server(self._handle_connection, sock=sock, backlog=self.backlog,
+                                            limit=MAX_HEADER_BYTES)
+        try:
+            await self._stop_event.wait()
+        finally:
+            server.close()
+        deadline = time.monotonic() + self.graceful_timeout
+        while self._busy and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._busy:
+            logger.warning(f"worker {os.getpid()} 等待处理中的请求超时，强制退出")
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._shutdown()
+
+    # ---------- lifespan ----------
+
+    async def _startup(self):
+        queue: asyncio.Queue = asyncio.Queue()
+        startup, shutdown = asyncio.get_running_loop().create_future(), asyncio.get_running_loop().create_future()
+
+        async def send(message):
+            future = startup if message['type'].startswith('lifespan.startup') else shutdown
+            if not future.done():
+                future.set_result(message)
+
+        async def run():
+            try:
+                await self.app({'type': 'lifespan', 'asgi': {'version': '3.0'}}, queue.get, send)
+            except Exception:
+                # 应用不支持 lifespan
+                for future in (startup, shutdown):
+                    if not future.done():
+                        future.set_result(None)
+
+        self._lifespan = {'queue': queue, 'shutdown': shutdown, 'task': asyncio.ensure_future(run())}
+        await queue.put({'type': 'lifespan.startup'})
+        message = await startup
+        if message is not None and message['type'] == 'lifespan.startup.failed':
+            raise RuntimeError(f"应用启动失败: {message.get('message', '')}")
+
+    async def _shutdown(self):
+        if self._lifespan is None:
+            return
+        await self._lifespan['queue'].put({'type': 'lifespan.shutdown'})
+        try:
+            await asyncio.wait_for(self._lifespan['shutdown'], 10)
+        except asyncio.TimeoutError:
+            logger.warning("应用关闭超时")
+
+    # ---------- 连接 ----------
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        peer = writer.get_extra_info('peername') or ('', 0)
+        sockname = writer.get_extra_info('sockname') or ('', 0)
+        try:
+            while not self.stopping:
+                self._idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                  self.keepalive or self.request_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._simple_response(writer, 431)
+                    return
+                finally:
+                    self._idle.discard(writer)
+                self._busy += 1
+                try:
+                    keep_alive = await self._handle_request(head, reader, writer, peer, sockname)
+                finally:
+                    self._busy -= 1
+                if not keep_alive or self.keepalive <= 0:
+                    return
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("处理连接异常")
+        finally:
+            self._tasks.discard(task)
+            self._idle.discard(writer)
+            writer.close()
+
+    async def _simple_response(self, writer: asyncio.StreamWriter, status: int):
+        reason = _REASONS.get(status, '')
+        writer.write(f"HTTP/1.1 {status} {reason}\r\ncontent-length: 0\r\nconnection: close\r\n\r\n".encode())
+        try:
+            await asyncio.wait_for(writer.drain(), self.request_timeout)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+    async def _handle_request(self, head: bytes, reader, writer, peer, sockname) -> bool:
+        """处理一个请求，返回连接能否复用"""
+        start = time.time()
+        try:
+            method, target, http_version, headers = _parse_head(head)
+        except BadRequest:
+            await self._simple_response(writer, 400)
+            return False
+        header_map: Dict[bytes, bytes] = {}
+        for name, value in headers:
+            header_map[name] = value
+        connection = header_map.get(b'connection', b'').lower()
+        keep_alive = http_version == '1.1' and b'close' not in connection and not self.stopping
+
+        chunked = b'chunked' in header_map.get(b'transfer-encoding', b'').lower()
+        try:
+            length = 0 if chunked else int(header_map.get(b'content-length', b'0'))
+        except ValueError:
+            await self._simple_response(writer, 400)
+            return False
+
+        async def send_continue():
+            if header_map.get(b'expect', b'').lower() == b'100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                await writer.drain()
+
+        body = _RequestBody(reader, length, chunked, self.request_timeout, send_continue)
+        response = _ResponseWriter(writer, method, http_version, keep_alive, self.request_timeout)
+        path, _, query = target.partition(b'?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': http_version,
+            'method': method,
+            'scheme': 'http',
+            'path': unquote(path.decode('latin-1')),
+            'raw_path': path,
+            'query_string': query,
+            'root_path': '',
+            'headers': headers,
+            'client': peer[:2],
+            'server': sockname[:2],
+        }
+
+        self.handled += 1
+        if self.max_requests and self.handled == self.max_requests:
+            logger.info(f"worker {os.getpid()} 已处理 {self.handled} 个请求，平滑重启")
+            self.begin_shutdown()
+
+        try:
+            await self.app(scope, body.receive, response.send)
+        except (ConnectionError, asyncio.TimeoutError):
+            return False
+        except Exception:
+            logger.exception("应用处理请求异常: %s %s", method, scope['path'])
+            if not response.started:
+                response.status, response.headers, response.keep_alive = 500, [], False
+                await response.send({'type': 'http.response.body', 'body': b''})
+            return False
+        finally:
+            body.response_done.set()
+            if self.access_log:
+                logger.info('%s - "%s %s HTTP/%s" %s %s %.3fs', peer[0], method, target.decode('latin-1'),
+                            http_version, response.status, response.bytes_sent, time.time() - start)
+
+        if not response.complete:
+            return False
+        if not response.keep_alive or self.stopping:
+            return False
+        try:
+            return await body.drain()
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, BadRequest):
+            return False
+
+
+def _parse_head(head: bytes) -> Tuple[str, bytes, str, List[Tuple[bytes, bytes]]]:
+    lines = head[:-4].split(b'\r\n')
+    parts = lines[0].split(b' ')
+    if len(parts) != 3 or not parts[2].startswith(b'HTTP/1.'):
+        raise BadRequest()
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep or not name or name != name.strip():
+            raise BadRequest()
+        headers.append((name.lower(), value.strip()))
+    return parts[0].decode('latin-1'), parts[1], parts[2][5:].decode('latin-1'), headers
+
+
+def serve_asgi_worker(config, fd: Optional[int] = None, worker_id: int = 0, show_startup_info: bool = True):
+    """在当前进程中运行一个 ASGI worker，返回时已停止"""
+    os.environ.setdefault('ASGI_BRIDGE_THREADS', str(config.threads))
+    from server import load_app
+    load_app(show_startup_info)
+    import asgi_app
+
+    if fd is not None:
+        sock = socket.socket(fileno=os.dup(fd))
+    else:
+        family = socket.AF_INET6 if ':' in config.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((config.host, config.port))
+        sock.listen(config.backlog)
+    sock.setblocking(False)
+
+    server = AsgiHttpServer(asgi_app.app, config, max_requests=config.worker_max_requests())
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, server.begin_shutdown)
+        if fd is None:
+            loop.add_signal_handler(signal.SIGINT, server.begin_shutdown)
+        else:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        logger.info(f"worker {worker_id} (pid {os.getpid()}) 开始处理请求: ASGI，桥接线程={config.threads}")
+        await server.serve(sock)
+
+    asyncio.run(main())
+    logger.info(f"worker {os.getpid()} 已停止，共处理 {server.handled} 个请求")
@@ -0,0 +1,402 @@
+"""基于 asyncio 的 HTTP/1.1 客户端
+
+ASGI 网关模式访问上游时使用：按 (协议, 主机, 端口, 代理) 复用 keep-alive 连接，等待上游时不占用线程。
+支持 HTTPS（与同步路径的 verify=False 一致，不校验证书）、HTTP 代理（HTTPS 目标走 CONNECT 隧道）、
+Content-Length / chunked / 读到关闭 三种响应体，以及 gzip、deflate（安装了 brotli 时还有 br）解压。
+不支持 SOCKS 代理，调用方先用 supports_proxy() 判断，不支持时回退到同步实现。
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import ssl
+import time
+import zlib
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Iterable, Optional, Tuple, Union
+from urllib.parse import unquote, urljoin, urlsplit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('gemini_pool.async_http')
+
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+READ_CHUNK = 64 * 1024
+MAX_HEADER_BYTES = 64 * 1024
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+Body = Union[None, bytes, Iterable[bytes]]
+
+
+class HTTPError(Exception):
+    """上游响应不符合 HTTP/1.1 协议，或连接在响应结束前关闭"""
+
+
+class ProxyNotSupported(HTTPError):
+    """代理类型不受支持（SOCKS 等）"""
+
+
+def supports_proxy(proxy: Optional[str]) -> bool:
+    if not proxy:
+        return True
+    scheme = urlsplit(proxy).scheme.lower()
+    return scheme == 'http' or (scheme == 'https' and hasattr(asyncio.StreamWriter, 'start_tls'))
+
+
+def _insecure_ssl_context() -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class _Decoder:
+    """按 Content-Encoding 增量解压"""
+
+    def __init__(self, encoding: str):
+        encoding = encoding.strip().lower()
+        if encoding in ('', 'identity'):
+            self._decompress = None
+        elif encoding in ('gzip', 'x-gzip'):
+            self._decompress = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+        elif encoding == 'deflate':
+            self._decompress = zlib.decompressobj(zlib.MAX_WBITS).decompress
+        elif encoding == 'br' and brotli is not None:
+            self._decompress = brotli.Decompressor().process
+        else:
+            raise HTTPError(f"不支持的 Content-Encoding: {encoding}")
+
+    def decode(self, data: bytes) -> bytes:
+        return self._decompress(data) if self._decompress is not None else data
+
+
+class _Connection:
+    def __init__(self, key: Tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = time.monotonic()
+        self.reused = False
+
+    def usable(self, idle_timeout: float) -> bool:
+        return (not self.reader.at_eof() and not self.writer.is_closing()
+                and time.monotonic() - self.idle_since < idle_timeout)
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncResponse:
+    """上游响应；响应体读完后连接自动放回连接池，中途放弃时调用 aclose() 关闭连接"""
+
+    def __init__(self, client: 'AsyncHTTPClient', conn: _Connection, method: str, status: int,
+                 reason: str, headers: Dict[str, str], read_timeout: Optional[float]):
+        self._client = client
+        self._conn: Optional[_Connection] = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.read_timeout = read_timeout
+        self.content: Optional[bytes] = None
+        self._decoder = _Decoder(headers.get('content-encoding', ''))
+        self._keep_alive = headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            self._mode, self._remaining = 'length', 0
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            self._mode, self._remaining = 'chunked', 0
+        elif 'content-length' in headers:
+            self._mode, self._remaining = 'length', int(headers['content-length'])
+        else:
+            self._mode, self._remaining = 'close', 0
+            self._keep_alive = False
+        self._done = False
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self.read_timeout)
+
+    async def _raw_chunks(self) -> AsyncIterator[bytes]:
+        reader = self._conn.reader
+        if self._mode == 'length':
+            while self._remaining > 0:
+                data = await self._read(reader.read(min(self._remaining, READ_CHUNK)))
+                if not data:
+                    raise HTTPError("响应体未读完连接已关闭")
+                self._remaining -= len(data)
+                yield data
+        elif self._mode == 'chunked':
+            while True:
+                line = await self._read(reader.readline())
+                if not line:
+                    raise HTTPError("chunked 响应体未读完连接已关闭")
+                size = int(line.split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    # 跳过 trailer
+                    while (await self._read(reader.readline())) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                yield await self._read(reader.readexactly(size))
+                await self._read(reader.readexactly(2))
+        else:
+            while True:
+                data = await self._read(reader.read(READ_CHUNK))
+                if not data:
+                    break
+                yield data
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        """逐块读取（已解压的）响应体"""
+        if self._conn is None:
+            if self.content is not None:
+                yield self.content
+            return
+        try:
+            async for data in self._raw_chunks():
+                data = self._decoder.decode(data)
+                if data:
+                    yield data
+        except BaseException:
+            self.aclose()
+            raise
+        self._done = True
+        self._release()
+
+    async def iter_lines(self) -> AsyncIterator[bytes]:
+        """按行读取响应体（与 requests 的 iter_lines 相同，按 \\r、\\n、\\r\\n 分行，不含换行符）"""
+        pending = b''
+        async for data in self.iter_chunks():
+            lines = (pending + data).splitlines(keepends=True)
+            pending = lines.pop() if lines and not lines[-1].endswith((b'\n', b'\r')) else b''
+            for line in lines:
+                yield line.rstrip(b'\r\n')
+        if pending:
+            yield pending
+
+    async def read(self) -> bytes:
+        if self.content is None:
+            self.content = b''.join([data async for data in self.iter_chunks()])
+        return self.content
+
+    @property
+    def text(self) -> str:
+        return (self.content or b'').decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content or b'')
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HTTPError(f"{self.status} {self.reason}")
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            if self._done and self._keep_alive:
+                self._client._put(conn)
+            else:
+                conn.close()
+
+    def aclose(self):
+        """放弃未读完的响应体并关闭连接"""
+        self._release()
+
+
+class AsyncHTTPClient:
+    """带连接池的异步 HTTP/1.1 客户端"""
+
+    def __init__(self, max_idle_per_host: int = 32, idle_timeout: float = 60.0, connect_timeout: float = 15.0):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._idle: Dict[Tuple, Deque[_Connection]] = {}
+        self._ssl = _insecure_ssl_context()
+        self.stats = {'connections': 0, 'reused': 0, 'requests': 0}
+
+    # ---------- 连接池 ----------
+
+    def _take(self, key: Tuple) -> Optional[_Connection]:
+        idle = self._idle.get(key)
+        while idle:
+            conn = idle.pop()
+            if conn.usable(self.idle_timeout):
+                conn.reused = True
+                return conn
+            conn.close()
+        return None
+
+    def _put(self, conn: _Connection):
+        idle = self._idle.setdefault(conn.key, deque())
+        if len(idle) >= self.max_idle_per_host:
+            idle.popleft().close()
+        conn.idle_since = time.monotonic()
+        idle.append(conn)
+
+    async def _connect(self, key: Tuple) -> _Connection:
+        scheme, host, port, proxy = key
+        tls = self._ssl if scheme == 'https' else None
+        if not proxy:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=tls, server_hostname=host if tls else None),
+                self.connect_timeout)
+        else:
+            proxy_url = urlsplit(proxy)
+            if not supports_proxy(proxy):
+                raise ProxyNotSupported(f"不支持的代理: {proxy_url.scheme}")
+            proxy_tls = self._ssl if proxy_url.scheme == 'https' else None
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(proxy_url.hostname, proxy_url.port or (443 if proxy_tls else 80),
+                                        ssl=proxy_tls, server_hostname=proxy_url.hostname if proxy_tls else None),
+                self.connect_timeout)
+            if tls is not None:
+                await self._tunnel(reader, writer, host, port, proxy)
+                await asyncio.wait_for(writer.start_tls(tls, server_hostname=host), self.connect_timeout)
+        self.stats['connections'] += 1
+        return _Connection(key, reader, writer)
+
+    async def _tunnel(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      host: str, port: int, proxy: str):
+        lines = [f"CONNECT {host}:{port} HTTP/1.1", f"Host: {host}:{port}"]
+        auth = _proxy_authorization(proxy)
+        if auth:
+            lines.append(f"Proxy-Authorization: {auth}")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.connect_timeout)
+        status = head.split(b' ', 2)[1] if head.count(b' ') >= 1 else b''
+        if status != b'200':
+            writer.close()
+            raise HTTPError(f"代理 CONNECT 失败: {head.splitlines()[0].decode('latin-1', 'replace')}")
+
+    def close(self):
+        for idle in self._idle.values():
+            while idle:
+                idle.pop().close()
+        self._idle.clear()
+
+    # ---------- 请求 ----------
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                      json_body=None, data: Body = None, proxy: Optional[str] = None,
+                      timeout: Optional[float] = 60.0) -> AsyncResponse:
+        """发送请求并在收到响应头后返回；timeout 作用于连接、发送和每次读取"""
+        split = urlsplit(url)
+        scheme = split.scheme.lower()
+        port = split.port or (443 if scheme == 'https' else 80)
+        key = (scheme, split.hostname, port, proxy or None)
+        if json_body is not None:
+            data = json.dumps(json_body).encode('utf-8')
+        target = url if proxy and scheme == 'http' else (split.path or '/') + (f"?{split.query}" if split.query else '')
+        head = self._build_head(method, target, split, headers or {}, data, proxy if scheme == 'http' else None)
+        self.stats['requests'] += 1
+
+        for attempt in (0, 1):
+            conn = self._take(key) or await self._connect(key)
+            try:
+                await asyncio.wait_for(self._send(conn, head, data), timeout)
+                response = await asyncio.wait_for(self._read_head(conn, method, timeout), timeout)
+            except (ConnectionError, asyncio.IncompleteReadError, HTTPError) as e:
+                conn.close()
+                # 空闲连接可能已被上游关闭：可重放的请求体换新连接重试一次
+                if attempt == 0 and conn.reused and (data is None or isinstance(data, bytes)) \
+                        and not isinstance(e, ProxyNotSupported):
+                    logger.debug("复用连接失败，重新连接: %s", e)
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            if conn.reused:
+                self.stats['reused'] += 1
+            return response
+        raise HTTPError("unreachable")
+
+    def _build_head(self, method: str, target: str, split, headers: Dict[str, str], data: Body,
+                    proxy: Optional[str]) -> bytes:
+        merged = {k.lower(): v for k, v in headers.items()}
+        merged['host'] = split.netloc.rsplit('@', 1)[-1]
+        merged['accept-encoding'] = ACCEPT_ENCODING
+        merged['connection'] = 'keep-alive'
+        if data is not None:
+            if isinstance(data, bytes) or hasattr(data, '__len__'):
+                merged['content-length'] = str(len(data))
+            else:
+                merged['transfer-encoding'] = 'chunked'
+        elif method in ('POST', 'PUT', 'PATCH'):
+            merged['content-length'] = '0'
+        if proxy:
+            auth = _proxy_authorization(proxy)
+            if auth:
+                merged['proxy-authorization'] = auth
+        lines = [f"{method} {target} HTTP/1.1"] + [f"{k}: {v}" for k, v in merged.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _send(self, conn: _Connection, head: bytes, data: Body):
+        writer = conn.writer
+        if data is None or isinstance(data, bytes):
+            writer.write(head + (data or b''))
+            await writer.drain()
+            return
+        writer.write(head)
+        chunked = not hasattr(data, '__len__')
+        for chunk in data:
+            if not chunk:
+                continue
+            writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+            await writer.drain()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    async def _read_head(self, conn: _Connection, method: str, read_timeout: Optional[float]) -> AsyncResponse:
+        while True:
+            try:
+                head = await conn.reader.readuntil(b'\r\n\r\n')
+            except asyncio.LimitOverrunError:
+                raise HTTPError("响应头过长")
+            if len(head) > MAX_HEADER_BYTES:
+                raise HTTPError("响应头过长")
+            lines = head.decode('latin-1').split('\r\n')
+            parts = lines[0].split(' ', 2)
+            if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+                raise HTTPError(f"无效的响应行: {lines[0][:100]}")
+            status = int(parts[1])
+            if status == 100:
+                continue
+            headers: Dict[str, str] = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    name = name.strip().lower()
+                    value = value.strip()
+                    headers[name] = f"{headers[name]}, {value}" if name in headers else value
+            if parts[0] == 'HTTP/1.0' and 'keep-alive' not in headers.get('connection', '').lower():
+                headers['connection'] = 'close'
+            return AsyncResponse(self, conn, method, status, parts[2] if len(parts) > 2 else '',
+                                 headers, read_timeout)
+
+    async def get(self, url: str, follow_redirects: bool = False, **kwargs) -> AsyncResponse:
+        """GET 请求；follow_redirects 时与 requests.get 一样跟随重定向（最多 MAX_REDIRECTS 次）"""
+        response = await self.request('GET', url, **kwargs)
+        for _ in range(MAX_REDIRECTS if follow_redirects else 0):
+            location = response.headers.get('location')
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+            await response.read()
+            url = urljoin(url, location)
+            response = await self.request('GET', url, **kwargs)
+        return response
+
+    async def post(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request('POST', url, **kwargs)
+
+
+def _proxy_authorization(proxy: str) -> Optional[str]:
+    split = urlsplit(proxy)
+    if not split.username:
+        return None
+    credentials = f"{unquote(split.username)}:{unquote(split.password or '')}"
+    return 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
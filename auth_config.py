@@ -0,0 +1,165 @@
+"""Business Gemini Pool 鉴权配置缓存
+在内存中保存鉴权配置快照，仅在 .env 文件修改时间变化、收到 SIGHUP
+或管理接口主动触发时重新加载，避免每个请求都读取并解析 .env
+"""
+
+import hmac
+import logging
+import os
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+logger = logging.getLogger('gemini_pool.auth')
+
+# 与启动时相同的 .env 查找顺序
+ENV_FILES = ['.env', '.env.local', '.env.production']
+
+
+@dataclass(frozen=True)
+class AuthConfig:
+    """鉴权配置快照（不可变，读取时无需加锁）"""
+    require_auth: bool
+    required_api_key: str
+    config_valid: bool
+    source: Optional[str] = None
+    source_mtime: Optional[float] = None
+    loaded_at: float = 0.0
+
+    def verify_key(self, provided_api_key: str) -> bool:
+        """常量时间比较API密钥"""
+        if not provided_api_key or not self.required_api_key:
+            return False
+        return hmac.compare_digest(provided_api_key.encode('utf-8'),
+                                   self.required_api_key.encode('utf-8'))
+
+
+def _find_env_file(env_files: List[str]) -> Optional[Path]:
+    for env_file in env_files:
+        path = Path(env_file)
+        if path.exists():
+            return path
+    return None
+
+
+class AuthConfigManager:
+    """鉴权配置管理器
+
+    get() 为请求热路径：在 check_interval 秒内直接返回快照，
+    超过间隔后仅 stat 一次 .env 文件，mtime 变化才重新解析
+    """
+
+    def __init__(self, env_files: Optional[List[str]] = None, check_interval: float = 1.0):
+        self.env_files = list(env_files or ENV_FILES)
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.reload_count = 0
+        self._next_check = 0.0
+        self._config = self._load()
+        logger.info(f"[认证] 配置已加载: REQUIRE_AUTH={self._config.require_auth}, "
+                    f"API_KEY={'*' * 10 if self._config.required_api_key else 'NOT_SET'}")
+
+    def _load(self) -> AuthConfig:
+        """读取 .env（如存在）并从环境变量构建配置快照"""
+        env_path = _find_env_file(self.env_files)
+        mtime = None
+        if env_path is not None:
+            try:
+                mtime = env_path.stat().st_mtime
+                from dotenv import load_dotenv
+                load_dotenv(env_path, override=True)
+            except ImportError:
+                pass
+            except Exception as e:
+                logger.warning(f"读取 {env_path} 失败: {e}")
+
+        require_auth = os.getenv('REQUIRE_AUTH', 'false').lower() == 'true'
+        required_api_key = os.getenv('DOWNSTREAM_API_KEY', '')
+        return AuthConfig(
+            require_auth=require_auth,
+            required_api_key=required_api_key,
+            config_valid=require_auth and bool(required_api_key),
+            source=str(env_path) if env_path else None,
+            source_mtime=mtime,
+            loaded_at=time.time()
+        )
+
+    def _swap(self, new_config: AuthConfig, reason: str):
+        old = self._config
+        self._config = new_config
+        self.reload_count += 1
+        if (old.require_auth != new_config.require_auth
+                or old.required_api_key != new_config.required_api_key):
+            logger.info(f"[认证] 配置已更新({reason}): REQUIRE_AUTH={new_config.require_auth}, "
+                        f"API_KEY={'*' * 10 if new_config.required_api_key else 'NOT_SET'}")
+
+    def reload(self, reason: str = "manual") -> AuthConfig:
+        """强制重新加载配置"""
+        with self.lock:
+            self._swap(self._load(), reason)
+            self._next_check = time.monotonic() + self.check_interval
+            return self._config
+
+    def _source_changed(self) -> bool:
+        env_path = _find_env_file(self.env_files)
+        source = str(env_path) if env_path else None
+        if source != self._config.source:
+            return True
+        if env_path is None:
+            return False
+        try:
+            return env_path.stat().st_mtime != self._config.source_mtime
+        except OSError:
+            return True
+
+    def get(self) -> AuthConfig:
+        """获取当前配置快照"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._config
+        # 只允许一个线程执行文件检查，其余线程直接使用旧快照
+        if self.lock.acquire(blocking=False):
+            try:
+                self._next_check = now + self.check_interval
+                if self._source_changed():
+                    self._swap(self._load(), "file changed")
+            finally:
+                self.lock.release()
+        return self._config
+
+    def install_sighup_handler(self) -> bool:
+        """注册 SIGHUP 信号处理器以重新加载配置（仅主线程、非Windows可用）"""
+        if not hasattr(signal, 'SIGHUP'):
+            return False
+        if threading.current_thread() is not threading.main_thread():
+            return False
+
+        previous = signal.getsignal(signal.SIGHUP)
+
+        def handler(signum, frame):
+            # 信号处理器中不持锁执行IO，交给后台线程完成
+            threading.Thread(target=self.reload, args=("SIGHUP",), daemon=True).start()
+            if callable(previous) and previous not in (signal.SIG_IGN, signal.SIG_DFL):
+                previous(signum, frame)
+
+        try:
+            signal.signal(signal.SIGHUP, handler)
+        except (ValueError, OSError):
+            return False
+        return True
+
+
+# 全局鉴权配置管理器
+_auth_config_manager = None
+
+
+def get_auth_config_manager() -> AuthConfigManager:
+    """获取全局鉴权配置管理器实例"""
+    global _auth_config_manager
+    if _auth_config_manager is None:
+        interval = float(os.getenv('AUTH_CONFIG_CHECK_INTERVAL', '1.0'))
+        _auth_config_manager = AuthConfigManager(check_interval=interval)
+    return _auth_config_manager
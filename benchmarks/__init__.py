@@ -0,0 +1 @@
+"""Business Gemini Pool 性能基准测试"""
@@ -0,0 +1,99 @@
+"""鉴权开销基准测试
+
+对比旧实现（每个请求 load_dotenv(override=True) + 字符串比较）
+与新实现（内存快照 + hmac.compare_digest）的单请求鉴权开销
+
+用法: python -m benchmarks.bench_auth [--iterations 20000] [--output result.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from auth_config import AuthConfigManager
+
+
+API_KEY = "bench-api-key-0123456789abcdef"
+
+
+def legacy_auth(provided_api_key: str) -> bool:
+    """旧实现：每次请求重新解析 .env"""
+    from dotenv import load_dotenv
+    load_dotenv(override=True)
+    require_auth = os.getenv('REQUIRE_AUTH', 'false').lower() == 'true'
+    required_api_key = os.getenv('DOWNSTREAM_API_KEY', '')
+    if not require_auth:
+        return True
+    return provided_api_key == required_api_key
+
+
+def measure(fn, iterations: int) -> dict:
+    """执行 iterations 次并返回每次调用耗时统计（微秒）"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        fn()
+        samples.append((time.perf_counter_ns() - start) / 1000)
+    samples.sort()
+    return {
+        'iterations': iterations,
+        'mean_us': round(statistics.fmean(samples), 3),
+        'p50_us': round(samples[len(samples) // 2], 3),
+        'p99_us': round(samples[int(len(samples) * 0.99) - 1], 3),
+        'max_us': round(samples[-1], 3),
+    }
+
+
+def run(iterations: int) -> dict:
+    workdir = tempfile.mkdtemp(prefix='bench_auth_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        # 使用与生产配置相近大小的 .env
+        Path('.env').write_text(
+            "\n".join([f"# comment line {i}" for i in range(40)] + [
+                "REQUIRE_AUTH=true",
+                f"DOWNSTREAM_API_KEY={API_KEY}",
+                "PROXY_URL=http://127.0.0.1:7890",
+                "ACCOUNTS_CONFIG='[]'",
+            ]) + "\n",
+            encoding='utf-8'
+        )
+        manager = AuthConfigManager(check_interval=1.0)
+
+        legacy = measure(lambda: legacy_auth(API_KEY), iterations)
+        cached = measure(lambda: manager.get().verify_key(API_KEY), iterations)
+    finally:
+        os.chdir(cwd)
+
+    return {
+        'benchmark': 'auth_overhead',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'legacy_load_dotenv': legacy,
+        'cached_snapshot': cached,
+        'speedup_mean': round(legacy['mean_us'] / max(cached['mean_us'], 1e-9), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='鉴权开销基准测试')
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--output', help='结果JSON输出路径')
+    args = parser.parse_args()
+
+    result = run(args.iterations)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+"""端到端基准测试
+
+启动本地模拟上游（进程内）和网关（子进程，运行在临时目录中，不影响本地数据库和图片缓存），
+按场景和并发度压测网关，统计 RPS、延迟分位数、流式首字节时间和网关内存，结果写为 JSON。
+
+场景: text（非流式聊天）、stream（流式聊天）、image（生图 + 图片下载保存）、
+      inline_image（消息内嵌 base64 图片）、upload（/v1/files 上传）
+
+用法:
+    python -m benchmarks.bench_e2e --scenarios text,stream --concurrency 1,8,32 --requests 200 --output e2e.json
+    # 压测已运行的网关（网关需以 GEMINI_API_ORIGIN/GEMINI_AUTH_ORIGIN 指向 --mock-port 上的模拟上游）
+    python -m benchmarks.bench_e2e --target http://127.0.0.1:7860 --mock-port 8990 --gateway-pid 1234
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.mock_upstream import MockUpstream, add_config_arguments, config_from_args, make_png
+
+ROOT = Path(__file__).resolve().parent.parent
+API_KEY = "bench-api-key-0123456789abcdef"
+SCENARIOS = ('text', 'stream', 'image', 'inline_image', 'upload')
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_rss_mb(pid: Optional[int]) -> Optional[float]:
+    """读取进程常驻内存（MB），仅支持 Linux"""
+    if not pid:
+        return None
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def read_tree_rss_mb(pid: Optional[int]) -> Optional[float]:
+    """读取进程及其所有子进程（多 worker 服务）的常驻内存之和（MB），仅支持 Linux"""
+    total = read_rss_mb(pid)
+    if total is None:
+        return None
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(c) for c in f.read().split()]
+    except OSError:
+        return total
+    for child in children:
+        total += read_tree_rss_mb(child) or 0.0
+    return round(total, 1)
+
+
+class GatewayProcess:
+    """在临时目录中以子进程运行网关
+
+    默认使用 Flask 开发服务器（app.run）；传入 server_args 时改用 server.py 启动，参数原样传给 server.py。
+    """
+
+    def __init__(self, upstream_origin: str, accounts: int, extra_env: Optional[Dict[str, str]] = None,
+                 server_args: Optional[List[str]] = None):
+        self.workdir = Path(tempfile.mkdtemp(prefix='bench_gateway_'))
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.upstream_origin = upstream_origin
+        self.accounts = accounts
+        self.extra_env = extra_env or {}
+        self.server_args = server_args
+        self.process: Optional[subprocess.Popen] = None
+        self.log_path = self.workdir / 'gateway.log'
+
+    def _prepare(self):
+        for pattern in ('*.py', '*.sql', '*.html'):
+            for path in ROOT.glob(pattern):
+                shutil.copy2(path, self.workdir / path.name)
+
+    def start(self, timeout: float = 60.0) -> 'GatewayProcess':
+        self._prepare()
+        accounts = [{
+            'team_id': f'bench-team-{i}',
+            'secure_c_ses': f'bench-ses-{i}',
+            'host_c_oses': f'bench-oses-{i}',
+            'csesidx': str(100000 + i),
+            'user_agent': 'bench',
+        } for i in range(self.accounts)]
+        env = dict(os.environ)
+        env.update({
+            'GEMINI_API_ORIGIN': self.upstream_origin,
+            'GEMINI_AUTH_ORIGIN': self.upstream_origin,
+            'ACCOUNTS_CONFIG': json.dumps(accounts),
+            'REQUIRE_AUTH': 'true',
+            'DOWNSTREAM_API_KEY': API_KEY,
+            'PROXY_URL': '',
+            'LOG_LEVEL': 'WARNING',
+            'PYTHONUNBUFFERED': '1',
+        })
+        env.update(self.extra_env)
+        if self.server_args is None:
+            code = f"import gemini; gemini.app.run(host='127.0.0.1', port={self.port}, threaded=True)"
+            command = [sys.executable, '-c', code]
+        else:
+            command = [sys.executable, 'server.py', '--host', '127.0.0.1', '--port', str(self.port),
+                       *self.server_args]
+        self.log_file = open(self.log_path, 'wb')
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=env,
+                                        stdout=self.log_file, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"网关启动失败，日志: {self.log_path}")
+            try:
+                if requests.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"网关启动超时，日志: {self.log_path}")
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self.process.pid if self.process else None
+
+    def stop(self, keep: bool = False):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.log_file.close()
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class MemorySampler:
+    """后台定期采样网关内存（tree=True 时包含所有 worker 子进程）"""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.1, tree: bool = False):
+        self.pid = pid
+        self.read = read_tree_rss_mb if tree else read_rss_mb
+        self.interval = interval
+        self.samples: List[float] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = self.read(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start_mb = self.read(self.pid)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.end_mb = self.read(self.pid)
+
+    def result(self) -> Optional[Dict[str, float]]:
+        if self.start_mb is None:
+            return None
+        return {'start_mb': self.start_mb, 'peak_mb': max(self.samples, default=self.start_mb),
+                'end_mb': self.end_mb}
+
+
+# ---------- 场景 ----------
+
+class Scenario:
+    """一个压测场景：send() 发送一次请求，返回 (是否成功, 首字节耗时秒)"""
+
+    def __init__(self, name: str, base_url: str, args):
+        self.name = name
+        self.base_url = base_url
+        self.model = args.model
+        self.headers = {'Authorization': f'Bearer {API_KEY}'}
+        self.inline_image = None
+        self.upload_body = None
+        if name == 'inline_image':
+            png = make_png(args.inline_image_bytes)
+            self.inline_image = f"data:image/png;base64,{base64.b64encode(png).decode()}"
+        if name == 'upload':
+            self.upload_body = make_png(args.upload_bytes)
+
+    def _chat(self, session: requests.Session, content, stream: bool = False):
+        body = {'model': self.model, 'stream': stream, 'messages': [{'role': 'user', 'content': content}]}
+        return session.post(f"{self.base_url}/v1/chat/completions", json=body, headers=self.headers,
+                            timeout=300, stream=stream)
+
+    def send(self, session: requests.Session):
+        start = time.perf_counter()
+        if self.name == 'text':
+            resp = self._chat(session, 'benchmark text request')
+        elif self.name == 'stream':
+            resp = self._chat(session, 'benchmark stream request', stream=True)
+            ttfb = None
+            ok = resp.status_code == 200
+            for line in resp.iter_lines():
+                if ttfb is None and line:
+                    ttfb = time.perf_counter() - start
+            return ok, ttfb
+        elif self.name == 'image':
+            resp = self._chat(session, '画一只猫 (benchmark image request)')
+        elif self.name == 'inline_image':
+            resp = self._chat(session, [
+                {'type': 'text', 'text': 'describe this image'},
+                {'type': 'image_url', 'image_url': {'url': self.inline_image}},
+            ])
+        else:
+            resp = session.post(f"{self.base_url}/v1/files", headers=self.headers, timeout=300,
+                                files={'file': ('bench.png', self.upload_body, 'image/png')},
+                                data={'purpose': 'assistants'})
+        _ = resp.content
+        return resp.status_code == 200, None
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(len(sorted_values) * p / 100.0) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    values = sorted(samples)
+    ms = lambda v: round(v * 1000, 2)
+    return {
+        'p50': ms(percentile(values, 50)),
+        'p90': ms(percentile(values, 90)),
+        'p99': ms(percentile(values, 99)),
+        'max': ms(values[-1]) if values else 0.0,
+        'mean': ms(sum(values) / len(values)) if values else 0.0,
+    }
+
+
+def run_load(scenario: Scenario, concurrency: int, total: int, warmup: int, pid: Optional[int],
+             tree: bool = False) -> Dict:
+    """以固定并发发送 total 个请求（先发送 warmup 个预热请求，不计入结果）"""
+    local = threading.local()
+
+    def get_session() -> requests.Session:
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        return session
+
+    def one(_) -> tuple:
+        start = time.perf_counter()
+        try:
+            ok, ttfb = scenario.send(get_session())
+        except requests.RequestException:
+            ok, ttfb = False, None
+        return ok, time.perf_counter() - start, ttfb
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(warmup)))
+        with MemorySampler(pid, tree=tree) as memory:
+            started = time.perf_counter()
+            results = list(pool.map(one, range(total)))
+            elapsed = time.perf_counter() - started
+
+    latencies = [r[1] for r in results if r[0]]
+    ttfbs = [r[2] for r in results if r[0] and r[2] is not None]
+    result = {
+        'scenario': scenario.name,
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': sum(1 for r in results if not r[0]),
+        'elapsed_s': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': latency_summary(latencies),
+        'memory': memory.result(),
+    }
+    if ttfbs:
+        result['ttfb_ms'] = latency_summary(ttfbs)
+    return result
+
+
+def run(args) -> Dict:
+    mock = MockUpstream(config_from_args(args), port=args.mock_port).start()
+    gateway = None
+    try:
+        if args.target:
+            base_url, pid = args.target.rstrip('/'), args.gateway_pid
+        else:
+            gateway = GatewayProcess(mock.origin, args.accounts).start()
+            base_url, pid = gateway.url, gateway.pid
+
+        results = []
+        for name in args.scenarios:
+            scenario = Scenario(name, base_url, args)
+            for concurrency in args.concurrency:
+                result = run_load(scenario, concurrency, args.requests, args.warmup, pid)
+                results.append(result)
+                lat = result['latency_ms']
+                print(f"{name:<13} c={concurrency:<4} rps={result['rps']:<8} p50={lat['p50']:<8} "
+                      f"p99={lat['p99']:<8} errors={result['errors']}", file=sys.stderr)
+    finally:
+        if gateway is not None:
+            gateway.stop(keep=args.keep)
+        mock.stop()
+
+    return {
+        'benchmark': 'e2e',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'target': args.target or 'subprocess',
+        'accounts': args.accounts,
+        'upstream': mock.state.config.to_dict(),
+        'upstream_calls': mock.stats(),
+        'results': results,
+    }
+
+
+def parse_list(value: str, cast: Callable = str) -> list:
+    return [cast(v.strip()) for v in value.split(',') if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端基准测试（本地模拟上游）')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), type=parse_list,
+                        help=f"逗号分隔，可选: {','.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', default='1,8,32', type=lambda v: parse_list(v, int))
+    parser.add_argument('--requests', type=int, default=200, help='每个场景/并发度的请求数')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--accounts', type=int, default=4, help='模拟账号数')
+    parser.add_argument('--model', default='gemini-enterprise')
+    parser.add_argument('--inline-image-bytes', type=int, default=512 * 1024)
+    parser.add_argument('--upload-bytes', type=int, default=1024 * 1024)
+    parser.add_argument('--target', help='压测已运行的网关，不启动子进程')
+    parser.add_argument('--gateway-pid', type=int, help='--target 模式下用于采样内存的网关进程号')
+    parser.add_argument('--mock-port', type=int, default=0, help='模拟上游端口（默认随机）')
+    parser.add_argument('--keep', action='store_true', help='保留网关临时目录（含日志）')
+    parser.add_argument('--output', help='结果JSON输出路径')
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {','.join(sorted(unknown))}")
+
+    result = run(args)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
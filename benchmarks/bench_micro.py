@@ -0,0 +1,233 @@
+"""请求热路径微基准测试
+
+测量每个请求都会执行的 CPU 密集函数：create_jwt、kq_encode、parse_base64_data_url、
+extract_images_from_openai_content、build_openai_response_content 和上游响应解析
+（parse_stream_assist_response），使用接近真实的数据（多张大图、长对话历史、大响应）。
+
+每个用例自动校准循环次数，重复多轮取最优和中位数；可保存为基线并与基线对比，
+超过阈值的退化以非零退出码返回，便于在 CI 中防止回退。
+仓库中的 benchmarks/micro_baseline.json 记录于参考机器（Python 与平台信息见文件内），
+在不同机器上对比前请先用 --save-baseline 重新生成本机基线。
+
+用法:
+    python -m benchmarks.bench_micro --save-baseline benchmarks/micro_baseline.json
+    python -m benchmarks.bench_micro --compare benchmarks/micro_baseline.json [--threshold 0.1]
+    python -m benchmarks.bench_micro --filter jwt,kq
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.mock_upstream import make_png
+
+
+def load_gateway():
+    """导入网关模块（屏蔽启动输出）"""
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('ACCOUNTS_CONFIG', '[]')
+    with contextlib.redirect_stdout(io.StringIO()):
+        import gemini
+    return gemini
+
+
+# ---------- 测试数据 ----------
+
+def data_url(size: int) -> str:
+    return f"data:image/png;base64,{base64.b64encode(make_png(size)).decode()}"
+
+
+def multi_image_content(images: int, image_bytes: int) -> List[Dict]:
+    content = [{'type': 'text', 'text': '请比较这些图片的差异，并给出详细说明。' * 4}]
+    for _ in range(images):
+        content.append({'type': 'image_url', 'image_url': {'url': data_url(image_bytes), 'detail': 'high'}})
+    return content
+
+
+def long_history(turns: int) -> List[Dict]:
+    messages = [{'role': 'system', 'content': 'You are a helpful assistant.'}]
+    for i in range(turns):
+        messages.append({'role': 'user', 'content': [
+            {'type': 'text', 'text': f'第{i}轮问题：' + '这是一段比较长的用户输入。' * 20},
+        ]})
+        messages.append({'role': 'assistant', 'content': '这是助手的回答。' * 40})
+    return messages
+
+
+def upstream_response(chunks: int, chars: int, file_refs: int) -> str:
+    """构造与真实上游格式一致的大响应（JSON 数组，每个元素一行）"""
+    session = 'collections/default_collection/engines/agentspace-engine/sessions/bench'
+    items = []
+    for i in range(chunks):
+        content = {'text': f'{i:05d}' + '响应内容' * (chars // 4)}
+        if i % 10 == 0:
+            content['thought'] = True
+        items.append({'streamAssistResponse': {
+            'sessionInfo': {'session': session},
+            'answer': {'state': 'IN_PROGRESS', 'replies': [{'groundedContent': {'content': content}}]},
+        }})
+    for i in range(file_refs):
+        items.append({'streamAssistResponse': {
+            'sessionInfo': {'session': session},
+            'answer': {'replies': [{'groundedContent': {'content': {
+                'file': {'fileId': f'file{i:04d}', 'mimeType': 'image/png', 'name': f'generated_{i}.png'}
+            }}}]},
+        }})
+    return '[' + ',\n'.join(json.dumps(item, ensure_ascii=False) for item in items) + ']\n'
+
+
+def build_cases(gemini) -> List[Tuple[str, Callable[[], object]]]:
+    rng = random.Random(42)
+    key_bytes = bytes(rng.randrange(256) for _ in range(32))
+    header_json = json.dumps({'alg': 'HS256', 'typ': 'JWT', 'kid': 'k' * 40}, separators=(',', ':'))
+    payload_json = json.dumps({
+        'iss': 'https://business.gemini.google', 'aud': 'https://biz-discoveryengine.googleapis.com',
+        'sub': 'csesidx/1234567890', 'iat': 1700000000, 'exp': 1700000300, 'nbf': 1700000000,
+    }, separators=(',', ':'))
+
+    url_small = data_url(64 * 1024)
+    url_large = data_url(4 * 1024 * 1024)
+    content_multi = multi_image_content(4, 2 * 1024 * 1024)
+    history = long_history(50)
+    response_large = upstream_response(400, 400, 4)
+    response_small = upstream_response(10, 100, 0)
+
+    chat_text = gemini.ChatResponse(text='回答内容' * 2000)
+    chat_images = gemini.ChatResponse(text='回答内容' * 2000, images=[
+        gemini.ChatImage(file_name=f'gemini_{i}.png', mime_type='image/png') for i in range(8)
+    ])
+
+    def extract_history():
+        for msg in history:
+            gemini.extract_images_from_openai_content(msg.get('content', ''))
+
+    return [
+        ('create_jwt', lambda: gemini.create_jwt(key_bytes, 'k' * 40, '1234567890')),
+        ('kq_encode/header', lambda: gemini.kq_encode(header_json)),
+        ('kq_encode/payload', lambda: gemini.kq_encode(payload_json)),
+        ('parse_base64_data_url/64KB', lambda: gemini.parse_base64_data_url(url_small)),
+        ('parse_base64_data_url/4MB', lambda: gemini.parse_base64_data_url(url_large)),
+        ('extract_images/4x2MB', lambda: gemini.extract_images_from_openai_content(content_multi)),
+        ('extract_images/history_100_messages', extract_history),
+        ('build_response_content/text', lambda: gemini.build_openai_response_content(chat_text, 'http://localhost/')),
+        ('build_response_content/8_images', lambda: gemini.build_openai_response_content(chat_images, 'http://localhost/')),
+        ('parse_stream_response/small', lambda: gemini.parse_stream_assist_response(response_small, gemini.ChatResponse())),
+        ('parse_stream_response/400_chunks', lambda: gemini.parse_stream_assist_response(response_large, gemini.ChatResponse())),
+    ]
+
+
+# ---------- 计时 ----------
+
+def measure(fn: Callable[[], object], repeat: int, min_time: float) -> Dict[str, float]:
+    """自动校准循环次数，使每轮至少 min_time 秒；返回每次调用耗时（微秒）"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1 << 20:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        timings.append((time.perf_counter() - start) / loops * 1e6)
+    return {
+        'loops': loops,
+        'best_us': round(min(timings), 3),
+        'median_us': round(statistics.median(timings), 3),
+        'stdev_us': round(statistics.stdev(timings), 3) if len(timings) > 1 else 0.0,
+    }
+
+
+def run(filters: Optional[List[str]], repeat: int, min_time: float) -> Dict:
+    gemini = load_gateway()
+    results = {}
+    for name, fn in build_cases(gemini):
+        if filters and not any(f in name for f in filters):
+            continue
+        results[name] = measure(fn, repeat, min_time)
+        print(f"{name:<40} {results[name]['median_us']:>14.3f} us", file=sys.stderr)
+    return {
+        'benchmark': 'micro',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> Tuple[List[Dict], bool]:
+    """按中位数对比，慢于基线超过 threshold 视为退化"""
+    rows = []
+    regressed = False
+    for name, cur in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            rows.append({'name': name, 'current_us': cur['median_us'], 'baseline_us': None, 'change': None})
+            continue
+        change = cur['median_us'] / base['median_us'] - 1 if base['median_us'] else 0.0
+        status = 'regressed' if change > threshold else 'improved' if change < -threshold else 'same'
+        regressed = regressed or status == 'regressed'
+        rows.append({'name': name, 'current_us': cur['median_us'], 'baseline_us': base['median_us'],
+                     'change': round(change, 4), 'status': status})
+    return rows, regressed
+
+
+def print_comparison(rows: List[Dict]):
+    print(f"{'benchmark':<40} {'baseline_us':>14} {'current_us':>14} {'change':>9}")
+    for row in rows:
+        if row['baseline_us'] is None:
+            print(f"{row['name']:<40} {'-':>14} {row['current_us']:>14.3f} {'new':>9}")
+            continue
+        mark = {'regressed': ' !', 'improved': ' *'}.get(row['status'], '')
+        print(f"{row['name']:<40} {row['baseline_us']:>14.3f} {row['current_us']:>14.3f} "
+              f"{row['change'] * 100:>+8.1f}%{mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='请求热路径微基准测试')
+    parser.add_argument('--filter', help='只运行名称包含这些子串的用例（逗号分隔）')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.2, help='每轮最少运行秒数')
+    parser.add_argument('--output', help='结果JSON输出路径')
+    parser.add_argument('--save-baseline', help='把本次结果保存为基线')
+    parser.add_argument('--compare', help='与基线JSON对比')
+    parser.add_argument('--threshold', type=float, default=0.10, help='判定退化的相对阈值')
+    args = parser.parse_args()
+
+    filters = [f.strip() for f in args.filter.split(',')] if args.filter else None
+    result = run(filters, args.repeat, args.min_time)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(text, encoding='utf-8')
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        rows, regressed = compare(baseline, result, args.threshold)
+        print_comparison(rows)
+        sys.exit(1 if regressed else 0)
+    if not args.output and not args.save_baseline:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
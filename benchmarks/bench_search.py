@@ -0,0 +1,163 @@
+"""会话搜索基准测试
+
+对比 ConversationManager.search_conversations 的两种实现在大量消息下的查询延迟：
+- like: LIKE '%关键词%' 扫描该用户的会话标题和消息（关键词不足三个字符或 SQLite 不支持 FTS5 trigram 时的退路）
+- fts: FTS5 trigram 全文索引，bm25 排序并生成命中片段
+
+数据库由 ConversationManager 按 schema.sql 建出（含全文索引和同步触发器），消息正文按 Zipf 分布从中英文词表抽词，
+分别查询高频、中频和低频词。
+
+用法:
+    python -m benchmarks.bench_search --messages 1000000 --users 1 --repeat 20 --output search.json
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.bench_e2e import latency_summary, parse_list
+from database import ConversationManager
+
+MODES = ('like', 'fts')
+CJK_CHARS = ('的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面'
+             '而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好'
+             '应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命'
+             '此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老')
+ASCII_CHARS = 'abcdefghijklmnopqrstuvwxyz'
+# 查询名 -> 关键词在词频表中的名次（Zipf 分布，名次越小越常见）
+QUERIES = {
+    'common': 3,
+    'frequent': 30,
+    'medium': 300,
+    'rare': 3000,
+}
+
+
+def build_vocabulary(size: int, rng: random.Random) -> List[str]:
+    """生成中英文混合词表，按假定词频名次排列"""
+    words, seen = [], set()
+    while len(words) < size:
+        if rng.random() < 0.6:
+            word = ''.join(rng.choice(CJK_CHARS) for _ in range(rng.randint(2, 4)))
+        else:
+            word = ''.join(rng.choice(ASCII_CHARS) for _ in range(rng.randint(4, 9)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def query_terms(vocabulary: List[str], rank: int) -> str:
+    """取该名次之后第一个不少于三个字符的词（trigram 索引的最短关键词）"""
+    return next(word for word in vocabulary[rank:] if len(word) >= 3)
+
+
+def create_database(path: Path, users: int, conversations: int, messages: int, vocabulary: List[str], seed: int):
+    ConversationManager(str(path))  # 建表、全文索引和触发器
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    per_conversation = max(messages // conversations, 1)
+    with sqlite3.connect(path) as conn:
+        conn.execute("PRAGMA synchronous=OFF")
+        for c in range(conversations):
+            title = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=3))
+            conversation_id = conn.execute(
+                "INSERT INTO conversations (session_id, title, user_id, message_count) VALUES (?, ?, ?, ?)",
+                (f"session-{c}", title, f"user-{c % users}", per_conversation)).lastrowid
+            rows = [(conversation_id, 'user' if m % 2 == 0 else 'assistant',
+                     ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(20, 60))))
+                    for m in range(per_conversation)]
+            conn.executemany("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)", rows)
+
+
+def run_query(manager: ConversationManager, mode: str, user_id: str, query: str, limit: int):
+    terms = query.split()
+    if mode == 'fts':
+        return manager._search_fts(user_id, terms, limit)
+    return manager._search_like(user_id, terms, limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='会话搜索基准测试')
+    parser.add_argument('--modes', default=','.join(MODES), type=parse_list)
+    parser.add_argument('--messages', type=int, default=200000, help='消息总数')
+    parser.add_argument('--conversations', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1, help='用户数（网关默认把请求都归到 default_user）')
+    parser.add_argument('--vocabulary', type=int, default=20000, help='词表大小')
+    parser.add_argument('--repeat', type=int, default=20, help='每个查询对不同用户重复的次数')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='结果JSON输出路径')
+    args = parser.parse_args()
+
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"未知模式: {','.join(sorted(unknown))}")
+
+    results: List[Dict] = []
+    with tempfile.TemporaryDirectory(prefix='bench_search_') as tmp:
+        path = Path(tmp) / 'conversations.db'
+        start = time.perf_counter()
+        vocabulary = build_vocabulary(args.vocabulary, random.Random(args.seed))
+        create_database(path, args.users, args.conversations, args.messages, vocabulary, args.seed)
+        build_seconds = time.perf_counter() - start
+        print(f"建库完成: {args.messages} 条消息, 耗时 {build_seconds:.1f}s, "
+              f"大小 {path.stat().st_size / 1024 / 1024:.1f}MB", file=sys.stderr)
+
+        manager = ConversationManager(str(path))
+        if 'fts' in args.modes and not manager.search_enabled:
+            parser.error('当前 SQLite 不支持 FTS5 trigram 分词')
+        rng = random.Random(args.seed)
+        for name, rank in QUERIES.items():
+            query = query_terms(vocabulary, rank)
+            # 两种模式查询同一组用户
+            user_ids = [f"user-{rng.randrange(args.users)}" for _ in range(args.repeat)]
+            for mode in args.modes:
+                samples = []
+                hits = 0
+                for user_id in user_ids:
+                    begin = time.perf_counter()
+                    found = run_query(manager, mode, user_id, query, args.limit)
+                    samples.append(time.perf_counter() - begin)
+                    hits += len(found)
+                result = {
+                    'query': name,
+                    'terms': query,
+                    'mode': mode,
+                    'latency_ms': latency_summary(samples),
+                    'avg_results': round(hits / args.repeat, 1),
+                }
+                results.append(result)
+                print(f"{name:<9} {query:<10} {mode:<5} p50={result['latency_ms']['p50']:<9} "
+                      f"p99={result['latency_ms']['p99']:<9} results={result['avg_results']}", file=sys.stderr)
+
+    output = {
+        'benchmark': 'search',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'messages': args.messages,
+        'conversations': args.conversations,
+        'users': args.users,
+        'build_seconds': round(build_seconds, 1),
+        'results': results,
+    }
+    text = json.dumps(output, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""服务对比基准测试
+
+分别以 Flask 开发服务器（app.run threaded）、server.py 内置多进程线程池服务、
+gunicorn gthread（已安装时）以及 ASGI 网关模式启动网关，对同一个本地模拟上游跑相同的场景和并发度，
+比较 RPS、延迟分位数、流式首字节时间和所有进程的内存之和。
+
+用法:
+    python -m benchmarks.bench_server --servers dev,builtin --workers 2 --threads 32 \
+        --scenarios text,stream --concurrency 8,64 --requests 500 --output server.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.bench_e2e import GatewayProcess, Scenario, parse_list, run_load
+from benchmarks.mock_upstream import MockUpstream, add_config_arguments, config_from_args
+
+SERVERS = ('dev', 'builtin', 'gunicorn', 'asgi')
+
+
+def gunicorn_available() -> bool:
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def server_args(name: str, args) -> Optional[List[str]]:
+    """返回 server.py 的启动参数，dev 返回 None（使用 app.run）"""
+    if name == 'dev':
+        return None
+    return ['--server', name, '--workers', str(args.workers), '--threads', str(args.threads),
+            '--keepalive', str(args.keepalive)]
+
+
+def run(args) -> Dict:
+    mock = MockUpstream(config_from_args(args), port=args.mock_port).start()
+    results = []
+    try:
+        for name in args.servers:
+            if name == 'gunicorn' and not gunicorn_available():
+                print("gunicorn 未安装，跳过", file=sys.stderr)
+                continue
+            extra_env = {}
+            if name != 'dev' and args.workers > 1:
+                # 多 worker 需要共享账号状态，否则每个 worker 各自获取 JWT 和会话
+                extra_env['STATE_BACKEND'] = args.state_backend
+            gateway = GatewayProcess(mock.origin, args.accounts, extra_env, server_args(name, args)).start()
+            try:
+                for scenario_name in args.scenarios:
+                    scenario = Scenario(scenario_name, gateway.url, args)
+                    for concurrency in args.concurrency:
+                        result = run_load(scenario, concurrency, args.requests, args.warmup, gateway.pid,
+                                          tree=True)
+                        result['server'] = name
+                        results.append(result)
+                        lat = result['latency_ms']
+                        print(f"{name:<9} {scenario_name:<7} c={concurrency:<4} rps={result['rps']:<8} "
+                              f"p50={lat['p50']:<8} p99={lat['p99']:<8} errors={result['errors']}",
+                              file=sys.stderr)
+            finally:
+                gateway.stop(keep=args.keep)
+    finally:
+        mock.stop()
+
+    return {
+        'benchmark': 'server',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'workers': args.workers,
+        'threads': args.threads,
+        'keepalive': args.keepalive,
+        'accounts': args.accounts,
+        'upstream': mock.state.config.to_dict(),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='服务对比基准测试（本地模拟上游）')
+    parser.add_argument('--servers', default=','.join(SERVERS), type=parse_list,
+                        help=f"逗号分隔，可选: {','.join(SERVERS)}（gunicorn 未安装时跳过）")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--keepalive', type=int, default=5)
+    parser.add_argument('--state-backend', default='sqlite', help='多 worker 时使用的 STATE_BACKEND')
+    parser.add_argument('--scenarios', default='text,stream', type=parse_list)
+    parser.add_argument('--concurrency', default='8,64', type=lambda v: parse_list(v, int))
+    parser.add_argument('--requests', type=int, default=500, help='每个场景/并发度的请求数')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--accounts', type=int, default=4, help='模拟账号数')
+    parser.add_argument('--model', default='gemini-enterprise')
+    parser.add_argument('--inline-image-bytes', type=int, default=512 * 1024)
+    parser.add_argument('--upload-bytes', type=int, default=1024 * 1024)
+    parser.add_argument('--mock-port', type=int, default=0, help='模拟上游端口（默认随机）')
+    parser.add_argument('--keep', action='store_true', help='保留网关临时目录（含日志）')
+    parser.add_argument('--output', help='结果JSON输出路径')
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    unknown = set(args.servers) - set(SERVERS)
+    if unknown:
+        parser.error(f"未知服务: {','.join(sorted(unknown))}")
+
+    result = run(args)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""SQLite 并发访问基准测试
+
+对比两种访问方式在多线程（可选多进程）混合读写下的吞吐、延迟和 "database is locked" 错误数：
+- legacy: 每次操作 sqlite3.connect 新连接、默认回滚日志（改造前 ConversationManager / AnalyticsManager 的方式）
+- pooled: sqlite_pool.SQLitePool（每线程只读连接 + 写线程队列、group commit、WAL）
+
+数据库为 schema.sql 建出的会话库，预置会话和消息；读操作为会话列表和消息列表查询，
+写操作为追加消息并更新会话。
+
+用法:
+    python -m benchmarks.bench_sqlite --modes legacy,pooled --threads 1,8,32 --processes 1,4 \
+        --duration 5 --write-ratio 0.2 --group-commit-ms 0,1 --output sqlite.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.bench_e2e import latency_summary, parse_list
+from sqlite_pool import SQLitePool
+
+ROOT = Path(__file__).resolve().parent.parent
+MODES = ('legacy', 'pooled')
+
+LIST_SQL = """
+    SELECT id, session_id, title, updated_at, message_count
+    FROM conversations WHERE user_id = ? ORDER BY updated_at DESC LIMIT 20
+"""
+MESSAGES_SQL = """
+    SELECT id, role, content, timestamp FROM messages
+    WHERE conversation_id = ? ORDER BY timestamp LIMIT 50
+"""
+INSERT_SQL = "INSERT INTO messages (conversation_id, role, content) VALUES (?, 'assistant', ?)"
+UPDATE_SQL = """
+    UPDATE conversations SET message_count = message_count + 1, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+"""
+
+
+def create_database(path: Path, users: int, conversations: int, messages: int):
+    schema = (ROOT / 'schema.sql').read_text(encoding='utf-8')
+    with sqlite3.connect(path) as conn:
+        conn.executescript(schema)
+        for c in range(conversations):
+            cursor = conn.execute(
+                "INSERT INTO conversations (session_id, title, user_id, message_count) VALUES (?, ?, ?, ?)",
+                (f"session-{c}", f"会话 {c}", f"user-{c % users}", messages))
+            conn.executemany(
+                "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                [(cursor.lastrowid, 'user' if m % 2 == 0 else 'assistant', f"消息内容 {m} " * 20)
+                 for m in range(messages)])
+
+
+class LegacyAccess:
+    def __init__(self, path: str):
+        self.path = path
+
+    def read(self, conversation_id: int, user_id: str):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(LIST_SQL, (user_id,)).fetchall()
+            conn.execute(MESSAGES_SQL, (conversation_id,)).fetchall()
+
+    def write(self, conversation_id: int, content: str):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(INSERT_SQL, (conversation_id, content))
+            conn.execute(UPDATE_SQL, (conversation_id,))
+            conn.commit()
+
+
+def append_message(conn: sqlite3.Connection, conversation_id: int, content: str) -> int:
+    message_id = conn.execute(INSERT_SQL, (conversation_id, content)).lastrowid
+    conn.execute(UPDATE_SQL, (conversation_id,))
+    return message_id
+
+
+class PooledAccess:
+    def __init__(self, path: str, group_commit_ms: float):
+        self.pool = SQLitePool(path, group_commit_ms=group_commit_ms)
+
+    def read(self, conversation_id: int, user_id: str):
+        with self.pool.read() as conn:
+            conn.execute(LIST_SQL, (user_id,)).fetchall()
+            conn.execute(MESSAGES_SQL, (conversation_id,)).fetchall()
+
+    def write(self, conversation_id: int, content: str):
+        # 与 ConversationManager.add_message 相同：提交写任务并等待事务提交后拿到消息ID
+        self.pool.execute(append_message, conversation_id, content)
+
+    def transactions(self) -> int:
+        return self.pool.stats()['transactions']
+
+
+def run_process(mode: str, path: str, threads: int, duration: float, write_ratio: float,
+                users: int, conversations: int, group_commit_ms: float, seed: int) -> Dict:
+    """在当前进程中以 threads 个线程跑 duration 秒，返回原始样本"""
+    access = LegacyAccess(path) if mode == 'legacy' else PooledAccess(path, group_commit_ms)
+    reads: List[float] = []
+    writes: List[float] = []
+    errors = {'locked': 0, 'other': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(index: int):
+        rng = random.Random(seed * 1000 + index)
+        local_reads, local_writes = [], []
+        local_errors = {'locked': 0, 'other': 0}
+        while time.monotonic() < deadline:
+            conversation_id = rng.randint(1, conversations)
+            is_write = rng.random() < write_ratio
+            start = time.perf_counter()
+            try:
+                if is_write:
+                    access.write(conversation_id, 'benchmark reply ' * 10)
+                else:
+                    access.read(conversation_id, f"user-{rng.randrange(users)}")
+            except sqlite3.OperationalError as e:
+                local_errors['locked' if 'locked' in str(e) else 'other'] += 1
+                continue
+            (local_writes if is_write else local_reads).append(time.perf_counter() - start)
+        with lock:
+            reads.extend(local_reads)
+            writes.extend(local_writes)
+            for key, value in local_errors.items():
+                errors[key] += value
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    # legacy 每次写入各自一个事务
+    transactions = access.transactions() if mode != 'legacy' else len(writes)
+    return {'reads': reads, 'writes': writes, 'errors': errors, 'transactions': transactions}
+
+
+def _process_entry(queue, *args):
+    queue.put(run_process(*args))
+
+
+def run_case(mode: str, threads: int, processes: int, group_commit_ms: float, args) -> Dict:
+    with tempfile.TemporaryDirectory(prefix='bench_sqlite_') as tmp:
+        path = Path(tmp) / 'conversations.db'
+        create_database(path, args.users, args.conversations, args.messages)
+        params = (mode, str(path), threads, args.duration, args.write_ratio, args.users, args.conversations,
+                  group_commit_ms)
+        if processes == 1:
+            parts = [run_process(*params, 0)]
+        else:
+            context = multiprocessing.get_context('fork')
+            queue = context.Queue()
+            workers = [context.Process(target=_process_entry, args=(queue, *params, i)) for i in range(processes)]
+            for worker in workers:
+                worker.start()
+            parts = [queue.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+
+    reads = [v for part in parts for v in part['reads']]
+    writes = [v for part in parts for v in part['writes']]
+    errors = {key: sum(part['errors'][key] for part in parts) for key in ('locked', 'other')}
+    transactions = sum(part['transactions'] for part in parts)
+    return {
+        'mode': mode,
+        'threads': threads,
+        'processes': processes,
+        'group_commit_ms': group_commit_ms if mode != 'legacy' else None,
+        'ops_per_sec': round((len(reads) + len(writes)) / args.duration, 1),
+        'reads': len(reads),
+        'writes': len(writes),
+        'read_latency_ms': latency_summary(reads),
+        'write_latency_ms': latency_summary(writes),
+        'writes_per_transaction': round(len(writes) / transactions, 2) if transactions else 0,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite 并发访问基准测试')
+    parser.add_argument('--modes', default=','.join(MODES), type=parse_list)
+    parser.add_argument('--threads', default='1,8,32', type=lambda v: parse_list(v, int), help='每个进程的线程数')
+    parser.add_argument('--processes', default='1', type=lambda v: parse_list(v, int), help='进程数（模拟多 worker）')
+    parser.add_argument('--duration', type=float, default=5.0, help='每个用例的运行秒数')
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--group-commit-ms', default='1', type=lambda v: parse_list(v, float),
+                        help='pooled 模式的 group commit 窗口（毫秒），可给多个值对比')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20, help='每个会话预置的消息数')
+    parser.add_argument('--output', help='结果JSON输出路径')
+    args = parser.parse_args()
+
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"未知模式: {','.join(sorted(unknown))}")
+
+    results = []
+    for processes in args.processes:
+        for threads in args.threads:
+            for mode in args.modes:
+                for group_commit_ms in (args.group_commit_ms if mode != 'legacy' else [0]):
+                    result = run_case(mode, threads, processes, group_commit_ms, args)
+                    results.append(result)
+                    label = mode if mode == 'legacy' else f"{mode}/{group_commit_ms:g}ms"
+                    print(f"{label:<12} p={processes:<3} t={threads:<4} ops/s={result['ops_per_sec']:<9} "
+                          f"read_p99={result['read_latency_ms']['p99']:<8} "
+                          f"write_p99={result['write_latency_ms']['p99']:<9} "
+                          f"writes/tx={result['writes_per_transaction']:<7} locked={result['errors']['locked']}",
+                          file=sys.stderr)
+
+    output = {
+        'benchmark': 'sqlite',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'duration': args.duration,
+        'write_ratio': args.write_ratio,
+        'results': results,
+    }
+    text = json.dumps(output, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text, encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""本地 Redis 协议替身
+
+实现 STATE_BACKEND=redis://... 用到的命令（PING、AUTH、SELECT、GET、SET [NX] [EX|PX]、DEL、INCR、INCRBY），
+数据保存在内存中，用于在没有 Redis 的环境下验证多 worker 共享状态。
+
+用法: python -m benchmarks.mock_redis [--port 6390]
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class MockRedisStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 键 -> (值, 过期时间或 None)
+        self.data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.commands = 0
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry[0]
+
+    def execute(self, args: List[bytes]):
+        command = args[0].upper()
+        with self.lock:
+            self.commands += 1
+            if command in (b'PING', b'AUTH', b'SELECT'):
+                return 'OK' if command != b'PING' else 'PONG'
+            if command == b'GET':
+                return self._get(args[1])
+            if command == b'SET':
+                key, value = args[1], args[2]
+                expires_at, nx = None, False
+                options = [a.upper() for a in args[3:]]
+                for i, option in enumerate(options):
+                    if option == b'NX':
+                        nx = True
+                    elif option == b'PX':
+                        expires_at = time.monotonic() + int(args[4 + i]) / 1000
+                    elif option == b'EX':
+                        expires_at = time.monotonic() + int(args[4 + i])
+                if nx and self._get(key) is not None:
+                    return None
+                self.data[key] = (value, expires_at)
+                return 'OK'
+            if command == b'DEL':
+                return sum(1 for key in args[1:] if self._get(key) is not None and self.data.pop(key))
+            if command in (b'INCR', b'INCRBY'):
+                value = int(self._get(args[1]) or 0) + (int(args[2]) if command == b'INCRBY' else 1)
+                self.data[args[1]] = (str(value).encode(), None)
+                return value
+        return Exception(f"ERR unknown command '{command.decode()}'")
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def _read_command(self) -> Optional[List[bytes]]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    @staticmethod
+    def _encode(reply) -> bytes:
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, Exception):
+            return b'-%s\r\n' % str(reply).encode()
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, str):
+            return b'+%s\r\n' % reply.encode()
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if not args:
+                return
+            self.wfile.write(self._encode(self.server.store.execute(args)))
+
+
+class MockRedis:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.server = socketserver.ThreadingTCPServer((host, port), RespHandler)
+        self.server.daemon_threads = True
+        self.server.store = MockRedisStore()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> 'MockRedis':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 Redis 协议替身')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    mock = MockRedis(args.host, args.port)
+    print(f"Redis 替身已启动: {mock.url}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+"""本地模拟 Gemini 上游
+
+模拟 getoxsrf、widgetCreateSession、widgetStreamAssist、widgetAddContextFile、
+widgetListSessionFileMetadata 和 downloadFile，用于在没有真实账号时压测网关。
+各接口的延迟按可配置的分布采样，widgetStreamAssist 以分块传输逐段返回。
+
+网关通过 GEMINI_API_ORIGIN / GEMINI_AUTH_ORIGIN 指向本服务。
+
+用法: python -m benchmarks.mock_upstream [--port 8990] [--ttfb lognormal:300,0.4] [--chunks 8]
+"""
+
+import argparse
+import base64
+import json
+import math
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+class LatencyDistribution:
+    """延迟分布（毫秒）
+
+    规格: "0" / "fixed:50" / "uniform:20,80" / "lognormal:中位数,sigma"
+    """
+
+    def __init__(self, spec: str = '0'):
+        self.spec = spec
+        kind, _, params = spec.partition(':')
+        if not params:
+            kind, params = 'fixed', kind
+        self.kind = kind
+        self.params = [float(p) for p in params.split(',') if p]
+        if kind not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError(f"未知的延迟分布: {spec}")
+
+    def sample(self) -> float:
+        """返回一次采样的延迟（秒）"""
+        if self.kind == 'fixed':
+            ms = self.params[0] if self.params else 0.0
+        elif self.kind == 'uniform':
+            ms = random.uniform(self.params[0], self.params[1])
+        else:
+            median, sigma = self.params[0], self.params[1] if len(self.params) > 1 else 0.5
+            ms = random.lognormvariate(math.log(max(median, 1e-3)), sigma)
+        return max(ms, 0.0) / 1000.0
+
+    def sleep(self):
+        delay = self.sample()
+        if delay > 0:
+            time.sleep(delay)
+
+    def __repr__(self):
+        return self.spec
+
+
+@dataclass
+class MockConfig:
+    jwt_latency: LatencyDistribution = field(default_factory=lambda: LatencyDistribution('fixed:20'))
+    session_latency: LatencyDistribution = field(default_factory=lambda: LatencyDistribution('fixed:50'))
+    ttfb_latency: LatencyDistribution = field(default_factory=lambda: LatencyDistribution('lognormal:300,0.4'))
+    chunk_latency: LatencyDistribution = field(default_factory=lambda: LatencyDistribution('fixed:20'))
+    upload_latency: LatencyDistribution = field(default_factory=lambda: LatencyDistribution('fixed:100'))
+    download_latency: LatencyDistribution = field(default_factory=lambda: LatencyDistribution('fixed:50'))
+    # widgetStreamAssist 返回的文本分块数和总字符数
+    chunks: int = 8
+    response_chars: int = 800
+    # 生成图片的大小（字节）
+    image_bytes: int = 256 * 1024
+    # 注入 500 错误的概率（0 表示不注入）
+    error_rate: float = 0.0
+
+    def to_dict(self) -> Dict:
+        return {k: (repr(v) if isinstance(v, LatencyDistribution) else v) for k, v in self.__dict__.items()}
+
+
+def make_png(size: int) -> bytes:
+    """生成约 size 字节的合法 PNG（1x1 像素 + 填充块）"""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    header = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 6, 0, 0, 0))
+    body = chunk(b'IDAT', zlib.compress(b'\x00\xff\x00\x00\xff'))
+    padding = max(0, size - len(header) - len(body) - 12 * 2 - 8)
+    return header + chunk(b'tEXt', b'Comment\x00' + b'x' * padding) + body + chunk(b'IEND', b'')
+
+
+class MockState:
+    """模拟服务状态：会话中生成的文件和各接口调用计数"""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.session_files: Dict[str, List[str]] = {}
+        self.counts: Dict[str, int] = {}
+        self.image = make_png(config.image_bytes)
+
+    def count(self, endpoint: str):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def add_file(self, session: str) -> str:
+        file_id = uuid.uuid4().hex
+        with self.lock:
+            files = self.session_files.setdefault(session, [])
+            files.append(file_id)
+            # 只保留最近的文件，避免长时间压测占用内存
+            del files[:-16]
+        return file_id
+
+    def files(self, session: str) -> List[str]:
+        with self.lock:
+            return list(self.session_files.get(session, []))
+
+
+def wants_image(message: str) -> bool:
+    """模拟生图触发：消息中包含"画"或 "draw" 时返回生成的图片"""
+    return '画' in message or 'draw' in message.lower()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockGemini/1.0'
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # ---------- 工具方法 ----------
+
+    def _read_json(self) -> Dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        return json.loads(body) if body else {}
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data, status: int = 200):
+        self._send(status, json.dumps(data).encode('utf-8'))
+
+    def _maybe_fail(self) -> bool:
+        rate = self.state.config.error_rate
+        if rate and random.random() < rate:
+            self._send_json({'error': {'code': 500, 'message': 'mock injected error'}}, 500)
+            return True
+        return False
+
+    # ---------- 路由 ----------
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/auth/getoxsrf':
+            return self._getoxsrf()
+        if url.path.endswith(':downloadFile'):
+            return self._download_file(url)
+        self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        handlers = {
+            'widgetCreateSession': self._create_session,
+            'widgetStreamAssist': self._stream_assist,
+            'widgetAddContextFile': self._add_context_file,
+            'widgetListSessionFileMetadata': self._list_file_metadata,
+        }
+        handler = handlers.get(path.rsplit('/', 1)[-1])
+        if handler is None:
+            return self._send_json({'error': 'not found'}, 404)
+        body = self._read_json()
+        handler(body)
+
+    def _getoxsrf(self):
+        self.state.count('getoxsrf')
+        self.state.config.jwt_latency.sleep()
+        data = {
+            'keyId': 'mock-key-id',
+            'xsrfToken': base64.urlsafe_b64encode(b'mock-xsrf-key-0123456789abcdef!!').decode().rstrip('='),
+        }
+        self._send(200, (")]}'\n" + json.dumps(data)).encode('utf-8'))
+
+    def _create_session(self, body: Dict):
+        self.state.count('create_session')
+        self.state.config.session_latency.sleep()
+        if self._maybe_fail():
+            return
+        name = f"collections/default_collection/engines/agentspace-engine/sessions/{uuid.uuid4().hex[:12]}"
+        self._send_json({'session': {'name': name}})
+
+    def _add_context_file(self, body: Dict):
+        self.state.count('add_context_file')
+        self.state.config.upload_latency.sleep()
+        if self._maybe_fail():
+            return
+        self._send_json({'addContextFileResponse': {'fileId': uuid.uuid4().hex}})
+
+    def _list_file_metadata(self, body: Dict):
+        self.state.count('list_file_metadata')
+        session = body.get('listSessionFileMetadataRequest', {}).get('name', '')
+        metadata = [{'fileId': fid, 'name': f'generated_{fid[:8]}.png', 'session': session,
+                     'mimeType': 'image/png'} for fid in self.state.files(session)]
+        self._send_json({'listSessionFileMetadataResponse': {'fileMetadata': metadata}})
+
+    def _download_file(self, url):
+        self.state.count('download_file')
+        self.state.config.download_latency.sleep()
+        if not parse_qs(url.query).get('fileId'):
+            return self._send_json({'error': 'missing fileId'}, 400)
+        self._send(200, self.state.image, 'image/png')
+
+    def _stream_assist(self, body: Dict):
+        self.state.count('stream_assist')
+        config = self.state.config
+        request = body.get('streamAssistRequest', {})
+        session = request.get('session', '')
+        message = ''.join(p.get('text', '') for p in request.get('query', {}).get('parts', []))
+
+        config.ttfb_latency.sleep()
+        if self._maybe_fail():
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write_chunk(text: str):
+            data = text.encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        chunks = max(1, config.chunks)
+        piece = max(1, config.response_chars // chunks)
+        items = []
+        for i in range(chunks):
+            items.append({'streamAssistResponse': {
+                'sessionInfo': {'session': session},
+                'answer': {'replies': [{'groundedContent': {'content': {'text': f"{i:04d}" + 'x' * max(0, piece - 4)}}}]}
+            }})
+        if wants_image(message):
+            file_id = self.state.add_file(session)
+            items.append({'streamAssistResponse': {
+                'sessionInfo': {'session': session},
+                'answer': {'replies': [{'groundedContent': {'content': {
+                    'file': {'fileId': file_id, 'mimeType': 'image/png', 'name': f'generated_{file_id[:8]}.png'}
+                }}}]}
+            }})
+
+        # 与真实上游一致：一个 JSON 数组，每个元素单独一行，逐块发送
+        for i, item in enumerate(items):
+            if i:
+                config.chunk_latency.sleep()
+            prefix = '[' if i == 0 else ','
+            suffix = ']' if i == len(items) - 1 else ''
+            write_chunk(f"{prefix}{json.dumps(item)}{suffix}\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MockUpstream:
+    """在后台线程中运行的模拟上游服务"""
+
+    def __init__(self, config: Optional[MockConfig] = None, host: str = '127.0.0.1', port: int = 0):
+        self.state = MockState(config or MockConfig())
+        handler = type('BoundMockHandler', (MockHandler,), {'state': self.state})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def origin(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'MockUpstream':
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mock-upstream', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> Dict[str, int]:
+        with self.state.lock:
+            return dict(self.state.counts)
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    """模拟上游的命令行参数（供基准测试驱动复用）"""
+    defaults = MockConfig()
+    parser.add_argument('--jwt-latency', default=repr(defaults.jwt_latency))
+    parser.add_argument('--session-latency', default=repr(defaults.session_latency))
+    parser.add_argument('--ttfb', default=repr(defaults.ttfb_latency), help='上游首字节延迟分布')
+    parser.add_argument('--chunk-latency', default=repr(defaults.chunk_latency), help='分块间隔分布')
+    parser.add_argument('--upload-latency', default=repr(defaults.upload_latency))
+    parser.add_argument('--download-latency', default=repr(defaults.download_latency))
+    parser.add_argument('--chunks', type=int, default=defaults.chunks)
+    parser.add_argument('--response-chars', type=int, default=defaults.response_chars)
+    parser.add_argument('--image-bytes', type=int, default=defaults.image_bytes)
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate)
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(
+        jwt_latency=LatencyDistribution(args.jwt_latency),
+        session_latency=LatencyDistribution(args.session_latency),
+        ttfb_latency=LatencyDistribution(args.ttfb),
+        chunk_latency=LatencyDistribution(args.chunk_latency),
+        upload_latency=LatencyDistribution(args.upload_latency),
+        download_latency=LatencyDistribution(args.download_latency),
+        chunks=args.chunks,
+        response_chars=args.response_chars,
+        image_bytes=args.image_bytes,
+        error_rate=args.error_rate,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟 Gemini 上游')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8990)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    mock = MockUpstream(config_from_args(args), args.host, args.port)
+    print(f"模拟上游已启动: {mock.origin}")
+    print(f"网关配置: GEMINI_API_ORIGIN={mock.origin} GEMINI_AUTH_ORIGIN={mock.origin}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Business Gemini Pool 响应压缩中间件
+对超过阈值的 JSON / 文本响应按 Accept-Encoding 协商进行 zstd / brotli / gzip 压缩，
+流式响应（text/event-stream、生成器响应）一律跳过，支持按路由关闭，
+并记录压缩率和 CPU 耗时
+"""
+
+import gzip
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from typing import Dict, Optional
+
+from flask import request
+
+from static_assets import choose_encoding
+
+# 可选压缩库
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('gemini_pool.compression')
+
+# 可压缩的 MIME 类型
+COMPRESSIBLE_MIMETYPES = (
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'text/html',
+    'text/plain',
+    'text/css',
+    'text/csv',
+    'image/svg+xml',
+)
+
+
+def no_compress(f):
+    """路由级关闭响应压缩的装饰器"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        return f(*args, **kwargs)
+    decorated_function._no_compress = True
+    return decorated_function
+
+
+class CompressionStats:
+    """压缩统计：按编码记录次数、压缩前后字节数和 CPU 耗时"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_encoding: Dict[str, Dict[str, float]] = {}
+        self.skipped: Dict[str, int] = {}
+
+    def record(self, encoding: str, bytes_in: int, bytes_out: int, cpu_seconds: float):
+        with self.lock:
+            entry = self.by_encoding.get(encoding)
+            if entry is None:
+                entry = self.by_encoding[encoding] = {
+                    'responses': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0
+                }
+            entry['responses'] += 1
+            entry['bytes_in'] += bytes_in
+            entry['bytes_out'] += bytes_out
+            entry['cpu_seconds'] += cpu_seconds
+
+    def record_skip(self, reason: str):
+        with self.lock:
+            self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            encodings = {}
+            for encoding, entry in self.by_encoding.items():
+                data = dict(entry)
+                data['ratio'] = round(entry['bytes_out'] / entry['bytes_in'], 4) if entry['bytes_in'] else 0
+                data['avg_cpu_ms'] = round(entry['cpu_seconds'] * 1000 / entry['responses'], 3) if entry['responses'] else 0
+                encodings[encoding] = data
+            return {'encodings': encodings, 'skipped': dict(self.skipped)}
+
+
+class ResponseCompressor:
+    """Flask after_request 压缩中间件"""
+
+    def __init__(self, min_size: int = 1024, gzip_level: int = 6,
+                 brotli_quality: int = 4, zstd_level: int = 3):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.zstd_level = zstd_level
+        self.stats = CompressionStats()
+        self.app = None
+
+        self.available = {'gzip': self._gzip}
+        self.preference = ['gzip']
+        if brotli is not None:
+            self.available['br'] = self._brotli
+            self.preference.insert(0, 'br')
+        if zstandard is not None:
+            self._zstd_local = threading.local()
+            self.available['zstd'] = self._zstd
+            self.preference.insert(0, 'zstd')
+
+    def _gzip(self, data: bytes) -> bytes:
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+    def _brotli(self, data: bytes) -> bytes:
+        return brotli.compress(data, quality=self.brotli_quality)
+
+    def _zstd(self, data: bytes) -> bytes:
+        # ZstdCompressor 非线程安全，每个线程复用一个实例
+        compressor = getattr(self._zstd_local, 'compressor', None)
+        if compressor is None:
+            compressor = self._zstd_local.compressor = zstandard.ZstdCompressor(level=self.zstd_level)
+        return compressor.compress(data)
+
+    def init_app(self, app):
+        self.app = app
+        app.after_request(self.after_request)
+
+    def _route_opted_out(self) -> bool:
+        if self.app is None or request.endpoint is None:
+            return False
+        view = self.app.view_functions.get(request.endpoint)
+        return bool(getattr(view, '_no_compress', False))
+
+    def _skip_reason(self, response) -> Optional[str]:
+        """返回跳过压缩的原因，None 表示可以压缩"""
+        if response.direct_passthrough or response.is_streamed:
+            return 'streamed'
+        if response.mimetype == 'text/event-stream':
+            return 'event_stream'
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return 'status'
+        if 'Content-Encoding' in response.headers:
+            return 'already_encoded'
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return 'mimetype'
+        if request.method == 'HEAD':
+            return 'head'
+        if self._route_opted_out():
+            return 'opt_out'
+        length = response.content_length
+        if length is not None and length < self.min_size:
+            return 'too_small'
+        return None
+
+    def after_request(self, response):
+        reason = self._skip_reason(response)
+        if reason is not None:
+            if reason in ('too_small', 'opt_out', 'mimetype'):
+                self.stats.record_skip(reason)
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.headers.get('Accept-Encoding', ''),
+                                   self.available, self.preference)
+        if encoding == 'identity':
+            self.stats.record_skip('not_accepted')
+            return response
+
+        data = response.get_data()
+        if len(data) < self.min_size:
+            self.stats.record_skip('too_small')
+            return response
+
+        cpu_start = time.thread_time()
+        compressed = self.available[encoding](data)
+        cpu_seconds = time.thread_time() - cpu_start
+
+        if len(compressed) >= len(data):
+            self.stats.record_skip('no_gain')
+            return response
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        if response.headers.get('ETag'):
+            response.headers['ETag'] = response.headers['ETag'].rstrip('"') + f'-{encoding}"'
+        self.stats.record(encoding, len(data), len(compressed), cpu_seconds)
+        return response
+
+
+def init_compression(app) -> Optional[ResponseCompressor]:
+    """根据环境变量为应用启用响应压缩
+
+    RESPONSE_COMPRESSION=false 可关闭，COMPRESSION_MIN_SIZE 设置最小压缩字节数
+    """
+    if os.getenv('RESPONSE_COMPRESSION', 'true').lower() != 'true':
+        logger.info("响应压缩已关闭")
+        return None
+
+    compressor = ResponseCompressor(
+        min_size=int(os.getenv('COMPRESSION_MIN_SIZE', '1024')),
+        gzip_level=int(os.getenv('COMPRESSION_GZIP_LEVEL', '6')),
+        brotli_quality=int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4')),
+        zstd_level=int(os.getenv('COMPRESSION_ZSTD_LEVEL', '3')),
+    )
+    compressor.init_app(app)
+    logger.info(f"响应压缩已启用: 编码={','.join(compressor.preference)}, 阈值={compressor.min_size}字节")
+    return compressor
@@ -1,20 +1,136 @@
 """Business Gemini Pool 数据库管理器 - 简化版本，Windows兼容"""
 
 import sqlite3
+import base64
+import html
 import json
 import uuid
 import logging
-from datetime import datetime, timedelta
+import mimetypes
+import time
 from pathlib import Path
 from typing import List, Dict, Optional, Any, Tuple
-from dataclasses import dataclass, asdict
-import threading
+from dataclasses import dataclass
 import os
 
+from sqlite_pool import get_sqlite_pool
+
 # 配置日志
 logger = logging.getLogger('gemini_pool.database')
 
 
+# 会话标题和消息内容的全文索引：FTS5 外部内容表（不重复存储正文），由触发器与原表保持同步。
+# trigram 分词按连续三个字符建索引，中文等不以空格分词的文本也能做子串匹配；少于三个字符的关键词无法走索引
+FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+        title, content='conversations', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+        INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE OF title ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+# 消息搜索最多打分的命中数（取最新的命中），限制高频词的查询耗时
+SEARCH_MAX_CANDIDATES = int(os.getenv('CONVERSATION_SEARCH_CANDIDATES', '2000'))
+# 标题命中的权重（bm25 分数越小越相关，乘以权重后排序更靠前）
+TITLE_MATCH_WEIGHT = 2.0
+# 片段高亮先用控制字符标记，HTML 转义正文后再替换成 <mark>
+_MARK_OPEN, _MARK_CLOSE = '\x02', '\x03'
+
+
+def fts5_trigram_available() -> bool:
+    """当前 SQLite 是否支持 FTS5 trigram 分词（SQLite 3.34+ 且编译了 FTS5）"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(x, tokenize='trigram')")
+        return True
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+
+def init_search_index(conn: sqlite3.Connection) -> bool:
+    """创建全文索引表和同步触发器，索引表为新建时用现有数据重建；不支持时返回 False"""
+    if not fts5_trigram_available():
+        # 没有索引表时不能建触发器，否则每次写入会话/消息都会失败
+        return False
+    existing = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE name IN ('conversations_fts', 'messages_fts')")}
+    for sql in FTS_SCHEMA:
+        conn.execute(sql)
+    for table in ('conversations_fts', 'messages_fts'):
+        if table not in existing:
+            conn.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+            logger.info(f"全文索引已重建: {table}")
+    return True
+
+
+def fts_phrase_query(terms: List[str]) -> str:
+    """把关键词转成 FTS5 查询：每个词作为短语（避免被解析成 AND/OR/NEAR 等语法），多个词同时命中"""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def encode_cursor(sort_value: Any, row_id: int) -> str:
+    """把分页位置（排序列的值和行ID）编码成不透明游标"""
+    raw = json.dumps([sort_value, row_id], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, int]:
+    """解码 encode_cursor 生成的游标，格式不对时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"无效的分页游标: {cursor!r}") from e
+    if not isinstance(sort_value, str) or not isinstance(row_id, int) or isinstance(row_id, bool):
+        raise ValueError(f"无效的分页游标: {cursor!r}")
+    return sort_value, row_id
+
+
+def _highlight(text: Optional[str]) -> Optional[str]:
+    if text is None:
+        return None
+    return html.escape(text).replace(_MARK_OPEN, '<mark>').replace(_MARK_CLOSE, '</mark>')
+
+
 @dataclass
 class Conversation:
     """会话数据类"""
@@ -29,6 +145,7 @@ class Conversation:
     gemini_session_data: Optional[str] = None
     user_id: str = ""
     metadata: Optional[Dict] = None
+    snippet: Optional[str] = None  # 搜索结果的命中片段（HTML 转义，命中处用 <mark> 标出）
 
 
 @dataclass
@@ -70,13 +187,16 @@ class Image:
 class ConversationManager:
     """会话管理器"""
 
-    def __init__(self, db_path: Optional[str] = None):
-        """初始化数据库连接"""
+    def __init__(self, db_path: Optional[str] = None, image_dir: Optional[str] = None):
+        """初始化数据库连接；image_dir 为图片缓存目录（与 gemini.IMAGE_CACHE_DIR 相同），用于补录旧图片"""
         if db_path is None:
             db_path = Path(__file__).parent / "conversations.db"
 
         self.db_path = db_path
-        self.lock = threading.Lock()
+        self.image_dir = Path(image_dir) if image_dir else Path(__file__).parent / "image"
+        self.search_enabled = False
+        # 写操作都以任务形式提交给连接池的写线程，按提交顺序串行执行并合并提交，这里不再需要锁
+        self.pool = get_sqlite_pool(db_path)
         self._init_database()
 
     def _init_database(self):
@@ -98,7 +218,7 @@ class ConversationManager:
             logger.info("开始执行数据库脚本...")
 
             try:
-                with sqlite3.connect(self.db_path, timeout=10.0) as conn:
+                with self.pool.write() as conn:
                     logger.info("数据库连接成功，开始执行脚本...")
 
                     # 分批执行SQL
@@ -111,16 +231,18 @@ class ConversationManager:
                             try:
                                 conn.execute(statement)
                                 executed_count += 1
-                                if executed_count % 10 == 0:
-                                    conn.commit()
-                                    logger.info(f"已执行 {executed_count} 条SQL语句")
                             except sqlite3.Error as e:
                                 logger.warning(f"SQL语句执行失败 (语句 {i}): {e}")
                                 logger.warning(f"语句内容: {statement[:100]}...")
 
-                    conn.commit()
                     logger.info(f"数据库初始化完成，共执行 {executed_count} 条SQL语句")
 
+                self.search_enabled = self.pool.execute(init_search_index)
+                if not self.search_enabled:
+                    logger.warning("当前 SQLite 不支持 FTS5 trigram 分词，会话搜索使用 LIKE 扫描")
+
+                self._backfill_images()
+
             except Exception as e:
                 logger.error(f"数据库初始化失败: {e}")
                 logger.error("跳过数据库初始化，服务将继续运行")
@@ -129,6 +251,43 @@ class ConversationManager:
             logger.error(f"数据库初始化异常: {e}")
             logger.error("跳过数据库初始化，服务将继续运行")
 
+    def _backfill_images(self):
+        """一次性把图片缓存目录中没有数据库记录的图片补录到默认用户下
+
+        图库改为按 images 表分页列出，之前只存在于缓存目录中的图片（以及未带用户ID保存的图片）
+        在这里补录一次，完成后在 settings 中记下 images_backfilled，之后启动不再扫描目录
+        """
+        with self.pool.read() as conn:
+            if conn.execute("SELECT 1 FROM settings WHERE key = 'images_backfilled'").fetchone():
+                return
+
+        files = []
+        if self.image_dir.is_dir():
+            for path in sorted(self.image_dir.iterdir()):
+                mime_type = mimetypes.guess_type(path.name)[0]
+                if not path.is_file() or not mime_type or not mime_type.startswith('image/'):
+                    continue
+                stat = path.stat()
+                created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(stat.st_mtime))
+                files.append((path.name, str(path), stat.st_size, mime_type, created_at))
+
+        user_id = self.get_user_id()
+
+        def backfill(conn):
+            count = 0
+            for filename, file_path, file_size, mime_type, created_at in files:
+                count += conn.execute("""
+                    INSERT INTO images (filename, file_path, file_size, mime_type, user_id, created_at)
+                    SELECT ?, ?, ?, ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM images WHERE filename = ?)
+                """, (filename, file_path, file_size, mime_type, user_id, created_at, filename)).rowcount
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('images_backfilled', '1')")
+            return count
+
+        count = self.pool.execute(backfill)
+        if count:
+            logger.info(f"已从图片缓存目录补录 {count} 张图片记录")
+
     def get_user_id(self, api_key: str = "", email: str = "") -> str:
         """基于邮箱或API key生成用户ID"""
         # 优先使用邮箱账号
@@ -137,121 +296,531 @@ class ConversationManager:
         # 如果没有邮箱，使用默认用户ID
         return "default_user"
 
-    def get_active_conversation(self, user_id: str):
+    # ---------- 行转换 ----------
+
+    @staticmethod
+    def _load_json(value):
+        if value is None or value == "":
+            return None
+        try:
+            return json.loads(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _dump_json(value) -> Optional[str]:
+        return None if value is None else json.dumps(value, ensure_ascii=False)
+
+    def _query(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        with self.pool.read() as conn:
+            cursor = conn.cursor()
+            # 只在本游标上按列名取值，共享的只读连接保持返回元组
+            cursor.row_factory = sqlite3.Row
+            return cursor.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _page(rows: List[sqlite3.Row], limit: int, sort_column: str) -> Tuple[List[sqlite3.Row], Optional[str]]:
+        """查询多取一行判断是否还有下一页，有则用本页最后一行生成游标"""
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1][sort_column], rows[-1]['id'])
+
+    def _to_conversation(self, row: sqlite3.Row) -> Conversation:
+        return Conversation(
+            id=row['id'], session_id=row['session_id'], title=row['title'], model=row['model'],
+            created_at=row['created_at'], updated_at=row['updated_at'],
+            message_count=row['message_count'] or 0, is_active=bool(row['is_active']),
+            gemini_session_data=row['gemini_session_data'], user_id=row['user_id'] or "",
+            metadata=self._load_json(row['metadata'])
+        )
+
+    def _to_message(self, row: sqlite3.Row) -> Message:
+        return Message(
+            id=row['id'], conversation_id=row['conversation_id'], role=row['role'], content=row['content'],
+            timestamp=row['timestamp'], message_type=row['message_type'] or "text",
+            file_metadata=self._load_json(row['file_metadata']), token_count=row['token_count'] or 0,
+            model=row['model'] or ""
+        )
+
+    def _to_image(self, row: sqlite3.Row) -> Image:
+        return Image(
+            id=row['id'], filename=row['filename'], original_filename=row['original_filename'],
+            file_path=row['file_path'], file_size=row['file_size'] or 0, image_width=row['image_width'],
+            image_height=row['image_height'], mime_type=row['mime_type'] or "image/png", title=row['title'],
+            description=row['description'], prompt=row['prompt'], conversation_id=row['conversation_id'],
+            message_id=row['message_id'], user_id=row['user_id'], tags=self._load_json(row['tags']),
+            metadata=self._load_json(row['metadata']), created_at=row['created_at']
+        )
+
+    # ---------- 会话 ----------
+
+    def get_active_conversation(self, user_id: str) -> Optional[Conversation]:
         """获取当前活跃会话"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT session_id, title, created_at, updated_at
-                    FROM conversations
-                    WHERE user_id = ? AND is_active = 1
-                    ORDER BY updated_at DESC
-                    LIMIT 1
-                """, (user_id,))
-                result = cursor.fetchone()
-                if result:
-                    return {
-                        'session_id': result[0],
-                        'title': result[1],
-                        'created_at': result[2],
-                        'updated_at': result[3]
-                    }
-                return None
+            rows = self._query("""
+                SELECT * FROM conversations
+                WHERE user_id = ? AND is_active = 1
+                ORDER BY updated_at DESC
+                LIMIT 1
+            """, (user_id,))
+            return self._to_conversation(rows[0]) if rows else None
         except Exception as e:
             logger.error(f"获取活跃会话失败: {e}")
             return None
 
-    def record_conversation(self, user_id: str, messages: List[Dict[str, Any]]) -> str:
-        """记录对话"""
+    def get_conversation(self, conversation_id: int, user_id: str) -> Optional[Conversation]:
+        """获取用户的指定会话"""
         try:
-            conversation_id = f"conv_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{user_id[:8]}"
-
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-
-                # 插入对话记录
-                cursor.execute("""
-                    INSERT INTO conversations
-                    (conversation_id, user_id, title, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (conversation_id, user_id, "新对话",
-                     datetime.now(), datetime.now()))
-
-                # 插入消息记录
-                for i, message in enumerate(messages):
-                    cursor.execute("""
-                        INSERT INTO messages
-                        (conversation_id, role, content, message_order, created_at)
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (conversation_id, message.get('role'),
-                         message.get('content'), i, datetime.now()))
-
-                conn.commit()
-                logger.info(f"记录对话成功: {conversation_id}")
-                return conversation_id
-
+            rows = self._query("SELECT * FROM conversations WHERE id = ? AND user_id = ?",
+                               (conversation_id, user_id))
+            return self._to_conversation(rows[0]) if rows else None
         except Exception as e:
-            logger.error(f"记录对话失败: {e}")
-            return ""
+            logger.error(f"获取会话失败: {e}")
+            return None
 
-    def get_conversations(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-        """获取用户的对话列表"""
+    def get_conversations(self, user_id: str, limit: int = 50,
+                          cursor: Optional[str] = None) -> Tuple[List[Conversation], Optional[str]]:
+        """按 (updated_at, id) 游标分页获取用户的会话列表（最近更新的在前）
+
+        返回 (会话列表, 下一页游标)，没有下一页时游标为 None；游标无效时抛出 ValueError
+        """
+        after = decode_cursor(cursor) if cursor else None
+        conditions = ["user_id = ?"]
+        params: List[Any] = [user_id]
+        if after is not None:
+            conditions.append("(updated_at, id) < (?, ?)")
+            params += after
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT conversation_id, title, created_at, updated_at,
-                           (SELECT COUNT(*) FROM messages WHERE conversation_id = c.conversation_id) as message_count
-                    FROM conversations c
-                    WHERE user_id = ?
-                    ORDER BY updated_at DESC
-                    LIMIT ?
-                """, (user_id, limit))
-
-                columns = [desc[0] for desc in cursor.description]
-                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            rows = self._query(f"""
+                SELECT * FROM conversations
+                WHERE {' AND '.join(conditions)}
+                ORDER BY updated_at DESC, id DESC
+                LIMIT ?
+            """, (*params, limit + 1))
+            rows, next_cursor = self._page(rows, limit, 'updated_at')
+            return [self._to_conversation(row) for row in rows], next_cursor
+        except Exception as e:
+            logger.error(f"获取会话列表失败: {e}")
+            return [], None
+
+    def search_conversations(self, user_id: str, query: str, limit: int = 50) -> List[Conversation]:
+        """按标题和消息内容搜索用户的会话，按相关度排序，结果带命中片段
 
+        所有关键词都不少于三个字符时走全文索引，否则（或 SQLite 不支持 FTS5 trigram 时）退回 LIKE 扫描该用户的会话。
+        命中消息很多时只在最新的 SEARCH_MAX_CANDIDATES 条中排序
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        try:
+            if self.search_enabled and all(len(term) >= 3 for term in terms):
+                return self._search_fts(user_id, terms, limit)
+            return self._search_like(user_id, terms, limit)
         except Exception as e:
-            logger.error(f"获取对话列表失败: {e}")
+            logger.error(f"搜索会话失败: {e}")
             return []
 
-    def get_messages(self, conversation_id: str) -> List[Dict[str, Any]]:
-        """获取对话的消息"""
+    def _search_fts(self, user_id: str, terms: List[str], limit: int) -> List[Conversation]:
+        # CROSS JOIN 固定以全文索引为外层循环：用户过滤不够选择性时（如所有会话都属于 default_user），
+        # 优化器会改为遍历该用户的全部会话/消息再逐行回查索引，慢几个数量级
+        match = fts_phrase_query(terms)
+        scores: Dict[int, float] = {}
+        for row in self._query("""
+            SELECT c.id, conversations_fts.rank AS score
+            FROM conversations_fts CROSS JOIN conversations c ON c.id = conversations_fts.rowid
+            WHERE conversations_fts MATCH ? AND c.user_id = ?
+        """, (match, user_id)):
+            scores[row['id']] = row['score'] * TITLE_MATCH_WEIGHT
+        # 只对最新的 SEARCH_MAX_CANDIDATES 条命中消息打分：索引按 rowid 倒序流式返回，高频词不必给全部命中算 bm25。
+        # 每个会话取最相关的一条消息，会话分数 = 标题分数 + 最佳消息分数
+        message_scores: Dict[int, Tuple[float, int]] = {}
+        for row in self._query("""
+            SELECT m.conversation_id, m.id AS message_id, messages_fts.rank AS score
+            FROM messages_fts
+            CROSS JOIN messages m ON m.id = messages_fts.rowid
+            CROSS JOIN conversations c ON c.id = m.conversation_id
+            WHERE messages_fts MATCH ? AND c.user_id = ?
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
+        """, (match, user_id, SEARCH_MAX_CANDIDATES)):
+            best = message_scores.get(row['conversation_id'])
+            if best is None or row['score'] < best[0]:
+                message_scores[row['conversation_id']] = (row['score'], row['message_id'])
+        best_message: Dict[int, int] = {}
+        for conversation_id, (score, message_id) in message_scores.items():
+            scores[conversation_id] = scores.get(conversation_id, 0.0) + score
+            best_message[conversation_id] = message_id
+
+        ranked = sorted(scores, key=scores.get)[:limit]
+        if not ranked:
+            return []
+        placeholders = ','.join('?' * len(ranked))
+        conversations = {row['id']: self._to_conversation(row) for row in self._query(
+            f"SELECT * FROM conversations WHERE id IN ({placeholders})", tuple(ranked))}
+
+        # 只为返回的会话生成片段：优先取命中的消息，只有标题命中时高亮标题
+        message_ids = [best_message[cid] for cid in ranked if cid in best_message]
+        message_snippets: Dict[int, str] = {}
+        title_snippets: Dict[int, str] = {}
+        if message_ids:
+            for row in self._query(f"""
+                SELECT rowid, snippet(messages_fts, 0, ?, ?, '…', 32) AS snippet FROM messages_fts
+                WHERE messages_fts MATCH ? AND rowid IN ({','.join('?' * len(message_ids))})
+            """, (_MARK_OPEN, _MARK_CLOSE, match, *message_ids)):
+                message_snippets[row['rowid']] = row['snippet']
+        title_only = [cid for cid in ranked if cid not in best_message]
+        if title_only:
+            for row in self._query(f"""
+                SELECT rowid, highlight(conversations_fts, 0, ?, ?) AS snippet FROM conversations_fts
+                WHERE conversations_fts MATCH ? AND rowid IN ({','.join('?' * len(title_only))})
+            """, (_MARK_OPEN, _MARK_CLOSE, match, *title_only)):
+                title_snippets[row['rowid']] = row['snippet']
+
+        result = []
+        for cid in ranked:
+            conversation = conversations.get(cid)
+            if conversation is None:
+                continue
+            if cid in best_message:
+                conversation.snippet = _highlight(message_snippets.get(best_message[cid]))
+            else:
+                conversation.snippet = _highlight(title_snippets.get(cid))
+            result.append(conversation)
+        return result
+
+    def _search_like(self, user_id: str, terms: List[str], limit: int) -> List[Conversation]:
+        # 关键词太短无法走 trigram 索引：只扫描该用户的会话，按更新时间排序
+        patterns = ['%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for term in terms]
+        condition = ' AND '.join(
+            "(c.title LIKE ? ESCAPE '\\' OR EXISTS (SELECT 1 FROM messages m "
+            "WHERE m.conversation_id = c.id AND m.content LIKE ? ESCAPE '\\'))" for _ in terms)
+        params = [value for pattern in patterns for value in (pattern, pattern)]
+        rows = self._query(f"""
+            SELECT c.* FROM conversations c
+            WHERE c.user_id = ? AND {condition}
+            ORDER BY c.updated_at DESC, c.id DESC
+            LIMIT ?
+        """, (user_id, *params, limit))
+        return [self._to_conversation(row) for row in rows]
+
+    def create_conversation(self, title: str = "新对话", model: str = "gemini-enterprise",
+                            user_id: str = "", metadata: Optional[Dict] = None) -> Conversation:
+        """创建会话，返回带数据库ID的会话对象"""
+        session_id = str(uuid.uuid4())
+
+        def insert(conn):
+            cursor = conn.execute("""
+                INSERT INTO conversations (session_id, title, model, user_id, metadata)
+                VALUES (?, ?, ?, ?, ?)
+            """, (session_id, title, model, user_id, self._dump_json(metadata)))
+            return cursor.lastrowid
+
+        conversation_id = self.pool.execute(insert)
+        conversation = self.get_conversation(conversation_id, user_id)
+        logger.info(f"创建会话成功: {conversation_id}")
+        return conversation or Conversation(id=conversation_id, session_id=session_id, title=title,
+                                            model=model, user_id=user_id, metadata=metadata)
+
+    def set_active_conversation(self, conversation_id: int, user_id: str) -> bool:
+        """将指定会话设为用户唯一的活跃会话"""
+        def activate(conn):
+            if conn.execute("SELECT 1 FROM conversations WHERE id = ? AND user_id = ?",
+                            (conversation_id, user_id)).fetchone() is None:
+                return False
+            conn.execute("""
+                UPDATE conversations SET is_active = (id = ?)
+                WHERE user_id = ? AND (is_active = 1 OR id = ?)
+            """, (conversation_id, user_id, conversation_id))
+            return True
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT role, content, message_order, created_at
-                    FROM messages
-                    WHERE conversation_id = ?
-                    ORDER BY message_order
-                """, (conversation_id,))
-
-                columns = [desc[0] for desc in cursor.description]
-                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            return self.pool.execute(activate)
+        except Exception as e:
+            logger.error(f"设置活跃会话失败: {e}")
+            return False
+
+    def update_conversation(self, conversation_id: int, user_id: str, **fields) -> bool:
+        """更新会话标题、模型、元数据或 Gemini 会话状态"""
+        allowed = {k: v for k, v in fields.items() if k in ('title', 'model', 'metadata', 'gemini_session_data')}
+        if not allowed:
+            return False
+        if 'metadata' in allowed:
+            allowed['metadata'] = self._dump_json(allowed['metadata'])
+        assignments = ', '.join(f"{k} = ?" for k in allowed)
+
+        def update(conn):
+            cursor = conn.execute(
+                f"UPDATE conversations SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?",
+                (*allowed.values(), conversation_id, user_id)
+            )
+            return cursor.rowcount > 0
 
+        try:
+            return self.pool.execute(update)
+        except Exception as e:
+            logger.error(f"更新会话失败: {e}")
+            return False
+
+    def delete_conversation(self, conversation_id: int, user_id: str) -> bool:
+        """删除会话及其消息和标签（图片保留，解除会话关联）"""
+        def delete(conn):
+            cursor = conn.execute("DELETE FROM conversations WHERE id = ? AND user_id = ?",
+                                  (conversation_id, user_id))
+            if cursor.rowcount == 0:
+                return False
+            # 连接未开启 foreign_keys，级联关系在这里显式处理
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM conversation_tags WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("UPDATE images SET conversation_id = NULL, message_id = NULL WHERE conversation_id = ?",
+                         (conversation_id,))
+            return True
+
+        try:
+            deleted = self.pool.execute(delete)
+            if deleted:
+                logger.info(f"删除会话成功: {conversation_id}")
+            return deleted
+        except Exception as e:
+            logger.error(f"删除会话失败: {e}")
+            return False
+
+    def record_conversation(self, user_id: str, messages: List[Dict[str, Any]]) -> Optional[int]:
+        """把一组消息记录为新会话（会话和消息在同一事务中写入），返回会话ID"""
+        session_id = str(uuid.uuid4())
+
+        def insert(conn):
+            conversation_id = conn.execute(
+                "INSERT INTO conversations (session_id, title, user_id, message_count) VALUES (?, ?, ?, ?)",
+                (session_id, "新对话", user_id, len(messages))
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                [(conversation_id, m.get('role'), m.get('content') or "") for m in messages]
+            )
+            return conversation_id
+
+        try:
+            conversation_id = self.pool.execute(insert)
+            logger.info(f"记录对话成功: {conversation_id}")
+            return conversation_id
+        except Exception as e:
+            logger.error(f"记录对话失败: {e}")
+            return None
+
+    # ---------- 消息 ----------
+
+    def get_messages(self, conversation_id: int, user_id: Optional[str] = None, limit: int = 100,
+                     cursor: Optional[str] = None, order: str = 'asc') -> Tuple[List[Message], Optional[str]]:
+        """按 (timestamp, id) 游标分页获取会话消息；order 为 'asc' 时从最早的消息开始，'desc' 时从最新的开始
+
+        传入 user_id 时只返回该用户会话的消息。返回 (消息列表, 下一页游标)，游标无效时抛出 ValueError
+        """
+        after = decode_cursor(cursor) if cursor else None
+        direction, compare = ('DESC', '<') if order == 'desc' else ('ASC', '>')
+        source = "messages m"
+        conditions = ["m.conversation_id = ?"]
+        params: List[Any] = [conversation_id]
+        if user_id is not None:
+            source += " JOIN conversations c ON c.id = m.conversation_id"
+            conditions.append("c.user_id = ?")
+            params.append(user_id)
+        if after is not None:
+            conditions.append(f"(m.timestamp, m.id) {compare} (?, ?)")
+            params += after
+        try:
+            rows = self._query(f"""
+                SELECT m.* FROM {source}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY m.timestamp {direction}, m.id {direction}
+                LIMIT ?
+            """, (*params, limit + 1))
+            rows, next_cursor = self._page(rows, limit, 'timestamp')
+            return [self._to_message(row) for row in rows], next_cursor
         except Exception as e:
             logger.error(f"获取消息失败: {e}")
-            return []
+            return [], None
+
+    def add_message(self, conversation_id: int, role: str, content: str, message_type: str = "text",
+                    file_metadata: Optional[Dict] = None, token_count: int = 0,
+                    model: Optional[str] = None) -> int:
+        """追加消息并更新会话的消息数和更新时间，返回消息ID"""
+        def insert(conn):
+            message_id = conn.execute("""
+                INSERT INTO messages (conversation_id, role, content, message_type, file_metadata, token_count, model)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (conversation_id, role, content, message_type, self._dump_json(file_metadata),
+                  token_count, model)).lastrowid
+            conn.execute("""
+                UPDATE conversations SET message_count = message_count + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (conversation_id,))
+            return message_id
+
+        return self.pool.execute(insert)
+
+    def clear_conversation_messages(self, conversation_id: int, user_id: str) -> bool:
+        """清除会话的全部消息"""
+        def clear(conn):
+            cursor = conn.execute("""
+                UPDATE conversations SET message_count = 0, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND user_id = ?
+            """, (conversation_id, user_id))
+            if cursor.rowcount == 0:
+                return False
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            return True
 
-    def delete_conversation(self, conversation_id: str) -> bool:
-        """删除对话"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM messages WHERE conversation_id = ?",
-                             (conversation_id,))
-                cursor.execute("DELETE FROM conversations WHERE conversation_id = ?",
-                             (conversation_id,))
-                conn.commit()
-                logger.info(f"删除对话成功: {conversation_id}")
-                return True
+            return self.pool.execute(clear)
+        except Exception as e:
+            logger.error(f"清除消息失败: {e}")
+            return False
 
+    def get_statistics(self, user_id: str) -> Dict[str, Any]:
+        """用户的会话、消息、Token 和图片统计"""
+        try:
+            conversations = self._query("""
+                SELECT COUNT(*) AS total, COALESCE(SUM(message_count), 0) AS messages,
+                       MAX(updated_at) AS last_updated
+                FROM conversations WHERE user_id = ?
+            """, (user_id,))[0]
+            tokens = self._query("""
+                SELECT COALESCE(SUM(m.token_count), 0) AS tokens FROM messages m
+                JOIN conversations c ON c.id = m.conversation_id
+                WHERE c.user_id = ?
+            """, (user_id,))[0]
+            images = self._query("SELECT COUNT(*) AS total FROM images WHERE user_id = ?", (user_id,))[0]
+            active = self.get_active_conversation(user_id)
+            return {
+                'total_conversations': conversations['total'],
+                'total_messages': conversations['messages'],
+                'total_tokens': tokens['tokens'],
+                'total_images': images['total'],
+                'active_conversation_id': active.id if active else None,
+                'last_updated': conversations['last_updated'],
+            }
+        except Exception as e:
+            logger.error(f"获取统计信息失败: {e}")
+            return {}
+
+    # ---------- 图片 ----------
+
+    def add_image(self, filename: str, file_path: str, user_id: str, file_size: int = 0,
+                  image_width: Optional[int] = None, image_height: Optional[int] = None,
+                  mime_type: str = "image/png", conversation_id: Optional[int] = None,
+                  message_id: Optional[int] = None, prompt: Optional[str] = None,
+                  title: Optional[str] = None, description: Optional[str] = None,
+                  original_filename: Optional[str] = None, tags: Optional[List[str]] = None,
+                  metadata: Optional[Dict] = None) -> int:
+        """记录生成的图片，返回图片ID（失败返回 -1）"""
+        def insert(conn):
+            return conn.execute("""
+                INSERT INTO images (
+                    filename, original_filename, file_path, file_size, image_width, image_height, mime_type,
+                    title, description, prompt, conversation_id, message_id, user_id, tags, metadata
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (filename, original_filename, file_path, file_size, image_width, image_height, mime_type,
+                  title, description, prompt, conversation_id, message_id, user_id,
+                  self._dump_json(tags), self._dump_json(metadata))).lastrowid
+
+        try:
+            return self.pool.execute(insert)
+        except Exception as e:
+            logger.error(f"保存图片记录失败: {e}")
+            return -1
+
+    def get_images(self, user_id: str, limit: int = 20, cursor: Optional[str] = None,
+                   search: str = "") -> Tuple[List[Image], Optional[str]]:
+        """按 (created_at, id) 游标分页获取用户的图片（最新的在前），search 按文件名、标题和提示词过滤
+
+        返回 (图片列表, 下一页游标)，游标无效时抛出 ValueError
+        """
+        after = decode_cursor(cursor) if cursor else None
+        conditions = ["user_id = ?"]
+        params: List[Any] = [user_id]
+        if after is not None:
+            conditions.append("(created_at, id) < (?, ?)")
+            params += after
+        if search:
+            pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            conditions.append("(filename LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\' OR prompt LIKE ? ESCAPE '\\')")
+            params += [pattern] * 3
+        try:
+            rows = self._query(f"""
+                SELECT * FROM images
+                WHERE {' AND '.join(conditions)}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            """, (*params, limit + 1))
+            rows, next_cursor = self._page(rows, limit, 'created_at')
+            return [self._to_image(row) for row in rows], next_cursor
+        except Exception as e:
+            logger.error(f"获取图片列表失败: {e}")
+            return [], None
+
+    def get_image_by_id(self, image_id: int, user_id: str) -> Optional[Image]:
+        """获取用户的指定图片"""
+        try:
+            rows = self._query("SELECT * FROM images WHERE id = ? AND user_id = ?", (image_id, user_id))
+            return self._to_image(rows[0]) if rows else None
         except Exception as e:
-            logger.error(f"删除对话失败: {e}")
+            logger.error(f"获取图片失败: {e}")
+            return None
+
+    def update_image(self, image_id: int, user_id: str, **fields) -> bool:
+        """更新图片标题、描述、标签或元数据"""
+        allowed = {k: v for k, v in fields.items() if k in ('title', 'description', 'tags', 'metadata')}
+        if not allowed:
+            return False
+        for key in ('tags', 'metadata'):
+            if key in allowed:
+                allowed[key] = self._dump_json(allowed[key])
+        assignments = ', '.join(f"{k} = ?" for k in allowed)
+
+        def update(conn):
+            cursor = conn.execute(f"UPDATE images SET {assignments} WHERE id = ? AND user_id = ?",
+                                  (*allowed.values(), image_id, user_id))
+            return cursor.rowcount > 0
+
+        try:
+            return self.pool.execute(update)
+        except Exception as e:
+            logger.error(f"更新图片失败: {e}")
+            return False
+
+    def delete_image(self, image_id: int, user_id: str) -> bool:
+        """删除图片记录（缓存目录中的文件由图片缓存清理负责）"""
+        def delete(conn):
+            cursor = conn.execute("DELETE FROM images WHERE id = ? AND user_id = ?", (image_id, user_id))
+            return cursor.rowcount > 0
+
+        try:
+            return self.pool.execute(delete)
+        except Exception as e:
+            logger.error(f"删除图片失败: {e}")
             return False
 
+    def delete_images_by_filename(self, filenames: List[str], user_id: Optional[str] = None) -> int:
+        """按文件名删除图片记录（缓存文件被删除或过期清理后调用），不传 user_id 时删除所有用户的记录，返回删除条数"""
+        if not filenames:
+            return 0
+
+        def delete(conn):
+            placeholders = ', '.join('?' * len(filenames))
+            if user_id is None:
+                cursor = conn.execute(f"DELETE FROM images WHERE filename IN ({placeholders})", tuple(filenames))
+            else:
+                cursor = conn.execute(f"DELETE FROM images WHERE filename IN ({placeholders}) AND user_id = ?",
+                                      (*filenames, user_id))
+            return cursor.rowcount
+
+        try:
+            return self.pool.execute(delete)
+        except Exception as e:
+            logger.error(f"删除图片记录失败: {e}")
+            return 0
+
 
 # 全局数据库管理器实例
 _conversation_manager = None
@@ -266,4 +835,4 @@ def get_conversation_manager() -> Optional[ConversationManager]:
 
 
 # 向后兼容的函数名
-init_database = get_conversation_manager
\ No newline at end of file
+init_database = get_conversation_manager
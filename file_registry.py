@@ -0,0 +1,412 @@
+"""Business Gemini Pool 上传文件注册表
+OpenAI file_id -> Gemini fileId 的映射持久化到 SQLite（重启后保留，多个进程可见），
+前面加一层有上限的内存 LRU 缓存；映射在 TTL 后过期（Gemini 会话中的上下文文件不会永久有效），
+后台线程定期清理过期记录，列表接口按 (created_at, id) 键集分页；
+记录文件所属的账号和会话用于亲和路由，并在磁盘上保留文件副本，换账号/会话时可以重新上传
+"""
+
+import base64
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from sqlite_pool import get_sqlite_pool
+
+logger = logging.getLogger('gemini_pool.files')
+
+# 本服务生成的文件ID形如 file-<十六进制>，也是副本的文件名
+_FILE_ID_RE = re.compile(r'file-[0-9a-f]+\Z')
+
+_COLUMNS = ("openai_file_id, gemini_file_id, session_name, filename, mime_type, "
+            "bytes, purpose, created_at, expires_at, account_idx")
+
+
+def _row_to_file(row: Tuple) -> Dict:
+    return {
+        "id": row[0],
+        "gemini_file_id": row[1],
+        "session_name": row[2],
+        "filename": row[3],
+        "mime_type": row[4],
+        "bytes": row[5],
+        "purpose": row[6],
+        "created_at": row[7],
+        "expires_at": row[8],
+        "account_idx": row[9],
+        "object": "file",
+    }
+
+
+def is_valid_file_id(openai_file_id: str) -> bool:
+    """是否为本服务生成的文件ID（客户端传入的ID用于拼接副本路径前先校验）"""
+    return isinstance(openai_file_id, str) and _FILE_ID_RE.match(openai_file_id) is not None
+
+
+def encode_file_cursor(created_at: int, openai_file_id: str) -> str:
+    """把分页位置（创建时间和文件ID）编码成不透明游标"""
+    raw = json.dumps([created_at, openai_file_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_file_cursor(cursor: str) -> Optional[Tuple[int, str]]:
+    """解码 encode_file_cursor 生成的游标，不是游标（如文件ID）时返回 None"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, openai_file_id = json.loads(raw)
+    except (TypeError, ValueError):
+        return None
+    if (not isinstance(created_at, int) or isinstance(created_at, bool)
+            or not isinstance(openai_file_id, str)):
+        return None
+    return created_at, openai_file_id
+
+
+def to_openai_file(file_info: Dict) -> Dict:
+    """OpenAI 文件对象（不暴露 Gemini 内部 ID 和会话）"""
+    return {
+        "id": file_info["id"],
+        "object": "file",
+        "bytes": file_info.get("bytes", 0),
+        "created_at": file_info.get("created_at", 0),
+        "expires_at": file_info.get("expires_at"),
+        "filename": file_info.get("filename", ""),
+        "purpose": file_info.get("purpose") or "assistants",
+    }
+
+
+class FileRegistry:
+    """上传文件注册表：SQLite 持久化 + LRU 缓存 + TTL 过期
+
+    缓存条目最多保留 cache_ttl 秒，其他进程删除的文件在这段时间后可见；
+    retain_dir 不为空时把文件内容保存在该目录下（按 openai_file_id 命名），随映射一起过期删除
+    """
+
+    def __init__(self, db_path: Optional[str] = None, ttl: float = 24 * 3600,
+                 cache_size: int = 1024, cache_ttl: float = 60.0, sweep_interval: float = 300.0,
+                 retain_dir: Optional[str] = None):
+        if db_path is None:
+            db_path = Path(__file__).parent / "conversations.db"
+        self.db_path = db_path
+        self.pool = get_sqlite_pool(db_path)
+        self.retain_dir = Path(retain_dir) if retain_dir else None
+        if self.retain_dir is not None:
+            self.retain_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        # openai_file_id -> (缓存时间, 文件信息)
+        self._cache: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.swept = 0
+        self._stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+        self._init_table()
+
+    def _init_table(self):
+        try:
+            with self.pool.write() as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS uploaded_files (
+                        openai_file_id VARCHAR(64) PRIMARY KEY,
+                        gemini_file_id VARCHAR(255) NOT NULL,
+                        session_name VARCHAR(255) NOT NULL,
+                        filename VARCHAR(255),
+                        mime_type VARCHAR(100),
+                        bytes INTEGER DEFAULT 0,
+                        purpose VARCHAR(50) DEFAULT 'assistants',
+                        created_at INTEGER NOT NULL,
+                        expires_at INTEGER NOT NULL,
+                        account_idx INTEGER
+                    )
+                """)
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(uploaded_files)")}
+                if 'account_idx' not in columns:
+                    conn.execute("ALTER TABLE uploaded_files ADD COLUMN account_idx INTEGER")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_uploaded_files_session ON uploaded_files(session_name)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_uploaded_files_expires ON uploaded_files(expires_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_uploaded_files_created "
+                             "ON uploaded_files(created_at, openai_file_id)")
+        except Exception as e:
+            logger.error(f"初始化上传文件表失败: {e}")
+
+    # ---------- 缓存 ----------
+
+    def _cache_get(self, openai_file_id: str) -> Optional[Dict]:
+        """查缓存并在锁内计数命中/未命中"""
+        now = time.time()
+        with self.lock:
+            entry = self._cache.get(openai_file_id)
+            if entry is not None:
+                cached_at, file_info = entry
+                if now - cached_at <= self.cache_ttl and file_info["expires_at"] > now:
+                    self._cache.move_to_end(openai_file_id)
+                    self.hits += 1
+                    return file_info
+                del self._cache[openai_file_id]
+            self.misses += 1
+            return None
+
+    def _cache_put(self, file_info: Dict):
+        with self.lock:
+            self._cache[file_info["id"]] = (time.time(), file_info)
+            self._cache.move_to_end(file_info["id"])
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_discard(self, openai_file_id: str):
+        with self.lock:
+            self._cache.pop(openai_file_id, None)
+
+    # ---------- 读写 ----------
+
+    def add_file(self, openai_file_id: str, gemini_file_id: str, session_name: str,
+                 filename: str, mime_type: str, size: int, purpose: str = "assistants",
+                 account_idx: Optional[int] = None, content: Optional[bytes] = None) -> Dict:
+        """添加文件映射；提供 content 且启用了副本目录时保留文件内容用于重新上传"""
+        now = int(time.time())
+        file_info = {
+            "id": openai_file_id,
+            "gemini_file_id": gemini_file_id,
+            "session_name": session_name,
+            "filename": filename,
+            "mime_type": mime_type,
+            "bytes": size,
+            "purpose": purpose,
+            "created_at": now,
+            "expires_at": now + int(self.ttl),
+            "account_idx": account_idx,
+            "object": "file",
+        }
+        if content is not None:
+            self._retain(openai_file_id, content)
+        with self.pool.write() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO uploaded_files ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (openai_file_id, gemini_file_id, session_name, filename, mime_type,
+                 size, purpose, file_info["created_at"], file_info["expires_at"], account_idx)
+            )
+        self._cache_put(file_info)
+        return file_info
+
+    def get_file(self, openai_file_id: str) -> Optional[Dict]:
+        """获取文件信息（已过期的视为不存在）"""
+        file_info = self._cache_get(openai_file_id)
+        if file_info is not None:
+            return file_info
+        try:
+            with self.pool.read() as conn:
+                row = conn.execute(
+                    f"SELECT {_COLUMNS} FROM uploaded_files WHERE openai_file_id = ? AND expires_at > ?",
+                    (openai_file_id, int(time.time()))
+                ).fetchone()
+        except Exception as e:
+            logger.error(f"查询上传文件失败 {openai_file_id}: {e}")
+            return None
+        if row is None:
+            return None
+        file_info = _row_to_file(row)
+        self._cache_put(file_info)
+        return file_info
+
+    def get_gemini_file_id(self, openai_file_id: str) -> Optional[str]:
+        """获取 Gemini 文件ID"""
+        file_info = self.get_file(openai_file_id)
+        return file_info.get("gemini_file_id") if file_info else None
+
+    def get_session_for_file(self, openai_file_id: str) -> Optional[str]:
+        """获取文件关联的会话名称"""
+        file_info = self.get_file(openai_file_id)
+        return file_info.get("session_name") if file_info else None
+
+    def rebind_file(self, openai_file_id: str, gemini_file_id: str, session_name: str,
+                    account_idx: Optional[int]) -> Optional[Dict]:
+        """文件重新上传到其他账号/会话后更新映射，之后的请求路由到新位置"""
+        with self.pool.write() as conn:
+            conn.execute(
+                "UPDATE uploaded_files SET gemini_file_id = ?, session_name = ?, account_idx = ? "
+                "WHERE openai_file_id = ?",
+                (gemini_file_id, session_name, account_idx, openai_file_id)
+            )
+        self._cache_discard(openai_file_id)
+        return self.get_file(openai_file_id)
+
+    def delete_file(self, openai_file_id: str) -> bool:
+        """删除文件映射；映射存在且未过期时才删除保留的副本"""
+        if not is_valid_file_id(openai_file_id):
+            return False
+        self._cache_discard(openai_file_id)
+        with self.pool.write() as conn:
+            cursor = conn.execute("DELETE FROM uploaded_files WHERE openai_file_id = ? AND expires_at > ?",
+                                  (openai_file_id, int(time.time())))
+        if cursor.rowcount <= 0:
+            return False
+        self._discard_retained([openai_file_id])
+        return True
+
+    def list_files(self, limit: int = 100, after: Optional[str] = None,
+                   order: str = "desc") -> Tuple[List[Dict], Optional[str]]:
+        """按创建时间分页列出未过期的文件，返回 (文件列表, 下一页游标)，没有下一页时游标为 None
+
+        after 为上一页返回的游标，游标中带着 (created_at, id)，按值比较定位，
+        上一页最后一个文件之后被删除或过期也能继续翻页；
+        兼容 OpenAI 的 after=<上一页最后一个文件ID>：按ID查出位置，该文件已不存在时抛出 ValueError
+        """
+        descending = order != "asc"
+        comparison = "<" if descending else ">"
+        direction = "DESC" if descending else "ASC"
+        now = int(time.time())
+        sql = f"SELECT {_COLUMNS} FROM uploaded_files WHERE expires_at > ?"
+        params: List = [now]
+        if after:
+            position = decode_file_cursor(after)
+            if position is None:
+                # 已过期但尚未清理的行仍可定位
+                with self.pool.read() as conn:
+                    position = conn.execute(
+                        "SELECT created_at, openai_file_id FROM uploaded_files WHERE openai_file_id = ?",
+                        (after,)
+                    ).fetchone()
+                if position is None:
+                    raise ValueError(f"分页位置的文件已不存在: {after}")
+            sql += f" AND (created_at, openai_file_id) {comparison} (?, ?)"
+            params += position
+        sql += f" ORDER BY created_at {direction}, openai_file_id {direction} LIMIT ?"
+        params.append(limit + 1)
+        with self.pool.read() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        files = [_row_to_file(row) for row in rows[:limit]]
+        if len(rows) <= limit:
+            return files, None
+        return files, encode_file_cursor(files[-1]["created_at"], files[-1]["id"])
+
+    def list_files_for_session(self, session_name: str) -> List[Dict]:
+        """列出某个会话中未过期的文件"""
+        with self.pool.read() as conn:
+            rows = conn.execute(
+                f"SELECT {_COLUMNS} FROM uploaded_files WHERE session_name = ? AND expires_at > ? "
+                f"ORDER BY created_at",
+                (session_name, int(time.time()))
+            ).fetchall()
+        return [_row_to_file(row) for row in rows]
+
+    # ---------- 文件副本 ----------
+
+    def _retained_path(self, openai_file_id: str) -> Optional[Path]:
+        if self.retain_dir is None or not is_valid_file_id(openai_file_id):
+            return None
+        return self.retain_dir / openai_file_id
+
+    def _retain(self, openai_file_id: str, content: bytes):
+        path = self._retained_path(openai_file_id)
+        if path is None:
+            return
+        try:
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"保存文件副本失败 {openai_file_id}: {e}")
+
+    def load_retained(self, openai_file_id: str) -> Optional[bytes]:
+        """读取保留的文件内容，没有副本时返回 None"""
+        path = self._retained_path(openai_file_id)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"读取文件副本失败 {openai_file_id}: {e}")
+            return None
+
+    def _discard_retained(self, openai_file_ids: List[str]):
+        for openai_file_id in openai_file_ids:
+            path = self._retained_path(openai_file_id)
+            if path is None:
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"删除文件副本失败 {openai_file_id}: {e}")
+
+    # ---------- 过期清理 ----------
+
+    def sweep_expired(self) -> int:
+        """删除过期记录和文件副本，返回删除条数"""
+        now = time.time()
+        with self.pool.write() as conn:
+            expired = [row[0] for row in conn.execute(
+                "SELECT openai_file_id FROM uploaded_files WHERE expires_at <= ?", (int(now),))]
+            cursor = conn.execute("DELETE FROM uploaded_files WHERE expires_at <= ?", (int(now),))
+        self._discard_retained(expired)
+        with self.lock:
+            for openai_file_id in [k for k, (_, info) in self._cache.items() if info["expires_at"] <= now]:
+                del self._cache[openai_file_id]
+        if cursor.rowcount:
+            self.swept += cursor.rowcount
+            logger.info(f"已清理 {cursor.rowcount} 个过期文件映射")
+        return cursor.rowcount
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep_expired()
+            except Exception as e:
+                logger.warning(f"清理过期文件映射失败: {e}")
+
+    def start_sweeper(self):
+        if self._sweeper is not None or self.sweep_interval <= 0:
+            return
+        self._sweeper = threading.Thread(target=self._sweep_loop, name='file-registry-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join(timeout=5)
+            self._sweeper = None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            cached = len(self._cache)
+            hits, misses = self.hits, self.misses
+        return {
+            "cached": cached,
+            "cache_size": self.cache_size,
+            "hits": hits,
+            "misses": misses,
+            "swept": self.swept,
+            "ttl_seconds": self.ttl,
+        }
+
+
+# 全局文件注册表
+_file_registry = None
+
+
+def get_file_registry() -> FileRegistry:
+    """获取全局文件注册表实例（首次调用时启动过期清理线程）"""
+    global _file_registry
+    if _file_registry is None:
+        _file_registry = FileRegistry(
+            ttl=float(os.getenv('FILE_TTL_HOURS', '24')) * 3600,
+            cache_size=int(os.getenv('FILE_CACHE_SIZE', '1024')),
+            cache_ttl=float(os.getenv('FILE_CACHE_TTL', '60')),
+            sweep_interval=float(os.getenv('FILE_SWEEP_INTERVAL', '300')),
+            retain_dir=(os.getenv('FILE_RETAIN_DIR') or str(Path(__file__).parent / "uploads"))
+            if os.getenv('FILE_RETAIN_COPIES', 'true').lower() == 'true' else None,
+        )
+        _file_registry.start_sweeper()
+    return _file_registry
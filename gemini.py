@@ -12,17 +12,31 @@ import base64
 import uuid
 import threading
 import os
-import re
 import mimetypes
 import requests
 import logging
 import logging.handlers
+import atexit
 from pathlib import Path
 from datetime import datetime
 from dataclasses import dataclass, field
 from typing import List, Optional, Dict, Any
-from flask import Flask, request, Response, jsonify, send_from_directory, abort
+from flask import Flask, request, Response, jsonify, send_from_directory, abort, g
 from flask_cors import CORS
+from static_assets import create_static_asset_cache
+from compression import init_compression, no_compress
+from auth_config import AuthConfig, get_auth_config_manager
+from latency_metrics import STAGES, get_latency_metrics
+from metrics import (REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, JWT_REFRESHES, SESSION_CREATIONS,
+                     UPSTREAM_ERRORS, IMAGE_CACHE_EVICTIONS, classify_upstream_error, init_metrics)
+from tracing import get_tracer, init_tracing
+from structured_logging import LogPipeline, RateLimitFilter, create_formatter
+from file_registry import get_file_registry, to_openai_file
+from sqlite_pool import pool_stats
+from shared_state import SharedAccountState, get_shared_state
+from streaming_body import BlobSlice, RequestTooLarge, SpooledBlob, StreamingJsonBody, parse_blob_data_url, parse_json_stream
+from api_keys import (AuthError, DownstreamAuthenticator, admin_only, check_admin_record, extract_api_key,
+                      get_api_key_registry, init_api_key_routes)
 
 # 导入数据库管理器
 try:
@@ -83,6 +97,8 @@ def setup_logging():
 
     # 是否启用文件日志
     enable_file_logging = os.getenv('ENABLE_FILE_LOGGING', 'false').lower() == 'true'
+    # text 或 json（每行一个 JSON 对象）
+    log_format = os.getenv('LOG_FORMAT', 'text').lower()
 
     # 创建根日志器
     logger = logging.getLogger('gemini_pool')
@@ -91,18 +107,18 @@ def setup_logging():
     # 清除现有处理器
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
+    global log_pipeline
+    if log_pipeline is not None:
+        log_pipeline.stop()
 
     # 控制台处理器
     console_handler = logging.StreamHandler()
     console_handler.setLevel(log_level)
 
     # 控制台格式
-    console_formatter = logging.Formatter(
-        '[%(asctime)s] %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    console_formatter = create_formatter(log_format, '[%(asctime)s] %(levelname)s - %(message)s')
     console_handler.setFormatter(console_formatter)
-    logger.addHandler(console_handler)
+    handlers = [console_handler]
 
     # 文件处理器
     if enable_file_logging:
@@ -117,117 +133,171 @@ def setup_logging():
         file_handler.setLevel(logging.DEBUG)
 
         # 文件格式 - 包含更详细的信息
-        file_formatter = logging.Formatter(
-            '[%(asctime)s] %(levelname)s - %(name)s - %(filename)s:%(lineno)d - %(funcName)s() - %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
+        file_formatter = create_formatter(
+            log_format,
+            '[%(asctime)s] %(levelname)s - %(name)s - %(filename)s:%(lineno)d - %(funcName)s() - %(message)s'
         )
         file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
 
         print(f"[日志系统] 文件日志已启用，日志文件: {LOGS_DIR / 'gemini_pool.log'}")
 
+    # 业务线程只入队，格式化和写出由后台监听线程完成；同类消息按窗口限流
+    rate_limit = RateLimitFilter(
+        limit=int(os.getenv('LOG_RATE_LIMIT', '20')),
+        window=float(os.getenv('LOG_RATE_WINDOW', '10'))
+    )
+    log_pipeline = LogPipeline(
+        handlers,
+        queue_size=int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+        rate_limit=rate_limit,
+        trace_id_getter=lambda: get_tracer().trace_id
+    )
+    logger.addHandler(log_pipeline.handler)
+    log_pipeline.start()
+
     # 为不同模块创建子日志器
     api_logger = logging.getLogger('gemini_pool.api')
     jwt_logger = logging.getLogger('gemini_pool.jwt')
     chat_logger = logging.getLogger('gemini_pool.chat')
     image_logger = logging.getLogger('gemini_pool.image')
+    session_logger = logging.getLogger('gemini_pool.session')
+    upload_logger = logging.getLogger('gemini_pool.upload')
 
     # 设置子日志器级别和传播
-    for sub_logger in [api_logger, jwt_logger, chat_logger, image_logger]:
+    for sub_logger in [api_logger, jwt_logger, chat_logger, image_logger, session_logger, upload_logger]:
         sub_logger.setLevel(log_level)
         sub_logger.propagate = True
 
     return logger
 
 # 初始化日志系统
+log_pipeline = None
 gemini_logger = setup_logging()
+atexit.register(log_pipeline.stop)
+
+jwt_logger = logging.getLogger('gemini_pool.jwt')
+session_logger = logging.getLogger('gemini_pool.session')
+upload_logger = logging.getLogger('gemini_pool.upload')
+image_logger = logging.getLogger('gemini_pool.image')
 
 # API endpoints
-BASE_URL = "https://biz-discoveryengine.googleapis.com/v1alpha/locations/global"
+# 上游地址可通过环境变量覆盖（例如指向 benchmarks.mock_upstream 做压测）
+GEMINI_API_ORIGIN = os.getenv("GEMINI_API_ORIGIN", "https://biz-discoveryengine.googleapis.com").rstrip("/")
+GEMINI_AUTH_ORIGIN = os.getenv("GEMINI_AUTH_ORIGIN", "https://business.gemini.google").rstrip("/")
+BASE_URL = f"{GEMINI_API_ORIGIN}/v1alpha/locations/global"
 CREATE_SESSION_URL = f"{BASE_URL}/widgetCreateSession"
 STREAM_ASSIST_URL = f"{BASE_URL}/widgetStreamAssist"
 LIST_FILE_METADATA_URL = f"{BASE_URL}/widgetListSessionFileMetadata"
 ADD_CONTEXT_FILE_URL = f"{BASE_URL}/widgetAddContextFile"
-GETOXSRF_URL = "https://business.gemini.google/auth/getoxsrf"
+GETOXSRF_URL = f"{GEMINI_AUTH_ORIGIN}/auth/getoxsrf"
+
+# 聊天请求体：超过上限直接返回 413；超过流式解析阈值时增量解析，大图片转存到临时文件
+CHAT_MAX_BODY_BYTES = int(float(os.getenv("CHAT_MAX_BODY_MB", "64")) * 1024 * 1024)
+CHAT_STREAMING_PARSE = os.getenv("CHAT_STREAMING_PARSE", "true").lower() == "true"
+CHAT_STREAM_PARSE_MIN_BYTES = int(os.getenv("CHAT_STREAM_PARSE_MIN_BYTES", str(1024 * 1024)))
+CHAT_SPOOL_MIN_BYTES = int(os.getenv("CHAT_SPOOL_MIN_BYTES", str(256 * 1024)))
 
 # Flask应用
 app = Flask(__name__, static_folder='.')
 CORS(app)
 
+# 管理页面静态资源（启动时加载到内存并预压缩）
+static_assets = create_static_asset_cache(Path(__file__).parent)
 
-# 在模块级别缓存环境变量，避免重复读取
-_auth_config = None
-_last_auth_config = None
+# 大型JSON响应压缩（流式响应自动跳过）
+response_compressor = init_compression(app)
 
-def get_auth_config():
-    """获取认证配置，每次都重新读取环境变量以确保配置是最新的"""
-    # 每次都重新读取环境变量以获取最新配置
-    from dotenv import load_dotenv
-    load_dotenv(override=True)
 
-    require_auth = os.getenv('REQUIRE_AUTH', 'false').lower() == 'true'
-    required_api_key = os.getenv('DOWNSTREAM_API_KEY', '')
+# Prometheus 指标（请求数、耗时、在途请求）
+init_metrics(app)
 
-    auth_config = {
-        'require_auth': require_auth,
-        'required_api_key': required_api_key,
-        'config_valid': require_auth and bool(required_api_key)
-    }
+# 按 阶段/账号/模型 分组的延迟直方图
+latency_metrics = get_latency_metrics()
+
+@app.before_request
+def reset_latency_context():
+    """每个请求开始时清除上一个请求残留的账号/模型维度"""
+    latency_metrics.clear_context()
+
+# 请求级阶段追踪（X-Trace-Id 响应头、慢请求缓冲、可选 OTLP 导出）
+tracer = get_tracer()
+init_tracing(app, tracer)
+
+@app.teardown_request
+def close_spooled_blobs(exc=None):
+    """关闭请求体解析时创建的临时文件"""
+    for blob in g.pop('spooled_blobs', ()):
+        blob.close()
+
+
+# 鉴权配置快照（.env 变化、SIGHUP 或管理接口触发时重新加载）
+auth_config_manager = get_auth_config_manager()
+auth_config_manager.install_sighup_handler()
+
+def get_auth_config() -> AuthConfig:
+    """获取当前鉴权配置快照"""
+    return auth_config_manager.get()
 
-    # 只在配置改变时打印日志（通过全局变量跟踪上次配置）
-    global _last_auth_config
-    current_config_str = f"{require_auth}:{'*' * 10 if required_api_key else 'NOT_SET'}"
-    if _last_auth_config != current_config_str:
-        print(f"[认证] 配置已更新: REQUIRE_AUTH={require_auth}, API_KEY={'*' * 10 if required_api_key else 'NOT_SET'}")
-        _last_auth_config = current_config_str
+# 下游多密钥注册表（SHA-256 哈希索引，支持按密钥限流/限并发，吊销无需重启）
+api_key_registry = get_api_key_registry()
+downstream_authenticator = DownstreamAuthenticator(auth_config_manager, api_key_registry)
 
-    return auth_config
+def _auth_error_response(error: AuthError):
+    response = jsonify(error.to_payload())
+    response.status_code = error.status
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, int(error.retry_after + 0.999)))
+    return response
+
+def check_request_auth():
+    """鉴权快速路径：校验密钥并执行限流，失败时返回错误响应，成功返回 None"""
+    try:
+        g.api_key_record = downstream_authenticator.authenticate(request.headers.get('Authorization', ''))
+    except AuthError as e:
+        return _auth_error_response(e)
+    return None
+
+def check_admin_request():
+    """管理接口的鉴权快速路径：校验密钥后只允许管理员密钥"""
+    auth_error = check_request_auth()
+    if auth_error is not None:
+        return auth_error
+    return check_admin_record()
 
 def require_api_key(f):
     """API Key 鉴权装饰器"""
     from functools import wraps
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        auth_config = get_auth_config()
+        with tracer.span('auth'):
+            auth_error = check_request_auth()
+            if auth_error is not None:
+                return auth_error
 
-        # 如果未启用鉴权，直接通过
-        if not auth_config['require_auth']:
+            # 占用该密钥的并发槽位
+            try:
+                limiter = downstream_authenticator.acquire_slot(g.api_key_record)
+            except AuthError as e:
+                return _auth_error_response(e)
+        if limiter is None:
             return f(*args, **kwargs)
 
-        # 检查配置是否有效
-        if not auth_config['config_valid']:
-            return jsonify({
-                "error": {
-                    "message": "Server requires authentication but API key not configured",
-                    "type": "configuration_error",
-                    "suggestion": "Please set DOWNSTREAM_API_KEY environment variable"
-                }
-            }), 503
-
-        # 从请求头获取 API key
-        provided_api_key = request.headers.get('Authorization', '').replace('Bearer ', '').replace('Api-Key ', '')
-
-        if not provided_api_key:
-            return jsonify({
-                "error": {
-                    "message": "Authentication required",
-                    "type": "authentication_required",
-                    "suggestion": "Please provide API key in Authorization header"
-                }
-            }), 401
-
-        # 验证API密钥
-        if provided_api_key != auth_config['required_api_key']:
-            return jsonify({
-                "error": {
-                    "message": "Invalid API key",
-                    "type": "authentication_failed"
-                }
-            }), 401
-
-        return f(*args, **kwargs)
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            limiter.release_slot()
+            raise
+        response = app.make_response(result)
+        # 流式响应在传输结束后才释放槽位
+        response.call_on_close(limiter.release_slot)
+        return response
     return decorated_function
 
+def require_admin_key(f):
+    """管理接口鉴权：校验密钥后只允许管理员密钥（团队密钥只能调用 /v1/* 和统计查询接口）"""
+    return require_api_key(admin_only(f))
+
 # 导入统计分析模块
 analytics_manager = None
 get_analytics_manager = None
@@ -235,9 +305,12 @@ init_analytics_routes = None
 set_auth_decorator = None
 
 try:
-    from analytics_apis import get_analytics_manager, init_analytics_routes, set_auth_decorator
-    # 设置认证装饰器
+    from analytics_apis import (get_analytics_manager, init_analytics_routes, set_admin_checker,
+                                set_auth_decorator, set_auth_checker)
+    # 设置认证装饰器（统计接口与主接口共用同一鉴权快速路径；修改统计数据的接口只允许管理员密钥）
     set_auth_decorator(require_api_key)
+    set_auth_checker(check_request_auth)
+    set_admin_checker(check_admin_request)
     analytics_manager = get_analytics_manager()
     print("统计分析模块加载成功")
 except ImportError as e:
@@ -254,6 +327,9 @@ if init_analytics_routes is not None:
 else:
     print("[警告] 统计分析模块未加载，跳过API路由初始化")
 
+# 初始化下游API密钥管理路由
+init_api_key_routes(app, require_api_key, api_key_registry)
+
 
 def load_config_from_env() -> dict:
     """从环境变量加载配置"""
@@ -376,15 +452,27 @@ def get_default_models() -> list:
     ]
 
 
+def account_key(account: dict) -> str:
+    """账号在共享状态中的标识"""
+    return str(account.get("csesidx") or account.get("team_id") or "")
+
+
 class AccountManager:
-    """多账号管理器，支持轮训策略"""
+    """多账号管理器，支持轮训策略
+
+    配置了共享状态后端时，可用状态和轮询位置在多个进程间共享；
+    lock 只保护内存中的账号状态，刷新 JWT、创建会话（包括等待其他进程的结果）在单个账号的锁内进行
+    """
     
-    def __init__(self):
+    def __init__(self, shared: Optional[SharedAccountState] = None):
         self.config = None
         self.accounts = []  # 账号列表
         self.current_index = 0  # 当前轮训索引
         self.account_states = {}  # 账号状态: {index: {jwt, jwt_time, session, available}}
         self.lock = threading.Lock()
+        self.account_locks: Dict[int, threading.Lock] = {}
+        self.shared = shared
+        self._availability_version = None
     
     def load_config(self):
         """从环境变量加载配置"""
@@ -419,25 +507,91 @@ class AccountManager:
                 self.account_states[index]["available"] = False
                 # 移除save_config()调用，配置通过环境变量管理
                 print(f"[!] 账号 {index} 已标记为不可用: {reason}")
+        self.publish_availability(index)
+
+    def publish_availability(self, index: int):
+        """把账号的可用状态写入共享状态，其他进程在下次选账号时同步"""
+        if self.shared is None or not 0 <= index < len(self.accounts):
+            return
+        account = self.accounts[index]
+        self.shared.store_availability(account_key(account), account.get("available", True),
+                                       account.get("unavailable_reason", ""))
+
+    def _load_availability(self):
+        """共享状态的版本号变化时读取所有账号的可用状态，返回 (版本号, {账号键: 记录})，无变化时返回 None
+
+        在 self.lock 之外调用：后端较慢或不可达时只影响本次选账号，不阻塞其他请求
+        """
+        if self.shared is None:
+            return None
+        version = self.shared.availability_version()
+        if version is None or version == self._availability_version:
+            return None
+        records = {}
+        for account in list(self.accounts):
+            key = account_key(account)
+            record = self.shared.load_availability(key)
+            if record is not None:
+                records[key] = record
+        return version, records
+
+    def _apply_availability(self, update):
+        """把 _load_availability 的结果应用到内存中的账号状态（调用方需持锁）"""
+        if update is None:
+            return
+        version, records = update
+        # 并发读取时较旧的结果可能后到，不覆盖已应用的新版本
+        if self._availability_version is not None and version <= self._availability_version:
+            return
+        for i, account in enumerate(self.accounts):
+            record = records.get(account_key(account))
+            if record is None:
+                continue
+            account["available"] = record["available"]
+            if record["available"]:
+                account.pop("unavailable_reason", None)
+            else:
+                account["unavailable_reason"] = record.get("reason", "")
+            self.account_states.setdefault(i, {"jwt": None, "jwt_time": 0, "session": None})["available"] = record["available"]
+        self._availability_version = version
     
     def get_available_accounts(self):
         """获取可用账号列表"""
         return [(i, acc) for i, acc in enumerate(self.accounts) 
                 if self.account_states.get(i, {}).get("available", True)]
     
+    def account_lock(self, index: int) -> threading.Lock:
+        """单个账号的锁：同一账号的 JWT 刷新和会话创建在进程内只进行一次，不阻塞其他账号"""
+        with self.lock:
+            return self.account_locks.setdefault(index, threading.Lock())
+
     def get_next_account(self):
         """轮训获取下一个可用账号"""
+        # 轮训选择（多进程部署时使用共享计数，在账号锁外按批次从共享后端预留）
+        shared_index = self.shared.next_round_robin() if self.shared is not None else None
+        availability = self._load_availability()
         with self.lock:
+            self._apply_availability(availability)
             available = self.get_available_accounts()
             if not available:
                 raise Exception("没有可用的账号")
             
-            # 轮训选择
+            if shared_index is not None:
+                return available[(shared_index - 1) % len(available)]
             self.current_index = self.current_index % len(available)
             idx, account = available[self.current_index]
             self.current_index = (self.current_index + 1) % len(available)
             return idx, account
     
+    def get_account(self, index: int):
+        """获取指定账号（用于文件亲和路由），账号不存在或不可用时返回 None"""
+        availability = self._load_availability()
+        with self.lock:
+            self._apply_availability(availability)
+            if 0 <= index < len(self.accounts) and self.account_states.get(index, {}).get("available", True):
+                return index, self.accounts[index]
+            return None
+
     def get_account_count(self):
         """获取账号数量统计"""
         total = len(self.accounts)
@@ -446,62 +600,13 @@ class AccountManager:
 
 
 # 全局账号管理器
-account_manager = AccountManager()
+account_manager = AccountManager(get_shared_state())
 # 自动加载配置
 account_manager.load_config()
 
 
-class FileManager:
-    """文件管理器 - 管理上传文件的映射关系（OpenAI file_id <-> Gemini fileId）"""
-    
-    def __init__(self):
-        self.files: Dict[str, Dict] = {}  # openai_file_id -> {gemini_file_id, session_name, filename, mime_type, size, created_at}
-    
-    def add_file(self, openai_file_id: str, gemini_file_id: str, session_name: str, 
-                 filename: str, mime_type: str, size: int) -> Dict:
-        """添加文件映射"""
-        file_info = {
-            "id": openai_file_id,
-            "gemini_file_id": gemini_file_id,
-            "session_name": session_name,
-            "filename": filename,
-            "mime_type": mime_type,
-            "bytes": size,
-            "created_at": int(time.time()),
-            "purpose": "assistants",
-            "object": "file"
-        }
-        self.files[openai_file_id] = file_info
-        return file_info
-    
-    def get_file(self, openai_file_id: str) -> Optional[Dict]:
-        """获取文件信息"""
-        return self.files.get(openai_file_id)
-    
-    def get_gemini_file_id(self, openai_file_id: str) -> Optional[str]:
-        """获取 Gemini 文件ID"""
-        file_info = self.files.get(openai_file_id)
-        return file_info.get("gemini_file_id") if file_info else None
-    
-    def delete_file(self, openai_file_id: str) -> bool:
-        """删除文件映射"""
-        if openai_file_id in self.files:
-            del self.files[openai_file_id]
-            return True
-        return False
-    
-    def list_files(self) -> List[Dict]:
-        """列出所有文件"""
-        return list(self.files.values())
-    
-    def get_session_for_file(self, openai_file_id: str) -> Optional[str]:
-        """获取文件关联的会话名称"""
-        file_info = self.files.get(openai_file_id)
-        return file_info.get("session_name") if file_info else None
-
-
-# 全局文件管理器
-file_manager = FileManager()
+# 全局文件管理器（SQLite 持久化，重启后和其他进程中可见）
+file_manager = get_file_registry()
 
 
 def check_proxy(proxy: str) -> bool:
@@ -519,11 +624,16 @@ def check_proxy(proxy: str) -> bool:
 
 def url_safe_b64encode(data: bytes) -> str:
     """URL安全的Base64编码，不带padding"""
-    return base64.urlsafe_b64encode(data).decode('utf-8').rstrip('=')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
 
 
 def kq_encode(s: str) -> str:
     """模拟JS的kQ函数"""
+    try:
+        # 快速路径：所有字符都在 0-255 范围内时逐字符结果与 latin-1 编码相同
+        return url_safe_b64encode(s.encode('latin-1'))
+    except UnicodeEncodeError:
+        pass
     byte_arr = bytearray()
     for char in s:
         val = ord(char)
@@ -543,33 +653,58 @@ def decode_xsrf_token(xsrf_token: str) -> bytes:
     return base64.urlsafe_b64decode(xsrf_token)
 
 
-def create_jwt(key_bytes: bytes, key_id: str, csesidx: str) -> str:
-    """创建JWT token"""
-    now = int(time.time())
+class JwtSigner:
+    """单个签名密钥的 JWT 签发器
 
-    header = {
-        "alg": "HS256",
-        "typ": "JWT",
-        "kid": key_id
-    }
+    header 段、payload 中不变的部分和 HMAC 初始状态都预先计算，
+    每次签发只格式化时间戳、编码 payload 并复制 HMAC 状态
+    """
+    __slots__ = ('header_segment', 'payload_prefix', '_mac')
 
-    payload = {
-        "iss": "https://business.gemini.google",
-        "aud": "https://biz-discoveryengine.googleapis.com",
-        "sub": f"csesidx/{csesidx}",
-        "iat": now,
-        "exp": now + 300,
-        "nbf": now
-    }
+    def __init__(self, key_bytes: bytes, key_id: str, csesidx: str):
+        header = {
+            "alg": "HS256",
+            "typ": "JWT",
+            "kid": key_id
+        }
+        self.header_segment = kq_encode(json.dumps(header, separators=(',', ':'))) + "."
+        # 与 json.dumps(payload, separators=(',', ':')) 的键顺序和格式保持一致
+        self.payload_prefix = (
+            '{"iss":"https://business.gemini.google",'
+            '"aud":"https://biz-discoveryengine.googleapis.com",'
+            f'"sub":{json.dumps(f"csesidx/{csesidx}")},'
+        )
+        self._mac = hmac.new(key_bytes, digestmod=hashlib.sha256)
 
-    header_b64 = kq_encode(json.dumps(header, separators=(',', ':')))
-    payload_b64 = kq_encode(json.dumps(payload, separators=(',', ':')))
-    message = f"{header_b64}.{payload_b64}"
+    def sign(self, now: Optional[int] = None) -> str:
+        if now is None:
+            now = int(time.time())
+        payload = f'{self.payload_prefix}"iat":{now},"exp":{now + 300},"nbf":{now}}}'
+        message = self.header_segment + kq_encode(payload)
+        mac = self._mac.copy()
+        mac.update(message.encode('ascii'))
+        return f"{message}.{url_safe_b64encode(mac.digest())}"
 
-    signature = hmac.new(key_bytes, message.encode('utf-8'), hashlib.sha256).digest()
-    signature_b64 = url_safe_b64encode(signature)
 
-    return f"{message}.{signature_b64}"
+# (key_bytes, key_id, csesidx) -> JwtSigner；密钥随 getoxsrf 刷新而变化，数量有限
+_jwt_signers: Dict[tuple, JwtSigner] = {}
+_JWT_SIGNER_CACHE_SIZE = 256
+
+
+def get_jwt_signer(key_bytes: bytes, key_id: str, csesidx: str) -> JwtSigner:
+    """获取（必要时创建）签名密钥对应的签发器"""
+    cache_key = (key_bytes, key_id, csesidx)
+    signer = _jwt_signers.get(cache_key)
+    if signer is None:
+        if len(_jwt_signers) >= _JWT_SIGNER_CACHE_SIZE:
+            _jwt_signers.clear()
+        signer = _jwt_signers[cache_key] = JwtSigner(key_bytes, key_id, csesidx)
+    return signer
+
+
+def create_jwt(key_bytes: bytes, key_id: str, csesidx: str) -> str:
+    """创建JWT token"""
+    return get_jwt_signer(key_bytes, key_id, csesidx).sign()
 
 
 def get_jwt_for_account(account: dict, proxy: str) -> str:
@@ -590,18 +725,17 @@ def get_jwt_for_account(account: dict, proxy: str) -> str:
         "cookie": f'__Secure-C_SES={secure_c_ses}; __Host-C_OSES={host_c_oses}',
     }
 
-    print(f"[JWT] 开始获取JWT - csesidx: {csesidx}")
-    print(f"[JWT] 请求URL: {url}")
-    print(f"[JWT] 使用代理: {proxy if proxy else '无'}")
+    jwt_logger.debug("[JWT] 开始获取JWT - csesidx: %s, 请求URL: %s, 使用代理: %s", csesidx, url, proxy or '无')
 
     resp = None
     try:
         # 使用适度的超时时间
         resp = requests.get(url, headers=headers, proxies=proxies, verify=False, timeout=10)
-        print(f"[JWT] 请求完成 - 状态码: {resp.status_code}")
+        jwt_logger.debug("[JWT] 请求完成 - 状态码: %s", resp.status_code)
 
         if resp.status_code != 200:
-            print(f"[JWT] 请求失败 - 响应内容: {resp.text[:200]}")
+            UPSTREAM_ERRORS.inc('jwt', classify_upstream_error(status_code=resp.status_code))
+            jwt_logger.warning("[JWT] 请求失败 - 状态码: %s, 响应内容: %s", resp.status_code, resp.text[:200])
             raise ValueError(f"JWT请求失败，状态码: {resp.status_code}")
 
         # 处理Google安全前缀
@@ -614,19 +748,19 @@ def get_jwt_for_account(account: dict, proxy: str) -> str:
             error_msg = f"账号 {csesidx} 认证失败，响应: {data}"
             if "message" in data:
                 error_msg += f" - {data['message']}"
-            print(f"[JWT] 认证失败: {error_msg}")
+            jwt_logger.warning("[JWT] 认证失败: %s", error_msg)
             raise ValueError(error_msg)
 
         key_id = data["keyId"]
         xsrf_token = data["xsrfToken"]
 
-        print(f"[JWT] JWT获取成功 - key_id: {key_id}")
+        jwt_logger.debug("[JWT] JWT获取成功 - key_id: %s", key_id)
 
         key_bytes = decode_xsrf_token(xsrf_token)
         return create_jwt(key_bytes, key_id, csesidx)
 
     except requests.exceptions.Timeout:
-        print(f"[JWT] 请求超时 - 网络连接问题")
+        jwt_logger.warning("[JWT] 请求超时 - 网络连接问题")
         error_msg = "JWT认证超时 - 无法连接到Google服务器"
         error_msg += "\n解决方案："
         error_msg += "\n1. 检查网络连接和代理设置"
@@ -635,7 +769,7 @@ def get_jwt_for_account(account: dict, proxy: str) -> str:
         error_msg += "\n4. 验证账号凭证是否有效"
         raise ValueError(error_msg)
     except requests.exceptions.ConnectionError as e:
-        print(f"[JWT] 连接错误: {e}")
+        jwt_logger.warning("[JWT] 连接错误: %s", e)
         error_msg = f"JWT连接失败 - 无法访问Google服务器: {str(e)}"
         error_msg += "\n请检查："
         error_msg += "\n1. 网络连接是否正常"
@@ -643,14 +777,10 @@ def get_jwt_for_account(account: dict, proxy: str) -> str:
         error_msg += "\n3. 账号凭证是否有效"
         raise ValueError(error_msg)
     except requests.exceptions.RequestException as e:
-        print(f"[JWT] 请求异常: {e}")
+        jwt_logger.warning("[JWT] 请求异常: %s", e)
         raise ValueError(f"JWT请求异常: {str(e)}")
     except json.JSONDecodeError as e:
-        print(f"[JWT] JSON解析失败: {e}")
-        if resp:
-            print(f"[JWT] 响应内容: {resp.text[:200]}")
-        else:
-            print("[JWT] 无法获取响应内容")
+        jwt_logger.warning("[JWT] JSON解析失败: %s, 响应内容: %s", e, resp.text[:200] if resp is not None else "无")
         raise ValueError(f"JWT响应解析失败: {str(e)}")
 
 
@@ -669,32 +799,68 @@ def get_headers(jwt: str) -> dict:
     }
 
 
+def record_upstream_error(operation: str, error: Exception):
+    """记录网络层面的上游异常（状态码错误已在发出请求处计数）"""
+    if isinstance(error, requests.RequestException):
+        UPSTREAM_ERRORS.inc(operation, classify_upstream_error(error))
+
+
+def refresh_jwt_for_account(account: dict) -> tuple:
+    """获取新的JWT，返回 (jwt, 获取时间)
+
+    多进程部署时同一账号只由一个进程请求上游，其他进程等待并复用共享的结果
+    """
+    proxy = account_manager.config.get("proxy")
+    shared = account_manager.shared
+    if shared is None:
+        return get_jwt_for_account(account, proxy), time.time()
+
+    key = account_key(account)
+
+    def fetch():
+        jwt, jwt_time = get_jwt_for_account(account, proxy), time.time()
+        shared.store_jwt(key, jwt, jwt_time)
+        return jwt, jwt_time
+
+    return shared.single_flight(f"jwt:{key}", lambda: shared.load_jwt(key), fetch)
+
+
 def ensure_jwt_for_account(account_idx: int, account: dict):
-    """确保指定账号的JWT有效，必要时刷新"""
-    with account_manager.lock:
-        state = account_manager.account_states[account_idx]
-        jwt_age = time.time() - state["jwt_time"] if state["jwt"] else float('inf')
+    """确保指定账号的JWT有效，必要时刷新
 
-        if state["jwt"] is None or jwt_age > 240:
-            proxy = account_manager.config.get("proxy")
-            try:
-                state["jwt"] = get_jwt_for_account(account, proxy)
-                state["jwt_time"] = time.time()
-            except Exception as e:
-                print(f"JWT刷新失败: {e}")
-                # JWT获取失败，标记账号不可用
-                account_manager.mark_account_unavailable(account_idx, str(e))
-                raise
+    刷新（请求上游或等待其他进程的结果）只持有该账号的锁，不阻塞其他账号的请求
+    """
+    with account_manager.account_lock(account_idx):
+        with account_manager.lock:
+            state = account_manager.account_states[account_idx]
+            jwt, jwt_time = state["jwt"], state["jwt_time"]
+        if jwt is not None and time.time() - jwt_time <= 240:
+            return jwt
+
+        try:
+            jwt, jwt_time = refresh_jwt_for_account(account)
+            JWT_REFRESHES.inc(account_idx, 'success')
+        except Exception as e:
+            JWT_REFRESHES.inc(account_idx, 'failure')
+            record_upstream_error('jwt', e)
+            jwt_logger.warning("JWT刷新失败: %s", e)
+            # JWT获取失败，标记账号不可用
+            account_manager.mark_account_unavailable(account_idx, str(e))
+            raise
 
-        return state["jwt"]
+        with account_manager.lock:
+            # 刷新期间账号配置可能被重新加载，写回当前的状态字典
+            state = account_manager.account_states.get(account_idx)
+            if state is not None:
+                state["jwt"], state["jwt_time"] = jwt, jwt_time
+        return jwt
 
 
 def create_chat_session(jwt: str, team_id: str, proxy: str) -> str:
     """创建会话，返回session ID"""
-    print(f"[DEBUG][create_chat_session] 开始 - team_id: {team_id}")
     start_time = time.time()
     session_id = uuid.uuid4().hex[:12]
-    print(f"[DEBUG][create_chat_session] 生成session_id: {session_id}")
+    session_logger.debug("[create_chat_session] 开始 - team_id: %s, session_id: %s", team_id, session_id)
     body = {
         "configId": team_id,
         "additionalParams": {"token": "-"},
@@ -704,9 +870,8 @@ def create_chat_session(jwt: str, team_id: str, proxy: str) -> str:
     }
 
     proxies = {"http": proxy, "https": proxy} if proxy else None
-    print(f"[DEBUG][create_chat_session] 发送请求到: {CREATE_SESSION_URL}")
-    print(f"[DEBUG][create_chat_session] 使用代理: {proxy}")
-    
+    session_logger.debug("[create_chat_session] 发送请求到: %s, 代理: %s", CREATE_SESSION_URL, proxy)
+
     request_start = time.time()
     resp = requests.post(
         CREATE_SESSION_URL,
@@ -716,79 +881,151 @@ def create_chat_session(jwt: str, team_id: str, proxy: str) -> str:
         verify=False,
         timeout=30
     )
-    print(f"[DEBUG][create_chat_session] 请求完成 - 状态码: {resp.status_code}, 耗时: {time.time() - request_start:.2f}秒")
+    session_logger.debug("[create_chat_session] 请求完成 - 状态码: %s, 耗时: %.2f秒",
+                         resp.status_code, time.time() - request_start)
 
     if resp.status_code != 200:
-        print(f"[DEBUG][create_chat_session] 请求失败 - 响应: {resp.text[:500]}")
+        session_logger.warning("[create_chat_session] 请求失败 - 状态码: %s, 响应: %s",
+                               resp.status_code, resp.text[:500])
         if resp.status_code == 401:
-            print(f"[DEBUG][create_chat_session] 401错误 - 可能是team_id填错了")
+            session_logger.warning("[create_chat_session] 401错误 - 可能是team_id填错了")
+        UPSTREAM_ERRORS.inc('session', classify_upstream_error(status_code=resp.status_code))
         raise Exception(f"创建会话失败: {resp.status_code}")
 
     data = resp.json()
     session_name = data.get("session", {}).get("name")
-    print(f"[DEBUG][create_chat_session] 完成 - session_name: {session_name}, 总耗时: {time.time() - start_time:.2f}秒")
+    session_logger.debug("[create_chat_session] 完成 - session_name: %s, 总耗时: %.2f秒",
+                         session_name, time.time() - start_time)
     return session_name
 
 
+def create_shared_session(account: dict, jwt: str, team_id: str, proxy: str, force_new_session: bool) -> str:
+    """创建会话；多进程部署时写入共享状态，同一账号的其他进程复用这个会话"""
+    shared = account_manager.shared
+    if shared is None:
+        return create_chat_session(jwt, team_id, proxy)
+
+    key = account_key(account)
+
+    def create():
+        session_name = create_chat_session(jwt, team_id, proxy)
+        shared.store_session(key, session_name)
+        return session_name
+
+    if force_new_session:
+        return create()
+    return shared.single_flight(f"session:{key}", lambda: shared.load_session(key) or None, create)
+
+
 def ensure_session_for_account(account_idx: int, account: dict, force_new_session: bool = False):
     """确保指定账号的会话有效"""
-    print(f"[DEBUG][ensure_session_for_account] 开始 - 账号索引: {account_idx}, 强制新session: {force_new_session}")
+    session_logger.debug("[ensure_session_for_account] 开始 - 账号索引: %s, 强制新session: %s",
+                         account_idx, force_new_session)
     start_time = time.time()
 
-    print(f"[DEBUG][ensure_session_for_account] 尝试获取JWT...")
     jwt_start = time.time()
-    jwt = ensure_jwt_for_account(account_idx, account)
-    print(f"[DEBUG][ensure_session_for_account] JWT获取完成 - 耗时: {time.time() - jwt_start:.2f}秒")
+    with tracer.span('jwt', account=account_idx):
+        jwt = ensure_jwt_for_account(account_idx, account)
+    latency_metrics.observe('jwt', time.time() - jwt_start, account=account_idx)
+    session_logger.debug("[ensure_session_for_account] JWT获取完成 - 耗时: %.2f秒", time.time() - jwt_start)
 
-    print(f"[DEBUG][ensure_session_for_account] 尝试获取account_manager.lock...")
     lock_start = time.time()
-    with account_manager.lock:
-        print(f"[DEBUG][ensure_session_for_account] 获取到lock - 耗时: {time.time() - lock_start:.2f}秒")
-        state = account_manager.account_states[account_idx]
-        print(f"[DEBUG][ensure_session_for_account] 当前session状态: {state['session'] is not None}")
+    lock_span = tracer.start_span('account_lock', account=account_idx)
+    # 只持有该账号的锁：创建会话（或等待其他进程创建）时不阻塞其他账号
+    with account_manager.account_lock(account_idx):
+        tracer.end_span(lock_span)
+        lock_wait = time.time() - lock_start
+        latency_metrics.observe('queue_wait', lock_wait, account=account_idx)
+        shared = account_manager.shared
+        # 使用其他进程创建（或重置）的会话
+        shared_session = None
+        if shared is not None and not force_new_session:
+            shared_session = shared.load_session(account_key(account))
+        with account_manager.lock:
+            state = account_manager.account_states[account_idx]
+            if shared_session is not None:
+                state["session"] = shared_session or None
+            session_name = state["session"]
 
         # 如果强制创建新session或者session不存在，则创建新session
-        if state["session"] is None or force_new_session:
-            if force_new_session and state["session"] is not None:
-                print(f"[DEBUG][ensure_session_for_account] 强制清除现有session: {state['session']}")
+        if session_name is None or force_new_session:
+            if force_new_session and session_name is not None:
+                session_logger.debug("[ensure_session_for_account] 强制清除现有session: %s", session_name)
 
-            print(f"[DEBUG][ensure_session_for_account] 需要创建新session...")
             proxy = account_manager.config.get("proxy")
             team_id = account.get("team_id")
             session_start = time.time()
-            state["session"] = create_chat_session(jwt, team_id, proxy)
-            print(f"[DEBUG][ensure_session_for_account] Session创建完成 - 耗时: {time.time() - session_start:.2f}秒")
-        else:
-            print(f"[DEBUG][ensure_session_for_account] 使用缓存session: {state['session']}")
+            try:
+                with tracer.span('session', account=account_idx):
+                    session_name = create_shared_session(account, jwt, team_id, proxy, force_new_session)
+            except Exception as e:
+                SESSION_CREATIONS.inc(account_idx, 'failure')
+                record_upstream_error('session', e)
+                raise
+            with account_manager.lock:
+                state = account_manager.account_states.get(account_idx)
+                if state is not None:
+                    state["session"] = session_name
+            SESSION_CREATIONS.inc(account_idx, 'success')
+            latency_metrics.observe('session', time.time() - session_start, account=account_idx)
+            session_logger.debug("[ensure_session_for_account] Session创建完成 - 账号: %s, 耗时: %.2f秒",
+                                 account_idx, time.time() - session_start)
 
-        print(f"[DEBUG][ensure_session_for_account] 释放lock - 总耗时: {time.time() - start_time:.2f}秒")
-        return state["session"], jwt, account.get("team_id")
+    session_logger.debug("[ensure_session_for_account] 完成 - 账号: %s, session: %s, 等锁: %.3f秒, 总耗时: %.2f秒",
+                         account_idx, session_name, lock_wait, time.time() - start_time)
+    return session_name, jwt, account.get("team_id")
 
 
 def reset_all_sessions():
     """重置所有账号的会话，强制创建新的session"""
-    print(f"[DEBUG][reset_all_sessions] 开始重置所有会话...")
+    session_logger.debug("[reset_all_sessions] 开始重置所有会话")
 
     with account_manager.lock:
         total_accounts = len(account_manager.accounts)
-        print(f"[DEBUG][reset_all_sessions] 总账号数: {total_accounts}")
+        session_logger.debug("[reset_all_sessions] 总账号数: %s", total_accounts)
 
         for account_idx in range(total_accounts):
             state = account_manager.account_states.get(account_idx, {})
             if state.get("session"):
-                print(f"[DEBUG][reset_all_sessions] 清除账号 {account_idx} 的session: {state['session']}")
+                session_logger.debug("[reset_all_sessions] 清除账号 %s 的session: %s", account_idx, state['session'])
                 state["session"] = None
             else:
-                print(f"[DEBUG][reset_all_sessions] 账号 {account_idx} 没有session需要清除")
+                session_logger.debug("[reset_all_sessions] 账号 %s 没有session需要清除", account_idx)
+            if account_manager.shared is not None:
+                account_manager.shared.clear_session(account_key(account_manager.accounts[account_idx]))
 
-    print(f"[DEBUG][reset_all_sessions] 所有会话已重置完成")
+    session_logger.info("[reset_all_sessions] 所有会话已重置完成")
 
 
 # ==================== 文件上传功能 ====================
 
-def upload_file_to_gemini(jwt: str, session_name: str, team_id: str, 
-                          file_content: bytes, filename: str, mime_type: str,
-                          proxy: str = None) -> str:
+def build_add_context_file_body(session_name: str, team_id: str, filename: str, mime_type: str,
+                                file_contents_b64: str) -> Dict:
+    """构建 widgetAddContextFile 请求体（文件内容为 base64 字符串）"""
+    return {
+        "addContextFileRequest": {
+            "fileContents": file_contents_b64,
+            "fileName": filename,
+            "mimeType": mime_type,
+            "name": session_name
+        },
+        "additionalParams": {"token": "-"},
+        "configId": team_id
+    }
+
+
+def extract_context_file_id(data: Dict) -> str:
+    """从 widgetAddContextFile 响应中取出 fileId，没有时抛出 ValueError"""
+    file_id = data.get("addContextFileResponse", {}).get("fileId")
+    if not file_id:
+        upload_logger.warning("[upload_file_to_gemini] 响应中未找到fileId - 响应数据: %s", data)
+        raise ValueError(f"响应中未找到 fileId: {data}")
+    return file_id
+
+
+def upload_file_to_gemini(jwt: str, session_name: str, team_id: str,
+                          file_content: Optional[bytes], filename: str, mime_type: str,
+                          proxy: str = None, file_contents_b64=None) -> str:
     """
     上传文件到 Gemini，返回 Gemini 的 fileId
     
@@ -796,61 +1033,57 @@ def upload_file_to_gemini(jwt: str, session_name: str, team_id: str,
         jwt: JWT 认证令牌
         session_name: 会话名称
         team_id: 团队ID
-        file_content: 文件内容（字节）
+        file_content: 文件内容（字节），提供 file_contents_b64 时可为 None
         filename: 文件名
         mime_type: MIME 类型
         proxy: 代理地址
+        file_contents_b64: 已经 base64 编码的文件内容（如内联 data URL），直接发送给上游；
+            为 BlobSlice（转存到临时文件的请求体图片）时从文件流式发送
     
     Returns:
         str: Gemini 返回的 fileId
     """
     start_time = time.time()
-    print(f"[DEBUG][upload_file_to_gemini] 开始上传文件: {filename}, MIME类型: {mime_type}, 文件大小: {len(file_content)} bytes")
-    
-    encode_start = time.time()
-    file_contents_b64 = base64.b64encode(file_content).decode('utf-8')
-    print(f"[DEBUG][upload_file_to_gemini] Base64编码完成 - 耗时: {time.time() - encode_start:.2f}秒, 编码后大小: {len(file_contents_b64)} chars")
+    if file_contents_b64 is None:
+        file_contents_b64 = base64.b64encode(file_content).decode('ascii')
+        file_size = len(file_content)
+    elif isinstance(file_contents_b64, BlobSlice):
+        file_size = file_contents_b64.decoded_size()
+    else:
+        file_size = base64_decoded_size(file_contents_b64)
+    upload_logger.debug("[upload_file_to_gemini] 开始上传文件: %s, MIME类型: %s, 文件大小: %d bytes, Base64编码耗时: %.3f秒",
+                        filename, mime_type, file_size, time.time() - start_time)
     
-    body = {
-        "addContextFileRequest": {
-            "fileContents": file_contents_b64,
-            "fileName": filename,
-            "mimeType": mime_type,
-            "name": session_name
-        },
-        "additionalParams": {"token": "-"},
-        "configId": team_id
-    }
+    streaming = isinstance(file_contents_b64, BlobSlice)
+    body = build_add_context_file_body(session_name, team_id, filename, mime_type,
+                                       StreamingJsonBody.PLACEHOLDER if streaming else file_contents_b64)
     
     proxies = {"http": proxy, "https": proxy} if proxy else None
-    print(f"[DEBUG][upload_file_to_gemini] 准备发送请求到: {ADD_CONTEXT_FILE_URL}")
-    print(f"[DEBUG][upload_file_to_gemini] 使用代理: {proxy if proxy else '无'}")
-    
+    upload_logger.debug("[upload_file_to_gemini] 发送请求到: %s, 代理: %s", ADD_CONTEXT_FILE_URL, proxy or '无')
+
     request_start = time.time()
-    resp = requests.post(
-        ADD_CONTEXT_FILE_URL,
-        headers=get_headers(jwt),
-        json=body,
-        proxies=proxies,
-        verify=False,
-        timeout=60
-    )
-    print(f"[DEBUG][upload_file_to_gemini] 请求完成 - 耗时: {time.time() - request_start:.2f}秒, 状态码: {resp.status_code}")
-    
+    with tracer.span('upload', bytes=file_size, mime_type=mime_type):
+        resp = requests.post(
+            ADD_CONTEXT_FILE_URL,
+            headers=get_headers(jwt),
+            json=None if streaming else body,
+            data=StreamingJsonBody(body, file_contents_b64) if streaming else None,
+            proxies=proxies,
+            verify=False,
+            timeout=60
+        )
+    latency_metrics.observe('upload', time.time() - request_start)
+    upload_logger.debug("[upload_file_to_gemini] 请求完成 - 耗时: %.2f秒, 状态码: %s",
+                        time.time() - request_start, resp.status_code)
+
     if resp.status_code != 200:
-        print(f"[DEBUG][upload_file_to_gemini] 上传失败 - 响应内容: {resp.text[:500]}")
+        UPSTREAM_ERRORS.inc('upload', classify_upstream_error(status_code=resp.status_code))
+        upload_logger.warning("[upload_file_to_gemini] 上传失败 - 状态码: %s, 响应内容: %s",
+                              resp.status_code, resp.text[:500])
         raise Exception(f"文件上传失败: {resp.status_code} - {resp.text}")
-    
-    parse_start = time.time()
-    data = resp.json()
-    file_id = data.get("addContextFileResponse", {}).get("fileId")
-    print(f"[DEBUG][upload_file_to_gemini] 解析响应完成 - 耗时: {time.time() - parse_start:.2f}秒")
-    
-    if not file_id:
-        print(f"[DEBUG][upload_file_to_gemini] 响应中未找到fileId - 响应数据: {data}")
-        raise ValueError(f"响应中未找到 fileId: {data}")
-    
-    print(f"[DEBUG][upload_file_to_gemini] 上传成功 - fileId: {file_id}, 总耗时: {time.time() - start_time:.2f}秒")
+
+    file_id = extract_context_file_id(resp.json())
+    upload_logger.debug("[upload_file_to_gemini] 上传成功 - fileId: %s, 总耗时: %.2f秒", file_id, time.time() - start_time)
     return file_id
 
 
@@ -875,6 +1108,17 @@ class ChatResponse:
     thoughts: List[str] = field(default_factory=list)
 
 
+def forget_image_records(filenames: List[str]) -> int:
+    """删除缓存文件后同步删除图片表中的记录，图片列表只列出仍在缓存中的图片；返回删除的记录数"""
+    if not filenames or get_conversation_manager is None:
+        return 0
+    try:
+        return get_conversation_manager().delete_images_by_filename(filenames)
+    except Exception as e:
+        image_logger.warning("[图片数据库] 删除记录失败: %s", e)
+        return 0
+
+
 def cleanup_expired_images():
     """清理过期的缓存图片"""
     if not IMAGE_CACHE_DIR.exists():
@@ -882,6 +1126,7 @@ def cleanup_expired_images():
     
     now = time.time()
     max_age_seconds = IMAGE_CACHE_HOURS * 3600
+    removed = []
     
     for filepath in IMAGE_CACHE_DIR.iterdir():
         if filepath.is_file():
@@ -889,9 +1134,13 @@ def cleanup_expired_images():
                 file_age = now - filepath.stat().st_mtime
                 if file_age > max_age_seconds:
                     filepath.unlink()
-                    print(f"[图片缓存] 已删除过期图片: {filepath.name}")
+                    removed.append(filepath.name)
+                    IMAGE_CACHE_EVICTIONS.inc()
+                    image_logger.info("[图片缓存] 已删除过期图片: %s", filepath.name)
             except Exception as e:
-                print(f"[图片缓存] 删除失败: {filepath.name}, 错误: {e}")
+                image_logger.warning("[图片缓存] 删除失败: %s, 错误: %s", filepath.name, e)
+
+    forget_image_records(removed)
 
 
 def save_image_to_cache(image_data: bytes, mime_type: str = "image/png", filename: Optional[str] = None,
@@ -922,77 +1171,122 @@ def save_image_to_cache(image_data: bytes, mime_type: str = "image/png", filenam
 
     try:
         filepath = IMAGE_CACHE_DIR / filename
-        with open(filepath, "wb") as f:
-            f.write(image_data)
+        with tracer.span('image_save', bytes=len(image_data)):
+            with open(filepath, "wb") as f:
+                f.write(image_data)
 
-        print(f"[图片缓存] 保存成功: {filename} ({len(image_data)} bytes)")
+        image_logger.debug("[图片缓存] 保存成功: %s (%s bytes)", filename, len(image_data))
 
-        # 如果提供了用户ID，同时保存到数据库
-        if user_id:
-            try:
-                if get_conversation_manager is not None:
-                    conversation_manager = get_conversation_manager()
+        # 同时保存到数据库（图库按数据库记录列出；未提供用户ID时记到默认用户下）
+        try:
+            if get_conversation_manager is not None:
+                conversation_manager = get_conversation_manager()
 
-                    # 获取图片尺寸信息
-                    image_width = None
-                    image_height = None
-                    try:
-                        # 尝试导入PIL，如果失败则跳过尺寸获取
-                        import PIL
-                        from PIL import Image as PILImage
-                        import io
-                        img = PILImage.open(io.BytesIO(image_data))
-                        image_width, image_height = img.size
-                    except ImportError:
-                        pass  # PIL未安装，跳过尺寸获取
-                    except Exception:
-                        pass  # 如果无法获取图片尺寸，跳过
-
-                    # 保存到数据库
-                    image_id = conversation_manager.add_image(
-                        filename=filename,
-                        file_path=str(IMAGE_CACHE_DIR / filename),
-                        user_id=user_id,
-                        file_size=len(image_data),
-                        image_width=image_width,
-                        image_height=image_height,
-                        mime_type=mime_type,
-                        conversation_id=conversation_id,
-                        prompt=prompt,
-                        title=f"生成图片_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                    )
+                # 获取图片尺寸信息
+                image_width = None
+                image_height = None
+                try:
+                    # 尝试导入PIL，如果失败则跳过尺寸获取
+                    import PIL
+                    from PIL import Image as PILImage
+                    import io
+                    img = PILImage.open(io.BytesIO(image_data))
+                    image_width, image_height = img.size
+                except ImportError:
+                    pass  # PIL未安装，跳过尺寸获取
+                except Exception:
+                    pass  # 如果无法获取图片尺寸，跳过
+
+                # 保存到数据库
+                image_id = conversation_manager.add_image(
+                    filename=filename,
+                    file_path=str(IMAGE_CACHE_DIR / filename),
+                    user_id=user_id or conversation_manager.get_user_id(),
+                    file_size=len(image_data),
+                    image_width=image_width,
+                    image_height=image_height,
+                    mime_type=mime_type,
+                    conversation_id=conversation_id,
+                    prompt=prompt,
+                    title=f"生成图片_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                )
 
-                    if image_id > 0:
-                        print(f"[图片数据库] 保存成功: {filename} (ID: {image_id})")
-                    else:
-                        print(f"[图片数据库] 保存失败: {filename}")
+                if image_id > 0:
+                    image_logger.debug("[图片数据库] 保存成功: %s (ID: %s)", filename, image_id)
                 else:
-                    print("[警告] 数据库模块不可用，跳过图片数据库保存")
+                    image_logger.warning("[图片数据库] 保存失败: %s", filename)
+            else:
+                image_logger.warning("[图片数据库] 数据库模块不可用，跳过图片数据库保存")
 
-            except Exception as db_error:
-                print(f"[图片数据库] 保存失败: {filename}, 错误: {db_error}")
+        except Exception as db_error:
+            image_logger.warning("[图片数据库] 保存失败: %s, 错误: %s", filename, db_error)
 
         return filename
     except Exception as e:
-        print(f"[图片缓存] 保存失败: {filename}, 错误: {e}")
+        image_logger.warning("[图片缓存] 保存失败: %s, 错误: %s", filename, e)
         # 在无状态环境中，即使保存失败也返回文件名，让前端显示错误信息
         return filename
 
 
-def parse_base64_data_url(data_url: str) -> Optional[Dict]:
-    """解析 base64 data URL，返回 {type, mime_type, data} 或 None"""
-    if not data_url or not data_url.startswith("data:"):
+BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+# 按行折叠的 base64（MIME 风格每 76 列换行）中允许出现的空白
+BASE64_WHITESPACE = ' \t\r\n'
+
+
+def is_base64_payload(payload: str) -> bool:
+    """不解码地校验 base64 负载：ASCII、长度为4的倍数、填充只出现在末尾、其余字符都在字母表内
+
+    前几项是 O(1) 检查；字母表用 bytes.translate 删除合法字符后看是否有剩余（C 循环，4MB 约 3ms）
+    """
+    if not payload or not payload.isascii() or len(payload) % 4:
+        return False
+    if payload.find('=', 0, len(payload) - 2) != -1:
+        return False
+    return not payload.encode('ascii').rstrip(b'=').translate(None, BASE64_ALPHABET)
+
+
+def normalize_base64_payload(payload: str) -> Optional[str]:
+    """校验 base64 负载，带换行等空白的先去掉空白再校验；不合法时返回 None"""
+    if is_base64_payload(payload):
+        return payload
+    if not any(ch in payload for ch in BASE64_WHITESPACE):
         return None
-    
+    payload = ''.join(payload.split())
+    return payload if is_base64_payload(payload) else None
+
+
+def base64_decoded_size(payload: str) -> int:
+    """base64 负载解码后的字节数"""
+    return len(payload) * 3 // 4 - payload.count('=', len(payload) - 2)
+
+
+def parse_base64_data_url(data_url) -> Optional[Dict]:
+    """解析 base64 data URL，返回 {type, mime_type, data} 或 None
+
+    只用 str.find 定位头部，负载只做一次切片，不经过正则匹配，也不解码；
+    流式解析请求体时转存到临时文件的 SpooledBlob 返回指向文件的 BlobSlice
+    """
+    if isinstance(data_url, SpooledBlob):
+        return parse_blob_data_url(data_url)
+    if not data_url or not isinstance(data_url, str) or not data_url.startswith("data:"):
+        return None
+
     # base64格式: data:image/png;base64,xxxxx
-    match = re.match(r"data:([^;]+);base64,(.+)", data_url)
-    if match:
-        return {
-            "type": "base64",
-            "mime_type": match.group(1),
-            "data": match.group(2)
-        }
-    return None
+    comma = data_url.find(",", 5, 5 + 256)
+    if comma == -1:
+        return None
+    mime_type, _, encoding = data_url[5:comma].partition(";")
+    if not mime_type or encoding != "base64":
+        return None
+
+    payload = normalize_base64_payload(data_url[comma + 1:])
+    if payload is None:
+        return None
+    return {
+        "type": "base64",
+        "mime_type": mime_type,
+        "data": payload
+    }
 
 
 def extract_images_from_files_array(files: List[Dict]) -> List[Dict]:
@@ -1034,6 +1328,10 @@ def extract_images_from_openai_content(content: Any) -> tuple[str, List[Dict]]:
     """
     if isinstance(content, str):
         return content, []
+
+    if isinstance(content, SpooledBlob):
+        # 以 data: 开头的超长纯文本消息也会被转存，读回为文本
+        return content.read_text(), []
     
     if not isinstance(content, list):
         return str(content), []
@@ -1060,7 +1358,7 @@ def extract_images_from_openai_content(content: Any) -> tuple[str, List[Dict]]:
             parsed = parse_base64_data_url(url)
             if parsed:
                 images.append(parsed)
-            elif url:
+            elif url and isinstance(url, str):
                 # 普通URL
                 images.append({
                     "type": "url",
@@ -1079,7 +1377,8 @@ def extract_images_from_openai_content(content: Any) -> tuple[str, List[Dict]]:
 def download_image_from_url(url: str, proxy: Optional[str] = None) -> tuple[bytes, str]:
     """从URL下载图片，返回(图片数据, mime_type)"""
     proxies = {"http": proxy, "https": proxy} if proxy else None
-    resp = requests.get(url, proxies=proxies, verify=False, timeout=60)
+    with latency_metrics.timer('image_download'), tracer.span('image_download'):
+        resp = requests.get(url, proxies=proxies, verify=False, timeout=60)
     resp.raise_for_status()
     
     content_type = resp.headers.get("Content-Type", "image/png")
@@ -1111,7 +1410,7 @@ def get_session_file_metadata(jwt: str, session_name: str, team_id: str, proxy:
     )
     
     if resp.status_code != 200:
-        print(f"[图片] 获取文件元数据失败: {resp.status_code}")
+        image_logger.warning("[图片] 获取文件元数据失败: %s", resp.status_code)
         return {}
     
     data = resp.json()
@@ -1127,7 +1426,7 @@ def get_session_file_metadata(jwt: str, session_name: str, team_id: str, proxy:
 
 def build_download_url(session_name: str, file_id: str) -> str:
     """构造正确的下载URL"""
-    return f"https://biz-discoveryengine.googleapis.com/v1alpha/{session_name}:downloadFile?fileId={file_id}&alt=media"
+    return f"{GEMINI_API_ORIGIN}/v1alpha/{session_name}:downloadFile?fileId={file_id}&alt=media"
 
 
 def download_file_with_jwt(jwt: str, session_name: str, file_id: str, proxy: Optional[str] = None) -> bytes:
@@ -1135,14 +1434,15 @@ def download_file_with_jwt(jwt: str, session_name: str, file_id: str, proxy: Opt
     url = build_download_url(session_name, file_id)
     proxies = {"http": proxy, "https": proxy} if proxy else None
     
-    resp = requests.get(
-        url,
-        headers=get_headers(jwt),
-        proxies=proxies,
-        verify=False,
-        timeout=120,
-        allow_redirects=True
-    )
+    with latency_metrics.timer('image_download'), tracer.span('image_download'):
+        resp = requests.get(
+            url,
+            headers=get_headers(jwt),
+            proxies=proxies,
+            verify=False,
+            timeout=120,
+            allow_redirects=True
+        )
     
     resp.raise_for_status()
     content = resp.content
@@ -1159,21 +1459,25 @@ def download_file_with_jwt(jwt: str, session_name: str, file_id: str, proxy: Opt
     return content
 
 
+def inline_image_filename(prefix: str, mime_type: str) -> str:
+    """为内联/URL 图片生成上传文件名"""
+    ext_map = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
+    return f"{prefix}_{uuid.uuid4().hex[:8]}{ext_map.get(mime_type, '.png')}"
+
+
 def upload_inline_image_to_gemini(jwt: str, session_name: str, team_id: str, 
                                    image_data: Dict, proxy: str = None) -> Optional[str]:
     """上传内联图片到 Gemini，返回 fileId"""
     try:
-        ext_map = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
-        
         if image_data.get("type") == "base64":
+            # 已经是 base64，直接转发给上游，不做解码再编码
             mime_type = image_data.get("mime_type", "image/png")
-            file_content = base64.b64decode(image_data.get("data", ""))
-            ext = ext_map.get(mime_type, ".png")
-            filename = f"inline_{uuid.uuid4().hex[:8]}{ext}"
+            filename = inline_image_filename("inline", mime_type)
+            return upload_file_to_gemini(jwt, session_name, team_id, None, filename, mime_type, proxy,
+                                         file_contents_b64=image_data.get("data", ""))
         elif image_data.get("type") == "url":
             file_content, mime_type = download_image_from_url(image_data.get("url"), proxy)
-            ext = ext_map.get(mime_type, ".png")
-            filename = f"url_{uuid.uuid4().hex[:8]}{ext}"
+            filename = inline_image_filename("url", mime_type)
         else:
             return None
         
@@ -1182,11 +1486,75 @@ def upload_inline_image_to_gemini(jwt: str, session_name: str, team_id: str,
         return None
 
 
-def stream_chat_with_images(jwt: str, sess_name: str, message: str,
-                            proxy: str, team_id: str, file_ids: List[str] = None,
-                            user_id: Optional[str] = None, conversation_id: Optional[int] = None,
-                            prompt: Optional[str] = None) -> ChatResponse:
-    """发送消息并流式接收响应"""
+def parse_stream_assist_response(full_response: str, result: ChatResponse, proxy: Optional[str] = None,
+                                 user_id: Optional[str] = None, conversation_id: Optional[int] = None,
+                                 prompt: Optional[str] = None) -> tuple[List[str], List[Dict], Optional[str]]:
+    """解析 widgetStreamAssist 的完整响应
+
+    内联图片直接写入 result，返回 (文本片段, 需要下载的文件 {fileId, mimeType, fileName}, 会话名)；
+    响应不是合法 JSON 时抛出 json.JSONDecodeError
+    """
+    texts = []
+    file_ids = []
+    current_session = None
+
+    data_list = json.loads(full_response)
+    for data in data_list:
+        sar = data.get("streamAssistResponse")
+        if not sar:
+            continue
+
+        # 获取session信息
+        session_info = sar.get("sessionInfo", {})
+        if session_info.get("session"):
+            current_session = session_info["session"]
+
+        # 检查顶层的generatedImages
+        for gen_img in sar.get("generatedImages", []):
+            parse_generated_image(gen_img, result, proxy, user_id, conversation_id, prompt)
+
+        answer = sar.get("answer") or {}
+
+        # 检查answer级别的generatedImages
+        for gen_img in answer.get("generatedImages", []):
+            parse_generated_image(gen_img, result, proxy, user_id, conversation_id, prompt)
+
+        for reply in answer.get("replies", []):
+            # 检查reply级别的generatedImages
+            for gen_img in reply.get("generatedImages", []):
+                parse_generated_image(gen_img, result, proxy, user_id, conversation_id, prompt)
+
+            gc = reply.get("groundedContent", {})
+            content = gc.get("content", {})
+            text = content.get("text", "")
+            thought = content.get("thought", False)
+
+            # 检查file字段（图片生成的关键）
+            file_info = content.get("file")
+            if file_info and file_info.get("fileId"):
+                file_ids.append({
+                    "fileId": file_info["fileId"],
+                    "mimeType": file_info.get("mimeType", "image/png"),
+                    "fileName": file_info.get("name")
+                })
+
+            # 解析图片数据
+            parse_image_from_content(content, result, proxy, user_id, conversation_id, prompt)
+            parse_image_from_content(gc, result, proxy, user_id, conversation_id, prompt)
+
+            # 检查attachments
+            for att in reply.get("attachments", []) + gc.get("attachments", []) + content.get("attachments", []):
+                parse_attachment(att, result, proxy, user_id, conversation_id, prompt)
+
+            if text and not thought:
+                texts.append(text)
+
+    return texts, file_ids, current_session
+
+
+def build_stream_assist_body(sess_name: str, message: str, team_id: str,
+                             file_ids: Optional[List[str]] = None) -> Dict:
+    """构建 widgetStreamAssist 请求体"""
     query_parts = [{"text": message}]
     request_file_ids = file_ids if file_ids else []
     
@@ -1210,85 +1578,22 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str,
             "assistSkippingMode": "REQUEST_ASSIST"
         }
     }
+    return body
 
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    resp = requests.post(
-        STREAM_ASSIST_URL,
-        headers=get_headers(jwt),
-        json=body,
-        proxies=proxies,
-        verify=False,
-        timeout=120,
-        stream=True
-    )
 
-    if resp.status_code != 200:
-        raise Exception(f"请求失败: {resp.status_code}")
-
-    # 收集完整响应
-    full_response = ""
-    for line in resp.iter_lines():
-        if line:
-            full_response += line.decode('utf-8') + "\n"
-
-    # 解析响应
+def parse_chat_response(full_response: str, jwt: str, team_id: str, proxy: Optional[str] = None,
+                        user_id: Optional[str] = None, conversation_id: Optional[int] = None,
+                        prompt: Optional[str] = None) -> ChatResponse:
+    """解析收集到的完整上游响应，下载通过 fileId 引用的生成图片"""
+    # 图片下载/保存记录为其子阶段
+    parse_span = tracer.start_span('parse')
     result = ChatResponse()
     texts = []
-    file_ids = []  # 收集需要下载的文件 {fileId, mimeType}
-    current_session = None
-    
-    try:
-        data_list = json.loads(full_response)
-        for data in data_list:
-            sar = data.get("streamAssistResponse")
-            if not sar:
-                continue
-            
-            # 获取session信息
-            session_info = sar.get("sessionInfo", {})
-            if session_info.get("session"):
-                current_session = session_info["session"]
-            
-            # 检查顶层的generatedImages
-            for gen_img in sar.get("generatedImages", []):
-                parse_generated_image(gen_img, result, proxy, user_id, conversation_id, prompt)
 
-            answer = sar.get("answer") or {}
-
-            # 检查answer级别的generatedImages
-            for gen_img in answer.get("generatedImages", []):
-                parse_generated_image(gen_img, result, proxy, user_id, conversation_id, prompt)
+    try:
+        texts, file_ids, current_session = parse_stream_assist_response(
+            full_response, result, proxy, user_id, conversation_id, prompt)
 
-            for reply in answer.get("replies", []):
-                # 检查reply级别的generatedImages
-                for gen_img in reply.get("generatedImages", []):
-                    parse_generated_image(gen_img, result, proxy, user_id, conversation_id, prompt)
-                
-                gc = reply.get("groundedContent", {})
-                content = gc.get("content", {})
-                text = content.get("text", "")
-                thought = content.get("thought", False)
-                
-                # 检查file字段（图片生成的关键）
-                file_info = content.get("file")
-                if file_info and file_info.get("fileId"):
-                    file_ids.append({
-                        "fileId": file_info["fileId"],
-                        "mimeType": file_info.get("mimeType", "image/png"),
-                        "fileName": file_info.get("name")
-                    })
-                
-                # 解析图片数据
-                parse_image_from_content(content, result, proxy, user_id, conversation_id, prompt)
-                parse_image_from_content(gc, result, proxy, user_id, conversation_id, prompt)
-                
-                # 检查attachments
-                for att in reply.get("attachments", []) + gc.get("attachments", []) + content.get("attachments", []):
-                    parse_attachment(att, result, proxy, user_id, conversation_id, prompt)
-                
-                if text and not thought:
-                    texts.append(text)
-        
         # 处理通过fileId引用的图片
         if file_ids and current_session:
             try:
@@ -1307,7 +1612,8 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str,
                     
                     try:
                         image_data = download_file_with_jwt(jwt, session_path, fid, proxy)
-                        filename = save_image_to_cache(image_data, mime, fname)
+                        filename = save_image_to_cache(image_data, mime, fname, user_id=user_id,
+                                                       conversation_id=conversation_id, prompt=prompt)
                         img = ChatImage(
                             file_id=fid,
                             file_name=filename,
@@ -1315,19 +1621,60 @@ def stream_chat_with_images(jwt: str, sess_name: str, message: str,
                             local_path=str(IMAGE_CACHE_DIR / filename)
                         )
                         result.images.append(img)
-                        print(f"[图片] 已保存: {filename}")
+                        image_logger.debug("[图片] 已保存: %s", filename)
                     except Exception as e:
-                        print(f"[图片] 下载失败 (fileId={fid}): {e}")
+                        image_logger.warning("[图片] 下载失败 (fileId=%s): %s", fid, e)
             except Exception as e:
-                print(f"[图片] 获取文件元数据失败: {e}")
+                image_logger.warning("[图片] 获取文件元数据失败: %s", e)
                 
     except json.JSONDecodeError:
         pass
+    finally:
+        tracer.end_span(parse_span)
 
     result.text = "".join(texts)
     return result
 
 
+def stream_chat_with_images(jwt: str, sess_name: str, message: str,
+                            proxy: str, team_id: str, file_ids: List[str] = None,
+                            user_id: Optional[str] = None, conversation_id: Optional[int] = None,
+                            prompt: Optional[str] = None) -> ChatResponse:
+    """发送消息并流式接收响应"""
+    body = build_stream_assist_body(sess_name, message, team_id, file_ids)
+
+    proxies = {"http": proxy, "https": proxy} if proxy else None
+    upstream_start = time.time()
+    with tracer.span('upstream_ttfb'):
+        resp = requests.post(
+            STREAM_ASSIST_URL,
+            headers=get_headers(jwt),
+            json=body,
+            proxies=proxies,
+            verify=False,
+            timeout=120,
+            stream=True
+        )
+    # stream=True 时 post 在收到响应头后返回，近似为上游首字节时间
+    latency_metrics.observe('upstream_ttfb', time.time() - upstream_start)
+
+    if resp.status_code != 200:
+        UPSTREAM_ERRORS.inc('chat', classify_upstream_error(status_code=resp.status_code))
+        raise Exception(f"请求失败: {resp.status_code}")
+
+    # 收集完整响应
+    full_response = ""
+    with tracer.span('upstream_stream') as stream_span:
+        for line in resp.iter_lines():
+            if line:
+                full_response += line.decode('utf-8') + "\n"
+        if stream_span is not None:
+            stream_span.attributes['bytes'] = len(full_response)
+    latency_metrics.observe('upstream_total', time.time() - upstream_start)
+
+    return parse_chat_response(full_response, jwt, team_id, proxy, user_id, conversation_id, prompt)
+
+
 def parse_generated_image(gen_img: Dict, result: ChatResponse, proxy: Optional[str] = None,
                          user_id: Optional[str] = None, conversation_id: Optional[int] = None,
                          prompt: Optional[str] = None):
@@ -1355,7 +1702,7 @@ def parse_generated_image(gen_img: Dict, result: ChatResponse, proxy: Optional[s
                 local_path=str(IMAGE_CACHE_DIR / filename)
             )
             result.images.append(img)
-            print(f"[图片] 已保存: {filename}")
+            image_logger.debug("[图片] 已保存: %s", filename)
 
             success = True
 
@@ -1363,14 +1710,14 @@ def parse_generated_image(gen_img: Dict, result: ChatResponse, proxy: Optional[s
             if get_conversation_manager is not None and user_id is not None:
                 try:
                     conversation_manager = get_conversation_manager()
-                    image_records = conversation_manager.get_images(user_id, page=1, per_page=1)
-                    if image_records and len(image_records) > 0:
+                    image_records, _ = conversation_manager.get_images(user_id, limit=1)
+                    if image_records:
                         image_id = image_records[0].id
                 except Exception as db_e:
-                    print(f"[统计] 获取图片ID失败: {db_e}")
+                    image_logger.warning("[统计] 获取图片ID失败: %s", db_e)
 
         except Exception as e:
-            print(f"[图片] 解析base64失败: {e}")
+            image_logger.warning("[图片] 解析base64失败: %s", e)
 
         # 记录生成统计数据
         if analytics_manager is not None:
@@ -1394,7 +1741,7 @@ def parse_generated_image(gen_img: Dict, result: ChatResponse, proxy: Optional[s
                     analytics_manager.record_image_generation(image_id, generation_data)
 
             except Exception as stat_e:
-                print(f"[统计] 记录生成统计失败: {stat_e}")
+                image_logger.warning("[统计] 记录生成统计失败: %s", stat_e)
 
 
 def parse_image_from_content(content: Dict, result: ChatResponse, proxy: Optional[str] = None,
@@ -1418,9 +1765,9 @@ def parse_image_from_content(content: Dict, result: ChatResponse, proxy: Optiona
                     local_path=str(IMAGE_CACHE_DIR / filename)
                 )
                 result.images.append(img)
-                print(f"[图片] 已保存: {filename}")
+                image_logger.debug("[图片] 已保存: %s", filename)
             except Exception as e:
-                print(f"[图片] 解析inlineData失败: {e}")
+                image_logger.warning("[图片] 解析inlineData失败: %s", e)
 
 
 def parse_attachment(att: Dict, result: ChatResponse, proxy: Optional[str] = None,
@@ -1447,9 +1794,9 @@ def parse_attachment(att: Dict, result: ChatResponse, proxy: Optional[str] = Non
                 local_path=str(IMAGE_CACHE_DIR / filename)
             )
             result.images.append(img)
-            print(f"[图片] 已保存: {filename}")
+            image_logger.debug("[图片] 已保存: %s", filename)
         except Exception as e:
-            print(f"[图片] 解析attachment失败: {e}")
+            image_logger.warning("[图片] 解析attachment失败: %s", e)
 
 
 # ==================== OpenAPI 接口 ====================
@@ -1531,140 +1878,142 @@ def list_models():
     return jsonify({"object": "list", "data": models_data})
 
 
+def record_upload_analytics(success: bool, duration: float, team_id: str = '', bytes_count: int = 0):
+    """记录文件上传请求事件"""
+    latency_metrics.observe('total', duration, model='upload')
+    if analytics_manager is None:
+        return
+    try:
+        with tracer.span('analytics'):
+            analytics_manager.record_request_event({
+                'kind': 'upload',
+                'api_key': extract_api_key(request.headers.get('Authorization', '')),
+                'success': success,
+                'duration_ms': int(duration * 1000),
+                'team_id': team_id or '',
+                'user_id': get_user_id_from_request(),
+                'bytes': bytes_count
+            })
+    except Exception as stats_e:
+        print(f"[统计] 记录上传统计失败: {stats_e}")
+
+
 @app.route('/v1/files', methods=['POST'])
 def upload_file():
     """OpenAI 兼容的文件上传接口"""
-    import traceback
     request_start_time = time.time()
-    print(f"\n{'='*60}")
-    print(f"[文件上传] ===== 接口调用开始 =====")
-    print(f"[文件上传] 请求时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-    
+    upload_logger.debug("[文件上传] 接口调用开始")
+
     try:
         # 检查是否有文件
-        step_start = time.time()
-        print(f"[文件上传] 步骤1: 检查请求中的文件...")
         if 'file' not in request.files:
-            print(f"[文件上传] 错误: 请求中没有文件")
+            upload_logger.info("[文件上传] 请求中没有文件")
             return jsonify({"error": {"message": "No file provided", "type": "invalid_request_error"}}), 400
-        
+
         file = request.files['file']
         if file.filename == '':
-            print(f"[文件上传] 错误: 文件名为空")
+            upload_logger.info("[文件上传] 文件名为空")
             return jsonify({"error": {"message": "No file selected", "type": "invalid_request_error"}}), 400
-        print(f"[文件上传] 步骤1完成: 文件名={file.filename}, 耗时={time.time()-step_start:.3f}秒")
-        
+
         # 获取文件内容和MIME类型
-        step_start = time.time()
-        print(f"[文件上传] 步骤2: 读取文件内容...")
         file_content = file.read()
         mime_type = file.content_type or mimetypes.guess_type(file.filename)[0] or 'application/octet-stream'
-        print(f"[文件上传] 步骤2完成: 文件大小={len(file_content)}字节, MIME类型={mime_type}, 耗时={time.time()-step_start:.3f}秒")
-        
+        upload_logger.debug("[文件上传] 文件名=%s, 大小=%d字节, MIME类型=%s", file.filename, len(file_content), mime_type)
+
         # 获取账号信息
         max_retries = len(account_manager.accounts)
         last_error = None
         gemini_file_id = None
-        print(f"[文件上传] 步骤3: 开始尝试上传, 最大重试次数={max_retries}")
-        
+
         for retry_idx in range(max_retries):
             retry_start = time.time()
-            print(f"\n[文件上传] --- 第{retry_idx+1}次尝试 ---")
             try:
                 # 获取账号
-                step_start = time.time()
-                print(f"[文件上传] 步骤3.{retry_idx+1}.1: 获取下一个可用账号...")
-                account_idx, account = account_manager.get_next_account()
-                print(f"[文件上传] 步骤3.{retry_idx+1}.1完成: 账号索引={account_idx}, CSESIDX={account.get('csesidx')}, 耗时={time.time()-step_start:.3f}秒")
-                
+                with tracer.span('account_pick'):
+                    account_idx, account = account_manager.get_next_account()
+                tracer.set_attribute('account', account_idx)
+                latency_metrics.set_context(account=account_idx)
+                upload_logger.debug("[文件上传] 第%d次尝试: 账号索引=%s, CSESIDX=%s",
+                                    retry_idx + 1, account_idx, account.get('csesidx'))
+
                 # 确保会话有效
-                step_start = time.time()
-                print(f"[文件上传] 步骤3.{retry_idx+1}.2: 确保会话有效(JWT+Session)...")
                 session, jwt, team_id = ensure_session_for_account(account_idx, account)
-                print(f"[文件上传] 步骤3.{retry_idx+1}.2完成: session={session}, team_id={team_id}, 耗时={time.time()-step_start:.3f}秒")
-                
                 proxy = account_manager.config.get("proxy")
-                print(f"[文件上传] 代理设置: {proxy}")
-                
+                upload_logger.debug("[文件上传] 会话就绪: session=%s, team_id=%s, 代理=%s", session, team_id, proxy)
+
                 # 上传文件到 Gemini
-                step_start = time.time()
-                print(f"[文件上传] 步骤3.{retry_idx+1}.3: 上传文件到Gemini...")
                 gemini_file_id = upload_file_to_gemini(jwt, session, team_id, file_content, file.filename, mime_type, proxy)
-                print(f"[文件上传] 步骤3.{retry_idx+1}.3完成: gemini_file_id={gemini_file_id}, 耗时={time.time()-step_start:.3f}秒")
-                
+
                 if gemini_file_id:
                     # 生成 OpenAI 格式的 file_id
-                    step_start = time.time()
-                    print(f"[文件上传] 步骤4: 生成OpenAI格式响应...")
                     openai_file_id = f"file-{uuid.uuid4().hex[:24]}"
-                    
+
                     # 保存映射关系
-                    file_manager.add_file(
+                    file_info = file_manager.add_file(
                         openai_file_id=openai_file_id,
                         gemini_file_id=gemini_file_id,
                         session_name=session,
                         filename=file.filename,
                         mime_type=mime_type,
-                        size=len(file_content)
+                        size=len(file_content),
+                        purpose=request.form.get('purpose', 'assistants'),
+                        account_idx=account_idx,
+                        content=file_content
                     )
-                    print(f"[文件上传] 步骤4完成: openai_file_id={openai_file_id}, 耗时={time.time()-step_start:.3f}秒")
-                    
+
                     total_time = time.time() - request_start_time
-                    print(f"\n[文件上传] ===== 上传成功 =====")
-                    print(f"[文件上传] 总耗时: {total_time:.3f}秒")
-                    print(f"{'='*60}\n")
-                    
+                    record_upload_analytics(True, total_time, team_id, len(file_content))
+                    upload_logger.info("[文件上传] 上传成功: %s -> %s, 账号=%s, 总耗时=%.3f秒",
+                                       file.filename, openai_file_id, account_idx, total_time)
+
                     # 返回 OpenAI 格式响应
-                    return jsonify({
-                        "id": openai_file_id,
-                        "object": "file",
-                        "bytes": len(file_content),
-                        "created_at": int(time.time()),
-                        "filename": file.filename,
-                        "purpose": request.form.get('purpose', 'assistants')
-                    })
+                    return jsonify(to_openai_file(file_info))
                 else:
-                    print(f"[文件上传] 警告: gemini_file_id为空")
-                    
+                    upload_logger.warning("[文件上传] gemini_file_id为空")
+
             except Exception as e:
                 last_error = e
-                print(f"[文件上传] 第{retry_idx+1}次尝试失败: {type(e).__name__}: {e}")
-                print(f"[文件上传] 堆栈跟踪:\n{traceback.format_exc()}")
-                print(f"[文件上传] 本次尝试耗时: {time.time()-retry_start:.3f}秒")
+                record_upstream_error('upload', e)
+                upload_logger.warning("[文件上传] 第%d次尝试失败: %s: %s, 耗时=%.3f秒",
+                                      retry_idx + 1, type(e).__name__, e, time.time() - retry_start,
+                                      exc_info=upload_logger.isEnabledFor(logging.DEBUG))
                 continue
-        
+
         total_time = time.time() - request_start_time
-        print(f"\n[文件上传] ===== 所有重试均失败 =====")
-        print(f"[文件上传] 最后错误: {last_error}")
-        print(f"[文件上传] 总耗时: {total_time:.3f}秒")
-        print(f"{'='*60}\n")
+        record_upload_analytics(False, total_time, bytes_count=len(file_content))
+        upload_logger.error("[文件上传] 所有重试均失败: %s, 总耗时=%.3f秒", last_error, total_time)
         return jsonify({"error": {"message": f"文件上传失败: {last_error}", "type": "api_error"}}), 500
-        
+
     except Exception as e:
-        total_time = time.time() - request_start_time
-        print(f"\n[文件上传] ===== 发生异常 =====")
-        print(f"[文件上传] 错误类型: {type(e).__name__}")
-        print(f"[文件上传] 错误信息: {e}")
-        print(f"[文件上传] 堆栈跟踪:\n{traceback.format_exc()}")
-        print(f"[文件上传] 总耗时: {total_time:.3f}秒")
-        print(f"{'='*60}\n")
+        upload_logger.exception("[文件上传] 发生异常: %s: %s, 总耗时=%.3f秒",
+                                type(e).__name__, e, time.time() - request_start_time)
         return jsonify({"error": {"message": str(e), "type": "api_error"}}), 500
 
 
 @app.route('/v1/files', methods=['GET'])
 def list_files():
-    """获取已上传文件列表"""
-    files = file_manager.list_files()
+    """获取已上传文件列表（分页：limit、after、order）"""
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({"error": {"message": "Invalid limit", "type": "invalid_request_error"}}), 400
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        return jsonify({"error": {"message": "Invalid order", "type": "invalid_request_error"}}), 400
+
+    try:
+        files, next_cursor = file_manager.list_files(limit, request.args.get('after') or None, order)
+    except ValueError as e:
+        return jsonify({"error": {"message": str(e), "type": "invalid_request_error"}}), 400
+    data = [to_openai_file(f) for f in files]
     return jsonify({
         "object": "list",
-        "data": [{
-            "id": f["openai_file_id"],
-            "object": "file",
-            "bytes": f.get("size", 0),
-            "created_at": f.get("created_at", int(time.time())),
-            "filename": f.get("filename", ""),
-            "purpose": "assistants"
-        } for f in files]
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        # next_cursor 作为 after 传回，上一页最后一个文件被删除后仍能继续翻页
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None
     })
 
 
@@ -1675,14 +2024,7 @@ def get_file(file_id):
     if not file_info:
         return jsonify({"error": {"message": "File not found", "type": "invalid_request_error"}}), 404
     
-    return jsonify({
-        "id": file_info["openai_file_id"],
-        "object": "file",
-        "bytes": file_info.get("size", 0),
-        "created_at": file_info.get("created_at", int(time.time())),
-        "filename": file_info.get("filename", ""),
-        "purpose": "assistants"
-    })
+    return jsonify(to_openai_file(file_info))
 
 
 @app.route('/v1/files/<file_id>', methods=['DELETE'])
@@ -1697,6 +2039,157 @@ def delete_file(file_id):
     return jsonify({"error": {"message": "File not found", "type": "invalid_request_error"}}), 404
 
 
+def record_chat_analytics(model: str, success: bool, duration: float, team_id: str = '',
+                          user_id: Optional[str] = None, conversation_id: Optional[int] = None,
+                          images: int = 0):
+    """记录聊天使用统计（进入异步写入队列，不阻塞响应）"""
+    latency_metrics.observe('total', duration, model=model)
+    if analytics_manager is None:
+        return
+    try:
+        with tracer.span('analytics'):
+            analytics_manager.record_chat_usage({
+                'api_key': extract_api_key(request.headers.get('Authorization', '')),
+                'model': model,
+                'success': success,
+                'duration': duration,
+                'tokens': 0,  # 可以从响应中提取token数量
+                'images': images,
+                'team_id': team_id or '',
+                'email': '',
+                'ip': request.headers.get('X-Forwarded-For', request.remote_addr),
+                'user_agent': request.headers.get('User-Agent', 'Unknown'),
+                'user_id': user_id,
+                'conversation_id': conversation_id
+            })
+    except Exception as stats_e:
+        print(f"[统计] 记录聊天统计失败: {stats_e}")
+
+
+def read_chat_request_body() -> Dict:
+    """读取聊天请求体
+
+    小请求体直接 request.json；大请求体或分块传输（无 Content-Length）时按块增量解析，
+    超过 CHAT_SPOOL_MIN_BYTES 的 data URL 转存到临时文件（请求结束时关闭），
+    读取过程中超过 CHAT_MAX_BODY_BYTES 即抛出 RequestTooLarge
+    """
+    length = request.content_length
+    if (not CHAT_STREAMING_PARSE or not request.is_json
+            or (length is not None and length < CHAT_STREAM_PARSE_MIN_BYTES)):
+        return request.json
+    with tracer.span('parse_body', bytes=length or 0):
+        data, blobs = parse_json_stream(request.stream, CHAT_MAX_BODY_BYTES, CHAT_SPOOL_MIN_BYTES)
+    g.spooled_blobs = blobs
+    if blobs:
+        logging.getLogger('gemini_pool.chat').debug(
+            "请求体流式解析完成: %d 个内联数据转存到临时文件, 共 %d 字节", len(blobs), sum(len(b) for b in blobs))
+    if not isinstance(data, dict):
+        raise ValueError("请求体必须是 JSON 对象")
+    return data
+
+
+def load_chat_user_context() -> tuple[Optional[str], Optional[int]]:
+    """返回当前请求的 (用户ID, 活跃会话ID)，用于生成图片的归属"""
+    user_id = get_user_id_from_request()
+    active_conversation_id = None
+    if user_id:
+        try:
+            conversation_manager = get_conversation_manager()
+            active_conversation = conversation_manager.get_active_conversation(user_id)
+            if active_conversation:
+                active_conversation_id = active_conversation.id
+        except Exception as e:
+            logging.getLogger('gemini_pool.chat').warning(f"获取活跃会话失败: {e}")
+    return user_id, active_conversation_id
+
+
+def extract_chat_inputs(messages: List[Dict], prompts: List[Dict]) -> tuple[str, List[Dict], List[str]]:
+    """从 OpenAI messages 或替代 prompts 格式中提取 (最后一条用户消息文本, 内联图片, OpenAI file_id 列表)"""
+    user_message = ""
+    input_images = []
+    input_file_ids = []  # OpenAI file_id 列表
+    
+    # 处理标准 OpenAI messages 格式
+    for msg in messages:
+        if msg.get('role') == 'user':
+            content = msg.get('content', '')
+            text, images = extract_images_from_openai_content(content)
+            if text:
+                user_message = text
+            input_images.extend(images)
+            
+            # 提取文件ID（支持多种格式）
+            if isinstance(content, list):
+                for item in content:
+                    if isinstance(item, dict):
+                        # 格式1: {"type": "file", "file_id": "xxx"}
+                        if item.get('type') == 'file' and item.get('file_id'):
+                            input_file_ids.append(item['file_id'])
+                        # 格式2: {"type": "file", "file": {"file_id": "xxx"}}
+                        elif item.get('type') == 'file' and isinstance(item.get('file'), dict):
+                            file_obj = item['file']
+                            # 支持 file_id 或 id 两种字段名
+                            fid = file_obj.get('file_id') or file_obj.get('id')
+                            if fid:
+                                input_file_ids.append(fid)
+    
+    # 处理替代 prompts 格式（支持内联 base64 图片）
+    # 格式: {"prompts": [{"role": "user", "text": "...", "files": [{"data": "data:image...", "type": "image"}]}]}
+    for prompt in prompts:
+        if prompt.get('role') == 'user':
+            # 提取文本
+            prompt_text = prompt.get('text', '')
+            if prompt_text and not user_message:
+                user_message = prompt_text
+            elif prompt_text:
+                user_message = prompt_text  # 使用最新的用户消息
+            
+            # 提取内联 files 数组中的图片
+            files_array = prompt.get('files', [])
+            if files_array:
+                images_from_files = extract_images_from_files_array(files_array)
+                input_images.extend(images_from_files)
+
+    return user_message, input_images, input_file_ids
+
+
+def pick_file_affinity_account(files: List[Dict]):
+    """选出持有最多引用文件的可用账号，返回 (account_idx, account) 或 None"""
+    counts: Dict[int, int] = {}
+    for file_info in files:
+        if file_info.get("account_idx") is not None:
+            counts[file_info["account_idx"]] = counts.get(file_info["account_idx"], 0) + 1
+    for account_idx in sorted(counts, key=counts.get, reverse=True):
+        picked = account_manager.get_account(account_idx)
+        if picked is not None:
+            return picked
+    return None
+
+
+def resolve_files_for_session(files: List[Dict], account_idx: int, session: str, jwt: str,
+                              team_id: str, proxy: Optional[str]) -> List[str]:
+    """返回文件在当前会话中的 Gemini fileId
+
+    文件不在当前会话（账号不可用时切换了账号，或会话已重建）时，用保留的副本重新上传并更新映射；
+    没有副本的文件无法在其他会话中使用，跳过
+    """
+    gemini_file_ids = []
+    for file_info in files:
+        if file_info["session_name"] == session:
+            gemini_file_ids.append(file_info["gemini_file_id"])
+            continue
+        content = file_manager.load_retained(file_info["id"])
+        if content is None:
+            upload_logger.warning("[文件亲和] 文件 %s 属于其他会话且没有保留副本，已跳过", file_info["id"])
+            continue
+        gemini_file_id = upload_file_to_gemini(jwt, session, team_id, content, file_info["filename"],
+                                               file_info["mime_type"], proxy)
+        file_manager.rebind_file(file_info["id"], gemini_file_id, session, account_idx)
+        upload_logger.info("[文件亲和] 文件 %s 已重新上传到账号 %s 的会话", file_info["id"], account_idx)
+        gemini_file_ids.append(gemini_file_id)
+    return gemini_file_ids
+
+
 @app.route('/v1/chat/completions', methods=['POST'])
 @require_api_key
 def chat_completions():
@@ -1708,90 +2201,49 @@ def chat_completions():
     client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
     user_agent = request.headers.get('User-Agent', 'Unknown')
 
+    if request.content_length and request.content_length > CHAT_MAX_BODY_BYTES:
+        chat_logger.warning(f"请求体过大: {request.content_length} 字节, 上限 {CHAT_MAX_BODY_BYTES} 字节")
+        return jsonify({"error": f"请求体超过上限 {CHAT_MAX_BODY_BYTES} 字节"}), 413
+
     try:
-        data = request.json
+        try:
+            data = read_chat_request_body()
+        except RequestTooLarge as e:
+            chat_logger.warning(f"请求体过大: {e}")
+            return jsonify({"error": str(e)}), 413
         messages = data.get('messages', [])
         prompts = data.get('prompts', [])  # 支持替代格式
         stream = data.get('stream', False)
         model = data.get('model', 'unknown')
         force_new_session = data.get('force_new_session', False)  # 强制创建新session
 
-        chat_logger.info(f"聊天请求开始 - IP: {client_ip}, 用户代理: {user_agent}")
-        chat_logger.debug(f"请求参数: 模型={model}, 流式={stream}, 消息数量={len(messages)}")
+        chat_logger.info("聊天请求开始 - IP: %s, 用户代理: %s", client_ip, user_agent)
+        chat_logger.debug("请求参数: 模型=%s, 流式=%s, 消息数量=%s", model, stream, len(messages))
 
         # 获取用户ID和活跃会话信息（用于图片保存）
-        user_id = get_user_id_from_request()
-        active_conversation_id = None
-        if user_id:
-            try:
-                conversation_manager = get_conversation_manager()
-                active_conversation = conversation_manager.get_active_conversation(user_id)
-                if active_conversation:
-                    active_conversation_id = active_conversation.id
-            except Exception as e:
-                chat_logger.warning(f"获取��跃会话失败: {e}")
+        user_id, active_conversation_id = load_chat_user_context()
 
         # 每次请求时清理过期图片
         cleanup_expired_images()
 
-        chat_logger.debug(f"请求数据解析完成: messages={len(messages)}, prompts={len(prompts)}, 强制新session={force_new_session}")
+        chat_logger.debug("请求数据解析完成: messages=%s, prompts=%s, 强制新session=%s",
+                          len(messages), len(prompts), force_new_session)
 
         # 提取用户消息、图片和文件ID
-        user_message = ""
-        input_images = []
-        input_file_ids = []  # OpenAI file_id 列表
-        
-        # 处理标准 OpenAI messages 格式
-        for msg in messages:
-            if msg.get('role') == 'user':
-                content = msg.get('content', '')
-                text, images = extract_images_from_openai_content(content)
-                if text:
-                    user_message = text
-                input_images.extend(images)
-                
-                # 提取文件ID（支持多种格式）
-                if isinstance(content, list):
-                    for item in content:
-                        if isinstance(item, dict):
-                            # 格式1: {"type": "file", "file_id": "xxx"}
-                            if item.get('type') == 'file' and item.get('file_id'):
-                                input_file_ids.append(item['file_id'])
-                            # 格式2: {"type": "file", "file": {"file_id": "xxx"}}
-                            elif item.get('type') == 'file' and isinstance(item.get('file'), dict):
-                                file_obj = item['file']
-                                # 支持 file_id 或 id 两种字段名
-                                fid = file_obj.get('file_id') or file_obj.get('id')
-                                if fid:
-                                    input_file_ids.append(fid)
-        
-        # 处理替代 prompts 格式（支持内联 base64 图片）
-        # 格式: {"prompts": [{"role": "user", "text": "...", "files": [{"data": "data:image...", "type": "image"}]}]}
-        for prompt in prompts:
-            if prompt.get('role') == 'user':
-                # 提取文本
-                prompt_text = prompt.get('text', '')
-                if prompt_text and not user_message:
-                    user_message = prompt_text
-                elif prompt_text:
-                    user_message = prompt_text  # 使用最新的用户消息
-                
-                # 提取内联 files 数组中的图片
-                files_array = prompt.get('files', [])
-                if files_array:
-                    images_from_files = extract_images_from_files_array(files_array)
-                    input_images.extend(images_from_files)
-        
-        # 将 OpenAI file_id 转换为 Gemini fileId
-        gemini_file_ids = []
+        user_message, input_images, input_file_ids = extract_chat_inputs(messages, prompts)
+
+        # 查找 OpenAI file_id 对应的 Gemini 文件及其所属账号/会话
+        input_files = []
         for fid in input_file_ids:
-            gemini_fid = file_manager.get_gemini_file_id(fid)
-            if gemini_fid:
-                gemini_file_ids.append(gemini_fid)
+            file_info = file_manager.get_file(fid)
+            if file_info:
+                input_files.append(file_info)
+        affinity_account = pick_file_affinity_account(input_files)
 
-        chat_logger.info(f"消息处理完成: 文本长度={len(user_message)}, 图片数量={len(input_images)}, 文件数量={len(gemini_file_ids)}")
+        chat_logger.info("消息处理完成: 文本长度=%s, 图片数量=%s, 文件数量=%s",
+                         len(user_message), len(input_images), len(input_files))
 
-        if not user_message and not input_images and not gemini_file_ids:
+        if not user_message and not input_images and not input_files:
             chat_logger.warning("请求中未找到有效的用户消息、图片或文件")
             return jsonify({"error": "No user message found"}), 400
 
@@ -1801,184 +2253,75 @@ def chat_completions():
         chat_response = None
 
         total_accounts, available_accounts = account_manager.get_account_count()
-        chat_logger.info(f"开始账号轮询: 总账号数={total_accounts}, 可用账号数={available_accounts}, 最大重试={max_retries}")
+        chat_logger.info("开始账号轮询: 总账号数=%s, 可用账号数=%s, 最大重试=%s",
+                         total_accounts, available_accounts, max_retries)
         
         for retry in range(max_retries):
             try:
-                account_idx, account = account_manager.get_next_account()
-                chat_logger.info(f"尝试账号 {account_idx+1}/{max_retries} (第{retry+1}次重试)")
+                with tracer.span('account_pick'):
+                    # 引用了文件时首次尝试路由到文件所在账号，失败后按轮询切换账号
+                    if retry == 0 and affinity_account is not None:
+                        account_idx, account = affinity_account
+                    else:
+                        account_idx, account = account_manager.get_next_account()
+                tracer.set_attribute('account', account_idx)
+                latency_metrics.set_context(account=account_idx, model=model)
+                chat_logger.info("尝试账号 %s/%s (第%s次重试)", account_idx + 1, max_retries, retry + 1)
 
                 session, jwt, team_id = ensure_session_for_account(account_idx, account, force_new_session)
                 proxy = account_manager.config.get("proxy")
+                gemini_file_ids = resolve_files_for_session(input_files, account_idx, session, jwt, team_id, proxy)
                 
                 # 上传内联图片获取 fileId
                 uploaded_count = 0
                 for i, img in enumerate(input_images):
-                    chat_logger.debug(f"上传第 {i+1}/{len(input_images)} 张图片")
+                    chat_logger.debug("上传第 %s/%s 张图片", i + 1, len(input_images))
                     uploaded_file_id = upload_inline_image_to_gemini(jwt, session, team_id, img, proxy)
                     if uploaded_file_id:
                         gemini_file_ids.append(uploaded_file_id)
                         uploaded_count += 1
 
-                chat_logger.info(f"图片上传完成: {uploaded_count}/{len(input_images)} 张图片成功上传")
-                chat_logger.debug(f"开始发送聊天请求，文件总数: {len(gemini_file_ids)}")
+                chat_logger.info("图片上传完成: %s/%s 张图片成功上传", uploaded_count, len(input_images))
+                chat_logger.debug("开始发送聊天请求，文件总数: %s", len(gemini_file_ids))
 
                 # 提取用户消息作为提示词
                 prompt_for_images = user_message if user_message else None
 
                 chat_response = stream_chat_with_images(jwt, session, user_message, proxy, team_id,
                                                      gemini_file_ids, user_id, active_conversation_id, prompt_for_images)
-                chat_logger.info(f"账号 {account_idx+1} 请求成功")
+                chat_logger.info("账号 %s 请求成功", account_idx + 1)
                 break
             except Exception as e:
                 last_error = e
+                record_upstream_error('chat', e)
                 chat_logger.warning(f"账号 {account_idx+1} 请求失败: {str(e)}")
                 continue
         else:
             # 所有账号都失败
             chat_logger.error(f"所有账号都失败，最后错误: {str(last_error)}")
+            record_chat_analytics(model, False, time.time() - start_time, user_id=user_id,
+                                  conversation_id=active_conversation_id)
             return jsonify({"error": f"所有账号请求失败: {last_error}"}), 500
 
         # 构建响应内容（包含图片）
         response_content = build_openai_response_content(chat_response, request.host_url)
-        chat_logger.info(f"响应内容构建完成，响应类型: {type(response_content)}")
+        chat_logger.info("响应内容构建完成，响应类型: %s", type(response_content))
 
         if stream:
             chat_logger.info("返回流式响应")
-            # 流式响应
-            def generate():
-                chunk_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
-
-                # 如果是多模态内容，需要特殊处理流式响应
-                if isinstance(response_content, list):
-                    # 对于多模态内容，转换为适合流式传输的格式
-                    # OpenAI流式响应要求content是字符串，所以我们转换为混合格式
-                    text_content = ""
-                    image_urls = []
-
-                    for part in response_content:
-                        if part.get("type") == "text":
-                            text_content += part.get("text", "")
-                        elif part.get("type") == "image_url":
-                            image_urls.append(part.get("image_url", {}).get("url", ""))
-
-                    # 构建包含图片URL的文本内容
-                    if image_urls:
-                        text_content += "\n\n[Generated Images]\n"
-                        for img_url in image_urls:
-                            text_content += f"![Generated Image]({img_url})\n"
-
-                    chunk = {
-                        "id": chunk_id,
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": "gemini-enterprise",
-                        "choices": [{
-                            "index": 0,
-                            "delta": {"content": text_content},
-                            "finish_reason": None
-                        }]
-                    }
-                else:
-                    # 纯文本内容
-                    chunk = {
-                        "id": chunk_id,
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": "gemini-enterprise",
-                        "choices": [{
-                            "index": 0,
-                            "delta": {"content": response_content},
-                            "finish_reason": None
-                        }]
-                    }
-
-                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-
-                # 结束标记
-                end_chunk = {
-                    "id": chunk_id,
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": "gemini-enterprise",
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": "stop"
-                    }]
-                }
-                yield f"data: {json.dumps(end_chunk, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
-
-            return Response(generate(), mimetype='text/event-stream')
+            record_chat_analytics(model, True, time.time() - start_time, team_id, user_id,
+                                  active_conversation_id, len(chat_response.images))
+            return Response(iter_chat_completion_chunks(response_content), mimetype='text/event-stream')
         else:
             chat_logger.info("返回非流式响应")
-            # 非流式响应
-            # 确保content字段格式正确
-            if isinstance(response_content, list):
-                # 多模态内容，直接使用数组格式
-                content = response_content
-            else:
-                # 纯文本内容，确保是字符串
-                content = str(response_content) if response_content else ""
-
-            response = {
-                "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": "gemini-enterprise",
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": content
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": {
-                    "prompt_tokens": len(user_message),
-                    "completion_tokens": len(chat_response.text),
-                    "total_tokens": len(user_message) + len(chat_response.text)
-                }
-            }
+            response = build_chat_completion(chat_response, response_content, user_message)
             end_time = time.time()
             request_duration = end_time - start_time
-            chat_logger.info(f"聊天请求完成，总耗时: {request_duration:.2f}秒")
+            chat_logger.info("聊天请求完成，总耗时: %.2f秒", request_duration)
 
             # 记录统计数据
-            chat_logger.info("开始记录统计数据...")
-            if analytics_manager is not None:
-                chat_logger.info("analytics_manager 不为空，开始记录...")
-                try:
-                    # 获取API key信息用于统计
-                    api_key = ''
-                    if 'Authorization' in request.headers:
-                        auth_header = request.headers['Authorization']
-                        if auth_header.startswith('Bearer '):
-                            api_key = auth_header[7:]  # 移除 'Bearer ' 前缀
-
-                    # 准备统计数据
-                    usage_data = {
-                        'api_key': api_key,
-                        'model': model,
-                        'success': True,
-                        'duration': request_duration,
-                        'tokens': 0,  # 可以从响应中提取token数量
-                        'images': 0,  # 可以从响应中提取图片数量
-                        'team_id': '',  # 可以从用户信息中获取
-                        'email': '',   # 可以从用户信息中获取
-                        'ip': client_ip,
-                        'user_agent': user_agent,
-                        'user_id': user_id,
-                        'conversation_id': active_conversation_id
-                    }
-
-                    # 调用analytics记录方法
-                    analytics_manager.record_chat_usage(usage_data)
-                    print(f"[统计] 聊天使用已记录: 模型={model}, 耗时={request_duration:.2f}s")
-
-                except Exception as stats_e:
-                    print(f"[统计] 记录聊天统计失败: {stats_e}")
+            record_chat_analytics(model, True, request_duration, team_id, user_id,
+                                  active_conversation_id, len(chat_response.images))
 
             return jsonify(response)
 
@@ -2071,28 +2414,126 @@ def build_openai_response_content(chat_response: ChatResponse, host_url: str):
     return content_parts
 
 
+def build_chat_completion(chat_response: ChatResponse, response_content, user_message: str) -> Dict:
+    """构建 OpenAI 非流式聊天响应"""
+    if isinstance(response_content, list):
+        # 多模态内容，直接使用数组格式
+        content = response_content
+    else:
+        # 纯文本内容，确保是字符串
+        content = str(response_content) if response_content else ""
+
+    response = {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "gemini-enterprise",
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": content
+            },
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": len(user_message),
+            "completion_tokens": len(chat_response.text),
+            "total_tokens": len(user_message) + len(chat_response.text)
+        }
+    }
+    return response
+
+
+def iter_chat_completion_chunks(response_content):
+    """把完整响应内容转换为 OpenAI 流式响应（SSE）的数据块"""
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+
+    # 如果是多模态内容，需要特殊处理流式响应
+    if isinstance(response_content, list):
+        # 对于多模态内容，转换为适合流式传输的格式
+        # OpenAI流式响应要求content是字符串，所以我们转换为混合格式
+        text_content = ""
+        image_urls = []
+
+        for part in response_content:
+            if part.get("type") == "text":
+                text_content += part.get("text", "")
+            elif part.get("type") == "image_url":
+                image_urls.append(part.get("image_url", {}).get("url", ""))
+
+        # 构建包含图片URL的文本内容
+        if image_urls:
+            text_content += "\n\n[Generated Images]\n"
+            for img_url in image_urls:
+                text_content += f"![Generated Image]({img_url})\n"
+
+        chunk = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "gemini-enterprise",
+            "choices": [{
+                "index": 0,
+                "delta": {"content": text_content},
+                "finish_reason": None
+            }]
+        }
+    else:
+        # 纯文本内容
+        chunk = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "gemini-enterprise",
+            "choices": [{
+                "index": 0,
+                "delta": {"content": response_content},
+                "finish_reason": None
+            }]
+        }
+
+    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+    # 结束标记
+    end_chunk = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "gemini-enterprise",
+        "choices": [{
+            "index": 0,
+            "delta": {},
+            "finish_reason": "stop"
+        }]
+    }
+    yield f"data: {json.dumps(end_chunk, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
 # ==================== 图片服务接口 ====================
 
 @app.route('/image/<path:filename>')
+@no_compress
 def serve_image(filename):
     """提供缓存图片的访问"""
     # 安全检查：防止路径遍历
     if '..' in filename or filename.startswith('/'):
-        print(f"[图片服务] 路径安全问题: {filename}")
+        image_logger.warning("[图片服务] 路径安全问题: %s", filename)
         abort(404)
 
     filepath = IMAGE_CACHE_DIR / filename
     if not filepath.exists():
-        print(f"[图片服务] 文件不存在: {filename}")
-        print(f"[图片服务] 查找路径: {filepath}")
-        try:
-            dir_contents = list(IMAGE_CACHE_DIR.iterdir())
-            print(f"[图片服务] 缓存目录内容: {dir_contents}")
-        except Exception as e:
-            print(f"[图片服务] 无法读取缓存目录: {e}")
+        image_logger.info("[图片服务] 文件不存在: %s", filepath)
+        # 列目录开销较大，只在调试级别执行
+        if image_logger.isEnabledFor(logging.DEBUG):
+            try:
+                image_logger.debug("[图片服务] 缓存目录内容: %s", [p.name for p in IMAGE_CACHE_DIR.iterdir()])
+            except Exception as e:
+                image_logger.debug("[图片服务] 无法读取缓存目录: %s", e)
         abort(404)
 
-    print(f"[图片服务] 提供图片: {filename}")
+    image_logger.debug("[图片服务] 提供图片: %s", filename)
 
     # 确定Content-Type
     ext = filepath.suffix.lower()
@@ -2115,7 +2556,7 @@ def health_check():
 
 
 @app.route('/v1/sessions/reset', methods=['POST'])
-@require_api_key
+@require_admin_key
 def reset_sessions():
     """重置所有会话，���除对话记忆"""
     try:
@@ -2173,12 +2614,10 @@ def diagnose_image_service():
 @app.route('/api/public/status', methods=['GET'])
 def public_status():
     """获取公共系统状态（不需要鉴权）"""
-    require_auth = os.getenv('REQUIRE_AUTH', 'false').lower() == 'true'
-
     return jsonify({
         "status": "ok",
         "timestamp": datetime.now().isoformat(),
-        "require_auth": require_auth,
+        "require_auth": get_auth_config().require_auth,
         "version": "Business Gemini Pool v1.0"
     })
 
@@ -2186,7 +2625,7 @@ def public_status():
 
 
 @app.route('/api/status', methods=['GET'])
-@require_api_key
+@require_admin_key
 def system_status():
     """获取系统状态"""
     total, available = account_manager.get_account_count()
@@ -2207,35 +2646,159 @@ def system_status():
     })
 
 
+@app.route('/api/compression/stats', methods=['GET'])
+@require_admin_key
+def compression_stats():
+    """获取响应压缩统计（压缩率、CPU耗时）"""
+    if response_compressor is None:
+        return jsonify({"enabled": False})
+    return jsonify({
+        "enabled": True,
+        "min_size": response_compressor.min_size,
+        "encodings_available": response_compressor.preference,
+        **response_compressor.stats.snapshot()
+    })
+
+
+def _account_availability() -> Dict:
+    return {(str(idx),): 1 if state.get("available", True) else 0
+            for idx, state in list(account_manager.account_states.items())}
+
+
+def _image_cache_usage() -> Dict:
+    files = size = 0
+    if IMAGE_CACHE_DIR.exists():
+        with os.scandir(IMAGE_CACHE_DIR) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files += 1
+                    size += entry.stat().st_size
+    return {('files',): files, ('bytes',): size}
+
+
+def _analytics_queue() -> Dict:
+    recorder = getattr(analytics_manager, 'recorder', None)
+    if recorder is None:
+        return {}
+    stats = recorder.stats()
+    return {('depth',): stats['queue_depth'], ('capacity',): stats['queue_capacity'],
+            ('dropped',): stats['dropped']}
+
+
+REGISTRY.gauge('gemini_account_available', '账号是否可用（1可用/0不可用）', ('account',),
+               callback=_account_availability)
+REGISTRY.gauge('gemini_image_cache', '图片缓存文件数和字节数', ('kind',), callback=_image_cache_usage)
+REGISTRY.gauge('gemini_analytics_queue', '统计写入队列深度、容量和累计丢弃数', ('kind',),
+               callback=_analytics_queue)
+REGISTRY.gauge('gemini_db_write_queue', 'SQLite 写线程队列中等待的写任务数', ('database',),
+               callback=lambda: {(name,): stats['queue_depth'] for name, stats in pool_stats().items()})
+
+
+@app.route('/metrics', methods=['GET'])
+@require_admin_key
+def prometheus_metrics():
+    """Prometheus 文本格式指标"""
+    return Response(REGISTRY.expose(), mimetype=METRICS_CONTENT_TYPE.split(';')[0],
+                    headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+
+@app.route('/api/metrics/latency', methods=['GET'])
+@require_admin_key
+def latency_stats():
+    """获取滑动窗口内各阶段延迟分位数（p50/p90/p99/max）
+
+    参数: window=窗口秒数, group_by=stage,account,model 的子集, stage/account/model 过滤
+    """
+    window = request.args.get('window', 60, type=int)
+    group_by = [d.strip() for d in request.args.get('group_by', 'stage,account,model').split(',') if d.strip()]
+    series = latency_metrics.snapshot(
+        window_seconds=window,
+        group_by=group_by,
+        stage=request.args.get('stage'),
+        account=request.args.get('account'),
+        model=request.args.get('model')
+    )
+    return jsonify({
+        "window_seconds": min(max(window, latency_metrics.slot_seconds), latency_metrics.window_seconds),
+        "stages": list(STAGES),
+        "series": series,
+        "memory": latency_metrics.memory_info()
+    })
+
+
+@app.route('/api/debug/slow-requests', methods=['GET'])
+@require_admin_key
+def slow_requests():
+    """获取时间窗口内最慢的请求及其阶段耗时（span 树）
+
+    参数: limit=返回条数
+    """
+    limit = request.args.get('limit', type=int)
+    buffer = tracer.slow_requests
+    return jsonify({
+        "enabled": tracer.enabled,
+        "capacity": buffer.capacity,
+        "window_seconds": buffer.window_seconds,
+        "min_duration_ms": buffer.min_duration_ms,
+        "exporter": tracer.exporter.stats() if tracer.exporter is not None else None,
+        "requests": buffer.snapshot(limit)
+    })
+
+
+@app.route('/api/auth/reload', methods=['POST'])
+@require_admin_key
+def reload_auth_config():
+    """重新加载鉴权配置（等同于发送 SIGHUP）"""
+    auth_config = auth_config_manager.reload("admin api")
+    return jsonify({
+        "success": True,
+        "require_auth": auth_config.require_auth,
+        "api_key_configured": bool(auth_config.required_api_key),
+        "source": auth_config.source,
+        "loaded_at": datetime.fromtimestamp(auth_config.loaded_at).isoformat(),
+        "reload_count": auth_config_manager.reload_count
+    })
+
+
 # ==================== 管理接口 ====================
 
 @app.route('/')
 def index():
     """返回管理页面"""
-    return send_from_directory('.', 'index.html')
+    return static_assets.serve('index.html')
 
 @app.route('/chat_history.html')
 def chat_history():
     """返回聊天记录页面"""
-    return send_from_directory('.', 'chat_history.html')
+    return static_assets.serve('chat_history.html')
 
 @app.route('/conversation_manager.html')
 def conversation_manager():
     """返回会话管理页面"""
-    return send_from_directory('.', 'conversation_manager.html')
+    return static_assets.serve('conversation_manager.html')
 
 @app.route('/image_gallery.html')
 def image_gallery():
     """返回图片相册页面"""
-    return send_from_directory('.', 'image_gallery.html')
+    return static_assets.serve('image_gallery.html')
+
+@app.route('/analytics.html')
+def analytics_page():
+    """返回统计分析页面"""
+    return static_assets.serve('analytics.html')
+
+@app.route('/api_key_manager.html')
+def api_key_manager_page():
+    """返回API密钥管理页面"""
+    return static_assets.serve('api_key_manager.html')
 
 @app.route('/test_analytics.html')
 def test_analytics():
     """返回统计分析测试页面"""
-    return send_from_directory('.', 'test_analytics.html')
+    return static_assets.serve('test_analytics.html')
 
 @app.route('/api/accounts', methods=['GET'])
-@require_api_key
+@require_admin_key
 def get_accounts():
     """获取账号列表"""
     accounts_data = []
@@ -2257,7 +2820,7 @@ def get_accounts():
 
 
 @app.route('/api/accounts', methods=['POST'])
-@require_api_key
+@require_admin_key
 def add_account():
     """添加账号"""
     data = request.json
@@ -2286,7 +2849,7 @@ def add_account():
 
 
 @app.route('/api/accounts/<int:account_id>', methods=['PUT'])
-@require_api_key
+@require_admin_key
 def update_account(account_id):
     """更新账号"""
     if account_id < 0 or account_id >= len(account_manager.accounts):
@@ -2314,7 +2877,7 @@ def update_account(account_id):
 
 
 @app.route('/api/accounts/<int:account_id>', methods=['DELETE'])
-@require_api_key
+@require_admin_key
 def delete_account(account_id):
     """删除账号"""
     if account_id < 0 or account_id >= len(account_manager.accounts):
@@ -2337,7 +2900,7 @@ def delete_account(account_id):
 
 
 @app.route('/api/accounts/<int:account_id>/toggle', methods=['POST'])
-@require_api_key
+@require_admin_key
 def toggle_account(account_id):
     """切换账号状态"""
     if account_id < 0 or account_id >= len(account_manager.accounts):
@@ -2352,6 +2915,7 @@ def toggle_account(account_id):
         # 重新启用时清除错误信息
         account_manager.accounts[account_id].pop("unavailable_reason", None)
         account_manager.accounts[account_id].pop("unavailable_time", None)
+    account_manager.publish_availability(account_id)
 
     # 移除save_config()调用，配置通过环境变量管理
     # account_manager.save_config()
@@ -2360,6 +2924,7 @@ def toggle_account(account_id):
 
 @require_api_key
 @app.route('/api/accounts/<int:account_id>/test', methods=['GET'])
+@require_admin_key
 def test_account(account_id):
     """测试账号JWT获取"""
     if account_id < 0 or account_id >= len(account_manager.accounts):
@@ -2376,7 +2941,7 @@ def test_account(account_id):
 
 
 @app.route('/api/accounts/batch-import', methods=['POST'])
-@require_api_key
+@require_admin_key
 def batch_import_accounts():
     """批量导入账号"""
     logger = logging.getLogger('gemini_pool.api')
@@ -2463,7 +3028,7 @@ def batch_import_accounts():
 
 
 @app.route('/api/accounts/batch-delete', methods=['POST'])
-@require_api_key
+@require_admin_key
 def batch_delete_accounts():
     """批量删除账号"""
     logger = logging.getLogger('gemini_pool.api')
@@ -2532,6 +3097,7 @@ def batch_delete_accounts():
 
 @require_api_key
 @app.route('/api/models', methods=['GET'])
+@require_admin_key
 def get_models_config():
     """获取模型配置"""
     models = account_manager.config.get("models", [])
@@ -2540,6 +3106,7 @@ def get_models_config():
 
 @require_api_key
 @app.route('/api/models', methods=['POST'])
+@require_admin_key
 def add_model():
     """添加模型"""
     data = request.json
@@ -2564,6 +3131,7 @@ def add_model():
 
 @require_api_key
 @app.route('/api/models/<model_id>', methods=['PUT'])
+@require_admin_key
 def update_model(model_id):
     """更新模型"""
     models = account_manager.config.get("models", [])
@@ -2589,6 +3157,7 @@ def update_model(model_id):
 
 @require_api_key
 @app.route('/api/models/<model_id>', methods=['DELETE'])
+@require_admin_key
 def delete_model(model_id):
     """删除模型"""
     models = account_manager.config.get("models", [])
@@ -2604,6 +3173,7 @@ def delete_model(model_id):
 
 @require_api_key
 @app.route('/api/config', methods=['GET'])
+@require_admin_key
 def get_config():
     """获取完整配置"""
     return jsonify(account_manager.config)
@@ -2611,6 +3181,7 @@ def get_config():
 
 @require_api_key
 @app.route('/api/config', methods=['PUT'])
+@require_admin_key
 def update_config():
     """更新配置"""
     data = request.json
@@ -2623,6 +3194,7 @@ def update_config():
 
 @require_api_key
 @app.route('/api/config/import', methods=['POST'])
+@require_admin_key
 def import_config():
     """导入配置"""
     try:
@@ -2648,6 +3220,7 @@ def import_config():
 
 @require_api_key
 @app.route('/api/proxy/test', methods=['POST'])
+@require_admin_key
 def test_proxy():
     """测试代理"""
     data = request.json
@@ -2665,6 +3238,7 @@ def test_proxy():
 
 @require_api_key
 @app.route('/api/proxy/status', methods=['GET'])
+@require_admin_key
 def get_proxy_status():
     """获取代理状态"""
     proxy = account_manager.config.get("proxy")
@@ -2680,7 +3254,7 @@ def get_proxy_status():
 
 
 @app.route('/api/config/export', methods=['GET'])
-@require_api_key
+@require_admin_key
 def export_config():
     """导出配置"""
     return jsonify(account_manager.config)
@@ -2716,19 +3290,27 @@ def get_conversations():
         conversation_manager = get_conversation_manager()
 
         # 获取查询参数
-        limit = min(int(request.args.get('limit', 50)), 100)  # 最大100条
-        offset = max(int(request.args.get('offset', 0)), 0)
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 100)  # 最大100条
+        except ValueError:
+            return jsonify({"error": "无效的参数"}), 400
+        cursor = request.args.get('cursor') or None
         search = request.args.get('search', '').strip()
 
         if search:
+            # 搜索结果按相关度排序，只返回最相关的一页
             conversations = conversation_manager.search_conversations(user_id, search, limit)
+            next_cursor = None
         else:
-            conversations = conversation_manager.get_conversations(user_id, limit, offset)
+            try:
+                conversations, next_cursor = conversation_manager.get_conversations(user_id, limit, cursor)
+            except ValueError:
+                return jsonify({"error": "无效的分页游标"}), 400
 
         # 转换为字典格式
         result = []
         for conv in conversations:
-            result.append({
+            item = {
                 'id': conv.id,
                 'session_id': conv.session_id,
                 'title': conv.title,
@@ -2737,13 +3319,18 @@ def get_conversations():
                 'updated_at': conv.updated_at,
                 'message_count': conv.message_count,
                 'is_active': conv.is_active
-            })
+            }
+            if search:
+                # 命中片段已做 HTML 转义，命中处用 <mark> 标出
+                item['snippet'] = conv.snippet
+            result.append(item)
 
         return jsonify({
             "conversations": result,
             "total": len(result),
             "limit": limit,
-            "offset": offset
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None
         })
 
     except Exception as e:
@@ -2801,6 +3388,29 @@ def create_conversation():
         logger.error(f"创建会话失败: {e}")
         return jsonify({"error": "创建会话失败"}), 500
 
+def get_message_page(conversation_manager, conversation_id: int, user_id: str):
+    """按请求参数 limit / cursor / order 取一页会话消息，返回 (消息字典列表, 下一页游标)；参数无效时抛出 ValueError"""
+    limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError(f"无效的排序方向: {order}")
+    messages, next_cursor = conversation_manager.get_messages(
+        conversation_id, user_id, limit=limit, cursor=request.args.get('cursor') or None, order=order)
+
+    message_list = []
+    for msg in messages:
+        message_list.append({
+            'id': msg.id,
+            'role': msg.role,
+            'content': msg.content,
+            'timestamp': msg.timestamp,
+            'message_type': msg.message_type,
+            'file_metadata': msg.file_metadata,
+            'token_count': msg.token_count,
+            'model': msg.model
+        })
+    return message_list, next_cursor
+
 @app.route('/v1/conversations/<int:conversation_id>', methods=['GET'])
 @require_api_key
 def get_conversation(conversation_id):
@@ -2816,22 +3426,11 @@ def get_conversation(conversation_id):
         if not conversation:
             return jsonify({"error": "会话不存在"}), 404
 
-        # 获取会话消息
-        messages = conversation_manager.get_messages(conversation_id, user_id, limit=1000)
-
-        # 转换消息格式
-        message_list = []
-        for msg in messages:
-            message_list.append({
-                'id': msg.id,
-                'role': msg.role,
-                'content': msg.content,
-                'timestamp': msg.timestamp,
-                'message_type': msg.message_type,
-                'file_metadata': msg.file_metadata,
-                'token_count': msg.token_count,
-                'model': msg.model
-            })
+        # 获取会话消息（第一页，更多消息按 next_cursor 翻页）
+        try:
+            message_list, next_cursor = get_message_page(conversation_manager, conversation_id, user_id)
+        except ValueError:
+            return jsonify({"error": "无效的参数"}), 400
 
         return jsonify({
             "conversation": {
@@ -2845,7 +3444,9 @@ def get_conversation(conversation_id):
                 'is_active': conversation.is_active,
                 'metadata': conversation.metadata
             },
-            "messages": message_list
+            "messages": message_list,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None
         })
 
     except Exception as e:
@@ -2975,6 +3576,35 @@ def get_active_conversation():
         logger.error(f"获取活跃会话失败: {e}")
         return jsonify({"error": "获取活跃会话失败"}), 500
 
+@app.route('/v1/conversations/<int:conversation_id>/messages', methods=['GET'])
+@require_api_key
+def get_conversation_messages(conversation_id):
+    """分页获取会话消息"""
+    try:
+        user_id = get_user_id_from_request()
+        if not user_id:
+            return jsonify({"error": "无法识别用户"}), 401
+
+        conversation_manager = get_conversation_manager()
+        if not conversation_manager.get_conversation(conversation_id, user_id):
+            return jsonify({"error": "会话不存在"}), 404
+
+        try:
+            message_list, next_cursor = get_message_page(conversation_manager, conversation_id, user_id)
+        except ValueError:
+            return jsonify({"error": "无效的参数"}), 400
+
+        return jsonify({
+            "messages": message_list,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None
+        })
+
+    except Exception as e:
+        logger = logging.getLogger('gemini_pool.api')
+        logger.error(f"获取会话消息失败: {e}")
+        return jsonify({"error": "获取会话消息失败"}), 500
+
 @app.route('/v1/conversations/<int:conversation_id>/messages', methods=['POST'])
 @require_api_key
 def add_message_to_conversation(conversation_id):
@@ -3076,99 +3706,46 @@ def get_conversation_statistics():
 @app.route('/v1/images', methods=['GET'])
 @require_api_key
 def get_images():
-    """获取用户的图片列表（分页）- 直接从image目录读取"""
+    """获取用户的图片列表（按 (created_at, id) 游标分页，最新的在前）"""
     try:
         user_id = get_user_id_from_request()
         if not user_id:
             return jsonify({"error": "无法识别用户"}), 401
 
-        # 获取查询参数
-        page = int(request.args.get('page', 1))
-        per_page = min(int(request.args.get('per_page', 20)), 100)  # 限制最大每页100张
+        # 获取查询参数（per_page 为旧参数名）
+        limit = min(max(int(request.args.get('limit', request.args.get('per_page', 20))), 1), 100)  # 限制最大每页100张
+        cursor = request.args.get('cursor') or None
         search_query = request.args.get('search', '').strip()
 
-        # 直接从image目录读取图片文件
-        images_data = []
-        image_files = []
-
-        # 扫描image目录
-        try:
-            for filename in os.listdir(IMAGE_CACHE_DIR):
-                file_path = IMAGE_CACHE_DIR / filename
-                if file_path.is_file() and filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
-                    # 获取文件信息
-                    stat = file_path.stat()
-
-                    # 应用搜索过滤
-                    if search_query and search_query.lower() not in filename.lower():
-                        continue
-
-                    # 获取图片尺寸（如果PIL可用）
-                    width = None
-                    height = None
-                    try:
-                        from PIL import Image as PILImage
-                        with PILImage.open(file_path) as img:
-                            width, height = img.size
-                    except ImportError:
-                        pass  # PIL不可用时跳过尺寸获取
-                    except Exception:
-                        pass  # 图片读取失败时跳过尺寸获取
-
-                    image_info = {
-                        'id': hash(filename) % (2**31),  # 使用文件名哈希作为临时ID
-                        'filename': filename,
-                        'original_filename': filename,  # 对于目录文件，原始文件名就是文件名
-                        'file_path': str(file_path),
-                        'file_size': stat.st_size,
-                        'image_width': width,
-                        'image_height': height,
-                        'mime_type': f"image/{filename.lower().split('.')[-1]}",
-                        'title': filename.replace('_', ' ').replace('.png', '').replace('.jpg', '').replace('.jpeg', ''),
-                        'description': f"Generated image: {filename}",
-                        'prompt': None,  # 从文件名无法获取原始提示词
-                        'conversation_id': None,
-                        'message_id': None,
-                        'user_id': user_id,
-                        'tags': [],
-                        'metadata': {'source': 'directory_scan'},
-                        'created_at': datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                        'url': f"/image/{filename}",
-                        'modified_time': stat.st_mtime
-                    }
-                    image_files.append((filename, stat.st_mtime, image_info))
-        except Exception as e:
-            logger = logging.getLogger('gemini_pool.api')
-            logger.error(f"扫描图片目录失败: {e}")
-            return jsonify({"error": "扫描图片目录失败"}), 500
-
-        # 按修改时间排序（最新的在前）
-        image_files.sort(key=lambda x: x[1], reverse=True)
-
-        # 分页处理
-        total_count = len(image_files)
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        paginated_files = image_files[start_idx:end_idx]
-
-        # 提取图片信息
-        for _, _, image_info in paginated_files:
-            images_data.append(image_info)
+        conversation_manager = get_conversation_manager()
+        images, next_cursor = conversation_manager.get_images(user_id, limit, cursor, search_query)
 
-        # 计算分页信息
-        total_pages = (total_count + per_page - 1) // per_page
+        images_data = []
+        for image in images:
+            images_data.append({
+                'id': image.id,
+                'filename': image.filename,
+                'original_filename': image.original_filename,
+                'file_size': image.file_size,
+                'image_width': image.image_width,
+                'image_height': image.image_height,
+                'mime_type': image.mime_type,
+                'title': image.title,
+                'description': image.description,
+                'prompt': image.prompt,
+                'conversation_id': image.conversation_id,
+                'message_id': image.message_id,
+                'tags': image.tags,
+                'metadata': image.metadata,
+                'created_at': image.created_at,
+                'url': f"/image/{image.filename}"
+            })
 
         return jsonify({
             'images': images_data,
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total_count': total_count,
-                'total_pages': total_pages,
-                'has_next': page < total_pages,
-                'has_prev': page > 1
-            },
-            'source': 'directory_scan'  # 标识数据来源
+            'limit': limit,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
         })
 
     except ValueError:
@@ -3177,6 +3754,7 @@ def get_images():
         logger = logging.getLogger('gemini_pool.api')
         logger.error(f"获取图片列表失败: {e}")
         return jsonify({"error": "获取图片列表失败"}), 500
+
 @app.route('/v1/images/<int:image_id>', methods=['GET'])
 @require_api_key
 def get_image(image_id):
@@ -3352,8 +3930,13 @@ def delete_image_by_filename():
         # 构建文件路径
         file_path = IMAGE_CACHE_DIR / filename
 
-        # 检查文件是否存在
+        # 检查文件是否存在（文件已不在但还有记录时只删记录）
         if not file_path.exists():
+            if forget_image_records([filename]):
+                return jsonify({
+                    "message": f"图片 {filename} 删除成功",
+                    "filename": filename
+                })
             return jsonify({"error": "文件不存在"}), 404
 
         # 检查是否为文件
@@ -3363,6 +3946,7 @@ def delete_image_by_filename():
         # 删除文件
         try:
             file_path.unlink()
+            forget_image_records([filename])
             logger = logging.getLogger('gemini_pool.api')
             logger.info(f"用户 {user_id} 删除了图片: {filename}")
 
@@ -3418,7 +4002,10 @@ def batch_delete_images():
             file_path = IMAGE_CACHE_DIR / filename
 
             if not file_path.exists():
-                failed_files.append({"filename": filename, "error": "文件不存在"})
+                if forget_image_records([filename]):
+                    deleted_files.append(filename)
+                else:
+                    failed_files.append({"filename": filename, "error": "文件不存在"})
                 continue
 
             if not file_path.is_file():
@@ -3431,6 +4018,8 @@ def batch_delete_images():
             except OSError as e:
                 failed_files.append({"filename": filename, "error": f"删除失败: {str(e)}"})
 
+        forget_image_records(deleted_files)
+
         logger = logging.getLogger('gemini_pool.api')
         logger.info(f"用户 {user_id} 批量删除图片: 成功 {len(deleted_files)}, 失败 {len(failed_files)}")
 
@@ -0,0 +1,272 @@
+"""Business Gemini Pool 延迟直方图
+HDR 风格的对数-线性分桶直方图（约 6% 相对误差），按 阶段/账号/模型 分组，
+以固定数量的时间槽组成滑动窗口，提供 p50/p90/p99/max；
+桶数、槽数和分组数都有上限，内存占用与流量无关
+"""
+
+import contextvars
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 记录的阶段
+STAGES = (
+    'total',            # 请求总耗时
+    'queue_wait',       # 等待账号锁
+    'jwt',              # 获取JWT
+    'session',          # 创建会话
+    'upload',           # 上传文件到上游
+    'upstream_ttfb',    # 上游首字节
+    'upstream_total',   # 上游完整响应
+    'image_download',   # 下载生成的图片
+)
+
+# 每个2的幂区间内的子桶数 = 2^SUB_BUCKET_BITS
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# 可记录的最大值为 2^MAX_EXPONENT 微秒（约 1.2 小时），超出的值计入最后一个桶
+MAX_EXPONENT = 32
+MAX_SHIFT = MAX_EXPONENT - SUB_BUCKET_BITS - 1
+BUCKET_COUNT = MAX_SHIFT * SUB_BUCKETS + 2 * SUB_BUCKETS
+_ZERO_COUNTS = array('I', [0]) * BUCKET_COUNT
+
+# 超出上限后新的分组合并到该账号/模型名下
+OVERFLOW_LABEL = '_other'
+
+
+def bucket_index(value_us: int) -> int:
+    """微秒值 -> 桶序号"""
+    if value_us < 2 * SUB_BUCKETS:
+        return max(value_us, 0)
+    shift = value_us.bit_length() - SUB_BUCKET_BITS - 1
+    if shift > MAX_SHIFT:
+        return BUCKET_COUNT - 1
+    return shift * SUB_BUCKETS + (value_us >> shift)
+
+
+def bucket_value(index: int) -> int:
+    """桶序号 -> 桶内中间值（微秒）"""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    sub = index - shift * SUB_BUCKETS
+    return (sub << shift) + (1 << shift) // 2
+
+
+class _Slot:
+    """滑动窗口中的一个时间槽"""
+    __slots__ = ('epoch', 'counts', 'total', 'sum_us', 'max_us')
+
+    def __init__(self):
+        self.epoch = -1
+        self.counts = None
+        self.total = 0
+        self.sum_us = 0
+        self.max_us = 0
+
+    def reset(self, epoch: int):
+        self.epoch = epoch
+        if self.counts is None:
+            self.counts = array('I', _ZERO_COUNTS)
+        else:
+            self.counts[:] = _ZERO_COUNTS
+        self.total = 0
+        self.sum_us = 0
+        self.max_us = 0
+
+
+class WindowedHistogram:
+    """固定槽数的滑动窗口直方图"""
+
+    def __init__(self, slot_seconds: int, slot_count: int):
+        self.slot_seconds = slot_seconds
+        self.slots = [_Slot() for _ in range(slot_count)]
+        self.lock = threading.Lock()
+
+    def record(self, value_us: int, now: float):
+        epoch = int(now) // self.slot_seconds
+        slot = self.slots[epoch % len(self.slots)]
+        index = bucket_index(value_us)
+        with self.lock:
+            if slot.epoch != epoch:
+                slot.reset(epoch)
+            slot.counts[index] += 1
+            slot.total += 1
+            slot.sum_us += value_us
+            if value_us > slot.max_us:
+                slot.max_us = value_us
+
+    def merge_into(self, counts: List[int], window_seconds: int, now: float) -> Tuple[int, int, int]:
+        """把窗口内的槽合并到 counts，返回 (次数, 总和, 最大值)"""
+        current = int(now) // self.slot_seconds
+        oldest = current - max(1, -(-window_seconds // self.slot_seconds)) + 1
+        total = sum_us = max_us = 0
+        with self.lock:
+            for slot in self.slots:
+                if slot.counts is None or not (oldest <= slot.epoch <= current) or not slot.total:
+                    continue
+                slot_counts = slot.counts
+                for i, c in enumerate(slot_counts):
+                    if c:
+                        counts[i] += c
+                total += slot.total
+                sum_us += slot.sum_us
+                max_us = max(max_us, slot.max_us)
+        return total, sum_us, max_us
+
+
+def summarize(counts: List[int], total: int, sum_us: int, max_us: int,
+              percentiles: Iterable[float] = (50, 90, 99)) -> Dict[str, float]:
+    """根据合并后的桶计数计算分位数（毫秒）"""
+    result = {'count': total}
+    if not total:
+        for p in percentiles:
+            result[f'p{int(p)}_ms'] = 0.0
+        result['max_ms'] = 0.0
+        result['mean_ms'] = 0.0
+        return result
+
+    targets = sorted((p, max(1, int(total * p / 100.0 + 0.5))) for p in percentiles)
+    seen = 0
+    t = 0
+    for index, c in enumerate(counts):
+        if not c:
+            continue
+        seen += c
+        while t < len(targets) and seen >= targets[t][1]:
+            value_us = min(bucket_value(index), max_us)
+            result[f'p{int(targets[t][0])}_ms'] = round(value_us / 1000.0, 3)
+            t += 1
+        if t == len(targets):
+            break
+    result['max_ms'] = round(max_us / 1000.0, 3)
+    result['mean_ms'] = round(sum_us / total / 1000.0, 3)
+    return result
+
+
+class LatencyMetrics:
+    """按 (阶段, 账号, 模型) 分组的延迟直方图集合"""
+
+    def __init__(self, slot_seconds: int = 15, window_seconds: int = 300, max_series: int = 256):
+        self.slot_seconds = slot_seconds
+        self.window_seconds = window_seconds
+        self.slot_count = max(1, -(-window_seconds // slot_seconds))
+        self.max_series = max_series
+        self._series: Dict[Tuple[str, str, str], WindowedHistogram] = {}
+        self._series_lock = threading.Lock()
+        self._context: contextvars.ContextVar = contextvars.ContextVar('latency_context', default=('', ''))
+
+    # ---------- 请求上下文（线程或 asyncio 任务各自一份） ----------
+
+    def set_context(self, account=None, model: Optional[str] = None):
+        """设置当前请求的默认账号/模型维度"""
+        current_account, current_model = self._context.get()
+        self._context.set((current_account if account is None else str(account),
+                           current_model if model is None else model))
+
+    def clear_context(self):
+        self._context.set(('', ''))
+
+    # ---------- 记录 ----------
+
+    def _get_series(self, key: Tuple[str, str, str]) -> WindowedHistogram:
+        series = self._series.get(key)
+        if series is not None:
+            return series
+        with self._series_lock:
+            series = self._series.get(key)
+            if series is None:
+                if len(self._series) >= self.max_series:
+                    key = (key[0], OVERFLOW_LABEL, OVERFLOW_LABEL)
+                    series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = WindowedHistogram(self.slot_seconds, self.slot_count)
+            return series
+
+    def observe(self, stage: str, seconds: float, account=None, model: Optional[str] = None):
+        """记录一次耗时（秒）"""
+        if account is None or model is None:
+            context_account, context_model = self._context.get()
+            account = context_account if account is None else account
+            model = context_model if model is None else model
+        key = (stage, str(account), model or '')
+        self._get_series(key).record(int(seconds * 1_000_000), time.time())
+
+    @contextmanager
+    def timer(self, stage: str, account=None, model: Optional[str] = None):
+        """计时上下文管理器，异常时同样记录耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, account, model)
+
+    # ---------- 查询 ----------
+
+    def snapshot(self, window_seconds: int = 60, group_by: Iterable[str] = ('stage', 'account', 'model'),
+                 stage: Optional[str] = None, account: Optional[str] = None,
+                 model: Optional[str] = None) -> List[Dict]:
+        """按维度合并窗口内的直方图并返回分位数"""
+        dims = ('stage', 'account', 'model')
+        group_by = [d for d in dims if d in group_by]
+        window_seconds = min(max(window_seconds, self.slot_seconds), self.window_seconds)
+        now = time.time()
+
+        groups: Dict[Tuple, List] = {}
+        with self._series_lock:
+            items = list(self._series.items())
+        for key, series in items:
+            if stage is not None and key[0] != stage:
+                continue
+            if account is not None and key[1] != account:
+                continue
+            if model is not None and key[2] != model:
+                continue
+            group_key = tuple(key[dims.index(d)] for d in group_by)
+            group = groups.get(group_key)
+            if group is None:
+                group = groups[group_key] = [[0] * BUCKET_COUNT, 0, 0, 0]
+            total, sum_us, max_us = series.merge_into(group[0], window_seconds, now)
+            group[1] += total
+            group[2] += sum_us
+            group[3] = max(group[3], max_us)
+
+        results = []
+        for group_key, (counts, total, sum_us, max_us) in groups.items():
+            if not total:
+                continue
+            entry = dict(zip(group_by, group_key))
+            entry.update(summarize(counts, total, sum_us, max_us))
+            results.append(entry)
+        results.sort(key=lambda e: tuple(str(e.get(d, '')) for d in group_by))
+        return results
+
+    def memory_info(self) -> Dict[str, int]:
+        with self._series_lock:
+            series = len(self._series)
+        return {
+            'series': series,
+            'max_series': self.max_series,
+            'slots_per_series': self.slot_count,
+            'buckets_per_slot': BUCKET_COUNT,
+            'max_bytes': self.max_series * self.slot_count * BUCKET_COUNT * _ZERO_COUNTS.itemsize,
+        }
+
+
+# 全局延迟直方图
+_latency_metrics = None
+
+
+def get_latency_metrics() -> LatencyMetrics:
+    """获取全局延迟直方图实例"""
+    global _latency_metrics
+    if _latency_metrics is None:
+        _latency_metrics = LatencyMetrics(
+            slot_seconds=int(os.getenv('LATENCY_SLOT_SECONDS', '15')),
+            window_seconds=int(os.getenv('LATENCY_WINDOW_SECONDS', '300')),
+            max_series=int(os.getenv('LATENCY_MAX_SERIES', '256')),
+        )
+    return _latency_metrics
@@ -0,0 +1,342 @@
+"""Business Gemini Pool Prometheus 指标
+提供 Counter / Gauge / Histogram 和 Prometheus 文本格式输出；
+计数器与直方图按线程分片累加（热路径无锁），只在抓取时合并，
+不会成为新的锁竞争点；账号可用性、队列深度等状态在抓取时通过回调读取
+"""
+
+import math
+import threading
+import weakref
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# 默认延迟桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _ShardOwner:
+    """线程局部变量中的占位对象，线程结束时随线程局部存储一起释放"""
+    __slots__ = ('__weakref__',)
+
+
+class _ThreadShards:
+    """按线程分片的存储：每个线程只写自己的字典，抓取时合并所有分片
+
+    线程结束后其分片由 fold 合并进 retired 并移除，每请求一线程的服务器上分片数不会无限增长
+    """
+
+    def __init__(self, fold: Callable[[dict, dict], None]):
+        self._fold = fold
+        self._local = threading.local()
+        self._shards: Dict[int, dict] = {}
+        self._retired: dict = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def local(self) -> dict:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            owner = self._local.owner = _ShardOwner()
+            # 仅在线程首次写入时加锁一次
+            with self._lock:
+                shard_id = self._next_id
+                self._next_id += 1
+                self._shards[shard_id] = shard
+            weakref.finalize(owner, self._retire, shard_id)
+        return shard
+
+    def _retire(self, shard_id: int):
+        with self._lock:
+            shard = self._shards.pop(shard_id, None)
+            if shard:
+                self._fold(self._retired, shard)
+
+    def shards(self) -> List[dict]:
+        # fold 只替换 retired 中的值、不原地修改，浅拷贝即可得到一致的快照
+        with self._lock:
+            return [dict(self._retired), *self._shards.values()]
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Tuple) -> LabelValues:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+        return tuple(str(v) for v in labels)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    @property
+    def exposed_name(self) -> str:
+        return self.name
+
+    def expose(self) -> str:
+        name = self.exposed_name
+        lines = [f'# HELP {name} {self.documentation}', f'# TYPE {name} {self.type_name}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """单调递增计数器（线程分片，无锁累加）"""
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._shards = _ThreadShards(self._fold)
+
+    @staticmethod
+    def _fold(target: dict, shard: dict):
+        for key, value in shard.items():
+            target[key] = target.get(key, 0) + value
+
+    def inc(self, *labels, amount: float = 1):
+        shard = self._shards.local()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def values(self) -> Dict[LabelValues, float]:
+        totals: Dict[LabelValues, float] = {}
+        for shard in self._shards.shards():
+            for key, value in list(shard.items()):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    @property
+    def exposed_name(self) -> str:
+        return f'{self.name}_total'
+
+    def samples(self):
+        return [('', _format_labels(self.labelnames, key), value)
+                for key, value in sorted(self.values().items())]
+
+
+class Gauge(Metric):
+    """瞬时值；可直接 set，也可以注册抓取时调用的回调"""
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 callback: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, *labels):
+        # 单个字典赋值在 GIL 下是原子的
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        values = dict(self._values)
+        if self.callback is not None:
+            try:
+                values.update(self.callback())
+            except Exception:
+                pass
+        return [('', _format_labels(self.labelnames, key), value)
+                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """固定桶直方图（线程分片，无锁累加）"""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._shards = _ThreadShards(self._fold)
+
+    @staticmethod
+    def _fold(target: dict, shard: dict):
+        for key, state in shard.items():
+            total = target.get(key)
+            target[key] = list(state) if total is None else [a + b for a, b in zip(total, state)]
+
+    def observe(self, value: float, *labels):
+        shard = self._shards.local()
+        key = self._key(labels)
+        state = shard.get(key)
+        if state is None:
+            # [各桶计数..., 总和]
+            state = shard[key] = [0] * len(self.buckets) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-1] += value
+
+    def samples(self):
+        merged: Dict[LabelValues, List[float]] = {}
+        for shard in self._shards.shards():
+            for key, state in list(shard.items()):
+                total = merged.get(key)
+                if total is None:
+                    total = merged[key] = [0] * len(state)
+                for i, v in enumerate(state):
+                    total[i] += v
+
+        result = []
+        for key, state in sorted(merged.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                result.append(('_bucket', _format_labels(self.labelnames, key, le), cumulative))
+            result.append(('_sum', _format_labels(self.labelnames, key), state[-1]))
+            result.append(('_count', _format_labels(self.labelnames, key), cumulative))
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已存在: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def expose(self) -> str:
+        """生成 Prometheus 文本格式（text/plain; version=0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(m.expose() for m in metrics) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 全局指标注册表
+REGISTRY = MetricsRegistry()
+
+# ---------- 网关指标 ----------
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'gemini_http_requests', '按路由和状态码统计的请求数', ('route', 'method', 'status'))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'gemini_http_request_duration_seconds', '请求处理耗时（不含流式响应传输）', ('route',))
+HTTP_STARTED = Counter('gemini_http_started', '已开始的请求数')
+HTTP_FINISHED = Counter('gemini_http_finished', '已结束的请求数（响应传输完成）')
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    'gemini_http_requests_in_flight', '正在处理的请求数（含流式传输中）',
+    callback=lambda: {(): sum(HTTP_STARTED.values().values()) - sum(HTTP_FINISHED.values().values())})
+
+JWT_REFRESHES = REGISTRY.counter(
+    'gemini_jwt_refreshes', 'JWT 刷新次数', ('account', 'result'))
+SESSION_CREATIONS = REGISTRY.counter(
+    'gemini_session_creations', '会话创建次数', ('account', 'result'))
+UPSTREAM_ERRORS = REGISTRY.counter(
+    'gemini_upstream_errors', '上游错误数（按操作和错误类别）', ('operation', 'error_class'))
+
+IMAGE_CACHE_EVICTIONS = REGISTRY.counter(
+    'gemini_image_cache_evictions', '图片缓存过期删除的文件数')
+
+DB_WRITE_SECONDS = REGISTRY.histogram(
+    'gemini_db_write_duration_seconds', '数据库批量写入耗时', ('operation',),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+DB_WRITE_WAIT_SECONDS = REGISTRY.histogram(
+    'gemini_db_write_wait_seconds', '写任务在 SQLite 写队列中等待的耗时',
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+DB_WRITE_BATCH_JOBS = REGISTRY.histogram(
+    'gemini_db_write_batch_jobs', '每个 SQLite 写事务合并提交的写任务数',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+DB_BUSY_ERRORS = REGISTRY.counter('gemini_db_busy_errors', 'SQLite database is locked 错误数')
+
+
+def classify_upstream_error(error=None, status_code: Optional[int] = None) -> str:
+    """把上游异常或状态码归类为有限的错误类别"""
+    if status_code is not None:
+        if status_code == 429:
+            return 'rate_limited'
+        if status_code in (401, 403):
+            return 'auth'
+        return f'http_{status_code // 100}xx'
+    name = type(error).__name__ if error is not None else ''
+    if 'Timeout' in name:
+        return 'timeout'
+    if 'Connection' in name or 'ProxyError' in name or 'SSLError' in name:
+        return 'connection'
+    if name in ('JSONDecodeError', 'ValueError', 'KeyError'):
+        return 'bad_response'
+    return 'other'
+
+
+class InFlightMiddleware:
+    """WSGI 中间件：响应体传输完成（close）时才计为结束，流式响应也能正确统计"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        from werkzeug.wsgi import ClosingIterator
+        HTTP_STARTED.inc()
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except BaseException:
+            HTTP_FINISHED.inc()
+            raise
+        return ClosingIterator(result, HTTP_FINISHED.inc)
+
+
+def init_metrics(app):
+    """为 Flask 应用注册请求计数、耗时和在途请求统计"""
+    import time
+    from flask import g, request
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _metrics_record(response):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUESTS.inc(route, request.method, response.status_code)
+        start = getattr(g, '_metrics_start', None)
+        if start is not None:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route)
+        return response
+
+    app.wsgi_app = InFlightMiddleware(app.wsgi_app)
@@ -74,6 +74,8 @@ CREATE TABLE IF NOT EXISTS settings (
 -- 索引优化
 CREATE INDEX IF NOT EXISTS idx_conversations_user_active ON conversations(user_id, is_active);
 CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at DESC);
+-- 会话列表按 (updated_at, id) 游标分页（id 即 rowid，索引隐含）
+CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations(user_id, updated_at);
 CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, timestamp);
 CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_conversation_tags_tag ON conversation_tags(tag);
@@ -81,6 +83,8 @@ CREATE INDEX IF NOT EXISTS idx_conversation_tags_tag ON conversation_tags(tag);
 -- 图片表索引
 CREATE INDEX IF NOT EXISTS idx_images_user_id ON images(user_id);
 CREATE INDEX IF NOT EXISTS idx_images_created_at ON images(created_at DESC);
+-- 图片列表按 (created_at, id) 游标分页
+CREATE INDEX IF NOT EXISTS idx_images_user_created ON images(user_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_images_conversation ON images(conversation_id);
 CREATE INDEX IF NOT EXISTS idx_images_filename ON images(filename);
 
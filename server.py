@@ -0,0 +1,481 @@
+"""Business Gemini Pool 生产环境启动入口
+
+安装了 gunicorn 时使用 gunicorn 的 gthread worker；否则使用内置的多进程 + 线程池 WSGI 服务：
+主进程绑定端口后 fork 出多个 worker（每个 worker 各自导入应用，不在主进程中预加载），
+worker 用固定大小的线程池处理连接（线程全部占用时不再 accept，连接在内核队列中等待），
+支持 HTTP/1.1 keep-alive、空闲连接和请求读写超时、处理一定请求数后（加随机抖动）平滑重启 worker，
+收到 SIGTERM/SIGINT 时停止接受新连接并等待处理中的请求完成。
+
+--server asgi 以 ASGI 网关模式运行（见 asgi_app.py）：安装了 uvicorn 时使用 uvicorn，
+否则由同样的主进程管理内置 asyncio 服务的 worker（见 asgi_server.py），--threads 为 WSGI 桥接线程数。
+
+多个 worker 共享账号池需要配置 STATE_BACKEND（见 shared_state.py）。
+
+用法:
+    python server.py [--workers 4] [--threads 32] [--port 7860]
+    所有参数也可通过环境变量 WEB_* 设置，见 .env.example
+"""
+
+import argparse
+import io
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from typing import Dict, Optional, Set
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+logger = logging.getLogger('gemini_pool.server')
+
+
+@dataclass
+class ServerConfig:
+    host: str = '0.0.0.0'
+    port: int = 7860
+    workers: int = 1
+    threads: int = 32
+    keepalive: float = 5.0
+    timeout: float = 120.0
+    graceful_timeout: float = 30.0
+    max_requests: int = 0
+    max_requests_jitter: int = 0
+    backlog: int = 2048
+    server: str = 'auto'
+    access_log: bool = False
+
+    @classmethod
+    def from_env(cls) -> 'ServerConfig':
+        config = cls()
+        env_names = {'host': 'WEB_HOST', 'port': 'PORT'}
+        for f in fields(cls):
+            raw = os.getenv(env_names.get(f.name, f"WEB_{f.name.upper()}"))
+            if raw is None or raw == '':
+                continue
+            if f.type is bool or f.type == 'bool':
+                value = raw.lower() == 'true'
+            else:
+                value = type(getattr(config, f.name))(raw)
+            setattr(config, f.name, value)
+        return config
+
+    def worker_max_requests(self) -> int:
+        """单个 worker 的请求上限（加随机抖动，避免所有 worker 同时重启）"""
+        if self.max_requests <= 0:
+            return 0
+        return self.max_requests + random.randint(0, max(self.max_requests_jitter, 0))
+
+
+def load_app(show_startup_info: bool = False):
+    import gemini
+    if show_startup_info:
+        gemini.print_startup_info()
+        if not gemini.account_manager.accounts:
+            print("[!] 警告: 没有配置任何账号")
+    return gemini.app
+
+
+# ==================== gunicorn ====================
+
+def run_gunicorn(config: ServerConfig):
+    class GunicornApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f"{config.host}:{config.port}",
+                'workers': config.workers,
+                'worker_class': 'gthread',
+                'threads': config.threads,
+                'keepalive': int(config.keepalive),
+                'timeout': int(config.timeout),
+                'graceful_timeout': int(config.graceful_timeout),
+                'max_requests': config.max_requests,
+                'max_requests_jitter': config.max_requests_jitter,
+                'backlog': config.backlog,
+                'accesslog': '-' if config.access_log else None,
+                'preload_app': False,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_app(show_startup_info=True)
+
+    GunicornApplication().run()
+
+
+# ==================== uvicorn ====================
+
+def run_uvicorn(config: ServerConfig):
+    os.environ.setdefault('ASGI_BRIDGE_THREADS', str(config.threads))
+    if config.workers == 1:
+        # 单 worker 时 uvicorn 在当前进程中运行应用；多 worker 时由各 worker 进程导入
+        load_app(show_startup_info=True)
+    uvicorn.run(
+        'asgi_app:app',
+        host=config.host,
+        port=config.port,
+        workers=config.workers,
+        timeout_keep_alive=int(config.keepalive),
+        timeout_graceful_shutdown=int(config.graceful_timeout),
+        limit_max_requests=config.worker_max_requests() or None,
+        backlog=config.backlog,
+        access_log=config.access_log,
+        lifespan='on',
+    )
+
+
+# ==================== 内置服务 ====================
+
+
+class ProductionRequestHandler(WSGIRequestHandler):
+    """支持 keep-alive 的请求处理器
+
+    werkzeug 默认每个响应都带 Connection: close。这里在连接可复用时改为 keep-alive，
+    并在响应结束后读掉应用没有读完的请求体，保证下一个请求行从正确位置开始。
+    空闲连接使用 keepalive 超时，读到请求行后改用请求超时；
+    线程全部占用、有新连接在等待时，keep-alive 连接在当前响应后关闭，避免长连接一直占住线程。
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # 未读完的请求体超过该大小时直接关闭连接，不再排空
+    max_drain_bytes = 1024 * 1024
+
+    def handle_one_request(self):
+        self._body = None
+        self.connection.settimeout(self.server.keepalive or self.server.request_timeout or None)
+        super().handle_one_request()
+        if not self._can_keep_alive():
+            self.close_connection = True
+
+    def parse_request(self):
+        self.connection.settimeout(self.server.request_timeout or None)
+        return super().parse_request()
+
+    def _can_keep_alive(self) -> bool:
+        return (
+            self.server.keepalive > 0
+            and not self.server.stopping
+            and not self.server.accept_waiting
+            and self.request_version == 'HTTP/1.1'
+            and self._body is not None
+        )
+
+    def make_environ(self):
+        environ = super().make_environ()
+        if not environ.get('wsgi.input_terminated'):
+            try:
+                length = max(int(environ.get('CONTENT_LENGTH') or 0), 0)
+            except ValueError:
+                length = None
+            if length is not None:
+                self._body = LimitedStream(self.rfile, length)
+                environ['wsgi.input'] = self._body
+                # werkzeug 在响应后会读空 socket 中的剩余数据（会吞掉下一个请求），
+                # 这里让它读到的是空流，请求体改由 run_wsgi 按长度排空
+                self._rfile, self.rfile = self.rfile, io.BytesIO()
+        return environ
+
+    def run_wsgi(self):
+        try:
+            super().run_wsgi()
+        finally:
+            if self._body is not None:
+                self.rfile = self._rfile
+        body = self._body
+        if body is not None and not self.close_connection:
+            remaining = body.limit - body.tell()
+            if remaining > self.max_drain_bytes:
+                self.close_connection = True
+            elif remaining:
+                try:
+                    body.exhaust()
+                except (OSError, ValueError):
+                    self.close_connection = True
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection' and value.lower() == 'close' and self._can_keep_alive() \
+                and not self.close_connection:
+            value = 'keep-alive'
+        super().send_header(keyword, value)
+
+    def log_request(self, code='-', size='-'):
+        if self.server.access_log:
+            super().log_request(code, size)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """固定线程池的 WSGI 服务，线程全部占用时暂停 accept"""
+
+    multithread = True
+
+    def __init__(self, app, config: ServerConfig, fd: Optional[int] = None, max_requests: int = 0):
+        self.keepalive = config.keepalive
+        self.request_timeout = config.timeout
+        self.access_log = config.access_log
+        self.request_queue_size = config.backlog
+        self.max_requests = max_requests
+        self.stopping = False
+        # 线程全部占用、已 accept 的连接在等待空闲线程时为 True，此时 keep-alive 连接在响应后关闭让出线程
+        self.accept_waiting = False
+        self.handled = 0
+        self._count_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(config.threads)
+        self._executor = ThreadPoolExecutor(config.threads, thread_name_prefix='wsgi')
+        super().__init__(config.host, config.port, self._counting(app), handler=ProductionRequestHandler, fd=fd)
+
+    def _counting(self, app):
+        def counting_app(environ, start_response):
+            with self._count_lock:
+                self.handled += 1
+                recycle = self.max_requests and self.handled == self.max_requests
+            if recycle:
+                logger.info(f"worker {os.getpid()} 已处理 {self.handled} 个请求，平滑重启")
+                self.begin_shutdown()
+            return app(environ, start_response)
+        return counting_app
+
+    def begin_shutdown(self):
+        """停止接受新连接（不阻塞调用线程）"""
+        if not self.stopping:
+            self.stopping = True
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            self.accept_waiting = True
+            try:
+                while not self._slots.acquire(timeout=0.5):
+                    if self.stopping:
+                        self.shutdown_request(request)
+                        return
+            finally:
+                self.accept_waiting = False
+        self._executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def drain(self, timeout: float) -> bool:
+        """等待处理中的连接完成，超时返回 False"""
+        done = threading.Event()
+        threading.Thread(target=lambda: (self._executor.shutdown(wait=True), done.set()), daemon=True).start()
+        return done.wait(timeout)
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        # BaseWSGIServer.serve_forever 结束时会关闭监听 socket，多进程共享的 socket 由主进程关闭
+        super(BaseWSGIServer, self).serve_forever(poll_interval=poll_interval)
+
+
+def serve_worker(config: ServerConfig, fd: Optional[int] = None, worker_id: int = 0,
+                 show_startup_info: bool = True):
+    """在当前进程中运行一个 worker，返回时已停止"""
+    app = load_app(show_startup_info)
+    server = PooledWSGIServer(app, config, fd=fd, max_requests=config.worker_max_requests())
+
+    def on_signal(signum, frame):
+        server.begin_shutdown()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal if fd is None else signal.SIG_IGN)
+    logger.info(f"worker {worker_id} (pid {os.getpid()}) 开始处理请求: 线程={config.threads}")
+    server.serve_forever()
+    if not server.drain(config.graceful_timeout):
+        logger.warning(f"worker {os.getpid()} 等待处理中的请求超时，强制退出")
+    logger.info(f"worker {os.getpid()} 已停止，共处理 {server.handled} 个请求")
+
+
+class Arbiter:
+    """主进程：绑定端口、fork worker、回收并补充退出的 worker、转发停止信号"""
+
+    def __init__(self, config: ServerConfig):
+        self.config = config
+        self.workers: Dict[int, int] = {}  # pid -> worker_id
+        self.retiring: Set[int] = set()  # 平滑重启中、退出后不再补充的 worker
+        self.spawned = 0
+        self.stopping = False
+        self.sock = self._bind()
+
+    def _bind(self) -> socket.socket:
+        family = socket.AF_INET6 if ':' in self.config.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.config.host, self.config.port))
+        sock.listen(self.config.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self, worker_id: int):
+        self.spawned += 1
+        show_startup_info = self.spawned == 1
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = worker_id
+            return
+        # 子进程
+        code = 0
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            if self.config.server == 'asgi':
+                from asgi_server import serve_asgi_worker as worker
+            else:
+                worker = serve_worker
+            worker(self.config, fd=self.sock.fileno(), worker_id=worker_id, show_startup_info=show_startup_info)
+        except BaseException:
+            logger.exception(f"worker {worker_id} 异常退出")
+            code = 1
+        finally:
+            logging.shutdown()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        # 执行 atexit 钩子（日志队列、统计写线程等），不回到主进程的循环
+        try:
+            import atexit
+            atexit._run_exitfuncs()
+        finally:
+            os._exit(code)
+
+    def _stop(self, signum, frame):
+        if not self.stopping:
+            self.stopping = True
+            logger.info(f"收到信号 {signum}，停止所有 worker")
+            self._signal_workers(signal.SIGTERM)
+
+    def _reload(self, signum, frame):
+        """SIGHUP：先启动新 worker，再让旧 worker 处理完当前请求后退出"""
+        if self.stopping:
+            return
+        logger.info("收到 SIGHUP，平滑重启所有 worker")
+        old_workers = [(pid, worker_id) for pid, worker_id in self.workers.items() if pid not in self.retiring]
+        for pid, worker_id in old_workers:
+            self.retiring.add(pid)
+            self.spawn(worker_id)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _signal_workers(self, signum: int):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker_id = self.workers.pop(pid, None)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif worker_id is not None and not self.stopping:
+                self.spawn(worker_id)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        logger.info(f"监听 {self.config.host}:{self.config.port}，worker={self.config.workers}，"
+                    f"线程={self.config.threads}")
+        for worker_id in range(self.config.workers):
+            self.spawn(worker_id)
+
+        stop_deadline = None
+        while self.workers:
+            time.sleep(0.2)
+            self._reap()
+            if self.stopping:
+                if stop_deadline is None:
+                    stop_deadline = time.monotonic() + self.config.graceful_timeout + 5
+                elif time.monotonic() > stop_deadline:
+                    logger.warning("worker 未在限定时间内退出，强制结束")
+                    self._signal_workers(signal.SIGKILL)
+                    stop_deadline = float('inf')
+        self.sock.close()
+
+
+def run(config: ServerConfig):
+    server = config.server
+    if server == 'auto':
+        server = 'gunicorn' if BaseApplication is not None else 'builtin'
+    if server == 'gunicorn':
+        if BaseApplication is None:
+            raise SystemExit("未安装 gunicorn，请 pip install gunicorn 或使用 --server builtin")
+        run_gunicorn(config)
+    elif server == 'asgi' and uvicorn is not None and os.getenv('ASGI_SERVER', 'auto') != 'builtin':
+        run_uvicorn(config)
+    elif hasattr(os, 'fork'):
+        # 单个 worker 也由主进程管理，达到请求上限或异常退出后能自动补充
+        config.server = server
+        Arbiter(config).run()
+    else:
+        if config.workers > 1:
+            logger.warning("当前平台不支持 fork，以单进程运行")
+        if server == 'asgi':
+            from asgi_server import serve_asgi_worker
+            serve_asgi_worker(config)
+        else:
+            serve_worker(config)
+
+
+def parse_args() -> ServerConfig:
+    config = ServerConfig.from_env()
+    parser = argparse.ArgumentParser(description='Business Gemini Pool 生产环境服务')
+    parser.add_argument('--host', default=config.host)
+    parser.add_argument('--port', type=int, default=config.port)
+    parser.add_argument('--workers', type=int, default=config.workers, help='worker 进程数')
+    parser.add_argument('--threads', type=int, default=config.threads, help='每个 worker 的线程数')
+    parser.add_argument('--keepalive', type=float, default=config.keepalive, help='空闲连接保持秒数，0 关闭 keep-alive')
+    parser.add_argument('--timeout', type=float, default=config.timeout, help='请求读写超时秒数')
+    parser.add_argument('--graceful-timeout', type=float, default=config.graceful_timeout)
+    parser.add_argument('--max-requests', type=int, default=config.max_requests, help='worker 处理多少请求后重启，0 不限')
+    parser.add_argument('--max-requests-jitter', type=int, default=config.max_requests_jitter)
+    parser.add_argument('--backlog', type=int, default=config.backlog)
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'builtin', 'asgi'), default=config.server)
+    parser.add_argument('--access-log', action='store_true', default=config.access_log)
+    args = parser.parse_args()
+    return ServerConfig(**{f.name: getattr(args, f.name) for f in fields(ServerConfig)})
+
+
+def main():
+    # 服务自身的日志直接输出（worker 中应用的日志系统挂在 gemini_pool 上，这里不向上传递避免重复）
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    config = parse_args()
+    if config.workers > 1 and os.getenv('STATE_BACKEND', 'local') == 'local':
+        logger.warning("多个 worker 使用 STATE_BACKEND=local 时各自维护账号池，建议设置 STATE_BACKEND=sqlite")
+    run(config)
+
+
+if __name__ == '__main__':
+    main()
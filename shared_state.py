@@ -0,0 +1,420 @@
+"""Business Gemini Pool 多进程共享状态
+多个 worker 进程共用一个账号池时，JWT、账号会话、可用状态和轮询位置需要跨进程共享，
+否则每个进程都会各自获取 JWT、创建会话，文件亲和和账号冷却也只在单个进程内有效。
+
+后端:
+    STATE_BACKEND=local        进程内状态（默认，单进程部署）
+    STATE_BACKEND=sqlite       SQLite（WAL 模式），同一台机器上的多个进程
+    STATE_BACKEND=redis://...  Redis 协议服务，多台机器；安装了 redis 包时使用它，否则使用内置的最小 RESP 客户端
+
+共享状态按账号的 csesidx 区分（账号列表下标在增删账号后会变化）
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+logger = logging.getLogger('gemini_pool.state')
+
+try:
+    import redis as redis_lib
+except ImportError:
+    redis_lib = None
+
+
+class StateBackend:
+    """键值后端接口：值为可 JSON 序列化的对象，ttl 单位为秒"""
+
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        """原子地加上 amount 并返回新值"""
+        raise NotImplementedError
+
+    def acquire(self, key: str, ttl: float) -> Optional[str]:
+        """键不存在时写入随机令牌并返回它（跨进程锁），已被占用时返回 None"""
+        raise NotImplementedError
+
+    def release(self, key: str, token: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(StateBackend):
+    """SQLite 键值表，WAL 模式下读不阻塞写；每个线程使用自己的连接"""
+
+    def __init__(self, db_path: str):
+        self.db_path = str(db_path)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS shared_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Any:
+        row = self._connect().execute(
+            "SELECT value, expires_at FROM shared_state WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = time.time() + ttl if ttl else None
+        self._connect().execute(
+            "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires_at))
+
+    def delete(self, key: str):
+        self._connect().execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM shared_state WHERE key = ?", (key,)).fetchone()
+            value = (json.loads(row[0]) if row else 0) + amount
+            conn.execute("INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, NULL)",
+                         (key, json.dumps(value)))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def acquire(self, key: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        now = time.time()
+        # 键不存在，或者已过期时覆盖
+        cursor = self._connect().execute("""
+            INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            WHERE shared_state.expires_at IS NOT NULL AND shared_state.expires_at <= ?
+        """, (key, json.dumps(token), now + ttl, now))
+        return token if cursor.rowcount > 0 else None
+
+    def release(self, key: str, token: str):
+        self._connect().execute("DELETE FROM shared_state WHERE key = ? AND value = ?", (key, json.dumps(token)))
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RespError(Exception):
+    """Redis 服务返回的错误"""
+
+
+class RespClient:
+    """最小的 Redis 协议（RESP2）客户端，只实现 execute_command；每个线程一个连接"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def from_url(cls, url: str) -> 'RespClient':
+        parsed = urlparse(url)
+        db = parsed.path.lstrip('/')
+        return cls(parsed.hostname or '127.0.0.1', parsed.port or 6379, int(db) if db else 0,
+                   unquote(parsed.password) if parsed.password else None)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self._local.conn = (sock, sock.makefile('rb'))
+            if self.password:
+                self._call(conn, ('AUTH', self.password))
+            if self.db:
+                self._call(conn, ('SELECT', self.db))
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(parts)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Redis 连接已关闭")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            raise RespError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2].decode('utf-8')
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [self._read_reply(reader) for _ in range(length)]
+        raise ConnectionError(f"无法解析的 Redis 响应: {line[:50]!r}")
+
+    def _call(self, conn, args):
+        conn[0].sendall(self._encode(args))
+        return self._read_reply(conn[1])
+
+    def execute_command(self, *args):
+        # 连接断开时重连重试一次
+        for attempt in range(2):
+            try:
+                return self._call(self._connection(), args)
+            except (OSError, ConnectionError):
+                self._disconnect()
+                if attempt:
+                    raise
+
+    def close(self):
+        self._disconnect()
+
+
+class RedisBackend(StateBackend):
+    """Redis 协议后端，键统一加前缀"""
+
+    def __init__(self, url: str, prefix: str = 'gemini_pool:'):
+        self.prefix = prefix
+        if redis_lib is not None:
+            self.client = redis_lib.Redis.from_url(url, decode_responses=True)
+        else:
+            self.client = RespClient.from_url(url)
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def get(self, key: str) -> Any:
+        value = self.client.execute_command('GET', self._key(key))
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        args = ['SET', self._key(key), json.dumps(value)]
+        if ttl:
+            args += ['PX', int(ttl * 1000)]
+        self.client.execute_command(*args)
+
+    def delete(self, key: str):
+        self.client.execute_command('DEL', self._key(key))
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        if amount == 1:
+            return int(self.client.execute_command('INCR', self._key(key)))
+        return int(self.client.execute_command('INCRBY', self._key(key), amount))
+
+    def acquire(self, key: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        reply = self.client.execute_command('SET', self._key(key), json.dumps(token), 'NX', 'PX', int(ttl * 1000))
+        return token if reply else None
+
+    def release(self, key: str, token: str):
+        # 只删除自己持有的锁（GET 与 DEL 之间锁恰好过期并被他人获取的情况由锁的 TTL 兜底）
+        if self.client.execute_command('GET', self._key(key)) == json.dumps(token):
+            self.client.execute_command('DEL', self._key(key))
+
+    def close(self):
+        self.client.close()
+
+
+class SharedAccountState:
+    """账号池的共享状态：JWT、会话、可用状态、轮询计数
+
+    所有方法在后端出错时记录警告并退化为“没有共享值”，调用方继续使用进程内状态；
+    轮询计数每次从后端预留 round_robin_batch 个位置，用完再取，避免每次选账号都写一次后端
+    """
+
+    def __init__(self, backend: StateBackend, jwt_ttl: float = 240.0, lock_ttl: float = 15.0,
+                 wait_timeout: float = 10.0, round_robin_batch: int = 16):
+        self.backend = backend
+        self.jwt_ttl = jwt_ttl
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.round_robin_batch = max(1, round_robin_batch)
+        self.errors = 0
+        # 本进程预留的轮询位置 [_round_robin_next, _round_robin_end]
+        self._round_robin_lock = threading.Lock()
+        self._round_robin_next = 1
+        self._round_robin_end = 0
+
+    def _safe(self, operation: str, fn: Callable[[], Any], default: Any = None) -> Any:
+        try:
+            return fn()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"共享状态{operation}失败: {e}")
+            return default
+
+    # ---------- JWT ----------
+
+    def load_jwt(self, account_key: str) -> Optional[Tuple[str, float]]:
+        """返回未过期的 (jwt, 获取时间)"""
+        record = self._safe('读取', lambda: self.backend.get(f"jwt:{account_key}"))
+        if not record or time.time() - record["time"] > self.jwt_ttl:
+            return None
+        return record["jwt"], record["time"]
+
+    def store_jwt(self, account_key: str, jwt: str, jwt_time: float):
+        self._safe('写入', lambda: self.backend.set(f"jwt:{account_key}", {"jwt": jwt, "time": jwt_time},
+                                                    ttl=self.jwt_ttl))
+
+    # ---------- 会话 ----------
+
+    def load_session(self, account_key: str) -> Optional[str]:
+        """返回共享的会话名；空字符串表示会话已被重置，None 表示没有记录"""
+        return self._safe('读取', lambda: self.backend.get(f"session:{account_key}"))
+
+    def store_session(self, account_key: str, session_name: str):
+        self._safe('写入', lambda: self.backend.set(f"session:{account_key}", session_name))
+
+    def clear_session(self, account_key: str):
+        """标记会话已重置（空字符串），其他进程读到后也会创建新会话"""
+        self._safe('写入', lambda: self.backend.set(f"session:{account_key}", ""))
+
+    # ---------- 可用状态 ----------
+
+    def load_availability(self, account_key: str) -> Optional[Dict]:
+        """返回 {available, reason, time}，没有记录时返回 None（使用配置中的值）"""
+        return self._safe('读取', lambda: self.backend.get(f"availability:{account_key}"))
+
+    def store_availability(self, account_key: str, available: bool, reason: str = ""):
+        """记录账号可用状态并递增版本号，其他进程在下次选账号时同步"""
+        record = {"available": available, "reason": reason, "time": time.time()}
+        self._safe('写入', lambda: self.backend.set(f"availability:{account_key}", record))
+        self._safe('写入', lambda: self.backend.incr("availability:version"))
+
+    def availability_version(self) -> Optional[int]:
+        return self._safe('读取', lambda: self.backend.get("availability:version"))
+
+    # ---------- 轮询 ----------
+
+    def next_round_robin(self) -> Optional[int]:
+        """返回下一个轮询位置；多个进程各自按批次预留，整体上仍均匀分布在账号之间"""
+        with self._round_robin_lock:
+            if self._round_robin_next > self._round_robin_end:
+                end = self._safe('写入', lambda: self.backend.incr("round_robin", self.round_robin_batch))
+                if end is None:
+                    return None
+                self._round_robin_next, self._round_robin_end = end - self.round_robin_batch + 1, end
+            index = self._round_robin_next
+            self._round_robin_next += 1
+            return index
+
+    # ---------- 跨进程单飞 ----------
+
+    @contextmanager
+    def lock(self, name: str):
+        """跨进程锁，yield 是否获得了锁；未获得时调用方应等待其他进程的结果"""
+        token = self._safe('加锁', lambda: self.backend.acquire(f"lock:{name}", self.lock_ttl))
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                self._safe('解锁', lambda: self.backend.release(f"lock:{name}", token))
+
+    def single_flight(self, name: str, load: Callable[[], Any], compute: Callable[[], Any]) -> Any:
+        """多个进程同时需要同一个值时只由一个进程计算，其余进程等待共享结果
+
+        等待超时（持锁进程失败或退出）后自行计算
+        """
+        value = load()
+        if value is not None:
+            return value
+        with self.lock(name) as acquired:
+            if acquired:
+                value = load()
+                return value if value is not None else compute()
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = load()
+            if value is not None:
+                return value
+        logger.warning(f"等待其他进程的 {name} 超时，自行获取")
+        return compute()
+
+    def stats(self) -> Dict:
+        return {"backend": type(self.backend).__name__, "errors": self.errors}
+
+
+def create_state_backend(spec: str, sqlite_path: Optional[str] = None) -> Optional[StateBackend]:
+    """按 STATE_BACKEND 创建后端，local 返回 None"""
+    spec = (spec or 'local').strip()
+    if spec == 'local':
+        return None
+    if spec == 'sqlite':
+        return SQLiteBackend(sqlite_path or Path(__file__).parent / "shared_state.db")
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        if spec.startswith(('rediss://', 'unix://')) and redis_lib is None:
+            raise ValueError(f"{spec.split(':')[0]} 需要安装 redis 包")
+        return RedisBackend(spec, prefix=os.getenv('STATE_KEY_PREFIX', 'gemini_pool:'))
+    raise ValueError(f"未知的 STATE_BACKEND: {spec}")
+
+
+# 全局共享状态
+_shared_state = None
+_shared_state_loaded = False
+
+
+def get_shared_state() -> Optional[SharedAccountState]:
+    """获取全局共享状态实例，单进程部署（STATE_BACKEND=local）时返回 None"""
+    global _shared_state, _shared_state_loaded
+    if not _shared_state_loaded:
+        _shared_state_loaded = True
+        backend = create_state_backend(os.getenv('STATE_BACKEND', 'local'), os.getenv('STATE_SQLITE_PATH'))
+        if backend is not None:
+            _shared_state = SharedAccountState(
+                backend, round_robin_batch=int(os.getenv('STATE_ROUND_ROBIN_BATCH', '16')))
+            logger.info(f"共享状态后端: {type(backend).__name__}")
+    return _shared_state
@@ -0,0 +1,377 @@
+"""Business Gemini Pool SQLite 连接层
+
+conversations.db 由会话、统计、上传文件映射、下游密钥等模块共用。这里为每个数据库文件提供：
+- 每个线程一个持久的只读连接（不再每次操作都 sqlite3.connect 再关闭），预编译语句按连接缓存
+- 一个进程内唯一的写线程：它独占写连接，按提交顺序从队列取写任务执行。
+  几毫秒内到达的任务合并进同一个 BEGIN IMMEDIATE 事务一起提交（group commit），
+  每个任务在各自的 SAVEPOINT 中执行，单个任务失败只回滚它自己
+- WAL 日志（读写互不阻塞）、synchronous=NORMAL、可配置的页缓存和 mmap 大小、忙等待超时
+
+多进程部署时各进程有各自的写线程，进程之间由 SQLite 文件锁和忙等待超时协调。
+
+用法:
+    pool = get_sqlite_pool(db_path)
+    with pool.read() as conn:
+        rows = conn.execute(...).fetchall()
+    # 写任务在写线程上以 job(conn, *args) 调用，不能自己 BEGIN/COMMIT
+    future = pool.submit(insert_row, values)   # 不等待；需要行ID时 future.result()
+    row_id = pool.execute(insert_row, values)  # 等待事务提交后返回 job 的返回值
+    with pool.write() as conn:  # 多步写操作：在写线程让出的连接上执行，正常退出时随所在事务提交
+        conn.execute(...)
+"""
+
+import atexit
+import contextlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+from metrics import DB_BUSY_ERRORS, DB_WRITE_BATCH_JOBS, DB_WRITE_WAIT_SECONDS
+
+logger = logging.getLogger('gemini_pool.database')
+
+BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '10000'))
+CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '8192'))
+MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+STATEMENT_CACHE = int(os.getenv('SQLITE_STATEMENT_CACHE', '256'))
+GROUP_COMMIT_MS = float(os.getenv('SQLITE_GROUP_COMMIT_MS', '1'))
+GROUP_COMMIT_MAX_JOBS = int(os.getenv('SQLITE_GROUP_COMMIT_MAX_JOBS', '256'))
+
+
+def _is_busy(error: BaseException) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+
+class _WriteJob:
+    __slots__ = ('fn', 'args', 'kwargs', 'future', 'enqueued')
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future: Future = Future()
+        self.enqueued = time.perf_counter()
+
+
+_STOP = object()
+
+
+class SQLitePool:
+    """单个数据库文件的连接池：每线程只读连接 + 独占写连接的写线程"""
+
+    def __init__(self, db_path: Union[str, Path], busy_timeout_ms: int = BUSY_TIMEOUT_MS,
+                 cache_size_kb: int = CACHE_SIZE_KB, mmap_size: int = MMAP_SIZE,
+                 statement_cache: int = STATEMENT_CACHE, group_commit_ms: float = GROUP_COMMIT_MS,
+                 max_batch_jobs: int = GROUP_COMMIT_MAX_JOBS):
+        self.db_path = str(db_path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.statement_cache = statement_cache
+        self.group_commit_window = max(group_commit_ms, 0) / 1000
+        self.max_batch_jobs = max(max_batch_jobs, 1)
+        self._local = threading.local()
+        self._writer_lock = threading.Lock()
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._writer_pid: Optional[int] = None
+        self._writer_ident: Optional[int] = None
+        self._writer_conn: Optional[sqlite3.Connection] = None
+        self._stats_lock = threading.Lock()
+        self.connections = 0
+        self.writes = 0
+        self.transactions = 0
+        self.failed_jobs = 0
+        self.write_wait_seconds = 0.0
+        self.busy_errors = 0
+
+    def _open(self, query_only: bool) -> sqlite3.Connection:
+        # isolation_level=None：写线程显式控制事务，只读连接每条查询各自是一个读事务
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                               check_same_thread=False, cached_statements=self.statement_cache)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        if not query_only:
+            # WAL 是数据库文件的持久属性，由写连接设置一次即可
+            mode = self._enable_wal(conn)
+            if mode.lower() != 'wal':
+                logger.warning(f"SQLite 无法启用 WAL（当前 {mode}）: {self.db_path}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if query_only:
+            conn.execute("PRAGMA query_only=1")
+        with self._stats_lock:
+            self.connections += 1
+        return conn
+
+    def _enable_wal(self, conn: sqlite3.Connection) -> str:
+        # 多个进程同时启动时切换日志模式可能直接返回 locked（不走 busy_timeout），在超时时间内重试
+        deadline = time.monotonic() + self.busy_timeout_ms / 1000
+        while True:
+            try:
+                return conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e) or time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.01)
+
+    def _reader(self) -> sqlite3.Connection:
+        local = self._local
+        # fork 之后子进程不能沿用父进程打开的连接
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = self._open(query_only=True)
+            local.pid = os.getpid()
+        return local.conn
+
+    @contextlib.contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """当前线程的只读连接（不能在 write() 块内或写线程的任务中使用，见 write()）"""
+        assert not getattr(self._local, 'write_depth', 0) and threading.get_ident() != self._writer_ident, \
+            "write() 块内的读取应使用写连接，读连接看不到尚未提交的写入"
+        try:
+            yield self._reader()
+        except sqlite3.OperationalError as e:
+            if _is_busy(e):
+                self._count_busy()
+            raise
+
+    # ---------- 写线程 ----------
+
+    def _ensure_writer(self) -> queue.Queue:
+        # fork 之后父进程的写线程不存在于子进程，按 pid 重新创建队列和线程
+        if self._writer_pid != os.getpid():
+            with self._writer_lock:
+                if self._writer_pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._writer_conn = None
+                    self._writer_ident = None
+                    self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                                    name=f"sqlite-writer-{Path(self.db_path).name}", daemon=True)
+                    self._thread.start()
+                    self._writer_pid = os.getpid()
+        return self._queue
+
+    def _inline(self) -> bool:
+        """当前线程已持有写连接（写线程自身，或 write() 块内）时写任务直接执行，避免排队等待自己"""
+        return threading.get_ident() == self._writer_ident or getattr(self._local, 'write_depth', 0) > 0
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """提交写任务，返回 Future；所在事务提交后才会完成，结果为 fn(conn, *args, **kwargs) 的返回值"""
+        job = _WriteJob(fn, args, kwargs)
+        if self._inline():
+            conn = self._writer_conn
+            try:
+                job.future.set_result(self._call_in_savepoint(conn, job))
+            except BaseException as e:
+                job.future.set_exception(e)
+            return job.future
+        self._ensure_writer().put(job)
+        return job.future
+
+    def execute(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """提交写任务并等待提交完成，返回 fn 的返回值（异常原样抛出）"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    @contextlib.contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """在写连接上执行多步写操作（同一线程内嵌套调用时并入外层）
+
+        写线程轮到这个任务时把连接交给调用方并等待 with 块结束，块内的操作与同批其他任务一起提交；
+        退出 with 时会等到事务提交完成，之后的读连接一定能读到写入结果。
+        块内的 pool.read() 使用另一个连接，看不到本事务（以及同批其他任务）尚未提交的写入，
+        块内需要读取时直接在 yield 出的写连接上查询；read() 会断言不在写块内调用。
+        """
+        depth = getattr(self._local, 'write_depth', 0)
+        if depth or threading.get_ident() == self._writer_ident:
+            self._local.write_depth = depth + 1
+            try:
+                yield self._writer_conn
+            finally:
+                self._local.write_depth = depth
+            return
+
+        granted = threading.Event()
+        released = threading.Event()
+        outcome: Dict[str, Any] = {}
+
+        def lease(conn):
+            granted.set()
+            released.wait()
+            if 'error' in outcome:
+                raise outcome['error']
+
+        future = self.submit(lease)
+        future.add_done_callback(lambda _: granted.set())
+        granted.wait()
+        if future.done():
+            future.result()  # 事务未能开始（如忙等待超时），抛出原因
+        self._local.write_depth = 1
+        try:
+            yield self._writer_conn
+        except BaseException as e:
+            outcome['error'] = e
+            raise
+        finally:
+            self._local.write_depth = 0
+            released.set()
+            if 'error' not in outcome:
+                future.result()
+
+    def _call_in_savepoint(self, conn: sqlite3.Connection, job: _WriteJob) -> Any:
+        conn.execute("SAVEPOINT job")
+        try:
+            result = job.fn(conn, *job.args, **job.kwargs)
+        except BaseException:
+            conn.execute("ROLLBACK TO job")
+            conn.execute("RELEASE job")
+            raise
+        conn.execute("RELEASE job")
+        return result
+
+    def _collect(self, jobs: queue.Queue, first: _WriteJob) -> List[_WriteJob]:
+        """取第一个任务后，在 group commit 窗口内继续收集任务直到达到上限"""
+        batch = [first]
+        deadline = time.monotonic() + self.group_commit_window
+        while len(batch) < self.max_batch_jobs:
+            timeout = deadline - time.monotonic()
+            try:
+                job = jobs.get(timeout=timeout) if timeout > 0 else jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is _STOP:
+                jobs.put(_STOP)
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self, jobs: queue.Queue):
+        self._writer_ident = threading.get_ident()
+        while True:
+            first = jobs.get()
+            if first is _STOP:
+                break
+            batch = self._collect(jobs, first)
+            if self._writer_conn is None:
+                # 打开失败时本批任务失败，下一批重新尝试
+                try:
+                    self._writer_conn = self._open(query_only=False)
+                except sqlite3.Error as e:
+                    logger.error(f"SQLite 写连接打开失败: {self.db_path}: {e}")
+                    for job in batch:
+                        if job.future.set_running_or_notify_cancel():
+                            job.future.set_exception(e)
+                    continue
+            self._commit_batch(self._writer_conn, batch)
+        if self._writer_conn is not None:
+            self._writer_conn.close()
+            self._writer_conn = None
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch: List[_WriteJob]):
+        started = time.perf_counter()
+        batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        for job in batch:
+            DB_WRITE_WAIT_SECONDS.observe(started - job.enqueued)
+        DB_WRITE_BATCH_JOBS.observe(len(batch))
+
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                try:
+                    outcomes.append((job, self._call_in_savepoint(conn, job), None))
+                except BaseException as e:
+                    outcomes.append((job, None, e))
+            conn.execute("COMMIT")
+        except BaseException as e:
+            # 事务本身失败（开始时忙等待超时、提交失败等）：同批任务全部失败
+            if conn.in_transaction:
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error as rollback_error:
+                    logger.error(f"SQLite 写事务回滚失败: {rollback_error}")
+            if _is_busy(e):
+                self._count_busy()
+            logger.error(f"SQLite 写事务失败（{len(batch)} 个任务）: {e}")
+            outcomes = [(job, None, e) for job in batch]
+
+        failed = 0
+        for job, result, error in outcomes:
+            if error is None:
+                job.future.set_result(result)
+            else:
+                failed += 1
+                job.future.set_exception(error)
+        with self._stats_lock:
+            self.transactions += 1
+            self.writes += len(batch)
+            self.failed_jobs += failed
+            self.write_wait_seconds += sum(started - job.enqueued for job in batch)
+
+    def _count_busy(self):
+        DB_BUSY_ERRORS.inc()
+        with self._stats_lock:
+            self.busy_errors += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            return {
+                'connections': self.connections,
+                'writes': self.writes,
+                'transactions': self.transactions,
+                'jobs_per_transaction': round(self.writes / self.transactions, 2) if self.transactions else 0,
+                'failed_jobs': self.failed_jobs,
+                'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+                'write_wait_ms': round(self.write_wait_seconds * 1000, 2),
+                'busy_errors': self.busy_errors,
+            }
+
+    def close(self, timeout: float = 5.0):
+        """写完队列中已有的任务后停止写线程，并关闭当前线程的只读连接（其他线程的连接随线程结束释放）"""
+        with self._writer_lock:
+            thread = self._thread if self._writer_pid == os.getpid() else None
+            if thread is not None:
+                self._queue.put(_STOP)
+                thread.join(timeout)
+                self._thread = None
+                self._writer_pid = None
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.pid = None
+
+
+_pools: Dict[str, SQLitePool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_sqlite_pool(db_path: Union[str, Path]) -> SQLitePool:
+    """获取数据库文件对应的连接池（同一文件在进程内共用一个写线程）"""
+    key = os.path.abspath(str(db_path))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = SQLitePool(key)
+    return pool
+
+
+def pool_stats() -> Dict[str, Dict[str, float]]:
+    """所有连接池的统计信息，按数据库文件名"""
+    return {Path(path).name: pool.stats() for path, pool in list(_pools.items())}
+
+
+@atexit.register
+def _close_pools():
+    # 进程退出前写完队列中剩余的写任务（写线程是守护线程，不等待会直接丢弃）
+    for pool in list(_pools.values()):
+        pool.close()
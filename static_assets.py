@@ -0,0 +1,269 @@
+"""Business Gemini Pool 静态页面资源层
+启动时将管理页面加载到内存，预先生成 gzip / brotli 压缩版本并计算 ETag，
+按 Accept-Encoding 协商返回，支持 If-None-Match 304 以及开发模式下的文件变更热加载
+"""
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from flask import Response, abort, request
+
+# brotli 为可选依赖，未安装时只提供 gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('gemini_pool.static')
+
+# 默认缓存的管理页面
+DEFAULT_PAGES = [
+    'index.html',
+    'chat_history.html',
+    'conversation_manager.html',
+    'image_gallery.html',
+    'analytics.html',
+    'api_key_manager.html',
+    'test_analytics.html',
+]
+
+# 编码优先级（同等q值时优先选择压缩率更高的编码）
+ENCODING_PREFERENCE = ['br', 'gzip', 'identity']
+ETAG_SUFFIXES = {'br': '-br', 'gzip': '-gz', 'identity': ''}
+
+
+@dataclass
+class StaticAsset:
+    """单个静态资源的内存表示"""
+    name: str
+    mimetype: str
+    mtime: float
+    etag: str
+    last_modified: str
+    variants: Dict[str, bytes] = field(default_factory=dict)  # encoding -> body
+
+    @property
+    def size(self) -> int:
+        return len(self.variants.get('identity', b''))
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """解析 Accept-Encoding 请求头，返回 {编码: q值}"""
+    result = {}
+    if not header:
+        return result
+    for part in header.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        coding, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        result[coding.strip().lower()] = q
+    return result
+
+
+def choose_encoding(accept_encoding: str, available, preference: Optional[List[str]] = None) -> str:
+    """根据客户端 Accept-Encoding 从可用编码中选择最优编码"""
+    accepted = parse_accept_encoding(accept_encoding)
+    wildcard = accepted.get('*')
+    best, best_q = 'identity', -1.0
+    for coding in (preference or ENCODING_PREFERENCE):
+        if coding not in available:
+            continue
+        q = accepted.get(coding, wildcard if wildcard is not None else (1.0 if coding == 'identity' else 0.0))
+        if q > best_q and q > 0:
+            best, best_q = coding, q
+    return best
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """判断 If-None-Match 是否命中（弱比较，忽略编码后缀）"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    base = etag.strip('"')
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        for suffix in ETAG_SUFFIXES.values():
+            if suffix and candidate.endswith(suffix):
+                candidate = candidate[:-len(suffix)]
+                break
+        if candidate == base:
+            return True
+    return False
+
+
+class StaticAssetCache:
+    """静态页面缓存，负责加载、预压缩、协商和热加载"""
+
+    def __init__(self, root_dir, filenames: Optional[List[str]] = None,
+                 watch: bool = False, watch_interval: float = 1.0):
+        self.root_dir = Path(root_dir)
+        self.filenames = list(filenames or DEFAULT_PAGES)
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.assets: Dict[str, StaticAsset] = {}
+        self.lock = threading.Lock()
+        self._watcher = None
+        self._stop_event = threading.Event()
+
+    def _build_asset(self, name: str) -> Optional[StaticAsset]:
+        """读取文件并生成压缩版本"""
+        path = self.root_dir / name
+        try:
+            stat = path.stat()
+            raw = path.read_bytes()
+        except OSError:
+            return None
+
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if mimetype.startswith('text/'):
+            mimetype += '; charset=utf-8'
+
+        variants = {'identity': raw}
+        gz = gzip.compress(raw, compresslevel=9, mtime=0)
+        if len(gz) < len(raw):
+            variants['gzip'] = gz
+        if brotli is not None:
+            br = brotli.compress(raw, quality=11)
+            if len(br) < len(raw):
+                variants['br'] = br
+
+        return StaticAsset(
+            name=name,
+            mimetype=mimetype,
+            mtime=stat.st_mtime,
+            etag=hashlib.sha256(raw).hexdigest()[:32],
+            last_modified=formatdate(stat.st_mtime, usegmt=True),
+            variants=variants
+        )
+
+    def load_all(self):
+        """加载全部页面到内存"""
+        start = time.time()
+        loaded = {}
+        for name in self.filenames:
+            asset = self._build_asset(name)
+            if asset is not None:
+                loaded[name] = asset
+        with self.lock:
+            self.assets = loaded
+        total = sum(a.size for a in loaded.values())
+        logger.info(f"静态页面已加载: {len(loaded)} 个, 原始大小 {total} 字节, "
+                    f"brotli={'可用' if brotli else '未安装'}, 耗时 {time.time() - start:.3f}秒")
+
+    def reload_changed(self) -> List[str]:
+        """检查文件修改时间，重新加载发生变化的页面"""
+        changed = []
+        for name in self.filenames:
+            path = self.root_dir / name
+            try:
+                mtime = path.stat().st_mtime
+            except OSError:
+                mtime = None
+            current = self.assets.get(name)
+            if mtime is None:
+                if current is not None:
+                    with self.lock:
+                        self.assets.pop(name, None)
+                    changed.append(name)
+                continue
+            if current is None or current.mtime != mtime:
+                asset = self._build_asset(name)
+                if asset is not None:
+                    with self.lock:
+                        self.assets[name] = asset
+                    changed.append(name)
+        if changed:
+            logger.info(f"静态页面已重新加载: {', '.join(changed)}")
+        return changed
+
+    def _watch_loop(self):
+        while not self._stop_event.wait(self.watch_interval):
+            try:
+                self.reload_changed()
+            except Exception as e:
+                logger.warning(f"静态页面热加载失败: {e}")
+
+    def start_watcher(self):
+        """启动文件变更监听线程（开发模式）"""
+        if self._watcher is not None:
+            return
+        self._stop_event.clear()
+        self._watcher = threading.Thread(target=self._watch_loop, name='static-asset-watcher', daemon=True)
+        self._watcher.start()
+        logger.info(f"静态页面热加载已启用，检查间隔 {self.watch_interval} 秒")
+
+    def stop_watcher(self):
+        self._stop_event.set()
+        self._watcher = None
+
+    def get(self, name: str) -> Optional[StaticAsset]:
+        return self.assets.get(name)
+
+    def serve(self, name: str) -> Response:
+        """按请求头协商编码并返回页面，命中 ETag 时返回 304"""
+        asset = self.assets.get(name)
+        if asset is None:
+            abort(404)
+
+        encoding = choose_encoding(request.headers.get('Accept-Encoding', ''), asset.variants)
+        etag = f'"{asset.etag}{ETAG_SUFFIXES[encoding]}"'
+
+        headers = {
+            'ETag': etag,
+            'Last-Modified': asset.last_modified,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+        }
+
+        if etag_matches(request.headers.get('If-None-Match', ''), asset.etag):
+            return Response(status=304, headers=headers)
+
+        body = asset.variants[encoding]
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(body, mimetype=asset.mimetype, headers=headers)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """返回各页面不同编码的大小"""
+        return {name: {enc: len(body) for enc, body in asset.variants.items()}
+                for name, asset in self.assets.items()}
+
+
+def create_static_asset_cache(root_dir) -> StaticAssetCache:
+    """根据环境变量创建并加载静态页面缓存
+
+    FLASK_ENV=development 或 STATIC_ASSETS_WATCH=true 时启用热加载
+    """
+    watch_env = os.getenv('STATIC_ASSETS_WATCH', '').lower()
+    if watch_env:
+        watch = watch_env == 'true'
+    else:
+        watch = os.getenv('FLASK_ENV', 'production').lower() == 'development'
+    interval = float(os.getenv('STATIC_ASSETS_WATCH_INTERVAL', '1.0'))
+
+    cache = StaticAssetCache(root_dir, watch=watch, watch_interval=interval)
+    cache.load_all()
+    if watch:
+        cache.start_watcher()
+    return cache
@@ -0,0 +1,461 @@
+"""Business Gemini Pool 流式请求体解析
+对大请求体（多张 base64 图片、长对话历史）按块增量解析 JSON，不先把整个请求体读入内存；
+超过阈值的 data URL 字符串直接转存到临时文件，上传到上游时再从文件流式读出，
+单个请求的内存占用与请求体大小无关；超过上限的请求体在读取过程中尽早拒绝
+"""
+
+import json
+import re
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+_WS_RE = re.compile(rb'[ \t\r\n]*')
+_NUMBER_RE = re.compile(rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+_NUMBER_CHARS_RE = re.compile(rb'[0-9eE.+-]*')
+_STRING_SPECIAL_RE = re.compile(rb'["\\]')
+_SIMPLE_ESCAPES = {
+    ord('"'): b'"', ord('\\'): b'\\', ord('/'): b'/', ord('b'): b'\b',
+    ord('f'): b'\f', ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t',
+}
+
+# 保留在内存中的 blob 开头字节数（用于解析 data URL 头部）
+HEAD_SIZE = 256
+
+BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+BASE64_WHITESPACE = b' \t\r\n'
+# 从末尾找最后一个 base64 字母表（含填充）之外的字节 / 最后一个空白字节
+_LAST_INVALID_RE = re.compile(rb'[^A-Za-z0-9+/= \t\r\n][A-Za-z0-9+/= \t\r\n]*\Z')
+_LAST_WHITESPACE_RE = re.compile(rb'[ \t\r\n][^ \t\r\n]*\Z')
+
+
+def _utf8_boundary(data: bytes) -> int:
+    """返回最后一个完整 UTF-8 字符之后的位置：块边界截断的多字节字符不计入"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 == 0x80:
+            # 续字节，继续往前找首字节
+            continue
+        need = 1 if byte < 0xC0 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+        return len(data) - back if need > back else len(data)
+    return len(data)
+
+
+class RequestTooLarge(Exception):
+    """请求体超过上限"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"请求体超过上限 {limit} 字节")
+        self.limit = limit
+
+
+class SpooledBlob:
+    """请求体中被转存到临时文件的大字符串（UTF-8 字节）"""
+
+    def __init__(self, spool_dir: Optional[str] = None):
+        self.file = tempfile.TemporaryFile(dir=spool_dir)
+        self.file_dir = spool_dir
+        self.size = 0
+        self.head = b''
+        self.ascii = True
+        # 末尾连续 '=' 的起始位置，以及最后一个出现在非 '=' 字符之前的 '='，
+        # 用于不读回文件地校验 base64 填充（只看负载范围内的位置）
+        self.pad_start = -1
+        self.last_inner_pad = -1
+        # 最后一个非 base64 字符（空白除外）和最后一个空白的位置，用于不读回文件地校验字母表
+        self.last_invalid = -1
+        self.last_whitespace = -1
+        # 去掉换行后的副本（compact），随本 blob 一起关闭
+        self.compacted: Optional['SpooledBlob'] = None
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        if len(self.head) < HEAD_SIZE:
+            self.head += data[:HEAD_SIZE - len(self.head)]
+        if self.ascii and not data.isascii():
+            self.ascii = False
+        stripped = data.rstrip(b'=')
+        if stripped:
+            index = stripped.rfind(b'=')
+            if index >= 0:
+                self.last_inner_pad = self.size + index
+            elif self.pad_start >= 0:
+                self.last_inner_pad = self.size - 1
+            self.pad_start = self.size + len(stripped) if len(stripped) < len(data) else -1
+        elif self.pad_start < 0:
+            self.pad_start = self.size
+        # 负载块通常全是字母表字符，translate 之后为空就不用再找位置
+        if data.translate(None, BASE64_ALPHABET + b'='):
+            match = _LAST_INVALID_RE.search(data)
+            if match:
+                self.last_invalid = self.size + match.start()
+            match = _LAST_WHITESPACE_RE.search(data)
+            if match:
+                self.last_whitespace = self.size + match.start()
+        self.file.write(data)
+        self.size += len(data)
+
+    def startswith(self, prefix: str) -> bool:
+        return self.head.startswith(prefix.encode('utf-8'))
+
+    def iter_chunks(self, offset: int = 0, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        self.file.seek(offset)
+        while True:
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def read_text(self) -> str:
+        """把整个字符串读回内存（仅用于必须得到 str 的场景）"""
+        return b''.join(self.iter_chunks()).decode('utf-8')
+
+    def slice(self, offset: int) -> 'BlobSlice':
+        return BlobSlice(self, offset)
+
+    def close(self):
+        self.file.close()
+        if self.compacted is not None:
+            self.compacted.close()
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return f"<SpooledBlob {self.size} bytes {self.head[:32]!r}...>"
+
+
+class BlobSlice:
+    """blob 中从 offset 开始的部分（data URL 的 base64 负载）"""
+
+    def __init__(self, blob: SpooledBlob, offset: int):
+        self.blob = blob
+        self.offset = offset
+
+    def __len__(self):
+        return self.blob.size - self.offset
+
+    def is_base64(self) -> bool:
+        """与 is_base64_payload 相同的校验：ASCII、长度为4的倍数、填充只出现在末尾、字符都在字母表内"""
+        length = len(self)
+        if not length or not self.blob.ascii or length % 4:
+            return False
+        if self.blob.last_invalid >= self.offset or self.blob.last_whitespace >= self.offset:
+            return False
+        if self.blob.last_inner_pad >= self.offset:
+            return False
+        return self.blob.pad_start < 0 or self.blob.pad_start >= self.blob.size - 2
+
+    def compact(self) -> Optional['BlobSlice']:
+        """按行折叠的 base64：把去掉空白的负载流式复制到新的临时文件；含其他非法字符时返回 None"""
+        if self.blob.last_invalid >= self.offset or self.blob.last_whitespace < self.offset:
+            return None
+        compacted = SpooledBlob(self.blob.file_dir)
+        self.blob.compacted = compacted
+        for chunk in self.iter_chunks():
+            compacted.write(chunk.translate(None, BASE64_WHITESPACE))
+        payload = compacted.slice(0)
+        return payload if payload.is_base64() else None
+
+    def decoded_size(self) -> int:
+        padding = 0
+        if self.blob.pad_start >= self.offset:
+            padding = self.blob.size - self.blob.pad_start
+        return len(self) * 3 // 4 - padding
+
+    def iter_chunks(self, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        return self.blob.iter_chunks(self.offset, chunk_size)
+
+    def __repr__(self):
+        return f"<BlobSlice {len(self)} bytes>"
+
+
+def parse_blob_data_url(blob: SpooledBlob) -> Optional[Dict]:
+    """解析转存的 base64 data URL，返回 {type, mime_type, data: BlobSlice} 或 None"""
+    if not blob.startswith('data:'):
+        return None
+    comma = blob.head.find(b',', 5)
+    if comma == -1:
+        return None
+    mime_type, _, encoding = blob.head[5:comma].decode('utf-8', 'replace').partition(';')
+    if not mime_type or encoding != 'base64':
+        return None
+    payload = blob.slice(comma + 1)
+    if not payload.is_base64():
+        payload = payload.compact()
+        if payload is None:
+            return None
+    return {"type": "base64", "mime_type": mime_type, "data": payload}
+
+
+class StreamingJsonBody:
+    """把 JSON 对象中的一个字符串字段替换为 blob 内容、按块生成的请求体
+
+    提供 __len__ 和 read()，requests 会设置 Content-Length 并分块发送；每次重试需要新建实例
+    """
+    PLACEHOLDER = '__STREAMING_BODY_PLACEHOLDER__'
+
+    def __init__(self, body: Dict, payload: BlobSlice, chunk_size: int = 64 * 1024):
+        # base64 负载不包含需要 JSON 转义的字符，可以直接拼接
+        head, tail = json.dumps(body).split(json.dumps(self.PLACEHOLDER), 1)
+        self.head = (head + '"').encode('utf-8')
+        self.tail = ('"' + tail).encode('utf-8')
+        self.payload = payload
+        self.length = len(self.head) + len(payload) + len(self.tail)
+        self._chunks = self._generate(chunk_size)
+        self._pending = b''
+
+    def _generate(self, chunk_size: int) -> Iterator[bytes]:
+        yield self.head
+        yield from self.payload.iter_chunks(chunk_size)
+        yield self.tail
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self._chunks
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data = self._pending + b''.join(self._chunks)
+            self._pending = b''
+            return data
+        while len(self._pending) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._pending += chunk
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+class StreamingJsonParser:
+    """按块读取并解析 JSON
+
+    长度超过 spool_threshold 的 data URL 字符串写入临时文件并以 SpooledBlob 返回，
+    其他值与 json.loads 的结果一致
+    """
+
+    def __init__(self, stream, max_bytes: int, spool_threshold: int = 1024 * 1024,
+                 chunk_size: int = 64 * 1024, spool_dir: Optional[str] = None):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.spool_threshold = spool_threshold
+        self.chunk_size = chunk_size
+        self.spool_dir = spool_dir
+        self.buf = b''
+        self.pos = 0
+        self.total = 0
+        self.eof = False
+        self.blobs: List[SpooledBlob] = []
+
+    # ---------- 读取 ----------
+
+    def _fill(self) -> bool:
+        """读取下一块（丢弃已消费的部分），没有更多数据时返回 False"""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.total += len(chunk)
+        if self.total > self.max_bytes:
+            raise RequestTooLarge(self.max_bytes)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _ensure(self, n: int) -> bool:
+        """确保缓冲区中至少还有 n 个未消费字节"""
+        while len(self.buf) - self.pos < n:
+            if not self._fill():
+                return False
+        return True
+
+    def _peek(self) -> int:
+        while True:
+            self.pos = _WS_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("JSON 意外结束")
+
+    def _expect(self, char: str):
+        if self._peek() != ord(char):
+            raise ValueError(f"JSON 格式错误：位置 {self.total - len(self.buf) + self.pos} 处应为 '{char}'")
+        self.pos += 1
+
+    # ---------- 解析 ----------
+
+    def parse(self) -> Any:
+        value = self._value()
+        try:
+            self._peek()
+        except ValueError:
+            return value
+        raise ValueError("JSON 之后存在多余数据")
+
+    def close(self):
+        """关闭所有临时文件"""
+        for blob in self.blobs:
+            blob.close()
+        self.blobs = []
+
+    def _value(self) -> Any:
+        c = self._peek()
+        if c == ord('{'):
+            return self._object()
+        if c == ord('['):
+            return self._array()
+        if c == ord('"'):
+            return self._string(spool=True)
+        if c in (ord('t'), ord('f'), ord('n')):
+            return self._literal()
+        return self._number()
+
+    def _object(self) -> Dict:
+        self.pos += 1
+        result = {}
+        if self._peek() == ord('}'):
+            self.pos += 1
+            return result
+        while True:
+            if self._peek() != ord('"'):
+                raise ValueError("JSON 格式错误：对象键必须是字符串")
+            key = self._string(spool=False)
+            self._expect(':')
+            result[key] = self._value()
+            c = self._peek()
+            self.pos += 1
+            if c == ord('}'):
+                return result
+            if c != ord(','):
+                raise ValueError("JSON 格式错误：对象中缺少 ',' 或 '}'")
+
+    def _array(self) -> List:
+        self.pos += 1
+        result = []
+        if self._peek() == ord(']'):
+            self.pos += 1
+            return result
+        while True:
+            result.append(self._value())
+            c = self._peek()
+            self.pos += 1
+            if c == ord(']'):
+                return result
+            if c != ord(','):
+                raise ValueError("JSON 格式错误：数组中缺少 ',' 或 ']'")
+
+    def _literal(self) -> Any:
+        self._ensure(5)
+        for token, value in ((b'true', True), (b'false', False), (b'null', None)):
+            if self.buf.startswith(token, self.pos):
+                self.pos += len(token)
+                return value
+        raise ValueError("JSON 格式错误：无效的字面量")
+
+    def _number(self) -> Any:
+        # 数字可能被块边界截断，先读到数字之后的分隔符
+        while _NUMBER_CHARS_RE.match(self.buf, self.pos).end() == len(self.buf) and self._fill():
+            pass
+        match = _NUMBER_RE.match(self.buf, self.pos)
+        if not match or match.end() == self.pos:
+            raise ValueError("JSON 格式错误：无效的值")
+        self.pos = match.end()
+        return json.loads(match.group())
+
+    def _escape_length(self) -> int:
+        """返回 buf[pos] 处转义序列的长度（保证整个序列都在缓冲区中）"""
+        self._ensure(2)
+        code = self.buf[self.pos + 1]
+        if code in _SIMPLE_ESCAPES:
+            return 2
+        if code != ord('u'):
+            raise ValueError("JSON 格式错误：无效的转义序列")
+        self._ensure(12)
+        # 代理对（如 \uD83D\uDE00）作为一个整体解码
+        if (self.buf.startswith(b'\\u', self.pos + 6)
+                and 0xd800 <= int(self.buf[self.pos + 2:self.pos + 6], 16) < 0xdc00):
+            return 12
+        return 6
+
+    def _string(self, spool: bool) -> Any:
+        self.pos += 1
+        parts: List[bytes] = []
+        size = 0
+        has_escape = False
+        blob: Optional[SpooledBlob] = None
+
+        while True:
+            match = _STRING_SPECIAL_RE.search(self.buf, self.pos)
+            end = match.start() if match else len(self.buf)
+            segment = self.buf[self.pos:end]
+            if blob is not None:
+                blob.write(segment)
+            elif segment:
+                parts.append(segment)
+                size += len(segment)
+                if spool and size > self.spool_threshold:
+                    blob = self._start_blob(parts, has_escape)
+                    if blob is not None:
+                        parts = []
+                    else:
+                        spool = False
+            self.pos = end
+
+            if match is None:
+                if not self._fill():
+                    raise ValueError("JSON 格式错误：字符串未结束")
+                continue
+
+            if self.buf[self.pos] == ord('"'):
+                self.pos += 1
+                break
+
+            length = self._escape_length()
+            escape = self.buf[self.pos:self.pos + length]
+            if blob is not None:
+                blob.write(json.loads(b'"' + escape + b'"').encode('utf-8', 'surrogatepass'))
+            else:
+                parts.append(escape)
+                has_escape = True
+            self.pos += length
+
+        if blob is not None:
+            return blob
+        raw = b''.join(parts)
+        if has_escape:
+            return json.loads(b'"' + raw + b'"')
+        return raw.decode('utf-8')
+
+    def _start_blob(self, parts: List[bytes], has_escape: bool) -> Optional[SpooledBlob]:
+        """字符串超过阈值时，如果是 data URL 就转存到临时文件
+
+        只按原始字节开头判断是否为 data URL（开头就被转义的字符串不转存，照常在内存中解析）；
+        已读部分可能在多字节 UTF-8 字符中间截断，只解码完整部分的转义，截断的尾部原样写入，
+        与后续原样写入的字节拼成完整字符
+        """
+        head = b''.join(parts)
+        if not head.startswith(b'data:'):
+            return None
+        if has_escape:
+            cut = _utf8_boundary(head)
+            head = json.loads(b'"' + head[:cut] + b'"').encode('utf-8', 'surrogatepass') + head[cut:]
+        blob = SpooledBlob(self.spool_dir)
+        self.blobs.append(blob)
+        blob.write(head)
+        return blob
+
+
+def parse_json_stream(stream, max_bytes: int, spool_threshold: int = 1024 * 1024,
+                      spool_dir: Optional[str] = None) -> Tuple[Any, List[SpooledBlob]]:
+    """增量解析请求体，返回 (数据, 临时文件列表)；出错时会关闭已创建的临时文件"""
+    parser = StreamingJsonParser(stream, max_bytes, spool_threshold, spool_dir=spool_dir)
+    try:
+        return parser.parse(), parser.blobs
+    except BaseException:
+        parser.close()
+        raise
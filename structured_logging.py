@@ -0,0 +1,174 @@
+"""Business Gemini Pool 非阻塞结构化日志
+业务线程只把日志记录放入队列（QueueHandler），由后台 QueueListener 线程完成格式化和 I/O；
+支持 JSON 格式输出，并按消息类型限流：同一类消息在时间窗口内超过上限后被丢弃，
+下一条放行的消息带上被丢弃的条数
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# LogRecord 的标准属性，其余属性（extra）作为结构化字段输出
+_RESERVED_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None)).keys()) | {
+    'message', 'asctime', 'trace_id', 'suppressed'
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            data['trace_id'] = trace_id
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            data['suppressed'] = suppressed
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """文本格式，附带被限流丢弃的条数"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f" (同类消息已省略 {suppressed} 条)"
+        return text
+
+
+class RateLimitFilter(logging.Filter):
+    """按消息类型限流：(日志器, 消息模板) 在 window 秒内最多放行 limit 条
+
+    只作用于低于 max_level 的级别，错误日志总是放行
+    """
+
+    def __init__(self, limit: int = 20, window: float = 10.0, max_level: int = logging.WARNING,
+                 max_keys: int = 4096):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.max_level = max_level
+        self.max_keys = max_keys
+        # 键 -> [窗口开始时间, 窗口内条数, 被丢弃条数]
+        self._buckets: Dict[Tuple[str, str], List] = {}
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0 or record.levelno > self.max_level:
+            return True
+        key = (record.name, getattr(record, 'log_type', None) or str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.clear()
+                bucket = self._buckets[key] = [now, 0, 0]
+            elif now - bucket[0] >= self.window:
+                if bucket[2]:
+                    record.suppressed = bucket[2]
+                bucket[0], bucket[1], bucket[2] = now, 0, 0
+            if bucket[1] >= self.limit:
+                bucket[2] += 1
+                self.dropped += 1
+                return False
+            bucket[1] += 1
+        return True
+
+
+class ContextFilter(logging.Filter):
+    """在业务线程中补充当前请求的 trace ID（监听线程中已无法获取）"""
+
+    def __init__(self, trace_id_getter=None):
+        super().__init__()
+        self.trace_id_getter = trace_id_getter
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.trace_id_getter is not None and not hasattr(record, 'trace_id'):
+            try:
+                record.trace_id = self.trace_id_getter()
+            except Exception:
+                record.trace_id = None
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """只入队不格式化的 QueueHandler
+
+    标准 QueueHandler.prepare 会在业务线程中拼接消息，这里只处理异常堆栈
+    （traceback 对象不能跨线程保留），消息拼接留给监听线程
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # 队列满时丢弃，不阻塞业务线程
+            self.dropped += 1
+
+
+class LogPipeline:
+    """QueueHandler + QueueListener 日志管道"""
+
+    def __init__(self, handlers: List[logging.Handler], queue_size: int = 10000,
+                 rate_limit: Optional[RateLimitFilter] = None, trace_id_getter=None):
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.handler = DeferredQueueHandler(self.queue)
+        self.handler.addFilter(ContextFilter(trace_id_getter))
+        self.rate_limit = rate_limit
+        if rate_limit is not None:
+            self.handler.addFilter(rate_limit)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        """停止监听线程并写出队列中剩余的日志"""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_dropped': self.handler.dropped,
+            'rate_limited': self.rate_limit.dropped if self.rate_limit is not None else 0,
+        }
+
+
+def create_formatter(log_format: str, text_format: str, datefmt: str = '%Y-%m-%d %H:%M:%S') -> logging.Formatter:
+    if log_format == 'json':
+        return JsonFormatter()
+    return TextFormatter(text_format, datefmt=datefmt)
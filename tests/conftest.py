@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# 模块都在仓库根目录（与 benchmarks 相同的导入方式）
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
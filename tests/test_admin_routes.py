@@ -0,0 +1,52 @@
+"""管理接口权限回归测试"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# gemini 导入时在模块所在目录创建数据库、日志和图片目录，在临时副本中运行
+SCRIPT = r'''
+import json
+import gemini
+
+team_key, _ = gemini.api_key_registry.create_key('team-a')
+client = gemini.app.test_client()
+
+def status(method, path, key):
+    return getattr(client, method)(path, headers={'Authorization': f'Bearer {key}'}).status_code
+
+print(json.dumps({
+    'team_accounts': status('get', '/api/accounts', team_key),
+    'team_config_export': status('get', '/api/config/export', team_key),
+    'team_reset_sessions': status('post', '/v1/sessions/reset', team_key),
+    'team_rollup': status('post', '/v1/analytics/rollup', team_key),
+    'team_models': status('get', '/v1/models', team_key),
+    'team_analytics': status('get', '/v1/analytics/usage', team_key),
+    'admin_accounts': status('get', '/api/accounts', 'admin-secret'),
+}))
+'''
+
+
+def test_registry_key_cannot_call_admin_routes(tmp_path):
+    for pattern in ('*.py', '*.sql', '*.html'):
+        for path in REPO_ROOT.glob(pattern):
+            shutil.copy(path, tmp_path)
+    env = dict(os.environ, REQUIRE_AUTH='true', DOWNSTREAM_API_KEY='admin-secret',
+               ANALYTICS_WRITE_BEHIND='false', PYTHONDONTWRITEBYTECODE='1')
+    result = subprocess.run([sys.executable, '-c', SCRIPT], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    statuses = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert statuses['team_accounts'] == 403
+    assert statuses['team_config_export'] == 403
+    assert statuses['team_reset_sessions'] == 403
+    assert statuses['team_rollup'] == 403
+    assert statuses['team_models'] == 200
+    assert statuses['team_analytics'] == 200
+    assert statuses['admin_accounts'] == 200
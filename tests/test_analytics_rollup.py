@@ -0,0 +1,33 @@
+"""统计汇总回归测试"""
+
+import sqlite3
+
+from analytics_apis import AnalyticsManager
+
+
+def test_chat_with_image_counts_one_request_and_one_image(tmp_path, monkeypatch):
+    monkeypatch.setenv('ANALYTICS_WRITE_BEHIND', 'false')
+    monkeypatch.setenv('ANALYTICS_ROLLUP_INTERVAL', '3600')
+    db_path = str(tmp_path / 'analytics.db')
+    manager = AnalyticsManager(db_path)
+    try:
+        # 与 gemini.py 相同：解析图片时记录图片生成事件，请求结束时记录带图片数的聊天事件
+        manager.record_image_generation(1, {'api_key': 'sk-test', 'model': 'gemini-enterprise',
+                                            'prompt': '画一只猫', 'duration': 1.5, 'success': True})
+        manager.record_chat_usage({'api_key': 'sk-test', 'model': 'gemini-enterprise',
+                                   'success': True, 'duration': 2.0, 'images': 1})
+        manager.run_rollup()
+
+        for bucket in ('hour', 'day'):
+            rows = manager.get_usage_rollups(bucket, days=1)
+            assert sum(r['requests'] for r in rows) == 1
+            assert sum(r['images'] for r in rows) == 1
+
+        with sqlite3.connect(db_path) as conn:
+            totals = conn.execute(
+                'SELECT SUM(total_requests), SUM(total_images_generated) FROM daily_usage_summary').fetchone()
+            assert totals == (1, 1)
+            # 图片明细仍然写入
+            assert conn.execute('SELECT COUNT(*) FROM image_generation_records').fetchone()[0] == 1
+    finally:
+        manager.rollup.stop()
@@ -0,0 +1,23 @@
+"""会话数据库回归测试"""
+
+from database import ConversationManager
+
+
+def test_backfill_cached_images_once(tmp_path):
+    image_dir = tmp_path / 'image'
+    image_dir.mkdir()
+    (image_dir / 'old.png').write_bytes(b'png')
+    (image_dir / 'recorded.jpg').write_bytes(b'jpg')
+    (image_dir / 'notes.txt').write_text('not an image')
+    db_path = str(tmp_path / 'conversations.db')
+
+    manager = ConversationManager(db_path, image_dir=str(image_dir))
+    images, _ = manager.get_images('default_user')
+    assert sorted(image.filename for image in images) == ['old.png', 'recorded.jpg']
+    assert {image.mime_type for image in images} == {'image/png', 'image/jpeg'}
+
+    # 只补录一次：之后新增到目录中的文件由保存图片时写入记录
+    (image_dir / 'later.png').write_bytes(b'png')
+    manager = ConversationManager(db_path, image_dir=str(image_dir))
+    images, _ = manager.get_images('default_user')
+    assert len(images) == 2
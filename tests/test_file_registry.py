@@ -0,0 +1,54 @@
+"""上传文件注册表回归测试"""
+
+import pytest
+
+from file_registry import FileRegistry
+
+
+def _registry(tmp_path) -> FileRegistry:
+    registry = FileRegistry(str(tmp_path / 'files.db'))
+    for i in range(5):
+        registry.add_file(f'file-{i}', f'gemini-{i}', 'session', f'{i}.txt', 'text/plain', 1)
+    return registry
+
+
+def test_cursor_survives_deleted_last_file(tmp_path):
+    registry = _registry(tmp_path)
+    for order in ('asc', 'desc'):
+        page, cursor = registry.list_files(limit=2, order=order)
+        assert cursor is not None
+        registry.delete_file(page[-1]['id'])
+        rest, _ = registry.list_files(limit=10, after=cursor, order=order)
+        expected = [f'file-{i}' for i in range(5)]
+        if order == 'desc':
+            expected.reverse()
+        assert [f['id'] for f in page] == expected[:2]
+        assert [f['id'] for f in rest] == expected[2:]
+        registry.add_file(page[-1]['id'], 'gemini', 'session', 'x.txt', 'text/plain', 1)
+
+
+def test_missing_file_id_cursor_is_rejected(tmp_path):
+    registry = _registry(tmp_path)
+    page, _ = registry.list_files(limit=2, after='file-1', order='asc')
+    assert [f['id'] for f in page] == ['file-2', 'file-3']
+    registry.delete_file('file-1')
+    with pytest.raises(ValueError):
+        registry.list_files(limit=2, after='file-1', order='asc')
+
+
+def test_delete_discards_copy_only_for_existing_mapping(tmp_path):
+    retain_dir = tmp_path / 'uploads'
+    registry = FileRegistry(str(tmp_path / 'files.db'), retain_dir=str(retain_dir))
+    registry.add_file('file-abc', 'gemini', 'session', 'a.txt', 'text/plain', 3, content=b'abc')
+    # 没有映射的副本（如其他进程刚写入）不会因为删除不存在的ID而被删掉
+    (retain_dir / 'file-def').write_bytes(b'def')
+
+    assert registry.delete_file('file-def') is False
+    assert (retain_dir / 'file-def').exists()
+    for bad_id in ('..', '../uploads', 'file-abc/../file-def', 'FILE-ABC'):
+        assert registry.delete_file(bad_id) is False
+    assert retain_dir.is_dir()
+
+    assert registry.delete_file('file-abc') is True
+    assert not (retain_dir / 'file-abc').exists()
+    assert registry.load_retained('file-abc') is None
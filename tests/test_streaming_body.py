@@ -0,0 +1,72 @@
+"""流式请求体解析回归测试"""
+
+import base64
+import io
+import json
+
+from streaming_body import SpooledBlob, StreamingJsonParser, parse_blob_data_url
+
+
+def _parse(body: bytes, spool_threshold: int, chunk_size: int):
+    parser = StreamingJsonParser(io.BytesIO(body), max_bytes=len(body) + 1,
+                                 spool_threshold=spool_threshold, chunk_size=chunk_size)
+    try:
+        return parser.parse(), parser.blobs
+    except BaseException:
+        parser.close()
+        raise
+
+
+def test_escape_and_cjk_across_spool_threshold():
+    # 转义在阈值之前，多字节字符正好跨过阈值所在的块边界
+    text = ('第一行\n' + '中文内容' * 20) * 3
+    body = json.dumps({'text': text}, ensure_ascii=False).encode('utf-8')
+    for chunk_size in range(7, 40):
+        for threshold in range(8, 48):
+            data, blobs = _parse(body, threshold, chunk_size)
+            assert data == {'text': text}
+            assert blobs == []
+
+
+def test_spooled_data_url_with_cjk_and_escape():
+    url = 'data:text/plain;charset=utf-8,' + ('中文\n"内容"' * 20)
+    body = json.dumps({'url': url}, ensure_ascii=False).encode('utf-8')
+    for chunk_size in range(7, 40):
+        data, blobs = _parse(body, 40, chunk_size)
+        try:
+            assert len(blobs) == 1
+            assert data['url'] is blobs[0]
+            assert blobs[0].read_text() == url
+        finally:
+            for blob in blobs:
+                blob.close()
+
+
+def _blob(text: str) -> SpooledBlob:
+    blob = SpooledBlob()
+    for i in range(0, len(text), 5):
+        blob.write(text[i:i + 5].encode('ascii'))
+    return blob
+
+
+def test_blob_data_url_rejects_non_base64_alphabet():
+    for payload in ('!!!!', 'ab=c', 'a===', 'YWJj!!!!YWJj'):
+        blob = _blob('data:image/png;base64,' + payload)
+        try:
+            assert parse_blob_data_url(blob) is None
+        finally:
+            blob.close()
+
+
+def test_blob_data_url_accepts_padded_and_wrapped_base64():
+    for raw in (bytes(range(256)) * 4, b'abcde', b'abcdef'):
+        for encoded in (base64.b64encode(raw).decode('ascii'), base64.encodebytes(raw).decode('ascii')):
+            blob = _blob('data:image/png;base64,' + encoded)
+            try:
+                parsed = parse_blob_data_url(blob)
+                assert parsed is not None
+                payload = parsed['data']
+                assert payload.decoded_size() == len(raw)
+                assert base64.b64decode(b''.join(payload.iter_chunks())) == raw
+            finally:
+                blob.close()
@@ -0,0 +1,402 @@
+"""Business Gemini Pool 请求级阶段追踪
+每个请求生成一棵 span 树（鉴权、选账号、JWT、会话、上传、上游首字节/流、解析、
+图片保存、统计等阶段），trace ID 通过响应头返回；可选以 OTLP/HTTP JSON 格式
+导出到本地 collector；内存中保留最近一段时间内最慢的 N 个请求及其阶段耗时
+"""
+
+import contextvars
+import heapq
+import logging
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger('gemini_pool.tracing')
+
+TRACE_HEADER = 'X-Trace-Id'
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    start_ns: int
+    end_ns: int = 0
+    parent: Optional['Span'] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    children: List['Span'] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns or time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def to_dict(self, origin_ns: int) -> Dict[str, Any]:
+        data = {
+            'name': self.name,
+            'offset_ms': round((self.start_ns - origin_ns) / 1e6, 3),
+            'duration_ms': round(self.duration_ms, 3),
+        }
+        if self.attributes:
+            data['attributes'] = self.attributes
+        if self.error:
+            data['error'] = self.error
+        if self.children:
+            data['children'] = [child.to_dict(origin_ns) for child in self.children]
+        return data
+
+
+@dataclass
+class Trace:
+    trace_id: str
+    root: Span
+    method: str = ''
+    path: str = ''
+    route: str = ''
+    status: int = 0
+    started_at: float = 0.0
+
+    @property
+    def duration_ms(self) -> float:
+        return self.root.duration_ms
+
+    def iter_spans(self):
+        stack = [self.root]
+        while stack:
+            span = stack.pop()
+            yield span
+            stack.extend(span.children)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'method': self.method,
+            'path': self.path,
+            'route': self.route,
+            'status': self.status,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration_ms, 3),
+            'spans': self.root.to_dict(self.root.start_ns),
+        }
+
+
+def _new_span_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def parse_traceparent(header: str) -> Optional[str]:
+    """从 W3C traceparent 请求头中取出 trace ID"""
+    parts = (header or '').split('-')
+    if len(parts) == 4 and len(parts[1]) == 32 and parts[1] != '0' * 32:
+        try:
+            int(parts[1], 16)
+            return parts[1].lower()
+        except ValueError:
+            return None
+    return None
+
+
+class SlowRequestBuffer:
+    """保留时间窗口内最慢的 N 个请求（小顶堆）"""
+
+    def __init__(self, capacity: int = 50, window_seconds: float = 3600.0, min_duration_ms: float = 0.0):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.min_duration_ms = min_duration_ms
+        self._heap: List[tuple] = []
+        self._counter = 0
+        # (下限毫秒, 失效时间)：作为一个元组整体赋值，无锁读取时两者一致
+        self._floor = (min_duration_ms, math.inf)
+        self.lock = threading.Lock()
+
+    def _evict_expired(self, now: float):
+        cutoff = now - self.window_seconds
+        if any(item[2].started_at < cutoff for item in self._heap):
+            self._heap = [item for item in self._heap if item[2].started_at >= cutoff]
+            heapq.heapify(self._heap)
+
+    def _update_floor(self):
+        """重算快速判断的下限（调用方需持锁）"""
+        if len(self._heap) >= self.capacity:
+            # 堆中最早的条目过期后下限可能降低，到那时快速判断失效，改为持锁驱逐后再比较
+            expires = min(item[2].started_at for item in self._heap) + self.window_seconds
+            self._floor = (max(self.min_duration_ms, self._heap[0][0]), expires)
+        else:
+            self._floor = (self.min_duration_ms, math.inf)
+
+    def offer(self, trace: Trace):
+        duration = trace.duration_ms
+        # 无锁快速判断：比当前最慢列表中最快的还快、且列表中没有条目过期时直接忽略
+        floor_ms, floor_expires = self._floor
+        if duration < floor_ms and (floor_expires == math.inf or time.time() < floor_expires):
+            return
+        with self.lock:
+            self._evict_expired(time.time())
+            if duration >= self.min_duration_ms:
+                self._counter += 1
+                item = (duration, self._counter, trace)
+                if len(self._heap) < self.capacity:
+                    heapq.heappush(self._heap, item)
+                else:
+                    heapq.heappushpop(self._heap, item)
+            self._update_floor()
+
+    def snapshot(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self.lock:
+            self._evict_expired(time.time())
+            self._update_floor()
+            items = sorted(self._heap, key=lambda item: item[0], reverse=True)
+        if limit is not None:
+            items = items[:limit]
+        return [item[2].to_dict() for item in items]
+
+    def clear(self):
+        with self.lock:
+            self._heap = []
+            self._floor = (self.min_duration_ms, math.inf)
+
+
+class OTLPExporter:
+    """后台批量导出到 OTLP/HTTP（JSON 编码）collector，队列满时丢弃"""
+
+    def __init__(self, endpoint: str, service_name: str = 'business-gemini-pool',
+                 batch_size: int = 64, flush_interval: float = 2.0, max_queue: int = 2048):
+        self.endpoint = endpoint.rstrip('/')
+        if not self.endpoint.endswith('/v1/traces'):
+            self.endpoint += '/v1/traces'
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: "queue.Queue[Trace]" = queue.Queue(maxsize=max_queue)
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name='otlp-exporter', daemon=True)
+        self._thread.start()
+
+    def submit(self, trace: Trace):
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    @staticmethod
+    def _attr(key: str, value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {'key': key, 'value': {'boolValue': value}}
+        if isinstance(value, int):
+            return {'key': key, 'value': {'intValue': str(value)}}
+        if isinstance(value, float):
+            return {'key': key, 'value': {'doubleValue': value}}
+        return {'key': key, 'value': {'stringValue': str(value)}}
+
+    def _encode(self, traces: List[Trace]) -> Dict[str, Any]:
+        spans = []
+        for trace in traces:
+            for span in trace.iter_spans():
+                attributes = dict(span.attributes)
+                if span is trace.root:
+                    attributes.update({'http.method': trace.method, 'http.route': trace.route,
+                                       'http.target': trace.path, 'http.status_code': trace.status})
+                spans.append({
+                    'traceId': trace.trace_id,
+                    'spanId': span.span_id,
+                    'parentSpanId': span.parent.span_id if span.parent else '',
+                    'name': span.name,
+                    'kind': 2 if span is trace.root else 1,
+                    'startTimeUnixNano': str(span.start_ns),
+                    'endTimeUnixNano': str(span.end_ns or span.start_ns),
+                    'attributes': [self._attr(k, v) for k, v in attributes.items()],
+                    'status': {'code': 2, 'message': span.error} if span.error else {'code': 0},
+                })
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [self._attr('service.name', self.service_name)]},
+                'scopeSpans': [{'scope': {'name': 'gemini_pool.tracing'}, 'spans': spans}],
+            }]
+        }
+
+    def _run(self):
+        import requests
+        session = requests.Session()
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                resp = session.post(self.endpoint, json=self._encode(batch), timeout=5)
+                if resp.status_code >= 300:
+                    raise RuntimeError(f"HTTP {resp.status_code}")
+                self.exported += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logger.warning(f"OTLP 导出失败({len(batch)} 条): {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {'endpoint': self.endpoint, 'queue_depth': self.queue.qsize(),
+                'exported': self.exported, 'dropped': self.dropped, 'failed': self.failed}
+
+
+class Tracer:
+    """请求级追踪器：当前 trace 与 span 栈保存在上下文变量中
+
+    同步 worker 中每个线程各自一份；ASGI 模式下每个 asyncio 任务各自一份，
+    asyncio.to_thread 复制上下文，线程中记录的 span 归入发起它的请求
+    """
+
+    def __init__(self, enabled: bool = True, slow_requests: Optional[SlowRequestBuffer] = None,
+                 exporter: Optional[OTLPExporter] = None):
+        self.enabled = enabled
+        self.slow_requests = slow_requests or SlowRequestBuffer()
+        self.exporter = exporter
+        # (trace, span 栈)
+        self._state: contextvars.ContextVar = contextvars.ContextVar('tracer_state', default=(None, None))
+
+    @property
+    def current_trace(self) -> Optional[Trace]:
+        return self._state.get()[0]
+
+    @property
+    def trace_id(self) -> Optional[str]:
+        trace = self.current_trace
+        return trace.trace_id if trace else None
+
+    def start_trace(self, name: str, trace_id: Optional[str] = None, **attributes) -> Optional[Trace]:
+        if not self.enabled:
+            return None
+        root = Span(name=name, span_id=_new_span_id(), start_ns=time.time_ns(), attributes=attributes)
+        trace = Trace(trace_id=trace_id or uuid.uuid4().hex, root=root, started_at=time.time())
+        self._state.set((trace, [root]))
+        return trace
+
+    def finish_trace(self, status: int = 0) -> Optional[Trace]:
+        trace = self.current_trace
+        if trace is None:
+            return None
+        self._state.set((None, None))
+        trace.status = status
+        trace.root.end_ns = time.time_ns()
+        self.slow_requests.offer(trace)
+        if self.exporter is not None:
+            self.exporter.submit(trace)
+        return trace
+
+    def start_span(self, name: str, **attributes) -> Optional[Span]:
+        """开始一个子阶段并设为当前 span；不在请求内时返回 None"""
+        stack = self._state.get()[1]
+        if not stack:
+            return None
+        parent = stack[-1]
+        span = Span(name=name, span_id=_new_span_id(), start_ns=time.time_ns(),
+                    parent=parent, attributes=attributes)
+        parent.children.append(span)
+        stack.append(span)
+        return span
+
+    def end_span(self, span: Optional[Span], error: Optional[BaseException] = None):
+        """结束 span，并把它（以及未正常结束的子 span）移出栈"""
+        if span is None:
+            return
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.error = f"{type(error).__name__}: {error}"[:200]
+        stack = self._state.get()[1]
+        if stack and span in stack:
+            del stack[stack.index(span):]
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """在当前请求的 span 树中记录一个阶段；不在请求内时不做任何事"""
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield None
+            return
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, e)
+            raise
+        self.end_span(span)
+
+    def set_attribute(self, key: str, value: Any):
+        """给当前 span 添加属性"""
+        stack = self._state.get()[1]
+        if stack:
+            stack[-1].attributes[key] = value
+
+
+def init_tracing(app, tracer: Tracer):
+    """为 Flask 应用注册请求追踪钩子，并在响应头中返回 trace ID"""
+    from flask import request
+
+    @app.before_request
+    def _start_trace():
+        trace = tracer.start_trace(
+            f"{request.method} {request.path}",
+            trace_id=parse_traceparent(request.headers.get('traceparent', ''))
+        )
+        if trace is not None:
+            trace.method = request.method
+            trace.path = request.path
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = tracer.current_trace
+        if trace is None:
+            return response
+        trace.route = request.url_rule.rule if request.url_rule is not None else ''
+        trace.root.name = f"{request.method} {trace.route or request.path}"
+        tracer.finish_trace(response.status_code)
+        response.headers[TRACE_HEADER] = trace.trace_id
+        response.headers['traceparent'] = f"00-{trace.trace_id}-{trace.root.span_id}-01"
+        return response
+
+    @app.teardown_request
+    def _drop_trace(exc):
+        # after_request 未执行（未处理的异常）时也要清理线程局部状态
+        if tracer.current_trace is not None:
+            tracer.finish_trace(500)
+
+
+# 全局追踪器
+_tracer = None
+
+
+def get_tracer() -> Tracer:
+    """获取全局追踪器实例
+
+    TRACING_ENABLED=false 关闭；SLOW_REQUEST_CAPACITY / SLOW_REQUEST_WINDOW_SECONDS /
+    SLOW_REQUEST_MIN_MS 控制慢请求缓冲；设置 OTEL_EXPORTER_OTLP_ENDPOINT 时导出到 OTLP collector
+    """
+    global _tracer
+    if _tracer is None:
+        slow_requests = SlowRequestBuffer(
+            capacity=int(os.getenv('SLOW_REQUEST_CAPACITY', '50')),
+            window_seconds=float(os.getenv('SLOW_REQUEST_WINDOW_SECONDS', '3600')),
+            min_duration_ms=float(os.getenv('SLOW_REQUEST_MIN_MS', '0')),
+        )
+        exporter = None
+        endpoint = os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT', '').strip()
+        if endpoint:
+            exporter = OTLPExporter(endpoint, service_name=os.getenv('OTEL_SERVICE_NAME', 'business-gemini-pool'))
+            logger.info(f"OTLP 追踪导出已启用: {exporter.endpoint}")
+        _tracer = Tracer(
+            enabled=os.getenv('TRACING_ENABLED', 'true').lower() == 'true',
+            slow_requests=slow_requests,
+            exporter=exporter,
+        )
+    return _tracer